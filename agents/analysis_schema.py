@@ -0,0 +1,198 @@
+import json
+import re
+from functools import lru_cache
+from typing import Callable, Dict, List, Optional, Tuple
+
+# 图片分析结果的 JSON Schema
+ANALYSIS_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "description": {"type": "string", "minLength": 1},
+        "scene": {"type": "string"},
+        "style": {"type": "string"},
+        "colors": {"type": "array", "items": {"type": "string"}},
+        "objects": {"type": "array", "items": {"type": "string"}, "minItems": 1},
+        "subject_features": {"type": "string"}
+    },
+    "required": ["description", "scene", "style", "colors", "objects", "subject_features"]
+}
+
+# 单次调用模式：分析字段 + 英文 SD 提示词
+FUSED_SCHEMA = {
+    "type": "object",
+    "properties": dict(ANALYSIS_SCHEMA["properties"], sd_prompt={"type": "string", "minLength": 1}),
+    "required": ANALYSIS_SCHEMA["required"] + ["sd_prompt"]
+}
+
+# 文本格式中各字段可能出现的标签（模型可能使用“主体”或“物体”）
+FIELD_LABELS = {
+    "description": ["描述"],
+    "scene": ["场景"],
+    "style": ["风格"],
+    "colors": ["颜色"],
+    "subject_features": ["主体特征", "特征"],
+    "objects": ["主体", "物体"],
+    "sd_prompt": ["SD提示词", "英文提示词", "提示词"]
+}
+LIST_FIELDS = {"colors", "objects"}
+
+# 评论和提示词生成时交给本地LLM的分析字段（顺序固定）
+PROMPT_FIELDS = [("description", "描述"), ("scene", "场景"), ("style", "风格"), ("colors", "颜色"), ("objects", "物体")]
+
+_TYPE_CHECKS = {
+    "object": lambda v: isinstance(v, dict),
+    "array": lambda v: isinstance(v, list),
+    "string": lambda v: isinstance(v, str),
+    "number": lambda v: isinstance(v, (int, float)) and not isinstance(v, bool),
+    "integer": lambda v: isinstance(v, int) and not isinstance(v, bool),
+    "boolean": lambda v: isinstance(v, bool)
+}
+
+_FENCE_PATTERN = re.compile(r"```(?:json)?\s*(.*?)```", re.S)
+_LIST_SPLIT_PATTERN = re.compile(r"[、，,；;]")
+# 行首的序号、列表符号和 markdown 加粗，例如 "1. **描述**："
+_LINE_PREFIX_PATTERN = re.compile(r"^\s*(?:[-*•]\s*)?(?:\d+[.、)）]\s*)?(?:\*\*)?")
+
+
+def compile_validator(schema: Dict, path: str = "$") -> Callable[[object], List[str]]:
+    """将 JSON Schema（type/properties/required/items/minLength/minItems 子集）编译为校验函数
+
+    编译只在模块加载时做一次，校验时不再解释 schema。
+
+    Args:
+        schema: JSON Schema
+        path: 错误信息中使用的字段路径
+
+    Returns:
+        Callable: 校验函数，返回错误信息列表，为空表示通过
+    """
+    checks = []
+
+    type_name = schema.get("type")
+    if type_name:
+        type_check = _TYPE_CHECKS[type_name]
+        checks.append(lambda v: [] if type_check(v) else [f"{path} 应为 {type_name}"])
+
+    if "minLength" in schema:
+        min_length = schema["minLength"]
+        checks.append(lambda v: [] if not isinstance(v, str) or len(v.strip()) >= min_length else [f"{path} 不能为空"])
+
+    if "minItems" in schema:
+        min_items = schema["minItems"]
+        checks.append(lambda v: [] if not isinstance(v, list) or len(v) >= min_items else [f"{path} 至少需要 {min_items} 项"])
+
+    if "items" in schema:
+        item_validator = compile_validator(schema["items"], f"{path}[]")
+        checks.append(lambda v: [e for item in v for e in item_validator(item)] if isinstance(v, list) else [])
+
+    required = tuple(schema.get("required", ()))
+    if required:
+        checks.append(lambda v: [f"{path}.{k} 缺失" for k in required if k not in v] if isinstance(v, dict) else [])
+
+    property_validators = [(name, compile_validator(sub, f"{path}.{name}"))
+                           for name, sub in schema.get("properties", {}).items()]
+    if property_validators:
+        def check_properties(v):
+            if not isinstance(v, dict):
+                return []
+            return [e for name, validator in property_validators if name in v for e in validator(v[name])]
+        checks.append(check_properties)
+
+    def validate(value):
+        errors = []
+        for check in checks:
+            errors.extend(check(value))
+            if errors and type_name and not _TYPE_CHECKS[type_name](value):
+                # 类型不对时其余检查没有意义
+                break
+        return errors
+
+    return validate
+
+
+SCHEMAS = {"analysis": ANALYSIS_SCHEMA, "fused": FUSED_SCHEMA}
+
+
+@lru_cache(maxsize=None)
+def _validator_for(schema_name: str) -> Callable[[object], List[str]]:
+    """按名称获取编译后的校验函数（每个 schema 只编译一次）"""
+    return compile_validator(SCHEMAS[schema_name])
+
+
+validate_analysis = _validator_for("analysis")
+
+
+def parse_strict(content: str, schema_name: str = "analysis") -> Tuple[Optional[Dict], List[str]]:
+    """严格解析：内容必须是符合 schema 的 JSON 对象"""
+    try:
+        data = json.loads(content)
+    except (TypeError, ValueError) as e:
+        return None, [f"JSON 解析失败: {str(e)}"]
+    errors = _validator_for(schema_name)(data)
+    return (data, []) if not errors else (None, errors)
+
+
+def parse_tolerant(content: str, schema_name: str = "analysis") -> Tuple[Optional[Dict], List[str]]:
+    """宽松解析：兼容 markdown 代码块、前后多余文字、字符串形式的列表，以及逐行的“字段：内容”文本"""
+    data = _extract_json_object(content)
+    if data is None:
+        data = _parse_labeled_lines(content)
+    data = _normalize(data, SCHEMAS[schema_name])
+    errors = _validator_for(schema_name)(data)
+    return (data, []) if not errors else (None, errors)
+
+
+def _extract_json_object(content: str) -> Optional[Dict]:
+    """从文本中提取第一个 JSON 对象"""
+    candidates = _FENCE_PATTERN.findall(content or "") + [content or ""]
+    for candidate in candidates:
+        start, end = candidate.find("{"), candidate.rfind("}")
+        if start == -1 or end <= start:
+            continue
+        try:
+            data = json.loads(candidate[start:end + 1])
+        except ValueError:
+            continue
+        if isinstance(data, dict):
+            return data
+    return None
+
+
+def _parse_labeled_lines(content: str) -> Dict:
+    """解析逐行的“字段：内容”文本，标签可以带序号、加粗和中英文冒号"""
+    data = {}
+    for line in (content or "").splitlines():
+        line = _LINE_PREFIX_PATTERN.sub("", line.strip())
+        for field, labels in FIELD_LABELS.items():
+            label = next((l for l in labels if line.startswith(l)), None)
+            if label is None:
+                continue
+            rest = line[len(label):].lstrip("*").strip()
+            if rest[:1] in ("：", ":"):
+                data.setdefault(field, rest[1:].strip())
+                break
+    return data
+
+
+def _normalize(data: Dict, schema: Dict) -> Dict:
+    """补全缺失的可选字段，并把字符串形式的列表拆分为列表"""
+    result = {}
+    for field in schema["properties"]:
+        value = data.get(field)
+        if field in LIST_FIELDS:
+            if isinstance(value, str):
+                value = _LIST_SPLIT_PATTERN.split(value)
+            value = [str(v).strip() for v in value or [] if str(v).strip()]
+        else:
+            value = "" if value is None else str(value).strip()
+        result[field] = value
+    return result
+
+
+def format_analysis(analysis_result: Dict) -> str:
+    """把分析结果格式化为“字段：值”的文本块，作为评论和提示词生成请求中唯一随图片变化的部分"""
+    lines = []
+    for field, label in PROMPT_FIELDS:
+        value = analysis_result.get(field, [] if field in LIST_FIELDS else "")
+        lines.append(f"{label}：{', '.join(value) if field in LIST_FIELDS else value}")
+    return "\n".join(lines)
@@ -1,17 +1,36 @@
-import os
-import requests
-from dotenv import load_dotenv
-from typing import Dict
+from typing import Dict, List
 import logging
 
-load_dotenv()
+from config.config import Config
+from agents.analysis_schema import format_analysis
+from services.upstream_governor import governor, error_code_for
+
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)  # 设置日志级别为INFO
 
+# 评论要求放在固定的 system 消息中，分析结果放在最后的 user 消息中：
+# 每次请求的前缀完全相同，服务端可以复用它的 KV 缓存，只需处理分析结果部分
+REVIEW_SYSTEM_PROMPT = """你是一个专业的儿童艺术教育专家。用户会给出一幅儿童画的图片分析结果，请据此生成一段温暖友好的艺术评论。
+
+你的评论应该：
+1. 积极正面，突出作品的优点
+2. 使用适合儿童理解的语言
+3. 包含具体的观察和建议
+4. 鼓励孩子继续创作和探索
+
+请在评论中包含：
+1. 对画作主题和创意的赞赏
+2. 对色彩运用的观察
+3. 对细节表现的肯定
+4. 鼓励性的建议和期待
+
+请直接给出评论内容，不要包含任何前缀或格式说明。"""
+
 class ArtReviewAgent:
-    def __init__(self):
-        self.llm_studio_url = os.getenv("LLM_STUDIO_URL", "http://localhost:1234")
-        self.model_name = os.getenv("LLM_MODEL", "default")
+    def __init__(self, config=Config):
+        self.llm_studio_url = config.LLM_STUDIO_URL
+        self.model_name = config.LLM_MODEL
+        self.cache_prompt = config.LLM_CACHE_PROMPT
         logger.info(f"ArtReviewAgent initialized with LLM URL: {self.llm_studio_url}")
     
     def generate_review(self, analysis_result: Dict) -> Dict:
@@ -28,44 +47,19 @@ class ArtReviewAgent:
             logger.info("开始生成艺术评论")
             logger.info(f"收到的图片分析结果: {analysis_result}")
             
-            # 构建提示词
-            prompt = f"""你是一个专业的儿童艺术教育专家。请基于以下图片分析结果生成一段温暖友好的艺术评论。
-
-图片分析结果：
-描述：{analysis_result.get('description', '')}
-场景：{analysis_result.get('scene', '')}
-风格：{analysis_result.get('style', '')}
-颜色：{', '.join(analysis_result.get('colors', []))}
-物体：{', '.join(analysis_result.get('objects', []))}
-
-你的评论应该：
-1. 积极正面，突出作品的优点
-2. 使用适合儿童理解的语言
-3. 包含具体的观察和建议
-4. 鼓励孩子继续创作和探索
-
-请在评论中包含：
-1. 对画作主题和创意的赞赏
-2. 对色彩运用的观察
-3. 对细节表现的肯定
-4. 鼓励性的建议和期待
-
-请直接给出评论内容，不要包含任何前缀或格式说明。"""
-
             logger.info("正在调用本地LLM生成评论")
             
-            response = requests.post(
+            body = {
+                "messages": self.build_messages(analysis_result),
+                "temperature": 0.7,
+                "max_tokens": 300
+            }
+            if self.cache_prompt:
+                body["cache_prompt"] = True
+            response = governor.post(
+                'llm_studio',
                 f"{self.llm_studio_url}/v1/chat/completions",
-                json={
-                    "messages": [
-                        {
-                            "role": "user",
-                            "content": prompt
-                        }
-                    ],
-                    "temperature": 0.7,
-                    "max_tokens": 300
-                }
+                json=body
             )
             
             if response.status_code != 200:
@@ -93,5 +87,21 @@ class ArtReviewAgent:
             logger.error(error_msg)
             return {
                 "status": "error",
-                "error": str(e)
-            } 
\ No newline at end of file
+                "error": str(e),
+                "error_code": error_code_for(e)
+            } 
+
+    def build_messages(self, analysis_result: Dict) -> List[Dict]:
+        """
+        构建评论请求的消息：固定的 system 前缀 + 随图片变化的 user 后缀
+        
+        Args:
+            analysis_result: 来自图像分析代理的分析结果
+            
+        Returns:
+            List[Dict]: chat completions 的 messages
+        """
+        return [
+            {"role": "system", "content": REVIEW_SYSTEM_PROMPT},
+            {"role": "user", "content": f"图片分析结果：\n{format_analysis(analysis_result)}"}
+        ]
@@ -1,106 +1,178 @@
-import base64
 import json
-import requests
 import logging
 import os
-from dotenv import load_dotenv
+from concurrent.futures import ThreadPoolExecutor
 from typing import Dict
 
-load_dotenv()
+from config.config import Config
+from agents.analysis_schema import parse_strict, parse_tolerant
+from agents.prompt_generation_agent import SD_PROMPT_REQUIREMENTS
+from services import metrics
+from services.image_memory import SharedImage, image_budget
+from services.palette_extractor import ACHROMATIC_NAMES, extract_palette
+from services.upstream_governor import UpstreamError, governor, error_code_for
+from services.hedging import LatencyWindow, hedged_call
+from services.llm_service import LLMService
 
 # 配置日志
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 
+ANALYSIS_SECONDS = metrics.histogram(
+    'image_analysis_seconds',
+    '图片分析请求的端到端耗时（秒），按最终采用的通道区分',
+    ['source'],
+    buckets=(0.5, 1, 2, 3, 5, 8, 12, 20, 30, 60)
+)
+HEDGES = metrics.counter('image_analysis_hedge_total', '图片分析对冲请求（fired: 发起; won: 对冲请求先返回）', ['provider', 'outcome'])
+HEDGE_DELAY = metrics.gauge('image_analysis_hedge_delay_seconds', '当前的对冲阈值（秒）')
+FALLBACKS = metrics.counter(
+    'image_analysis_fallback_total',
+    '百度分析不可用时的降级结果（caption: 本地多模态模型，palette: 只用本地调色板）',
+    ['fallback', 'reason']
+)
+
+# 对冲请求使用的线程池和首选请求的耗时窗口（所有代理实例共享）
+_hedge_executor = ThreadPoolExecutor(max_workers=16, thread_name_prefix='analysis-hedge')
+_primary_latencies = LatencyWindow()
+
+PARSE_RESULTS = metrics.counter(
+    'image_analysis_parse_total',
+    '图片分析回复的解析结果（strict/tolerant/repaired/failed）',
+    ['mode', 'outcome']
+)
+
+# 结构化输出模式的提示词
+ANALYSIS_JSON_PROMPT = """请分析这幅儿童涂鸦，只返回一个JSON对象，不要包含任何其他文字。格式如下：
+{
+  "description": "一句话描述图片主要内容",
+  "scene": "画面场景",
+  "style": "画风特点",
+  "colors": ["颜色和对应的部位，例如：蓝色头发"],
+  "objects": ["画面中的主要物体"],
+  "subject_features": "主体的特征"
+}"""
+
+# 单次调用模式的提示词：分析字段和英文SD提示词一起返回
+ANALYSIS_FUSED_PROMPT = f"""请分析这幅儿童涂鸦，并为它生成一个用于Stable Diffusion的英文提示词串。只返回一个JSON对象，不要包含任何其他文字。格式如下：
+{{
+  "description": "一句话描述图片主要内容",
+  "scene": "画面场景",
+  "style": "画风特点",
+  "colors": ["颜色和对应的部位，例如：蓝色头发"],
+  "objects": ["画面中的主要物体"],
+  "subject_features": "主体的特征",
+  "sd_prompt": "英文提示词串"
+}}
+
+sd_prompt 的要求：
+{SD_PROMPT_REQUIREMENTS}
+
+sd_prompt 示例：
+a cute little girl, wearing blue dress, holding a teddy bear, standing in garden, soft lighting"""
+
+# 文本输出模式的提示词
+ANALYSIS_TEXT_PROMPT = """请分析这幅儿童涂鸦并返回以下信息：
+1. 描述：一句话描述图片主要内容
+2. 场景：画面场景
+3. 风格：画风特点
+4. 颜色：主要使用的颜色和对应颜色的部位
+5. 主体：画面中的主要物体
+6. 主体特征：主体的特征"""
+
+# 解析失败时的修复提示词
+ANALYSIS_REPAIR_PROMPT = """下面是一段图片分析结果，格式不符合要求（{errors}）。
+请把它改写为一个JSON对象，只返回JSON，不要包含任何其他文字。字段为：
+{fields}。
+
+分析结果：
+{content}"""
+
+# 修复提示词中各 schema 要求的字段
+ANALYSIS_REPAIR_FIELDS = {
+    "analysis": "description（字符串）、scene（字符串）、style（字符串）、colors（字符串数组）、objects（字符串数组，至少一项）、subject_features（字符串）"
+}
+ANALYSIS_REPAIR_FIELDS["fused"] = ANALYSIS_REPAIR_FIELDS["analysis"] + "、sd_prompt（英文SD提示词串，逗号分隔）"
+
 class ImageAnalysisAgent:
-    def __init__(self):
+    def __init__(self, config=Config):
         # 使用直接的Bearer token认证
         self.baidu_api_url = "https://qianfan.baidubce.com/v2/chat/completions"
-        self.baidu_token = os.getenv("BAIDU_TOKEN", "bce-v3/ALTAK-5vJ2WWcxX1gOitlDF7bDt/d00bb952484368905660e7444ecda5fbbaffca52")
+        self.baidu_token = config.BAIDU_TOKEN
+        # 输出模式：json（结构化输出，默认）或 text（逐行文本）
+        self.output_mode = config.ANALYSIS_OUTPUT_MODE
+        
+        # 对冲配置：首选请求超过历史耗时的该百分位仍未返回时，向对冲通道再发一次请求
+        # ANALYSIS_HEDGE_PROVIDER: off（关闭）、baidu（同一服务再发一次）或 local（本地多模态模型）
+        self.hedge_provider = config.ANALYSIS_HEDGE_PROVIDER
+        self.hedge_percentile = config.ANALYSIS_HEDGE_PERCENTILE
+        # 样本不足时使用的固定阈值（秒）
+        self.hedge_default_delay = config.ANALYSIS_HEDGE_DELAY
+        self.hedge_min_samples = 20
+        self.local_llm = LLMService(config.LLM_STUDIO_URL, config.LLM_VISION_MODEL)
 
-    def analyze_image(self, image_path: str) -> Dict:
+    def analyze_image(self, image_path: str, include_sd_prompt: bool = False, image: SharedImage = None) -> Dict:
         """
         使用百度多模态模型分析图片
         
         Args:
             image_path: 图片文件路径
+            include_sd_prompt: 是否在同一次请求中生成英文SD提示词（单次调用模式，结果中包含 sd_prompt）
+            image: 本次请求共享的 SharedImage；为空时在这里打开，并在图片内存预算中预留解码所需的内存
             
         Returns:
             Dict: 包含图片分析结果的字典
         """
         try:
-            # 读取图片文件并转换为base64
-            img_base64 = self._process_local_image(image_path)
+            if image is None:
+                if not os.path.exists(image_path):
+                    raise FileNotFoundError(f"图片文件不存在: {image_path}")
+                with SharedImage(image_path, image_budget) as image:
+                    return self.analyze_image(image_path, include_sd_prompt, image)
             
-            payload = json.dumps({
-                "model": "ernie-4.5-8k-preview",
-                "messages": [
-                    {
-                        "role": "user",
-                        "content": [
-                            {
-                                "type": "text",
-                                "text": """请分析这幅儿童涂鸦并返回以下信息：
-1. 描述：一句话描述图片主要内容
-2. 场景：画面场景
-3. 风格：画风特点
-4. 颜色：主要使用的颜色和对应颜色的部位
-5. 主体：画面中的主要物体
-6. 主体特征：主体的特征"""
-                            },
-                            {
-                                "type": "image_url",
-                                "image_url": {
-                                    "url": img_base64
-                                }
-                            }
-                        ]
-                    }
-                ]
-            })
-            
-            headers = {
-                "Content-Type": "application/json",
-                "Authorization": f"Bearer {self.baidu_token}"
-            }
-
-            response = requests.post(self.baidu_api_url, headers=headers, data=payload)
+            # 小图使用原始字节，大图使用共享解码结果的 JPEG
+            img_base64 = image.analysis_base64()
             
-            if response.status_code != 200:
-                raise Exception(f"Baidu API error: {response.text}")
-
-            result = response.json()
-            
-            # 解析返回的结果
-            if "error_code" in result:
-                raise Exception(f"API返回错误: {result}")
-                
-            content = result.get("choices", [{}])[0].get("message", {}).get("content", "")
+            # 单次调用模式总是使用结构化输出
+            structured = include_sd_prompt or self.output_mode == "json"
+            if include_sd_prompt:
+                prompt = ANALYSIS_FUSED_PROMPT
+            else:
+                prompt = ANALYSIS_JSON_PROMPT if structured else ANALYSIS_TEXT_PROMPT
+            schema_name = "fused" if include_sd_prompt else "analysis"
+            usage = {}
+            messages = [
+                {
+                    "role": "user",
+                    "content": [
+                        {
+                            "type": "text",
+                            "text": prompt
+                        },
+                        {
+                            "type": "image_url",
+                            "image_url": {
+                                "url": img_base64
+                            }
+                        }
+                    ]
+                }
+            ]
+            try:
+                content = self._call_with_hedging(messages, prompt, img_base64, structured, usage)
+            except UpstreamError as e:
+                # 熔断、排队超时或服务不可用时不再等待百度，改用本地降级结果
+                return self._fallback_analysis(image, img_base64, prompt, structured, schema_name, e)
             
-            # 解析返回的文本内容
-            lines = content.strip().split('\n')
-            analysis_result = {
-                "status": "success",
-                "description": "",
-                "scene": "",
-                "style": "",
-                "colors": [],
-                "objects": []
-            }
+            # 解析返回的结果：严格JSON -> 宽松解析 -> 修复提示重试一次
+            fields, outcome = self._parse_content(content, structured, schema_name, usage)
+            PARSE_RESULTS.inc(mode=schema_name if include_sd_prompt else self.output_mode, outcome=outcome)
+            if fields is None:
+                raise Exception(f"无法解析分析结果: {content[:200]}")
             
-            for line in lines:
-                if "描述：" in line:
-                    analysis_result["description"] = line.split("描述：")[1].strip()
-                elif "场景：" in line:
-                    analysis_result["scene"] = line.split("场景：")[1].strip()
-                elif "风格：" in line:
-                    analysis_result["style"] = line.split("风格：")[1].strip()
-                elif "颜色：" in line:
-                    colors = line.split("颜色：")[1].strip()
-                    analysis_result["colors"] = [c.strip() for c in colors.split("、")]
-                elif "物体：" in line:
-                    objects = line.split("物体：")[1].strip()
-                    analysis_result["objects"] = [o.strip() for o in objects.split("、")]
+            analysis_result = {"status": "success"}
+            analysis_result.update(fields)
+            analysis_result["usage"] = usage
             
             logger.debug(f"Image analysis result: {analysis_result}")
             return analysis_result
@@ -109,20 +181,163 @@ class ImageAnalysisAgent:
             logger.error(f"Image analysis failed: {str(e)}")
             return {
                 "status": "error",
-                "error": str(e)
+                "error": str(e),
+                "error_code": error_code_for(e)
             }
 
-    def _process_local_image(self, image_path):
-        """处理本地图片，返回base64编码"""
+    def _fallback_analysis(self, image, img_base64, prompt, structured, schema_name, error):
+        """百度分析不可用时的降级结果
+        
+        本地LLM的熔断器闭合时先用本地多模态模型生成描述（caption），失败或本地LLM也不可用时
+        只用本地调色板填充颜色字段（palette），描述为通用的“儿童画”。
+        
+        Returns:
+            Dict: 与 analyze_image 相同格式的分析结果，degraded 为 True，fallback 为降级方案名称
+        """
+        reason = error_code_for(error)
+        logger.warning(f"百度分析不可用（{reason}），使用本地降级分析: {str(error)}")
+        
+        if governor.available('llm_studio'):
+            try:
+                content, usage = self.local_llm.analyze_image(img_base64, prompt, json_format=structured)
+                fields = parse_strict(content, schema_name)[0] if structured else None
+                if fields is None:
+                    fields = parse_tolerant(content, schema_name)[0]
+                if fields is not None:
+                    FALLBACKS.inc(fallback="caption", reason=reason)
+                    return dict(fields, status="success", usage=usage, degraded=True, fallback="caption")
+                logger.warning("本地多模态模型的分析结果无法解析")
+            except Exception as e:
+                logger.warning(f"本地多模态模型分析失败: {str(e)}")
+        
+        palette = extract_palette(image.path, image=image.working()) or []
+        names = [entry["name"] for entry in palette]
+        colors = [name for name in names if name not in ACHROMATIC_NAMES][:3] or names[:1]
+        FALLBACKS.inc(fallback="palette", reason=reason)
+        return {
+            "status": "success",
+            "description": f"一幅以{'、'.join(colors)}为主的儿童画" if colors else "一幅儿童画",
+            "scene": "",
+            "style": "儿童画",
+            "colors": colors,
+            "objects": [],
+            "subject_features": "",
+            "palette": palette,
+            "usage": {},
+            "degraded": True,
+            "fallback": "palette"
+        }
+
+    def _call_with_hedging(self, messages, prompt, img_base64, structured, usage):
+        """发送分析请求；首选请求超过对冲阈值仍未返回时向对冲通道再发一次，取先返回的结果"""
+        if self.hedge_provider == "off":
+            return self._call_model(messages, structured, usage)
+        
+        primary_usage, hedge_usage = {}, {}
+        
+        def primary():
+            return self._call_model(messages, structured, primary_usage)
+        
+        def hedge():
+            if self.hedge_provider == "local":
+                content, local_usage = self.local_llm.analyze_image(img_base64, prompt, json_format=structured)
+                hedge_usage.update(local_usage)
+                return content
+            return self._call_model(messages, structured, hedge_usage)
+        
+        delay = self._hedge_delay()
+        content, source, hedged, elapsed = hedged_call(primary, hedge, delay, _hedge_executor)
+        
+        ANALYSIS_SECONDS.observe(elapsed, source=source)
+        if source == "primary":
+            # 只用首选通道的耗时更新阈值，避免对冲结果拉低分位数
+            _primary_latencies.record(elapsed)
+        if hedged:
+            HEDGES.inc(provider=self.hedge_provider, outcome="fired")
+            if source == "hedge":
+                HEDGES.inc(provider=self.hedge_provider, outcome="won")
+            logger.info(f"分析请求超过 {delay:.1f}秒 未返回，已发起对冲，采用 {source} 的结果（{elapsed:.1f}秒）")
+        
+        for key, value in (hedge_usage if source == "hedge" else primary_usage).items():
+            usage[key] = usage.get(key, 0) + value
+        return content
+
+    def _hedge_delay(self):
+        """当前的对冲阈值：首选请求历史耗时的指定百分位，样本不足时使用固定值"""
+        if len(_primary_latencies) < self.hedge_min_samples:
+            delay = self.hedge_default_delay
+        else:
+            delay = _primary_latencies.percentile(self.hedge_percentile)
+        HEDGE_DELAY.set(round(delay, 3))
+        return delay
+
+    def _call_model(self, messages, structured, usage=None):
+        """调用百度多模态模型，返回回复文本；提供 usage 时累加本次请求的 token 用量"""
+        body = {
+            "model": "ernie-4.5-8k-preview",
+            "messages": messages
+        }
+        if structured:
+            body["response_format"] = {"type": "json_object"}
+        payload = json.dumps(body)
+        
+        headers = {
+            "Content-Type": "application/json",
+            "Authorization": f"Bearer {self.baidu_token}"
+        }
+
+        response = governor.post('baidu', self.baidu_api_url, headers=headers, data=payload)
+        
+        if response.status_code != 200:
+            raise Exception(f"Baidu API error: {response.text}")
+
+        result = response.json()
+        
+        if "error_code" in result:
+            raise Exception(f"API返回错误: {result}")
+        
+        if usage is not None:
+            for key, value in result.get("usage", {}).items():
+                if isinstance(value, (int, float)):
+                    usage[key] = usage.get(key, 0) + value
+            
+        return result.get("choices", [{}])[0].get("message", {}).get("content", "")
+
+    def _parse_content(self, content, structured, schema_name="analysis", usage=None):
+        """
+        解析模型回复
+        
+        Returns:
+            Tuple[Dict, str]: (分析字段, 解析结果类型 strict/tolerant/repaired/failed)，失败时字段为None
+        """
+        if structured:
+            fields, errors = parse_strict(content, schema_name)
+            if fields is not None:
+                return fields, "strict"
+            logger.info(f"严格解析失败: {errors}")
+        
+        fields, errors = parse_tolerant(content, schema_name)
+        if fields is not None:
+            return fields, "tolerant"
+        logger.warning(f"宽松解析失败: {errors}，使用修复提示重试")
+        
+        # 只发送上一次的回复文本，让模型改写为JSON，不再重复上传图片
+        repair_prompt = ANALYSIS_REPAIR_PROMPT.format(
+            errors="；".join(errors), fields=ANALYSIS_REPAIR_FIELDS[schema_name], content=content
+        )
         try:
-            if not os.path.exists(image_path):
-                raise FileNotFoundError(f"图片文件不存在: {image_path}")
-                
-            with open(image_path, 'rb') as f:
-                image_data = f.read()
-                if not image_data:
-                    raise ValueError("图片文件为空")
-                return base64.b64encode(image_data).decode()
+            repaired = self._call_model([
+                {
+                    "role": "user",
+                    "content": repair_prompt
+                }
+            ], structured=True, usage=usage)
         except Exception as e:
-            logger.error(f"处理图片失败: {str(e)}")
-            raise 
\ No newline at end of file
+            logger.error(f"修复请求失败: {str(e)}")
+            return None, "failed"
+        
+        fields, errors = parse_tolerant(repaired, schema_name)
+        if fields is not None:
+            return fields, "repaired"
+        logger.error(f"修复后仍无法解析: {errors}")
+        return None, "failed"
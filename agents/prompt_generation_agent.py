@@ -1,16 +1,62 @@
-import os
-import requests
-from dotenv import load_dotenv
-from typing import Dict, Tuple
+from typing import Dict, List, Tuple
 import logging
 
-load_dotenv()
+from config.config import Config
+from agents.analysis_schema import format_analysis
+from services import metrics
+from services.upstream_governor import UpstreamError, governor, error_code_for
+
 logger = logging.getLogger(__name__)
 
+PROMPT_FALLBACKS = metrics.counter('prompt_generation_fallback_total', '本地LLM不可用时改用本地模板生成提示词的次数', ['reason'])
+
+# SD 提示词的生成要求（两次调用模式和单次调用模式共用）
+SD_PROMPT_REQUIREMENTS = """1. 使用英文
+2. 所有提示词用逗号和空格分隔
+3. 不要使用冒号和换行
+4. 为主体添加量词(a, one)确保生成单个角色
+5. 保持简洁清晰的描述
+6. 确保提示词间的关系合理
+7. 如果图片是黑白的，那么提示词中不需要出现black and white
+8. 如果接受到了图片的彩色信息，那么需要包含颜色加部位，例如：blue hair, yellow dress, red shoes"""
+
+# 生成要求放在固定的 system 消息中，分析结果放在最后的 user 消息中，便于服务端复用前缀的 KV 缓存
+PROMPT_SYSTEM_PROMPT = f"""你是一个专业的图像提示词生成专家。用户会给出一幅图片的分析结果，请据此生成一个简洁的英文提示词串。
+
+要求：
+{SD_PROMPT_REQUIREMENTS}
+
+示例格式：
+a cute little girl, wearing blue dress, holding a teddy bear, standing in garden, soft lighting
+
+请直接给出提示词，不要包含任何解释或前缀。"""
+
+# 本地模板（LLM 不可用时的降级方案）把中文分析字段映射为英文提示词。主体按顺序匹配，较具体的词在前
+TEMPLATE_SUBJECTS = [
+    ("小女孩", "little girl"), ("女孩", "girl"), ("小男孩", "little boy"), ("男孩", "boy"), ("公主", "princess"),
+    ("小朋友", "child"), ("独角兽", "unicorn"), ("恐龙", "dinosaur"), ("龙", "dragon"), ("猫", "cat"), ("狗", "dog"),
+    ("兔", "rabbit"), ("熊", "bear"), ("鸟", "bird"), ("鱼", "fish"), ("马", "horse"), ("猪", "pig"),
+    ("老虎", "tiger"), ("狮子", "lion"), ("大象", "elephant"), ("猴", "monkey"), ("蝴蝶", "butterfly"),
+    ("机器人", "robot"), ("怪兽", "monster"), ("消防车", "fire truck"), ("汽车", "car"), ("车", "car"),
+    ("飞机", "airplane"), ("火箭", "rocket"), ("船", "boat"), ("城堡", "castle"), ("房子", "house"),
+    ("树", "tree"), ("花", "flower"), ("太阳", "sun"), ("彩虹", "rainbow"), ("人", "person")
+]
+TEMPLATE_COLORS = {
+    "红": "red", "橙": "orange", "黄": "yellow", "绿": "green", "青": "cyan", "蓝": "blue", "紫": "purple",
+    "粉": "pink", "棕": "brown", "褐": "brown", "金": "golden", "黑": "black", "白": "white", "灰": "gray"
+}
+TEMPLATE_PARTS = {
+    "头发": "hair", "眼睛": "eyes", "衣服": "clothes", "裙子": "dress", "裤子": "pants", "帽子": "hat",
+    "鞋": "shoes", "翅膀": "wings", "尾巴": "tail", "耳朵": "ears", "脸": "face", "身体": "body"
+}
+# 没有部位的黑白灰多来自线条和纸张，不写入提示词
+TEMPLATE_ACHROMATIC = {"black", "white", "gray"}
+
 class PromptGenerationAgent:
-    def __init__(self):
-        self.llm_studio_url = os.getenv("LLM_STUDIO_URL", "http://localhost:1234")
-        self.model_name = os.getenv("LLM_MODEL", "default")
+    def __init__(self, config=Config):
+        self.llm_studio_url = config.LLM_STUDIO_URL
+        self.model_name = config.LLM_MODEL
+        self.cache_prompt = config.LLM_CACHE_PROMPT
         self.style_base = "cute style, simple lines, children's drawing style, no background, sticker"
         self.negative_base = "low quality, blurry, distorted, bad anatomy, text, watermark, multiple characters, duplicate, multiple views, many heads, mutiple heads, background, extra subjects, extra objects"
     
@@ -25,43 +71,17 @@ class PromptGenerationAgent:
             Dict: 包含生成的提示词的字典
         """
         try:
-            # 构建提示词
-            prompt = f"""你是一个专业的图像提示词生成专家。请基于以下图片分析结果生成一个简洁的英文提示词串。
-
-图片分析结果：
-描述：{analysis_result.get('description', '')}
-场景：{analysis_result.get('scene', '')}
-风格：{analysis_result.get('style', '')}
-颜色：{', '.join(analysis_result.get('colors', []))}
-物体：{', '.join(analysis_result.get('objects', []))}
-
-要求：
-1. 使用英文
-2. 所有提示词用逗号和空格分隔
-3. 不要使用冒号和换行
-4. 为主体添加量词(a, one)确保生成单个角色
-5. 保持简洁清晰的描述
-6. 确保提示词间的关系合理
-7. 如果图片是黑白的，那么提示词中不需要出现black and white
-8. 如果接受到了图片的彩色信息，那么需要包含颜色加部位，例如：blue hair, yellow dress, red shoes
-
-示例格式：
-a cute little girl, wearing blue dress, holding a teddy bear, standing in garden, soft lighting
-
-请直接给出提示词，不要包含任何解释或前缀。"""
-            
-            response = requests.post(
+            body = {
+                "messages": self.build_messages(analysis_result),
+                "temperature": 0.7,
+                "max_tokens": 150
+            }
+            if self.cache_prompt:
+                body["cache_prompt"] = True
+            response = governor.post(
+                'llm_studio',
                 f"{self.llm_studio_url}/v1/chat/completions",
-                json={
-                    "messages": [
-                        {
-                            "role": "user",
-                            "content": prompt
-                        }
-                    ],
-                    "temperature": 0.7,
-                    "max_tokens": 150
-                }
+                json=body
             )
             
             if response.status_code != 200:
@@ -80,16 +100,113 @@ a cute little girl, wearing blue dress, holding a teddy bear, standing in garden
                 "status": "success",
                 "positive_prompt": positive_prompt,
                 "negative_prompt": negative_prompt,
-                "raw_prompt": generated_prompt
+                "raw_prompt": generated_prompt,
+                "usage": response.json().get("usage", {})
             }
             
+        except UpstreamError as e:
+            # 熔断、排队超时或服务不可用时不让调用方失败重试，改用本地模板
+            logger.warning(f"本地LLM不可用（{error_code_for(e)}），使用本地模板生成提示词: {str(e)}")
+            PROMPT_FALLBACKS.inc(reason=error_code_for(e))
+            return self.generate_from_template(analysis_result)
         except Exception as e:
             logger.error(f"提示词生成失败: {str(e)}")
             return {
                 "status": "error",
-                "error": str(e)
+                "error": str(e),
+                "error_code": error_code_for(e)
             }
 
+    def build_messages(self, analysis_result: Dict) -> List[Dict]:
+        """
+        构建提示词生成请求的消息：固定的 system 前缀 + 随图片变化的 user 后缀
+        
+        Args:
+            analysis_result: 来自图像分析代理的分析结果
+            
+        Returns:
+            List[Dict]: chat completions 的 messages
+        """
+        return [
+            {"role": "system", "content": PROMPT_SYSTEM_PROMPT},
+            {"role": "user", "content": f"图片分析结果：\n{format_analysis(analysis_result)}"}
+        ]
+
+    def generate_from_raw_prompt(self, raw_prompt: str) -> Dict:
+        """
+        基于多模态模型在分析时一并返回的英文提示词生成最终提示词（单次调用模式，无需再请求LLM）
+        
+        Args:
+            raw_prompt: 模型返回的英文SD提示词
+            
+        Returns:
+            Dict: 与 generate_from_analysis 相同格式的提示词字典
+        """
+        positive_prompt, negative_prompt = self.generate_prompts(raw_prompt)
+        return {
+            "status": "success",
+            "positive_prompt": positive_prompt,
+            "negative_prompt": negative_prompt,
+            "raw_prompt": raw_prompt,
+            "usage": {}
+        }
+
+    def generate_from_template(self, analysis_result: Dict) -> Dict:
+        """
+        不请求LLM，用分析字段按本地模板生成提示词（本地LLM不可用时的降级方案）
+        
+        结果是确定性的：同样的分析结果总是得到同样的提示词。
+        
+        Args:
+            analysis_result: 来自图像分析代理的分析结果
+            
+        Returns:
+            Dict: 与 generate_from_analysis 相同格式的提示词字典，degraded 为 True
+        """
+        features = self._template_features(analysis_result)
+        positive_prompt, negative_prompt = self.generate_prompts(features)
+        return {
+            "status": "success",
+            "positive_prompt": positive_prompt,
+            "negative_prompt": negative_prompt,
+            "raw_prompt": features,
+            "usage": {},
+            "degraded": True
+        }
+
+    def _template_features(self, analysis_result: Dict) -> str:
+        """
+        把中文的物体和颜色字段映射为英文特征描述，例如 "a cat, blue hat, yellow"
+        
+        Args:
+            analysis_result: 图像分析结果
+            
+        Returns:
+            str: 英文特征描述，没有可识别的主体时以 children's drawing 作为主体
+        """
+        subjects = []
+        for text in list(analysis_result.get("objects") or []) + [analysis_result.get("description") or ""]:
+            subject = next((en for zh, en in TEMPLATE_SUBJECTS if zh in text), None)
+            if subject and subject not in subjects:
+                subjects.append(subject)
+            if len(subjects) == 2:
+                break
+        subject = " and ".join(f"{'an' if en[0] in 'aeiou' else 'a'} {en}" for en in subjects) or "children's drawing"
+        
+        phrases = []
+        for text in analysis_result.get("colors") or []:
+            found = [(text.index(zh), en) for zh, en in TEMPLATE_COLORS.items() if zh in text]
+            if not found:
+                continue
+            color = min(found)[1]
+            part = next((en for zh, en in TEMPLATE_PARTS.items() if zh in text), None)
+            if not part and color in TEMPLATE_ACHROMATIC:
+                continue
+            phrase = f"{color} {part}" if part else color
+            if phrase not in phrases:
+                phrases.append(phrase)
+        return ", ".join([subject] + phrases[:4])
+
     def generate_prompts(self, features: str) -> Tuple[str, str]:
         """
         根据图像特征生成正面和负面提示词
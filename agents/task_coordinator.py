@@ -1,35 +1,84 @@
+from config.config import Config
 from agents.image_analysis_agent import ImageAnalysisAgent
 from agents.prompt_generation_agent import PromptGenerationAgent
 from agents.art_review_agent import ArtReviewAgent
+from services.image_memory import SharedImage, image_budget
+from services.palette_extractor import extract_palette, merge_colors
+from services.phash_index import NearDuplicateCache, cache_key, image_hashes
+from services.upstream_governor import error_code_for
 import logging
 
 logger = logging.getLogger(__name__)
 
+# 协调策略：two_call（百度分析 + LLM生成提示词）或 fused（一次多模态请求同时返回分析和提示词）
+STRATEGY_TWO_CALL = "two_call"
+STRATEGY_FUSED = "fused"
+STRATEGIES = {STRATEGY_TWO_CALL, STRATEGY_FUSED}
+
+# 近重复图片（重新拍照、轻微裁剪、转存格式）的结果缓存，所有协调器实例共享
+result_cache = NearDuplicateCache(
+    max_distance=Config.PHASH_MAX_DISTANCE,
+    min_confidence=Config.PHASH_MIN_CONFIDENCE,
+    max_entries=Config.PHASH_CACHE_MAX_ENTRIES,
+    ttl=Config.PHASH_CACHE_TTL
+)
+
 class TaskCoordinator:
-    def __init__(self):
-        self.image_analyzer = ImageAnalysisAgent()
-        self.prompt_generator = PromptGenerationAgent()
-        self.art_reviewer = ArtReviewAgent()
+    def __init__(self, strategy=None, config=Config, shared_state=None):
+        """
+        Args:
+            strategy: 协调策略 two_call/fused，默认使用 COORDINATOR_STRATEGY
+            config: 配置类，默认 config.Config
+            shared_state: SharedState，多进程部署时让各进程共享近重复结果缓存
+        """
+        if shared_state is not None:
+            result_cache.attach_store(shared_state)
+        self.image_analyzer = ImageAnalysisAgent(config)
+        self.prompt_generator = PromptGenerationAgent(config)
+        self.art_reviewer = ArtReviewAgent(config)
+        
+        self.strategy = strategy or config.COORDINATOR_STRATEGY
+        if self.strategy not in STRATEGIES:
+            logger.warning(f"未知的协调策略: {self.strategy}，使用 {STRATEGY_TWO_CALL}")
+            self.strategy = STRATEGY_TWO_CALL
+        logger.info(f"任务协调策略: {self.strategy}")
     
-    def process_image(self, image_path):
+    def process_image(self, image_path, image=None):
         """
         协调处理图像分析任务
         
         Args:
             image_path: 图片文件路径
+            image: 本次请求共享的 SharedImage；为空时在这里打开，并在图片内存预算中预留解码所需的内存
             
         Returns:
             Dict: 包含所有处理结果的字典
         """
         try:
+            if image is None:
+                with SharedImage(image_path, image_budget) as image:
+                    return self.process_image(image_path, image)
+            
             logger.info(f"开始处理图片: {image_path}")
             
-            # 第一步：分析图像
-            analysis_result = self.image_analyzer.analyze_image(image_path)
+            # 近重复图片直接复用之前的分析和提示词
+            hashes = self._image_hashes(image)
+            cached = result_cache.lookup(hashes) if hashes else None
+            if cached:
+                result, confidence, key = cached
+                logger.info(f"找到近重复图片 {key}（置信度 {confidence:.3f}），复用分析结果")
+                return dict(result, usage={}, cache={"hit": True, "confidence": round(confidence, 3), "source": key})
+            
+            # 第一步：分析图像（单次调用模式下同时生成英文提示词）
+            fused = self.strategy == STRATEGY_FUSED
+            analysis_result = self.image_analyzer.analyze_image(image_path, include_sd_prompt=fused, image=image)
             if analysis_result.get("status") == "error":
                 logger.error(f"图像分析失败: {analysis_result.get('error')}")
                 return analysis_result
             
+            # 用本地调色板补全模型经常漏掉的颜色字段，评论和提示词都依赖它
+            self._check_colors(image, analysis_result)
+            
             # 第二步：生成艺术评论
             logger.info("开始生成艺术评论")
             review_result = self.art_reviewer.generate_review(analysis_result)
@@ -41,21 +90,23 @@ class TaskCoordinator:
             
             # 第三步：生成提示词
             logger.info("开始生成提示词")
-            prompt_result = self.prompt_generator.generate_from_analysis(analysis_result)
+            prompt_result = self.generate_prompts(analysis_result)
             if prompt_result.get("status") == "error":
                 logger.error(f"提示词生成失败: {prompt_result.get('error')}")
             else:
                 logger.info("提示词生成成功")
             
             # 整合所有结果
-            return {
+            result = {
                 "status": "success",
                 "analysis": {
                     "description": analysis_result.get("description", ""),
                     "scene": analysis_result.get("scene", ""),
                     "style": analysis_result.get("style", ""),
                     "colors": analysis_result.get("colors", []),
-                    "objects": analysis_result.get("objects", [])
+                    "objects": analysis_result.get("objects", []),
+                    "subject_features": analysis_result.get("subject_features", ""),
+                    "palette": analysis_result.get("palette", [])
                 },
                 "review": {
                     "status": review_result.get("status", "error"),
@@ -66,12 +117,63 @@ class TaskCoordinator:
                     "positive_prompt": prompt_result.get("positive_prompt", ""),
                     "negative_prompt": prompt_result.get("negative_prompt", ""),
                     "raw_prompt": prompt_result.get("raw_prompt", "")
-                }
+                },
+                "usage": {
+                    "analysis": analysis_result.get("usage", {}),
+                    "prompt": prompt_result.get("usage", {})
+                },
+                # 上游不可用时使用了本地降级结果的步骤
+                "degraded": [stage for stage, stage_result in (("analysis", analysis_result), ("prompt", prompt_result))
+                             if stage_result.get("degraded")]
             }
             
+            # 评论和提示词都成功且没有降级时才缓存，避免把失败或降级的结果复用给之后的上传
+            if hashes and review_result.get("status") != "error" and prompt_result.get("status") != "error" \
+                    and not result["degraded"]:
+                result_cache.store(cache_key(hashes), hashes, {k: v for k, v in result.items() if k != "usage"})
+            return dict(result, cache={"hit": False})
+            
         except Exception as e:
             logger.error(f"任务处理失败: {str(e)}")
             return {
                 "status": "error",
-                "error": str(e)
-            } 
\ No newline at end of file
+                "error": str(e),
+                "error_code": error_code_for(e)
+            }
+    
+    def _check_colors(self, image, analysis_result):
+        """用本地提取的调色板填充或补全分析结果的 colors 字段，并附上 palette"""
+        palette = analysis_result.get("palette") or extract_palette(image.path, image=image.working())
+        if palette is None:
+            return
+        colors, action = merge_colors(analysis_result.get("colors", []), palette)
+        if action != "unchanged":
+            logger.info(f"颜色字段已用本地调色板{'填充' if action == 'filled' else '补全'}: {colors}")
+        analysis_result["colors"] = colors
+        analysis_result["palette"] = palette
+    
+    def _image_hashes(self, image):
+        """计算图片的感知哈希，失败时返回None（不影响正常处理）"""
+        try:
+            return image_hashes(image.working())
+        except Exception as e:
+            logger.warning(f"计算感知哈希失败: {str(e)}")
+            return None
+    
+    def generate_prompts(self, analysis_result):
+        """
+        根据分析结果生成SD提示词
+        
+        单次调用模式下直接使用分析结果中的 sd_prompt，只做确定性的风格和负面提示词拼接；
+        否则（或 sd_prompt 为空时）再请求一次LLM。
+        
+        Args:
+            analysis_result: 图像分析结果
+            
+        Returns:
+            Dict: 提示词生成结果
+        """
+        sd_prompt = analysis_result.get("sd_prompt", "")
+        if self.strategy == STRATEGY_FUSED and sd_prompt:
+            return self.prompt_generator.generate_from_raw_prompt(sd_prompt)
+        return self.prompt_generator.generate_from_analysis(analysis_result)
@@ -1,8 +1,17 @@
-from flask import Flask, request, jsonify, send_from_directory, render_template
+from flask import Flask, request, jsonify, send_from_directory, render_template, Response, stream_with_context, g
 import os
+import io
+import json
+from PIL import Image
 from werkzeug.utils import secure_filename
-from agents.task_coordinator import TaskCoordinator
-from services.comfyui_service import ComfyUIService
+from config.config import Config
+from services.comfyui_service import (ANIMATION_ACTIONS, ANIMATION_FORMATS, DEFAULT_ANIMATION_FORMAT, ANIMATION_TIMEOUT,
+                                      ANIMATION_TIERS, DEFAULT_ANIMATION_TIER, ENHANCE_PRESETS, WARMUP_TEMPLATES)
+from services.container import ServiceContainer
+from services.job_manager import JOB_SUCCEEDED
+from services.upstream_governor import governor
+from services.warmup import WarmupManager
+from services import metrics
 import logging
 import time
 
@@ -20,14 +29,176 @@ app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max-limit
 # 确保上传目录存在
 os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
 
-# 初始化服务和代理
-task_coordinator = TaskCoordinator()
-comfyui_service = ComfyUIService("http://localhost:8188")
+# 共享的服务和代理，在第一次使用时创建
+container = ServiceContainer(Config)
+warmup = WarmupManager()
+
+# 记录启动后第一个请求耗时的接口（冷启动 vs 预热后）
+FIRST_REQUEST_ENDPOINTS = {'enhance_image', 'animate_image', 'generate_review'}
+
+def prime_local_caches():
+    """解析工作流模板，并在示例图片上执行一次感知哈希和调色板提取（NumPy/Pillow 的导入和首次调用开销）"""
+    from services.phash_index import hash_file
+    from services.palette_extractor import extract_palette
+    
+    for template in WARMUP_TEMPLATES:
+        container.comfyui_service._load_workflow(f"{template}_workflow.json")
+    sample = io.BytesIO()
+    Image.new('RGB', (256, 256), 'white').save(sample, 'PNG')
+    sample.seek(0)
+    hash_file(sample)
+    sample.seek(0)
+    extract_palette(sample)
+
+def configure_warmup():
+    """登记预热步骤：本地缓存、到百度和本地LLM的连接池、每个 ComfyUI 模板的预热工作流
+    
+    WARMUP=off 时跳过预热直接就绪；WARMUP_COMFYUI_TEMPLATES 指定要预热的模板（逗号分隔）。
+    """
+    if not Config.WARMUP:
+        warmup.skip()
+        return
+    warmup.add_step('local_caches', prime_local_caches)
+    warmup.add_step('baidu_connection', lambda: governor.warm('baidu', container.task_coordinator.image_analyzer.baidu_api_url))
+    warmup.add_step('llm_connection', lambda: governor.warm(
+        'llm_studio', f"{Config.LLM_STUDIO_URL}/v1/models", connections=2))
+    for template in [t for t in Config.WARMUP_COMFYUI_TEMPLATES if t in WARMUP_TEMPLATES]:
+        warmup.add_step(f"comfyui_{template}", lambda template=template: container.comfyui_service.warm_up(template))
+    warmup.start()
+
+@app.before_request
+def start_request_timer():
+    g.request_started_at = time.time()
+
+@app.after_request
+def record_first_request(response):
+    if request.endpoint in FIRST_REQUEST_ENDPOINTS and hasattr(g, 'request_started_at'):
+        warmup.record_request(request.endpoint, time.time() - g.request_started_at, g.request_started_at)
+    return response
 
 def allowed_file(filename):
     """检查文件类型是否允许"""
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in {'png', 'jpg', 'jpeg', 'gif'}
 
+def select_animation_format(requested_format, accept_mimetypes):
+    """选择动画输出格式
+    
+    优先使用表单中显式指定的格式，否则根据 Accept 头在支持的格式中协商，
+    都没有时使用默认格式（GIF）。
+    
+    Args:
+        requested_format: 表单中的 format 参数
+        accept_mimetypes: 请求的 Accept 头
+        
+    Returns:
+        str: ANIMATION_FORMATS 中的格式键，不支持的显式格式返回None
+    """
+    if requested_format:
+        requested_format = requested_format.lower()
+        return requested_format if requested_format in ANIMATION_FORMATS else None
+    
+    # 默认格式放在首位，客户端只发送 */* 时保持原有的 GIF 输出
+    format_order = [DEFAULT_ANIMATION_FORMAT] + [f for f in ANIMATION_FORMATS if f != DEFAULT_ANIMATION_FORMAT]
+    mimetypes = [ANIMATION_FORMATS[f]['mimetype'] for f in format_order]
+    best_mimetype = accept_mimetypes.best_match(mimetypes)
+    for output_format in format_order:
+        if ANIMATION_FORMATS[output_format]['mimetype'] == best_mimetype:
+            return output_format
+    return DEFAULT_ANIMATION_FORMAT
+
+def run_animation(filepath, filename, action, output_format, timeout=ANIMATION_TIMEOUT, job=None,
+                  tier=DEFAULT_ANIMATION_TIER, seed=None, preview=None):
+    """生成动画并整理为接口返回格式，失败时返回None
+    
+    action 为列表时在一个 ComfyUI 工作流中生成多个动作的动画（返回 animations 列表）。
+    tier 为 preview 时渲染短、低分辨率的预览；preview 为预览的结果（prompts、seed、gpu_seconds）时
+    沿用预览的提示词和种子渲染完整动画。
+    服务重启后继续的任务带有重启前提交的 prompt_id，此时继续等待该工作流的输出；
+    只有 ComfyUI 中已经找不到该工作流时才重新提交。
+    """
+    service = container.comfyui_service
+    actions = action if isinstance(action, list) else None
+    if preview is not None:
+        tier, seed = DEFAULT_ANIMATION_TIER, preview.get('seed')
+    
+    def submit():
+        if preview is not None:
+            return service.promote_animation(filepath, preview, action, output_format, job=job, timeout=timeout)
+        if actions:
+            return service.create_animations(filepath, actions, output_format, job=job, timeout=timeout, tier=tier,
+                                             seed=seed)
+        return service.create_animation(filepath, action, output_format, job=job, timeout=timeout, tier=tier, seed=seed)
+    
+    if job and job.prompt_id:
+        animation = service.resume_animation(job.prompt_id, filepath, output_format, job=job, timeout=timeout,
+                                             actions=actions, tier=tier,
+                                             preview_seconds=(preview.get('gpu_seconds') or 0.0) if preview else None)
+        if animation and animation.get('lost'):
+            animation = submit()
+    else:
+        animation = submit()
+    if not animation:
+        return None
+    
+    def public_urls(item):
+        return {
+            'animation': f"/uploads/{os.path.basename(item['animation'])}",
+            'poster': f"/uploads/{os.path.basename(item['poster'])}" if item['poster'] else None
+        }
+    
+    result = {'success': True, 'original': f"/uploads/{filename}"}
+    if actions:
+        result['animations'] = [dict(public_urls(item), action=item['action']) for item in animation['animations']]
+    else:
+        result.update(public_urls(animation))
+    result.update(format=animation['format'], mimetype=animation['mimetype'], tier=animation['tier'],
+                  seed=animation.get('seed', seed), gpu_seconds=animation['gpu_seconds'],
+                  prompts=animation.get('prompts', preview.get('prompts') if preview else None))
+    if 'total_gpu_seconds' in animation:
+        result['total_gpu_seconds'] = animation['total_gpu_seconds']
+    return result
+
+# 服务重启后可以继续的后台任务类型及其任务函数（与提交时相同）
+JOB_HANDLERS = {'animate': run_animation}
+
+def recover_jobs():
+    """继续已停止的进程留下的未完成任务（已提交到 ComfyUI 的工作流只等待输出，不重新提交）"""
+    try:
+        recovered = container.job_manager.recover(JOB_HANDLERS)
+        if recovered:
+            logger.info(f"已继续 {len(recovered)} 个重启前未完成的任务")
+    except Exception as e:
+        logger.error(f"恢复未完成任务失败: {str(e)}")
+
+def reset_shared_metrics():
+    """清空上一次运行留下的各进程指标和 ComfyUI 节点耗时汇总（主进程启动时调用，不创建任何服务）"""
+    from services.comfyui_telemetry import reset_shared_state
+    from services.shared_state import SharedState
+    
+    store = SharedState(container.config.STATE_DB_PATH)
+    metrics.PROCESS_METRICS.reset(store)
+    reset_shared_state(store)
+
+def configure_metrics():
+    """定期把本进程的指标写入共享状态，/metrics 由任意进程处理时都导出所有进程的合计"""
+    metrics.PROCESS_METRICS.attach_store(container.shared_state, container.config.METRICS_PUBLISH_INTERVAL)
+
+def parse_timeout(value):
+    """解析客户端给出的截止时间（秒），客户端只能缩短不能延长
+
+    Returns:
+        tuple: (timeout, error)，参数不是正数时 timeout 为None、error 为错误信息
+    """
+    if value is None:
+        return ANIMATION_TIMEOUT, None
+    try:
+        timeout = float(value)
+    except ValueError:
+        return None, f"超时时间必须是正数: {value}"
+    if not timeout > 0:
+        return None, f"超时时间必须是正数: {value}"
+    return min(timeout, ANIMATION_TIMEOUT), None
+
 def process_uploaded_file(file, denoise_value=0.6):
     """处理上传的文件
     
@@ -104,19 +275,34 @@ def enhance_image():
         if not 0 <= denoise_value <= 100:
             return jsonify({'success': False, 'error': f'降噪值必须在0%到100%之间, 当前值: {denoise_value}%'})
         
+        # 质量预设（fast/balanced/best，默认 auto 按队列长度自动选择）和延迟预算（秒）
+        preset = request.form.get('preset', 'auto')
+        if preset != 'auto' and preset not in ENHANCE_PRESETS:
+            return jsonify({'success': False, 'error': f'不支持的预设: {preset}'})
+        budget = request.form.get('budget', type=float)
+        
+        # 候选图数量：大于 1 时在一次采样中生成多张候选图，以画廊形式返回
+        variants = request.form.get('variants', 1, type=int)
+        max_variants = Config.ENHANCE_MAX_VARIANTS
+        if not 1 <= variants <= max_variants:
+            return jsonify({'success': False, 'error': f'候选图数量必须在1到{max_variants}之间, 当前值: {variants}'})
+        
         # 保存上传的文件
         filename = secure_filename(file.filename)
         file_path = os.path.join('uploads', filename)
         file.save(file_path)
         
         # 调用 ComfyUI 服务进行图片美化
-        enhanced_path = comfyui_service.enhance_image(file_path, denoise_value)
+        enhanced_paths = container.comfyui_service.enhance_variants(file_path, variants, denoise_value, preset=preset,
+                                                                    budget_seconds=budget)
         
-        if enhanced_path:
+        if enhanced_paths:
+            gallery = [f'/uploads/{os.path.basename(path)}' for path in enhanced_paths]
             return jsonify({
                 'success': True,
                 'original': f'/uploads/{filename}',
-                'enhanced': f'/uploads/{os.path.basename(enhanced_path)}'
+                'enhanced': gallery[0],
+                'variants': gallery
             })
         else:
             return jsonify({'success': False, 'error': '图片美化失败'})
@@ -147,7 +333,7 @@ def adjust_image():
             return jsonify({'status': 'error', 'error': f'降噪值必须在0%到100%之间, 当前值: {denoise_value}%'})
             
         # 使用ComfyUI调整图片
-        enhanced_path = comfyui_service.enhance_image(filepath, denoise_value)
+        enhanced_path = container.comfyui_service.enhance_image(filepath, denoise_value)
         if not enhanced_path:
             return jsonify({'status': 'error', 'error': '图片调整失败'})
             
@@ -177,25 +363,186 @@ def animate_image():
         filepath = result['filepath']
         filename = result['filename']
         
-        # 获取动作参数
+        # 获取动作参数；actions（逗号分隔）指定多个动作时在一个工作流中全部生成
         action = request.form.get('action', 'smile')
+        if request.form.get('actions'):
+            action = list(dict.fromkeys(a.strip() for a in request.form['actions'].split(',') if a.strip()))
+            unknown = [a for a in action if a not in ANIMATION_ACTIONS]
+            if not action or unknown:
+                return jsonify({'error': f"不支持的动画动作: {', '.join(unknown)}"}), 400
         logger.info(f"选择的动画动作: {action}")
         
+        # 获取输出格式参数（表单 format 参数优先，其次按 Accept 头协商）
+        output_format = select_animation_format(request.form.get('format'), request.accept_mimetypes)
+        if not output_format:
+            return jsonify({'error': f"不支持的动画格式: {request.form.get('format')}"}), 400
+        logger.info(f"选择的动画格式: {output_format}")
+        
+        # 渲染档位：preview 为几秒内完成的短、低分辨率预览，之后可通过 /jobs/<id>/promote 升级为完整动画
+        tier = request.form.get('tier', DEFAULT_ANIMATION_TIER)
+        if tier not in ANIMATION_TIERS:
+            return jsonify({'error': f"不支持的渲染档位: {tier}"}), 400
+        seed = request.form.get('seed')
+        if seed is not None:
+            if not seed.isdigit():
+                return jsonify({'error': f"种子必须是非负整数: {seed}"}), 400
+            seed = int(seed)
+        
+        # 服务端截止时间（秒），客户端只能缩短不能延长
+        timeout, error = parse_timeout(request.form.get('timeout'))
+        if error:
+            return jsonify({'error': error}), 400
+        
+        # 异步模式：立即返回任务ID，客户端通过 /jobs/<id>/events 获取进度和预览帧
+        if request.form.get('async', '').lower() in ('1', 'true'):
+            job = container.job_manager.submit('animate', run_animation, filepath, filename, action, output_format, timeout,
+                                     tier=tier, seed=seed,
+                                     params={'action': action, 'format': output_format, 'tier': tier})
+            return jsonify({
+                'success': True,
+                'job_id': job.id,
+                'status_url': f"/jobs/{job.id}",
+                'events_url': f"/jobs/{job.id}/events"
+            }), 202
+        
         # 使用ComfyUI生成动画
-        animation_path = comfyui_service.create_animation(filepath, action)
-        if not animation_path:
+        result = run_animation(filepath, filename, action, output_format, timeout, tier=tier, seed=seed)
+        if not result:
             return jsonify({'error': '动画生成失败'}), 500
             
-        return jsonify({
-            'success': True,
-            'original': f"/uploads/{filename}",
-            'animation': f"/uploads/{os.path.basename(animation_path)}"
-        })
+        return jsonify(result)
         
     except Exception as e:
         logger.error(f"处理失败: {str(e)}")
         return jsonify({'error': '动画生成失败', 'details': str(e)}), 500
 
+@app.route('/jobs/<job_id>')
+def get_job(job_id):
+    """查询后台任务状态和进度"""
+    job = container.job_manager.get(job_id)
+    if not job:
+        return jsonify({'error': f'任务不存在: {job_id}'}), 404
+    
+    data = job.to_dict()
+    if job.remote:
+        # 任务在其他工作进程中执行，进度来自共享状态
+        data['progress'] = job.progress
+    else:
+        data['progress'] = container.comfyui_service.get_progress(job.prompt_id, include_preview=False) if job.prompt_id else None
+    return jsonify(data)
+
+@app.route('/jobs/<job_id>', methods=['DELETE'])
+def cancel_job(job_id):
+    """取消后台任务，并从ComfyUI队列中移除或中断对应的工作流"""
+    job = container.job_manager.cancel(job_id, 'client')
+    if not job:
+        return jsonify({'error': f'任务不存在: {job_id}'}), 404
+    return jsonify(job.to_dict()), 202
+
+@app.route('/jobs/<job_id>/promote', methods=['POST'])
+def promote_job(job_id):
+    """把已完成的预览档动画任务升级为完整动画
+    
+    沿用预览任务的图片、动作、格式、提示词和种子（不再分析图片），只把帧数、分辨率和采样步数恢复为模板设置。
+    async=1 时立即返回新任务的ID，否则等待完成后返回结果；结果中的 total_gpu_seconds 包含预览的耗时。
+    """
+    job = container.job_manager.get(job_id)
+    if not job:
+        return jsonify({'error': f'任务不存在: {job_id}'}), 404
+    if job.kind != 'animate' or job.status != JOB_SUCCEEDED or (job.result or {}).get('tier') != 'preview' \
+            or not job.inputs:
+        return jsonify({'error': f'只能升级已完成的预览动画任务: {job_id}'}), 409
+    
+    filepath, filename, action, output_format = job.inputs['args'][:4]
+    if not os.path.exists(filepath):
+        return jsonify({'error': f'预览任务的原图已不存在: {filename}'}), 410
+    preview = {key: job.result.get(key) for key in ('prompts', 'seed', 'gpu_seconds')}
+    timeout, error = parse_timeout(request.form.get('timeout'))
+    if error:
+        return jsonify({'error': error}), 400
+    
+    if request.form.get('async', '').lower() in ('1', 'true'):
+        promoted = container.job_manager.submit('animate', run_animation, filepath, filename, action, output_format,
+                                                timeout, preview=preview,
+                                                params={'action': action, 'format': output_format,
+                                                        'tier': DEFAULT_ANIMATION_TIER, 'preview_job': job_id})
+        return jsonify({
+            'success': True,
+            'job_id': promoted.id,
+            'status_url': f"/jobs/{promoted.id}",
+            'events_url': f"/jobs/{promoted.id}/events"
+        }), 202
+    
+    result = run_animation(filepath, filename, action, output_format, timeout, preview=preview)
+    if not result:
+        return jsonify({'error': '动画生成失败'}), 500
+    return jsonify(result)
+
+@app.route('/jobs/<job_id>/events')
+def job_events(job_id):
+    """以 Server-Sent Events 推送任务的步骤进度、ETA 和低分辨率预览帧"""
+    job = container.job_manager.get(job_id)
+    if not job:
+        return jsonify({'error': f'任务不存在: {job_id}'}), 404
+    
+    def generate():
+        nonlocal job
+        # 客户端断开时生成器会被关闭，没有订阅者且未在宽限期内重连的任务将被取消
+        container.job_manager.attach_watcher(job)
+        try:
+            last_version = None
+            last_preview_version = 0
+            while not job.finished:
+                if job.remote:
+                    # 任务在其他工作进程中执行：从共享状态读取进度（没有预览帧）
+                    job, progress = container.job_manager.wait_for_remote_progress(job, last_version)
+                    if job.finished:
+                        break
+                else:
+                    progress = container.comfyui_service.wait_for_progress(job.prompt_id, last_version) if job.prompt_id else None
+                if progress is None:
+                    # 任务尚未提交到ComfyUI或正在保存输出
+                    time.sleep(0.5)
+                    continue
+                if progress['version'] == last_version:
+                    # 保持连接（同时用于发现已断开的客户端）
+                    yield ": keepalive\n\n"
+                    continue
+                
+                last_version = progress['version']
+                if progress['preview_version'] == last_preview_version:
+                    progress.pop('preview', None)
+                last_preview_version = progress['preview_version']
+                yield f"event: progress\ndata: {json.dumps(progress)}\n\n"
+            
+            yield f"event: done\ndata: {json.dumps(job.to_dict())}\n\n"
+        finally:
+            container.job_manager.detach_watcher(job)
+    
+    return Response(stream_with_context(generate()), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@app.route('/readyz')
+def readiness():
+    """就绪检查：预热完成前返回 503，负载均衡器据此暂不转发流量"""
+    status = warmup.status()
+    return jsonify(status), 200 if status['ready'] else 503
+
+@app.route('/metrics')
+def metrics_endpoint():
+    """以 Prometheus 文本格式导出指标（多进程部署时为所有工作进程的合计）"""
+    return Response(metrics.PROCESS_METRICS.render(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/debug/comfyui')
+def comfyui_debug():
+    """ComfyUI 运行状态：最近一次队列和显存采样、各模板按总耗时排序的节点类型、最近工作流的各节点耗时
+    
+    refresh=1 时先重新采样一次。
+    """
+    telemetry = container.comfyui_service.telemetry
+    telemetry.start()
+    return jsonify(telemetry.snapshot(refresh=request.args.get('refresh') == '1'))
+
 @app.route('/uploads/<filename>')
 def uploaded_file(filename):
     """提供上传文件的访问"""
@@ -209,6 +556,29 @@ def uploaded_file(filename):
     logger.info(f"文件存在，返回: {file_path}")
     return send_from_directory(app.config['UPLOAD_FOLDER'], filename)
 
+@app.route('/generate_prompts', methods=['POST'])
+def generate_prompts():
+    """根据原图和美化后的图片流式生成提示词（application/x-ndjson）
+
+    请求体为 {"original_path", "enhanced_path"}（/enhance 返回的 original 和 enhanced）。每行一个事件：
+    {"status": "partial", "stage", "delta"} 为部分结果，最后一行为 success（含完整提示词和 timings）或 error。
+    """
+    data = request.get_json(silent=True) or {}
+    paths = []
+    for field in ('original_path', 'enhanced_path'):
+        filename = os.path.basename((data.get(field) or '').split('?')[0])
+        filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
+        if not filename or not os.path.exists(filepath):
+            return jsonify({'status': 'error', 'error': f"找不到图片文件: {filename}"}), 404
+        paths.append(filepath)
+
+    def generate():
+        for event in container.llm_service.stream_prompts(*paths):
+            yield json.dumps(event, ensure_ascii=False) + "\n"
+
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
 @app.route('/generate_review', methods=['POST'])
 def generate_review():
     """生成图片评论"""
@@ -231,7 +601,7 @@ def generate_review():
             
         # 使用任务协调器生成评论
         logger.info(f"开始生成图片评论: {filepath}")
-        result = task_coordinator.process_image(filepath)
+        result = container.task_coordinator.process_image(filepath)
         
         if result.get("status") == "success":
             if result["review"]["status"] == "success":
@@ -258,4 +628,12 @@ def generate_review():
         return jsonify({'status': 'error', 'error': str(e)})
 
 if __name__ == '__main__':
-    app.run(debug=True) 
\ No newline at end of file
+    # 开发模式（单进程、reloader 和调试器）；生产环境使用 gunicorn -c gunicorn.conf.py app:app
+    debug = True
+    # 调试模式下 reloader 的父进程不处理请求，只在实际提供服务的子进程中预热
+    if not debug or os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        reset_shared_metrics()
+        configure_metrics()
+        recover_jobs()
+        configure_warmup()
+    app.run(debug=debug) 
\ No newline at end of file
@@ -0,0 +1,86 @@
+"""多动作动画：一个工作流生成 N 个动作 vs 依次提交 N 个单动作工作流的 GPU 耗时
+
+GPU 耗时取 ComfyUI 历史记录中 execution_start 到 execution_success 的时间（不含排队），
+没有这两个事件时使用提交到拿到输出的耗时。两种方式使用相同的主体和动作提示词，不调用图片分析。
+请在 ComfyUI 队列空闲时运行；先提交一次预热工作流，避免第一种方式承担模型加载时间。
+
+不指定 --comfyui 时只打印两种方式的节点数。
+
+用法：
+    python benchmarks/bench_animation_actions.py uploads/示例.png --comfyui http://localhost:8188 [--actions smile,wave,dance]
+"""
+import argparse
+import os
+import shutil
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from services.comfyui_service import (ANIMATION_ACTIONS, ANIMATION_FORMATS, ANIMATION_SAMPLER_CLASS,  # noqa: E402
+                                      ComfyUIService)
+
+
+def gpu_seconds(service, prompt_id, fallback):
+    """ComfyUI 记录的执行耗时（秒）"""
+    try:
+        history = service.session.get(f"{service.comfyui_url}/history/{prompt_id}", timeout=10).json()
+        events = {name: data.get('timestamp') for name, data in history[prompt_id]['status']['messages']}
+        if events.get('execution_start') and events.get('execution_success'):
+            return (events['execution_success'] - events['execution_start']) / 1000
+    except Exception:
+        pass
+    return fallback
+
+
+def run(service, image_name, prompts):
+    workflow = service._animation_workflow(image_name, prompts, ANIMATION_FORMATS['gif'])
+    start = time.perf_counter()
+    prompt_id = service._queue_prompt(workflow, 'animation' if len(prompts) == 1 else f"animation_x{len(prompts)}",
+                                      ANIMATION_SAMPLER_CLASS)
+    if not prompt_id or not service._wait_for_output(prompt_id):
+        return None
+    return gpu_seconds(service, prompt_id, time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('image')
+    parser.add_argument('--comfyui', help='ComfyUI 地址；不指定时只打印节点数')
+    parser.add_argument('--actions', default='smile,wave,dance')
+    parser.add_argument('--subject', default='a cute cat')
+    args = parser.parse_args()
+
+    actions = [action.strip() for action in args.actions.split(',') if action.strip()]
+    prompts = [ANIMATION_ACTIONS[action].format(subject=args.subject) for action in actions]
+    service = ComfyUIService(args.comfyui or 'http://localhost:8188')
+    image_name = os.path.basename(args.image)
+
+    single_nodes = len(service._animation_workflow(image_name, prompts[:1], ANIMATION_FORMATS['gif']))
+    multi_nodes = len(service._animation_workflow(image_name, prompts, ANIMATION_FORMATS['gif']))
+    print(f"动作: {', '.join(actions)}")
+    print(f"节点数：依次提交 {single_nodes} x {len(actions)} = {single_nodes * len(actions)}，一个工作流 {multi_nodes}")
+    if not args.comfyui:
+        return
+
+    shutil.copy2(args.image, os.path.join(service.comfyui_input_dir, image_name))
+    print("预热（加载模型）...")
+    run(service, image_name, prompts[:1])
+
+    sequential = []
+    for action, prompt in zip(actions, prompts):
+        seconds = run(service, image_name, [prompt])
+        print(f"  依次提交 {action:6s} {seconds:.1f}s" if seconds is not None else f"  依次提交 {action:6s} 失败")
+        if seconds is not None:
+            sequential.append(seconds)
+    multi = run(service, image_name, prompts)
+
+    print(f"\n{'方式':12s} {'GPU 总耗时(s)':>14s} {'每个动画(s)':>12s}")
+    if len(sequential) == len(actions):
+        print(f"{'依次提交':12s} {sum(sequential):>14.1f} {sum(sequential) / len(actions):>12.1f}")
+    if multi is not None:
+        print(f"{'一个工作流':12s} {multi:>14.1f} {multi / len(actions):>12.1f}")
+
+
+if __name__ == '__main__':
+    main()
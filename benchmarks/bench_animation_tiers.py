@@ -0,0 +1,91 @@
+"""预览档 vs 完整档动画的 GPU 耗时，以及不同保留率下每个保留动画分摊的 GPU 耗时
+
+GPU 耗时取 ComfyUI 历史记录中 execution_start 到 execution_success 的时间（不含排队），
+没有这两个事件时使用提交到拿到输出的耗时。两档使用相同的提示词和种子，不调用图片分析。
+请在 ComfyUI 队列空闲时运行；先提交一次预热工作流，避免第一档承担模型加载时间。
+
+每个保留动画分摊的 GPU 耗时（保留率 k，即用户最终想要的动画占全部请求的比例）：
+  - 只有完整档：每个请求都完整渲染，full / k
+  - 两档：每个请求先渲染预览，只有保留的升级为完整动画，preview / k + full
+
+不指定 --comfyui 时只打印两档的帧数、最长边和采样步数。
+
+用法：
+    python benchmarks/bench_animation_tiers.py uploads/示例.png --comfyui http://localhost:8188 [--keep-rates 0.2 0.5 1]
+"""
+import argparse
+import os
+import shutil
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from services.comfyui_service import (ANIMATION_ACTIONS, ANIMATION_FORMATS, ANIMATION_FRAMES_NODE,  # noqa: E402
+                                      ANIMATION_SAMPLER_CLASS, ANIMATION_SIZE_NODE, ANIMATION_TIERS, ComfyUIService)
+
+
+def gpu_seconds(service, prompt_id, fallback):
+    """ComfyUI 记录的执行耗时（秒）"""
+    try:
+        history = service.session.get(f"{service.comfyui_url}/history/{prompt_id}", timeout=10).json()
+        events = {name: data.get('timestamp') for name, data in history[prompt_id]['status']['messages']}
+        if events.get('execution_start') and events.get('execution_success'):
+            return (events['execution_success'] - events['execution_start']) / 1000
+    except Exception:
+        pass
+    return fallback
+
+
+def run(service, image_name, prompt, tier, seed):
+    workflow = service._animation_workflow(image_name, [prompt], ANIMATION_FORMATS['gif'], tier, seed)
+    start = time.perf_counter()
+    prompt_id = service._queue_prompt(workflow, service._animation_workflow_name(1, tier), ANIMATION_SAMPLER_CLASS)
+    if not prompt_id or not service._wait_for_output(prompt_id, timeout=900):
+        return None
+    return gpu_seconds(service, prompt_id, time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('image')
+    parser.add_argument('--comfyui', help='ComfyUI 地址；不指定时只打印两档的设置')
+    parser.add_argument('--action', default='wave', choices=list(ANIMATION_ACTIONS))
+    parser.add_argument('--subject', default='a cute cat')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--keep-rates', type=float, nargs='+', default=[0.2, 0.5, 1.0])
+    args = parser.parse_args()
+
+    service = ComfyUIService(args.comfyui or 'http://localhost:8188')
+    image_name = os.path.basename(args.image)
+    prompt = ANIMATION_ACTIONS[args.action].format(subject=args.subject)
+    for tier in ANIMATION_TIERS:
+        workflow = service._animation_workflow(image_name, [prompt], ANIMATION_FORMATS['gif'], tier, args.seed)
+        print(f"{tier:8s} 帧数 {workflow[ANIMATION_FRAMES_NODE]['inputs']['Number']:>3}，"
+              f"最长边 {workflow[ANIMATION_SIZE_NODE]['inputs']['Number']:>4}，"
+              f"采样步数 {workflow['144']['inputs']['steps']:>2}")
+    if not args.comfyui:
+        return
+
+    shutil.copy2(args.image, os.path.join(service.comfyui_input_dir, image_name))
+    print("预热（加载模型）...")
+    run(service, image_name, prompt, 'preview', args.seed)
+
+    seconds = {}
+    for tier in ANIMATION_TIERS:
+        seconds[tier] = run(service, image_name, prompt, tier, args.seed)
+        if seconds[tier] is None:
+            print(f"{tier} 渲染失败")
+            return
+    preview, full = seconds['preview'], seconds['full']
+    print(f"\nGPU 耗时：preview {preview:.1f}s，full {full:.1f}s（{full / preview:.1f} 倍）")
+
+    print(f"\n{'保留率':>6} {'只有完整档(s)':>14} {'两档(s)':>9} {'节省':>7}")
+    for keep_rate in args.keep_rates:
+        full_only = full / keep_rate
+        tiered = preview / keep_rate + full
+        print(f"{keep_rate:>6.0%} {full_only:>14.1f} {tiered:>9.1f} {1 - tiered / full_only:>7.0%}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,99 @@
+"""对比两次调用（百度分析 + LLM生成提示词）和单次调用（一次多模态请求）两种协调策略
+
+需要可用的百度千帆接口和本地LLM服务。对每张图片分别用两种策略完成“分析 + 提示词”阶段，
+统计延迟、token 用量和提示词质量评分。
+
+用法：
+    python benchmarks/bench_coordinator_strategies.py [图片目录] [--limit N]
+"""
+import argparse
+import os
+import re
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from agents.task_coordinator import TaskCoordinator, STRATEGY_TWO_CALL, STRATEGY_FUSED
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg')
+COLOR_WORDS = {'red', 'orange', 'yellow', 'green', 'blue', 'purple', 'pink', 'brown', 'black', 'white', 'gray', 'grey'}
+
+
+def score_prompt(raw_prompt, analysis):
+    """按 PromptGenerationAgent 的要求给提示词打分（0-1）
+
+    检查项：非空、英文、逗号分隔且无冒号和换行、以量词开头、长度适中、有颜色信息时包含颜色词。
+    """
+    raw_prompt = (raw_prompt or '').strip()
+    if not raw_prompt:
+        return 0.0
+    words = re.findall(r"[A-Za-z']+", raw_prompt)
+    checks = [
+        raw_prompt.isascii(),
+        ':' not in raw_prompt and '\n' not in raw_prompt and ',' in raw_prompt,
+        raw_prompt.lower().startswith(('a ', 'an ', 'one ', 'the ')),
+        8 <= len(words) <= 60,
+    ]
+    if analysis.get('colors'):
+        checks.append(any(w.lower() in COLOR_WORDS for w in words))
+    return sum(checks) / len(checks)
+
+
+def run_strategy(coordinator, image_path):
+    """执行“分析 + 提示词”阶段，返回 (耗时, token 数, 分数)，失败时返回None"""
+    fused = coordinator.strategy == STRATEGY_FUSED
+    start = time.perf_counter()
+    analysis = coordinator.image_analyzer.analyze_image(image_path, include_sd_prompt=fused)
+    if analysis.get('status') == 'error':
+        return None
+    prompts = coordinator.generate_prompts(analysis)
+    elapsed = time.perf_counter() - start
+    if prompts.get('status') == 'error':
+        return None
+    tokens = analysis.get('usage', {}).get('total_tokens', 0) + prompts.get('usage', {}).get('total_tokens', 0)
+    return elapsed, tokens, score_prompt(prompts.get('raw_prompt'), analysis)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('image_dir', nargs='?', default='uploads')
+    parser.add_argument('--limit', type=int, default=10)
+    args = parser.parse_args()
+
+    images = sorted(
+        os.path.join(args.image_dir, f) for f in os.listdir(args.image_dir)
+        if f.lower().endswith(IMAGE_EXTENSIONS) and not f.startswith(('enhanced_', 'animated_', 'poster_'))
+    )[:args.limit]
+    if not images:
+        print(f"目录中没有图片: {args.image_dir}")
+        return
+
+    coordinators = {name: TaskCoordinator(strategy=name) for name in (STRATEGY_TWO_CALL, STRATEGY_FUSED)}
+    results = {name: [] for name in coordinators}
+    failures = {name: 0 for name in coordinators}
+
+    for image_path in images:
+        for name, coordinator in coordinators.items():
+            result = run_strategy(coordinator, image_path)
+            if result is None:
+                failures[name] += 1
+            else:
+                results[name].append(result)
+                print(f"{name:9s} {os.path.basename(image_path)}: {result[0]:.2f}s, {result[1]} tokens, 评分 {result[2]:.2f}")
+
+    print()
+    print(f"{'策略':9s} {'成功':>4s} {'失败':>4s} {'p50(s)':>8s} {'p95(s)':>8s} {'平均token':>10s} {'平均评分':>8s}")
+    for name, rows in results.items():
+        if not rows:
+            print(f"{name:9s} {0:>4d} {failures[name]:>4d}")
+            continue
+        latencies = sorted(r[0] for r in rows)
+        p95 = latencies[min(len(latencies) - 1, int(round(0.95 * (len(latencies) - 1))))]
+        print(f"{name:9s} {len(rows):>4d} {failures[name]:>4d} {statistics.median(latencies):>8.2f} {p95:>8.2f} "
+              f"{statistics.mean(r[1] for r in rows):>10.0f} {statistics.mean(r[2] for r in rows):>8.2f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,179 @@
+"""美化请求的本地准备（预处理、写入 ComfyUI 输入目录、加载工作流）与百度/LLM 分析串行 vs 并行的耗时
+
+  - sequential：ENHANCE_PIPELINE=off，分析完成后再预处理图片、写入输入目录并准备工作流
+  - pipelined：分析期间在线程池中准备，分析完成后只填入提示词即提交
+
+上游使用模拟实现：任务协调器在本地计算感知哈希并构造分析请求的图片（与真实协调器相同），
+然后等待 --analysis-delay + --prompt-delay 秒代替百度分析和 LLM 提示词生成；ComfyUI 为本地模拟服务，
+收到工作流后立即返回一张输出图片。统计从调用 enhance_image 到 ComfyUI 收到 /prompt 的时间（提交延迟），
+每次运行前清空已写入的输入图片，避免复用上一次的预处理结果。
+测试图片为合成的手机照片（4032x3024 JPEG）和扫描件（1654x2339 PNG）。
+
+用法：
+    python benchmarks/bench_enhance_pipeline.py [--runs 5] [--analysis-delay 1.5] [--prompt-delay 1.0]
+"""
+import argparse
+import json
+import os
+import shutil
+import statistics
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from config.config import Config  # noqa: E402
+from services.comfyui_service import ComfyUIService  # noqa: E402
+from services.phash_index import image_hashes  # noqa: E402
+
+
+def make_stub_comfyui(output_dir, submissions):
+    """模拟 ComfyUI：/prompt 记录收到的时间并写入一张输出图片，/history 立即返回该输出"""
+    from PIL import Image
+
+    history = {}
+
+    class StubHandler(BaseHTTPRequestHandler):
+        def log_message(self, *args):
+            pass
+
+        def _json(self, obj):
+            body = json.dumps(obj).encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if self.path.startswith('/history/'):
+                prompt_id = self.path.rsplit('/', 1)[-1]
+                self._json({prompt_id: history[prompt_id]} if prompt_id in history else {})
+            elif self.path == '/queue':
+                self._json({'queue_running': [], 'queue_pending': []})
+            else:
+                self.send_response(404)
+                self.end_headers()
+
+        def do_POST(self):
+            submissions.append(time.perf_counter())
+            self.rfile.read(int(self.headers['Content-Length']))
+            prompt_id = str(uuid.uuid4())
+            Image.new('RGB', (64, 64), 'white').save(os.path.join(output_dir, f"{prompt_id}.png"))
+            history[prompt_id] = {'status': {'status_str': 'success', 'messages': []},
+                                  'outputs': {'42': {'images': [{'filename': f"{prompt_id}.png", 'subfolder': ''}]}}}
+            self._json({'prompt_id': prompt_id})
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StubHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+class StubCoordinator:
+    """模拟任务协调器：本地步骤与真实协调器相同，上游调用用固定延迟代替"""
+
+    def __init__(self, analysis_delay, prompt_delay):
+        self.analysis_delay = analysis_delay
+        self.prompt_delay = prompt_delay
+
+    def process_image(self, image_path, image=None):
+        image_hashes(image.working())
+        image.analysis_base64()
+        time.sleep(self.analysis_delay)
+        time.sleep(self.prompt_delay)
+        return {'status': 'success', 'prompts': {'positive_prompt': 'a cute cartoon character, sticker style',
+                                                 'negative_prompt': 'lowres, blurry'}}
+
+
+def make_images(directory):
+    """生成一张彩笔画的手机照片（JPEG）和一张扫描件（PNG）"""
+    import numpy as np
+    from PIL import Image, ImageDraw
+
+    rng = np.random.default_rng(0)
+    paths = []
+    for name, size in (('bench_pipeline_photo.jpg', (4032, 3024)), ('bench_pipeline_scan.png', (1654, 2339))):
+        image = Image.new('RGB', size, (238, 232, 220))
+        draw = ImageDraw.Draw(image)
+        for _ in range(40):
+            x, y = rng.integers(0, size[0]), rng.integers(0, size[1])
+            color = tuple(int(c) for c in rng.integers(0, 255, 3))
+            draw.ellipse([x, y, x + rng.integers(80, 500), y + rng.integers(80, 500)], outline=color, width=14)
+        path = os.path.join(directory, name)
+        if name.endswith('.jpg'):
+            noise = rng.normal(0, 6, (size[1], size[0], 3))
+            image = Image.fromarray(np.clip(np.asarray(image, dtype=np.float32) + noise, 0, 255).astype(np.uint8))
+            image.save(path, 'JPEG', quality=92)
+        else:
+            image.save(path, 'PNG')
+        paths.append(path)
+    return paths
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--analysis-delay', type=float, default=1.5, help='模拟的百度分析耗时（秒）')
+    parser.add_argument('--prompt-delay', type=float, default=1.0, help='模拟的 LLM 提示词生成耗时（秒）')
+    args = parser.parse_args()
+
+    os.chdir(ROOT)
+    with tempfile.TemporaryDirectory() as directory:
+        comfyui_root = os.path.join(directory, 'ComfyUI')
+        os.makedirs(os.path.join(comfyui_root, 'output'))
+
+        class BenchConfig(Config):
+            COMFYUI_ROOT = comfyui_root
+            COMFYUI_TELEMETRY_INTERVAL = 0
+            COMFYUI_CACHE_AFFINITY = False
+
+        submissions = []
+        server = make_stub_comfyui(os.path.join(comfyui_root, 'output'), submissions)
+        service = ComfyUIService(f"http://127.0.0.1:{server.server_port}",
+                                 task_coordinator=StubCoordinator(args.analysis_delay, args.prompt_delay),
+                                 config=BenchConfig)
+        # 模拟服务没有 websocket，不启动进度监听
+        service.progress_tracker.start = lambda: None
+        images = make_images(directory)
+        upstream = args.analysis_delay + args.prompt_delay
+
+        print(f"模拟上游耗时 {upstream:.2f}s（分析 {args.analysis_delay}s + 提示词 {args.prompt_delay}s），每种方式 {args.runs} 次")
+        print(f"{'图片':28s} {'mode':>10} {'提交延迟(ms)':>13} {'其中本地(ms)':>13}")
+        try:
+            for path in images:
+                results = {}
+                for mode in ('sequential', 'pipelined'):
+                    service.enhance_pipeline = mode == 'pipelined'
+                    latencies = []
+                    for _ in range(args.runs):
+                        service._staged_inputs.clear()
+                        service._evict_inputs(force=True)
+                        start = time.perf_counter()
+                        submitted = len(submissions)
+                        if not service.enhance_image(path, 60, preset='best'):
+                            print(f"{os.path.basename(path):28s} {mode:>10} 失败")
+                            break
+                        latencies.append((submissions[submitted] - start) * 1000)
+                    if not latencies:
+                        continue
+                    median = statistics.median(latencies)
+                    results[mode] = median
+                    print(f"{os.path.basename(path):28s} {mode:>10} {median:>13.0f} {median - upstream * 1000:>13.0f}")
+                if len(results) == 2:
+                    print(f"{'':28s} {'节省':>10} {results['sequential'] - results['pipelined']:>13.0f}")
+        finally:
+            for path in images:
+                enhanced = os.path.join('uploads', f"enhanced_{os.path.basename(path)}")
+                if os.path.exists(enhanced):
+                    os.remove(enhanced)
+            shutil.rmtree(service.comfyui_input_dir, ignore_errors=True)
+            server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
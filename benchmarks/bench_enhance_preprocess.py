@@ -0,0 +1,105 @@
+"""美化任务的 CPU 预处理效果和 GPU 耗时对比
+
+对目录中的每张图片统计预处理耗时、裁剪比例、送入 ComfyUI 的像素数和是否判定为干净扫描件。
+指定 --comfyui 时，再对每张图片依次运行三种工作流并统计 ComfyUI 执行耗时（请在队列空闲时运行）：
+
+- original：原图 + 原工作流（改动前的行为）
+- full：预处理后的图片 + 完整工作流
+- light：预处理后的图片 + 轻量工作流（去掉第二遍放大采样和 GPU 去背景）
+
+用法：
+    python benchmarks/bench_enhance_preprocess.py [图片目录] [--comfyui http://localhost:8188] [--limit N]
+"""
+import argparse
+import os
+import shutil
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from PIL import Image
+
+from services.image_preprocess import preprocess_drawing
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg')
+POSITIVE_PROMPT = "a cute cartoon character, children's drawing, colorful, sticker style"
+NEGATIVE_PROMPT = "lowres, bad anatomy, blurry, watermark"
+
+
+def run_workflow(service, image_name, size=None, light=False):
+    """提交一次美化工作流，返回 ComfyUI 执行耗时（秒），失败时返回None"""
+    workflow = service._load_workflow('enhance_workflow.json')
+    workflow["50"]["inputs"]["image"] = image_name
+    workflow["6"]["inputs"]["text"] = POSITIVE_PROMPT
+    workflow["7"]["inputs"]["text"] = NEGATIVE_PROMPT
+    if size:
+        service._apply_enhance_variant(workflow, size, light)
+    start = time.perf_counter()
+    prompt_id = service._queue_prompt(workflow, 'bench')
+    if not prompt_id or not service._wait_for_output(prompt_id):
+        return None
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('image_dir', nargs='?', default='uploads')
+    parser.add_argument('--comfyui', help='ComfyUI 地址；不指定时只统计 CPU 预处理')
+    parser.add_argument('--limit', type=int, default=20)
+    args = parser.parse_args()
+
+    images = sorted(
+        f for f in os.listdir(args.image_dir)
+        if f.lower().endswith(IMAGE_EXTENSIONS) and not f.startswith(('enhanced_', 'animated_', 'poster_'))
+    )[:args.limit]
+    service = None
+    if args.comfyui:
+        from services.comfyui_service import ComfyUIService
+        service = ComfyUIService(args.comfyui)
+    output_dir = service.comfyui_input_dir if service else os.path.join('uploads', 'preprocess_bench')
+    os.makedirs(output_dir, exist_ok=True)
+
+    print(f"{'图片':36s} {'预处理ms':>9s} {'原始像素':>10s} {'输出像素':>9s} {'裁剪保留':>8s} {'扫描件':>6s}"
+          + (f" {'original':>9s} {'full':>7s} {'light':>7s}" if service else ''))
+    timings = {'original': [], 'full': [], 'light': []}
+    for name in images:
+        path = os.path.join(args.image_dir, name)
+        prepared_name = f"prep_{os.path.splitext(name)[0]}.png"
+        result = preprocess_drawing(path, os.path.join(output_dir, prepared_name))
+        if result is None:
+            continue
+        left, top, right, bottom = result['crop_box']
+        kept = (right - left) * (bottom - top) / float(result['original_size'][0] * result['original_size'][1])
+        line = (f"{name[:36]:36s} {result['seconds'] * 1000:>9.0f} {result['original_size'][0] * result['original_size'][1]:>10d} "
+                f"{result['size'][0] * result['size'][1]:>9d} {kept:>8.0%} {'是' if result['clean_scan'] else '否':>6s}")
+        if service:
+            original_name = f"orig_{name}"
+            with Image.open(path) as img:
+                img.convert('RGB').save(os.path.join(output_dir, original_name), 'PNG')
+            runs = {
+                'original': run_workflow(service, original_name),
+                'full': run_workflow(service, prepared_name, result['size']),
+                'light': run_workflow(service, prepared_name, result['size'], light=True)
+            }
+            for variant, seconds in runs.items():
+                if seconds is not None:
+                    timings[variant].append(seconds)
+            line += ''.join(f" {seconds if seconds is not None else float('nan'):>{w}.1f}"
+                            for seconds, w in zip(runs.values(), (9, 7, 7)))
+        print(line)
+
+    if service and timings['original']:
+        baseline = statistics.mean(timings['original'])
+        print()
+        for variant, values in timings.items():
+            if values:
+                mean = statistics.mean(values)
+                print(f"{variant:9s} 平均 {mean:.1f}s，相对 original 节省 {baseline - mean:.1f}s/张")
+    if not service:
+        shutil.rmtree(output_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,95 @@
+"""美化预设（fast/balanced/best）的 GPU 耗时，以及不同队列长度和预算下的预设选择
+
+不指定 --comfyui 时只打印预设参数和按各预设预计耗时模拟出的选择表；
+指定时对每张图片依次运行各预设并统计 ComfyUI 执行耗时（请在队列空闲时运行）。
+
+用法：
+    python benchmarks/bench_enhance_presets.py [图片目录] [--comfyui http://localhost:8188] [--limit N]
+"""
+import argparse
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from services.comfyui_service import ComfyUIService, ENHANCE_PRESETS, ENHANCE_PRESET_ORDER
+from services.image_preprocess import preprocess_drawing
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg')
+POSITIVE_PROMPT = "a cute cartoon character, children's drawing, colorful, sticker style"
+NEGATIVE_PROMPT = "lowres, bad anatomy, blurry, watermark"
+
+
+def run_preset(service, image_name, size, preset):
+    """提交一次美化工作流，返回 ComfyUI 执行耗时（秒），失败时返回None"""
+    workflow = service._load_workflow('enhance_workflow.json')
+    workflow["50"]["inputs"]["image"] = image_name
+    workflow["6"]["inputs"]["text"] = POSITIVE_PROMPT
+    workflow["7"]["inputs"]["text"] = NEGATIVE_PROMPT
+    service._apply_enhance_variant(workflow, size, False, preset)
+    start = time.perf_counter()
+    prompt_id = service._queue_prompt(workflow, f"enhance_{preset}")
+    if not prompt_id or not service._wait_for_output(prompt_id):
+        return None
+    return time.perf_counter() - start
+
+
+def print_choice_table(service, seconds_per_job):
+    """模拟不同队列长度（每个任务 seconds_per_job 秒）和预算下自动选择的预设"""
+    budgets = (30, 60, 90, 180)
+    print(f"\n自动选择（队列中每个任务按 {seconds_per_job:.0f} 秒估算）")
+    print(f"{'队列长度':>8s} " + ''.join(f"{f'预算{b}s':>10s}" for b in budgets))
+    for depth in (0, 1, 2, 4, 8):
+        service._estimate_queue_wait = lambda: depth * seconds_per_job
+        print(f"{depth:>8d} " + ''.join(f"{service.choose_enhance_preset(b):>10s}" for b in budgets))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('image_dir', nargs='?', default='uploads')
+    parser.add_argument('--comfyui', help='ComfyUI 地址；不指定时只打印预设和模拟的选择表')
+    parser.add_argument('--limit', type=int, default=5)
+    args = parser.parse_args()
+
+    print(f"{'预设':9s} {'步数':>8s} {'放大':>6s} {'调度器':>8s} {'预计(s)':>8s}")
+    for name in ENHANCE_PRESET_ORDER:
+        config = ENHANCE_PRESETS[name]
+        steps = f"{config['steps']}+{config['second_steps']}" if config['second_steps'] else str(config['steps'])
+        print(f"{name:9s} {steps:>8s} {config['second_pass_scale']:>6.2f} {config['scheduler'] or '原设置':>8s} "
+              f"{config['estimated_seconds']:>8d}")
+
+    service = ComfyUIService(args.comfyui or 'http://localhost:8188')
+    if args.comfyui:
+        images = sorted(
+            f for f in os.listdir(args.image_dir)
+            if f.lower().endswith(IMAGE_EXTENSIONS) and not f.startswith(('enhanced_', 'animated_', 'poster_'))
+        )[:args.limit]
+        timings = {name: [] for name in ENHANCE_PRESET_ORDER}
+        print(f"\n{'图片':36s} " + ''.join(f"{name:>10s}" for name in ENHANCE_PRESET_ORDER))
+        for name in images:
+            prepared_name = f"prep_{os.path.splitext(name)[0]}.png"
+            result = preprocess_drawing(os.path.join(args.image_dir, name),
+                                        os.path.join(service.comfyui_input_dir, prepared_name))
+            if result is None:
+                continue
+            row = []
+            for preset in ENHANCE_PRESET_ORDER:
+                seconds = run_preset(service, prepared_name, result['size'], preset)
+                if seconds is not None:
+                    timings[preset].append(seconds)
+                row.append(seconds if seconds is not None else float('nan'))
+            print(f"{name[:36]:36s} " + ''.join(f"{seconds:>10.1f}" for seconds in row))
+
+        print()
+        for preset, values in timings.items():
+            if values:
+                print(f"{preset:9s} 平均 {statistics.mean(values):.1f}s")
+                service._avg_job_seconds[f"enhance_{preset}"] = statistics.mean(values)
+
+    print_choice_table(service, ENHANCE_PRESETS['best']['estimated_seconds'])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,104 @@
+"""一次生成 N 张候选美化图（latent 批次）时每张候选图分摊的 GPU 耗时
+
+每个 N 提交一次美化工作流（ComfyUIService._apply_enhance_variant 插入 RepeatLatentBatch），
+GPU 耗时取 ComfyUI 历史记录中 execution_start 到 execution_success 的时间（不含排队），
+没有这两个事件时使用提交到拿到输出的耗时。所有 N 使用相同的提示词和降噪值，不调用图片分析；
+输入图片使用不同的文件名，避免后一次运行复用前一次的 VAE 编码缓存。请在 ComfyUI 队列空闲时运行，
+先提交一次预热工作流，避免第一个 N 承担模型加载时间。
+
+不指定 --comfyui 时只打印各 N 的工作流节点数和批次节点。
+
+用法：
+    python benchmarks/bench_enhance_variants.py uploads/示例.png --comfyui http://localhost:8188 [--variants 1 2 4] [--preset best]
+"""
+import argparse
+import os
+import sys
+import time
+import uuid
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from services.comfyui_service import (ENHANCE_BATCH_NODE, ENHANCE_PRESETS, ENHANCE_SAMPLER_CLASS,  # noqa: E402
+                                      ComfyUIService)
+from services.image_preprocess import preprocess_drawing  # noqa: E402
+
+POSITIVE_PROMPT = "a cute cartoon character, children's drawing, colorful, sticker style"
+NEGATIVE_PROMPT = "lowres, bad anatomy, blurry, watermark"
+
+
+def build(service, input_name, size, preset, variants):
+    workflow = service._load_workflow('enhance_workflow.json')
+    workflow["50"]["inputs"]["image"] = input_name
+    workflow["6"]["inputs"]["text"] = POSITIVE_PROMPT
+    workflow["7"]["inputs"]["text"] = NEGATIVE_PROMPT
+    service._apply_enhance_variant(workflow, size, False, preset, variants)
+    return workflow
+
+
+def gpu_seconds(service, prompt_id, fallback):
+    """ComfyUI 记录的执行耗时（秒）"""
+    try:
+        history = service.session.get(f"{service.comfyui_url}/history/{prompt_id}", timeout=10).json()
+        events = {name: data.get('timestamp') for name, data in history[prompt_id]['status']['messages']}
+        if events.get('execution_start') and events.get('execution_success'):
+            return (events['execution_success'] - events['execution_start']) / 1000
+    except Exception:
+        pass
+    return fallback
+
+
+def run(service, image, preset, variants):
+    """提交一次 N 张候选图的工作流，返回 (输出图片数, GPU 耗时秒)"""
+    input_name = f"bench_{uuid.uuid4().hex[:8]}.png"
+    path = os.path.join(service.comfyui_input_dir, input_name)
+    size = (preprocess_drawing(image, path) or {}).get('size')
+    try:
+        workflow = build(service, input_name, size, preset, variants)
+        start = time.perf_counter()
+        name = f"enhance_{preset}" if variants == 1 else f"enhance_{preset}_x{variants}"
+        prompt_id = service._queue_prompt(workflow, name, ENHANCE_SAMPLER_CLASS)
+        output = prompt_id and service._wait_for_output(prompt_id)
+        if not output:
+            return None
+        return len(output), gpu_seconds(service, prompt_id, time.perf_counter() - start)
+    finally:
+        os.remove(path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('image')
+    parser.add_argument('--comfyui', help='ComfyUI 地址；不指定时只打印工作流结构')
+    parser.add_argument('--variants', type=int, nargs='+', default=[1, 2, 4])
+    parser.add_argument('--preset', default='best', choices=list(ENHANCE_PRESETS))
+    args = parser.parse_args()
+
+    service = ComfyUIService(args.comfyui or 'http://localhost:8188')
+    for variants in args.variants:
+        workflow = build(service, os.path.basename(args.image), None, args.preset, variants)
+        batch = workflow.get(ENHANCE_BATCH_NODE, {}).get('inputs', {}).get('amount', 1)
+        print(f"N={variants}: {len(workflow)} 个节点，latent 批次 {batch}")
+    if not args.comfyui:
+        return
+
+    print("预热（加载模型）...")
+    run(service, args.image, args.preset, 1)
+
+    print(f"\n{'N':>3} {'输出':>5} {'GPU 总耗时(s)':>14} {'每张(s)':>9} {'相对 N=1':>9}")
+    single = None
+    for variants in args.variants:
+        result = run(service, args.image, args.preset, variants)
+        if result is None:
+            print(f"{variants:>3} {'失败':>5}")
+            continue
+        count, seconds = result
+        per_variant = seconds / variants
+        if variants == 1:
+            single = per_variant
+        ratio = f"{per_variant / single:>8.2f}x" if single else f"{'-':>9}"
+        print(f"{variants:>3} {count:>5} {seconds:>14.1f} {per_variant:>9.1f} {ratio}")
+
+
+if __name__ == '__main__':
+    main()
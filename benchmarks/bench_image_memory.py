@@ -0,0 +1,151 @@
+"""并发处理大尺寸上传图片时的峰值内存（RSS）
+
+每个并发任务执行一次美化请求在本地的图片处理：感知哈希、构造分析请求（base64 + JSON）、
+调色板提取和美化预处理，构造好的分析请求在模拟的上游延迟期间一直保留（与等待百度返回时相同）。
+
+  - before：各步骤各自打开原图，分析请求发送整个文件的 base64
+  - after：每个任务一个 SharedImage（只解码一次，大图发送工作分辨率的 JPEG），按进程内存预算放行
+
+每种方式和并发数在独立的子进程中运行，峰值 RSS 为子进程的 VmHWM 减去导入完成后的 RSS
+（ru_maxrss 会继承父进程的峰值，不能使用）。
+测试图片为合成的手机照片（4032x3024 JPEG）和截图（2400x3200 RGBA PNG），各占一半。
+
+用法：
+    python benchmarks/bench_image_memory.py [--concurrency 1 10 50] [--budget-mb 512] [--upstream-delay 0.5]
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+
+def make_images(directory):
+    """生成一张白纸彩笔画的手机照片（JPEG）和一张带透明背景的截图（PNG）"""
+    import numpy as np
+    from PIL import Image, ImageDraw
+
+    rng = np.random.default_rng(0)
+    paths = []
+    for name, size, mode in (('photo.jpg', (4032, 3024), 'RGB'), ('screenshot.png', (2400, 3200), 'RGBA')):
+        image = Image.new(mode, size, (238, 232, 220, 255) if mode == 'RGB' else (0, 0, 0, 0))
+        draw = ImageDraw.Draw(image)
+        for _ in range(60):
+            x, y = rng.integers(0, size[0]), rng.integers(0, size[1])
+            color = tuple(int(c) for c in rng.integers(0, 255, 3)) + (255,)
+            draw.ellipse([x, y, x + rng.integers(80, 600), y + rng.integers(80, 600)], outline=color, width=18)
+        if mode == 'RGB':
+            # 拍照的纸纹和噪声，让 JPEG 大小接近真实照片
+            noise = rng.normal(0, 6, (size[1], size[0], 3))
+            image = Image.fromarray(np.clip(np.asarray(image, dtype=np.float32) + noise, 0, 255).astype(np.uint8))
+            image.save(os.path.join(directory, name), 'JPEG', quality=92)
+        else:
+            image.save(os.path.join(directory, name), 'PNG')
+        paths.append(os.path.join(directory, name))
+    return paths
+
+
+def proc_status_kb(field):
+    """/proc/self/status 中的内存字段（KB）：VmRSS 为当前 RSS，VmHWM 为本进程（exec 之后）的峰值 RSS"""
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith(field + ':'):
+                return int(line.split()[1])
+    return 0
+
+
+def worker(mode, concurrency, images, budget_mb, delay):
+    """子进程：并发执行 concurrency 个任务，输出 JSON 结果"""
+    import base64
+
+    from services.image_memory import MemoryBudget, SharedImage
+    from services.image_preprocess import preprocess_drawing
+    from services.palette_extractor import extract_palette
+    from services.phash_index import hash_file, image_hashes
+
+    budget = MemoryBudget(budget_mb * 1024 * 1024, wait_seconds=600)
+    output_dir = tempfile.mkdtemp()
+    baseline = proc_status_kb('VmRSS')
+    errors = []
+
+    def request_body(img_base64):
+        return json.dumps({"model": "ernie-4.5-8k-preview", "messages": [{"role": "user", "content": [
+            {"type": "text", "text": "请分析这幅儿童涂鸦"}, {"type": "image_url", "image_url": {"url": img_base64}}]}]})
+
+    def job(index):
+        path = images[index % len(images)]
+        output = os.path.join(output_dir, f"{index}.png")
+        try:
+            if mode == 'before':
+                hash_file(path)
+                with open(path, 'rb') as f:
+                    payload = request_body(base64.b64encode(f.read()).decode())
+                time.sleep(delay)
+                extract_palette(path)
+                preprocess_drawing(path, output)
+            else:
+                with SharedImage(path, budget) as image:
+                    image_hashes(image.working())
+                    payload = request_body(image.analysis_base64())
+                    time.sleep(delay)
+                    extract_palette(path, image=image.working())
+                    preprocess_drawing(path, output, image)
+            del payload
+        except Exception as e:
+            errors.append(str(e))
+
+    start = time.perf_counter()
+    threads = [threading.Thread(target=job, args=(i,)) for i in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    peak = proc_status_kb('VmHWM')
+    print(json.dumps({'peak_mb': (peak - baseline) / 1024, 'seconds': elapsed, 'errors': len(errors),
+                      'estimated_mb': [SharedImage(p).estimated_bytes / 2 ** 20 for p in images]}))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 10, 50])
+    parser.add_argument('--budget-mb', type=int, default=512, help='after 方式的进程内存预算（MB）')
+    parser.add_argument('--upstream-delay', type=float, default=0.5, help='模拟的分析请求耗时（秒）')
+    parser.add_argument('--worker', nargs=2, help=argparse.SUPPRESS)
+    parser.add_argument('--images', nargs='+', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        worker(args.worker[0], int(args.worker[1]), args.images, args.budget_mb, args.upstream_delay)
+        return
+
+    with tempfile.TemporaryDirectory() as directory:
+        images = make_images(directory)
+        sizes = ', '.join(f"{os.path.basename(p)} {os.path.getsize(p) / 2 ** 20:.1f}MB" for p in images)
+        print(f"测试图片: {sizes}；内存预算 {args.budget_mb}MB，模拟上游延迟 {args.upstream_delay}s")
+        print(f"{'mode':>7} {'并发':>5} {'峰值 RSS 增量(MB)':>18} {'耗时(s)':>9} {'失败':>5}")
+        for concurrency in args.concurrency:
+            for mode in ('before', 'after'):
+                output = subprocess.run(
+                    [sys.executable, os.path.abspath(__file__), '--worker', mode, str(concurrency),
+                     '--budget-mb', str(args.budget_mb), '--upstream-delay', str(args.upstream_delay),
+                     '--images', *images],
+                    capture_output=True, text=True, cwd=ROOT
+                )
+                if output.returncode != 0:
+                    print(f"{mode:>7} {concurrency:>5} 失败: {output.stderr.strip().splitlines()[-1:]}")
+                    continue
+                result = json.loads(output.stdout.strip().splitlines()[-1])
+                print(f"{mode:>7} {concurrency:>5} {result['peak_mb']:>18.0f} {result['seconds']:>9.1f} "
+                      f"{result['errors']:>5}")
+        print(f"after 方式每个任务的预计内存: {', '.join(f'{mb:.0f}MB' for mb in result['estimated_mb'])}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,122 @@
+"""提示词生成链路（LLMService.generate_prompts）在非流式和流式模式下的首个 token 延迟和总耗时
+
+  - first_token：调用方拿到第一个 token 的时间；非流式模式下等于第一段全部生成完
+  - enhancement：第一段（图片描述）完成的时间
+  - total：两段全部完成的时间
+
+默认启动一个模拟 Ollama /api/generate 的本地服务（预填充延迟 + 固定生成速度，流式时按 NDJSON
+分块返回），不需要 GPU；指定 --llm 时改为测试真实服务。
+
+用法：
+    python benchmarks/bench_llm_streaming.py [--image uploads/示例.png] [--runs 5]
+    python benchmarks/bench_llm_streaming.py --image uploads/示例.png --llm http://localhost:11434 --model llava
+"""
+import argparse
+import json
+import os
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from services.llm_service import LLMService  # noqa: E402
+
+
+def make_stub_handler(prefill, image_prefill, tokens_per_second, tokens):
+    class StubHandler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def log_message(self, *args):
+            pass
+
+        def do_POST(self):
+            body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+            # 带图片的请求预填充更慢，生成的 token 也更多
+            delay = prefill + image_prefill * len(body.get('images', []))
+            count = tokens * 2 if body.get('images') else tokens
+            time.sleep(delay)
+            if not body.get('stream'):
+                time.sleep(count / tokens_per_second)
+                payload = json.dumps({'response': '字' * count, 'done': True, 'eval_count': count}).encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+                return
+
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/x-ndjson')
+            self.send_header('Transfer-Encoding', 'chunked')
+            self.end_headers()
+            for i in range(count):
+                self._chunk({'response': '字', 'done': False})
+                time.sleep(1 / tokens_per_second)
+            self._chunk({'response': '', 'done': True, 'eval_count': count})
+            self.wfile.write(b'0\r\n\r\n')
+
+        def _chunk(self, data):
+            line = json.dumps(data).encode() + b'\n'
+            self.wfile.write(f"{len(line):x}\r\n".encode() + line + b'\r\n')
+            self.wfile.flush()
+
+    return StubHandler
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--image', help='测试图片（同时作为原图和美化图），默认使用一个占位文件')
+    parser.add_argument('--llm', help='真实的本地LLM地址，不指定时使用模拟服务')
+    parser.add_argument('--model', default='default')
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--prefill', type=float, default=0.2, help='模拟服务：文本预填充耗时（秒）')
+    parser.add_argument('--image-prefill', type=float, default=0.6, help='模拟服务：每张图片的预填充耗时（秒）')
+    parser.add_argument('--tokens-per-second', type=float, default=40, help='模拟服务：生成速度')
+    parser.add_argument('--tokens', type=int, default=80, help='模拟服务：第二段的 token 数（第一段加倍）')
+    args = parser.parse_args()
+
+    server = None
+    llm_url = args.llm
+    if not llm_url:
+        server = ThreadingHTTPServer(('127.0.0.1', 0), make_stub_handler(
+            args.prefill, args.image_prefill, args.tokens_per_second, args.tokens))
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        llm_url = f"http://127.0.0.1:{server.server_port}"
+
+    with tempfile.NamedTemporaryFile(suffix='.png') as placeholder:
+        image = args.image
+        if not image:
+            placeholder.write(b'\x89PNG\r\n\x1a\n' + b'\0' * 1024)
+            placeholder.flush()
+            image = placeholder.name
+
+        service = LLMService(llm_url, args.model)
+        print(f"{'模拟服务' if server else llm_url}，每种模式 {args.runs} 轮（中位数）")
+        print(f"{'mode':>9} {'first_token s':>14} {'enhancement s':>14} {'total s':>8} {'failures':>9}")
+        for mode, stream in (('blocking', False), ('stream', True)):
+            samples, failures = [], 0
+            for _ in range(args.runs):
+                result = service.generate_prompts(image, image, stream=stream)
+                if result is None:
+                    failures += 1
+                else:
+                    samples.append(result['timings'])
+            if not samples:
+                print(f"{mode:>9} {'-':>14} {'-':>14} {'-':>8} {failures:>9}")
+                continue
+            medians = {key: statistics.median(sample[key] for sample in samples)
+                       for key in ('first_token_seconds', 'enhancement_seconds', 'total_seconds')}
+            print(f"{mode:>9} {medians['first_token_seconds']:>14.3f} {medians['enhancement_seconds']:>14.3f} "
+                  f"{medians['total_seconds']:>8.3f} {failures:>9}")
+
+    if server:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
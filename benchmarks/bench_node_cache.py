@@ -0,0 +1,79 @@
+"""同一张图片连续美化（如 /adjust 只改降噪值）时 ComfyUI 节点缓存的命中数和执行耗时
+
+  - fresh：旧方式，每次以新的文件名写入输入图片，用完删除
+  - stable：按内容哈希命名并保留输入图片（ComfyUIService._stage_input）
+
+每种方式依次提交 --denoise 中的各降噪值，统计每个工作流的 execution_cached 节点数和
+execution_start 到 execution_success 的耗时。请在 ComfyUI 队列空闲时运行。
+
+用法：
+    python benchmarks/bench_node_cache.py uploads/示例.png --comfyui http://localhost:8188 [--denoise 60 50 40]
+"""
+import argparse
+import os
+import sys
+import time
+import uuid
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from services.comfyui_service import ENHANCE_SAMPLER_CLASS, ComfyUIService  # noqa: E402
+from services.image_preprocess import preprocess_drawing  # noqa: E402
+
+POSITIVE_PROMPT = "a cute cartoon character, children's drawing, colorful, sticker style"
+NEGATIVE_PROMPT = "lowres, bad anatomy, blurry, watermark"
+
+
+def run(service, input_name, size, denoise):
+    """提交一次美化工作流，返回 (命中缓存的节点数, 节点总数, 执行耗时秒)"""
+    workflow = service._load_workflow('enhance_workflow.json')
+    workflow["50"]["inputs"]["image"] = input_name
+    workflow["48"]["inputs"]["float_value"] = denoise / 100.0
+    workflow["6"]["inputs"]["text"] = POSITIVE_PROMPT
+    workflow["7"]["inputs"]["text"] = NEGATIVE_PROMPT
+    service._apply_enhance_variant(workflow, size, False, 'best')
+    start = time.perf_counter()
+    prompt_id = service._queue_prompt(workflow, 'enhance_best', ENHANCE_SAMPLER_CLASS)
+    if not prompt_id or not service._wait_for_output(prompt_id):
+        return None
+    elapsed = time.perf_counter() - start
+    info = service.session.get(f"{service.comfyui_url}/history/{prompt_id}", timeout=10).json()[prompt_id]
+    cached, total = service._record_cache_hits(prompt_id, info)
+    events = {name: data.get('timestamp') for name, data in info['status']['messages']}
+    if events.get('execution_start') and events.get('execution_success'):
+        elapsed = (events['execution_success'] - events['execution_start']) / 1000
+    return cached, total, elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('image')
+    parser.add_argument('--comfyui', default='http://localhost:8188')
+    parser.add_argument('--denoise', type=float, nargs='+', default=[60, 50, 40])
+    args = parser.parse_args()
+
+    service = ComfyUIService(args.comfyui)
+    print(f"{'mode':>7} {'denoise':>8} {'cached':>8} {'seconds':>8}")
+    for mode in ('fresh', 'stable'):
+        # 先运行一个无关的工作流，两种方式都从冷缓存开始
+        service.warm_up('enhance')
+        for denoise in args.denoise:
+            if mode == 'fresh':
+                input_name = f"bench_{uuid.uuid4().hex[:8]}.png"
+                path = os.path.join(service.comfyui_input_dir, input_name)
+                size = (preprocess_drawing(args.image, path) or {}).get('size')
+            else:
+                input_name, metadata = service._stage_input(args.image, 'enhance', preprocess_drawing)
+                size = (metadata or {}).get('size')
+            result = run(service, input_name, size, denoise)
+            if mode == 'fresh':
+                os.remove(os.path.join(service.comfyui_input_dir, input_name))
+            if result is None:
+                print(f"{mode:>7} {denoise:>8.0f} {'失败':>8}")
+                continue
+            cached, total, seconds = result
+            print(f"{mode:>7} {denoise:>8.0f} {f'{cached}/{total}':>8} {seconds:>8.1f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,83 @@
+"""本地调色板提取的单张耗时（区分解码和聚类），以及对模型颜色字段的补全情况
+
+默认先生成几张大尺寸的合成图片（4032x3024 JPEG、2400x2400 PNG、带透明通道的 PNG），
+再测试指定目录中的图片。
+
+用法：
+    python benchmarks/bench_palette.py [图片目录] [--repeat 5]
+"""
+import argparse
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np
+from PIL import Image
+
+from services.palette_extractor import extract_palette, _load_pixels
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg')
+
+
+def synthetic_images(directory):
+    """生成白纸上有几块彩色涂鸦的大图"""
+    rng = np.random.default_rng(0)
+    specs = [('photo_4032x3024.jpg', (3024, 4032), 'RGB'), ('scan_2400x2400.png', (2400, 2400), 'RGB'),
+             ('transparent_2048x2048.png', (2048, 2048), 'RGBA')]
+    paths = []
+    for name, (height, width), mode in specs:
+        pixels = np.full((height, width, len(mode)), 235, dtype=np.uint8)
+        if mode == 'RGBA':
+            pixels[..., 3] = 0
+        for color in ((40, 80, 200), (240, 200, 30), (220, 50, 40)):
+            y, x = rng.integers(0, height // 2), rng.integers(0, width // 2)
+            pixels[y:y + height // 3, x:x + width // 4, :3] = color
+            if mode == 'RGBA':
+                pixels[y:y + height // 3, x:x + width // 4, 3] = 255
+        path = os.path.join(directory, name)
+        Image.fromarray(pixels, mode).save(path, quality=90) if name.endswith('.jpg') else Image.fromarray(pixels, mode).save(path)
+        paths.append(path)
+    return paths
+
+
+def bench(path, repeat):
+    totals, decodes = [], []
+    palette = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        with Image.open(path) as img:
+            _load_pixels(img)
+        decodes.append(time.perf_counter() - start)
+        start = time.perf_counter()
+        palette = extract_palette(path)
+        totals.append(time.perf_counter() - start)
+    with Image.open(path) as img:
+        size = img.size
+    total, decode = statistics.median(totals), statistics.median(decodes)
+    names = ', '.join(f"{e['name']}{e['ratio']:.0%}" for e in palette or [])
+    print(f"{os.path.basename(path)[:36]:36s} {size[0]:>5d}x{size[1]:<5d} {total * 1000:>8.1f} {decode * 1000:>8.1f} "
+          f"{(total - decode) * 1000:>8.1f}  {names}")
+    return total
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('image_dir', nargs='?', default='uploads')
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    print(f"{'图片':36s} {'尺寸':>11s} {'总计ms':>8s} {'解码ms':>8s} {'聚类ms':>8s}  调色板")
+    with tempfile.TemporaryDirectory() as directory:
+        timings = [bench(path, args.repeat) for path in synthetic_images(directory)]
+    if os.path.isdir(args.image_dir):
+        timings += [bench(os.path.join(args.image_dir, f), args.repeat) for f in sorted(os.listdir(args.image_dir))
+                    if f.lower().endswith(IMAGE_EXTENSIONS)]
+    print(f"\n共 {len(timings)} 张，单张耗时中位数 {statistics.median(timings) * 1000:.1f}ms，最大 {max(timings) * 1000:.1f}ms")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,107 @@
+"""感知哈希近重复索引的查询延迟和匹配效果
+
+1. 用随机 64 位哈希构建 N 条记录的多索引哈希表，对随机翻转若干位的查询哈希测查询延迟；
+2. 可选：对目录中的图片做重新保存为 JPEG、轻微裁剪、缩放等变换，检查变换后是否仍能命中。
+
+用法：
+    python benchmarks/bench_phash_index.py [--entries 1000000] [--queries 10000] [--images uploads]
+"""
+import argparse
+import io
+import os
+import random
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from PIL import Image
+
+from services.phash_index import MultiIndexHashIndex, NearDuplicateCache, hamming, image_hashes
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg')
+
+
+def bench_lookup(entries, queries, radius):
+    rng = random.Random(42)
+    index = MultiIndexHashIndex()
+    hashes = [rng.getrandbits(64) for _ in range(entries)]
+    start = time.perf_counter()
+    for i, h in enumerate(hashes):
+        index.add(i, h, 0, None)
+    print(f"构建 {entries} 条记录: {time.perf_counter() - start:.1f}s")
+
+    latencies = []
+    hits = 0
+    for _ in range(queries):
+        target = rng.randrange(entries)
+        query = hashes[target]
+        for bit in rng.sample(range(64), rng.randint(0, radius)):
+            query ^= 1 << bit
+        start = time.perf_counter()
+        results = index.search(query, radius)
+        latencies.append(time.perf_counter() - start)
+        hits += any(key == target for _, key, _, _ in results)
+
+    latencies.sort()
+    p99 = latencies[int(0.99 * (len(latencies) - 1))]
+    print(f"半径 {radius}: 查询 {queries} 次, 召回 {hits / queries:.1%}, "
+          f"p50 {statistics.median(latencies) * 1000:.3f}ms, p99 {p99 * 1000:.3f}ms")
+
+
+def variants(image):
+    """模拟重新上传的常见变化"""
+    rgb = image.convert('RGB')
+    width, height = rgb.size
+    buffer = io.BytesIO()
+    rgb.save(buffer, 'JPEG', quality=70)
+    yield 'jpeg_q70', Image.open(io.BytesIO(buffer.getvalue()))
+    yield 'crop_3pct', rgb.crop((int(width * 0.03), int(height * 0.03), int(width * 0.97), int(height * 0.97)))
+    yield 'resize_50pct', rgb.resize((max(1, width // 2), max(1, height // 2)))
+    yield 'brightness', rgb.point(lambda v: min(255, int(v * 1.1)))
+
+
+def bench_images(image_dir):
+    paths = sorted(
+        os.path.join(image_dir, f) for f in os.listdir(image_dir)
+        if f.lower().endswith(IMAGE_EXTENSIONS) and not f.startswith(('enhanced_', 'animated_', 'poster_'))
+    )
+    if not paths:
+        print(f"目录中没有图片: {image_dir}")
+        return
+    cache = NearDuplicateCache()
+    originals = {}
+    for path in paths:
+        with Image.open(path) as img:
+            originals[path] = image_hashes(img)
+        cache.store(path, originals[path], path)
+
+    print(f"\n{'变换':14s} {'命中':>6s} {'平均pHash距离':>14s}")
+    for name in ('jpeg_q70', 'crop_3pct', 'resize_50pct', 'brightness'):
+        hits, distances = 0, []
+        for path in paths:
+            with Image.open(path) as img:
+                variant = dict(variants(img))[name]
+            hashes = image_hashes(variant)
+            distances.append(hamming(hashes[0], originals[path][0]))
+            match = cache.lookup(hashes)
+            hits += bool(match and match[0] == path)
+        print(f"{name:14s} {hits / len(paths):>6.0%} {statistics.mean(distances):>14.1f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--entries', type=int, default=1000000)
+    parser.add_argument('--queries', type=int, default=10000)
+    parser.add_argument('--radius', type=int, default=10)
+    parser.add_argument('--images', help='可选：用于检查变换后命中率的图片目录')
+    args = parser.parse_args()
+
+    bench_lookup(args.entries, args.queries, args.radius)
+    if args.images:
+        bench_images(args.images)
+
+
+if __name__ == '__main__':
+    main()
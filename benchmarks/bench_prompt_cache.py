@@ -0,0 +1,196 @@
+"""评论和提示词生成请求在旧布局和新布局下的提示词处理（prefill）耗时
+
+  - before：旧布局，分析字段夹在长指令模板中间，整段放在一条 user 消息里
+  - after：新布局，固定指令放在 system 消息，分析字段放在最后的 user 消息（ArtReviewAgent/PromptGenerationAgent.build_messages）
+
+按协调器的顺序对每组分析结果依次发送评论和提示词请求（max_tokens=1，只测提示词处理），两种布局都带
+cache_prompt。服务端返回 llama.cpp 格式的 timings 时使用其中的 prompt_ms 和 cache_n（复用的 token 数），
+否则用请求耗时近似。
+
+默认启动一个模拟 llama.cpp 的本地服务：有 --slots 个槽位，按公共前缀选择槽位（与 llama.cpp 相同），只有
+未命中缓存的部分按 --ms-per-char 计算处理耗时。评论和提示词请求交替发送，只有一个槽位时两者会互相
+覆盖缓存，可用 --slots 1 观察。指定 --llm 时改为测试真实服务（如 llama-server -np 2）。
+
+用法：
+    python benchmarks/bench_prompt_cache.py [--rounds 3]
+    python benchmarks/bench_prompt_cache.py --llm http://localhost:8080
+"""
+import argparse
+import json
+import os
+import statistics
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from agents.art_review_agent import ArtReviewAgent  # noqa: E402
+from agents.prompt_generation_agent import SD_PROMPT_REQUIREMENTS, PromptGenerationAgent  # noqa: E402
+
+SAMPLES = [
+    {'description': '一只戴着红色帽子的小猫坐在草地上', 'scene': '户外草地', 'style': '蜡笔画',
+     'colors': ['红色', '绿色', '黄色'], 'objects': ['小猫', '帽子']},
+    {'description': '一个小女孩拿着蓝色气球', 'scene': '公园', 'style': '水彩',
+     'colors': ['蓝色', '粉色'], 'objects': ['小女孩', '气球']},
+    {'description': '一条橙色的小鱼在水里吐泡泡', 'scene': '海底', 'style': '彩色铅笔',
+     'colors': ['橙色', '蓝色'], 'objects': ['小鱼', '泡泡']},
+    {'description': '一辆红色的消防车', 'scene': '街道', 'style': '马克笔',
+     'colors': ['红色', '黑色'], 'objects': ['消防车']},
+    {'description': '一只大恐龙和一棵树', 'scene': '森林', 'style': '蜡笔画',
+     'colors': ['绿色', '棕色'], 'objects': ['恐龙', '树']},
+]
+
+
+def analysis_block(analysis):
+    return f"""描述：{analysis.get('description', '')}
+场景：{analysis.get('scene', '')}
+风格：{analysis.get('style', '')}
+颜色：{', '.join(analysis.get('colors', []))}
+物体：{', '.join(analysis.get('objects', []))}"""
+
+
+def legacy_review_messages(analysis):
+    """旧版 ArtReviewAgent 的提示词"""
+    return [{'role': 'user', 'content': f"""你是一个专业的儿童艺术教育专家。请基于以下图片分析结果生成一段温暖友好的艺术评论。
+
+图片分析结果：
+{analysis_block(analysis)}
+
+你的评论应该：
+1. 积极正面，突出作品的优点
+2. 使用适合儿童理解的语言
+3. 包含具体的观察和建议
+4. 鼓励孩子继续创作和探索
+
+请在评论中包含：
+1. 对画作主题和创意的赞赏
+2. 对色彩运用的观察
+3. 对细节表现的肯定
+4. 鼓励性的建议和期待
+
+请直接给出评论内容，不要包含任何前缀或格式说明。"""}]
+
+
+def legacy_prompt_messages(analysis):
+    """旧版 PromptGenerationAgent 的提示词"""
+    return [{'role': 'user', 'content': f"""你是一个专业的图像提示词生成专家。请基于以下图片分析结果生成一个简洁的英文提示词串。
+
+图片分析结果：
+{analysis_block(analysis)}
+
+要求：
+{SD_PROMPT_REQUIREMENTS}
+
+示例格式：
+a cute little girl, wearing blue dress, holding a teddy bear, standing in garden, soft lighting
+
+请直接给出提示词，不要包含任何解释或前缀。"""}]
+
+
+def make_stub_handler(slots, ms_per_char):
+    cached = [''] * slots
+    last_used = [0.0] * slots
+    lock = threading.Lock()
+
+    def common_prefix(a, b):
+        n = 0
+        for x, y in zip(a, b):
+            if x != y:
+                break
+            n += 1
+        return n
+
+    class StubHandler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def log_message(self, *args):
+            pass
+
+        def do_POST(self):
+            body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+            # 按聊天模板展开后的文本就是模型看到的 token 序列
+            rendered = ''.join(f"<|{m['role']}|>{m['content']}<|end|>" for m in body['messages'])
+            with lock:
+                # 与 llama.cpp 一样：公共前缀超过槽位内容一半时选择该槽位，否则使用最久未用的槽位
+                matches = [common_prefix(rendered, c) for c in cached]
+                best = max(range(slots), key=lambda i: matches[i])
+                slot = best if cached[best] and matches[best] >= len(cached[best]) / 2 else last_used.index(min(last_used))
+                reused = matches[slot] if body.get('cache_prompt') else 0
+                cached[slot] = rendered
+                last_used[slot] = time.monotonic()
+            prompt_ms = (len(rendered) - reused) * ms_per_char
+            time.sleep(prompt_ms / 1000)
+            payload = json.dumps({
+                'choices': [{'message': {'role': 'assistant', 'content': '好'}}],
+                'timings': {'prompt_n': len(rendered) - reused, 'cache_n': reused, 'prompt_ms': prompt_ms}
+            }).encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+    return StubHandler
+
+
+def measure(session, url, messages):
+    start = time.perf_counter()
+    response = session.post(f"{url}/v1/chat/completions", json={
+        'messages': messages, 'temperature': 0.7, 'max_tokens': 1, 'cache_prompt': True
+    }, timeout=300)
+    elapsed = (time.perf_counter() - start) * 1000
+    response.raise_for_status()
+    timings = response.json().get('timings') or {}
+    return timings.get('prompt_ms', elapsed), timings.get('cache_n'), timings.get('prompt_n')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--llm', help='真实的本地LLM地址（OpenAI 兼容接口），不指定时使用模拟服务')
+    parser.add_argument('--rounds', type=int, default=3, help='每种布局把全部样例跑几轮')
+    parser.add_argument('--slots', type=int, default=2, help='模拟服务：槽位数')
+    parser.add_argument('--ms-per-char', type=float, default=0.5, help='模拟服务：每个未缓存字符的处理耗时（毫秒）')
+    args = parser.parse_args()
+
+    server = None
+    url = args.llm
+    if not url:
+        server = ThreadingHTTPServer(('127.0.0.1', 0), make_stub_handler(args.slots, args.ms_per_char))
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        url = f"http://127.0.0.1:{server.server_port}"
+
+    reviewer, prompter = ArtReviewAgent(), PromptGenerationAgent()
+    layouts = {
+        'before': (legacy_review_messages, legacy_prompt_messages),
+        'after': (reviewer.build_messages, prompter.build_messages),
+    }
+    session = requests.Session()
+    print(f"{'模拟服务（' + str(args.slots) + ' 个槽位）' if server else url}，{len(SAMPLES)} 组样例 x {args.rounds} 轮")
+    print(f"{'layout':>7} {'agent':>7} {'prompt ms p50':>14} {'mean':>8} {'reused':>8}")
+    for layout, builders in layouts.items():
+        # 先发一组请求，让两种布局都从已经缓存过一次的状态开始
+        for build in builders:
+            measure(session, url, build(SAMPLES[-1]))
+        results = {'review': [], 'prompt': []}
+        for _ in range(args.rounds):
+            for analysis in SAMPLES:
+                for agent, build in zip(('review', 'prompt'), builders):
+                    results[agent].append(measure(session, url, build(analysis)))
+        for agent, samples in results.items():
+            prompt_ms = [s[0] for s in samples]
+            reused = [s[1] / (s[1] + s[2]) for s in samples if s[1] is not None and s[2] is not None]
+            reused_text = f"{statistics.mean(reused) * 100:7.1f}%" if reused else f"{'-':>8}"
+            print(f"{layout:>7} {agent:>7} {statistics.median(prompt_ms):>14.1f} "
+                  f"{statistics.mean(prompt_ms):>8.1f} {reused_text}")
+
+    if server:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,92 @@
+"""app.py 的导入耗时和启动耗时
+
+每轮在新的 Python 进程中测量：
+  - import：导入 app.py 的耗时
+  - first_request：测试客户端请求首页的耗时（不依赖上游服务）
+  - services：创建 ComfyUI 服务和任务协调器（三个代理）的耗时；旧版本在导入时已经创建，这里接近 0
+另起一个进程统计导入并创建服务后 load_dotenv 和 TaskCoordinator 的调用次数。
+
+用 --tree 指定另一个检出目录即可和旧版本对比，例如：
+    git worktree add /tmp/baseline <旧提交>
+    python benchmarks/bench_startup.py --tree /tmp/baseline
+    python benchmarks/bench_startup.py
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+TIMING_SNIPPET = r"""
+import json, logging, time
+start = time.perf_counter()
+import app
+imported = time.perf_counter()
+logging.disable(logging.CRITICAL)
+app.app.test_client().get('/')
+first_request = time.perf_counter()
+if hasattr(app, 'container'):
+    app.container.comfyui_service, app.container.task_coordinator
+else:
+    app.comfyui_service, app.task_coordinator
+services = time.perf_counter()
+print(json.dumps({'import': imported - start, 'first_request': first_request - imported, 'services': services - first_request}))
+"""
+
+COUNT_SNIPPET = r"""
+import json, logging
+import dotenv
+counts = {'load_dotenv': 0, 'TaskCoordinator': 0}
+original_load_dotenv = dotenv.load_dotenv
+def counting_load_dotenv(*args, **kwargs):
+    counts['load_dotenv'] += 1
+    return original_load_dotenv(*args, **kwargs)
+dotenv.load_dotenv = counting_load_dotenv
+import agents.task_coordinator as task_coordinator
+original_init = task_coordinator.TaskCoordinator.__init__
+def counting_init(self, *args, **kwargs):
+    counts['TaskCoordinator'] += 1
+    original_init(self, *args, **kwargs)
+task_coordinator.TaskCoordinator.__init__ = counting_init
+logging.disable(logging.CRITICAL)
+import app
+if hasattr(app, 'container'):
+    app.container.comfyui_service, app.container.task_coordinator
+print(json.dumps(counts))
+"""
+
+
+def run_snippet(tree, snippet, env):
+    output = subprocess.run([sys.executable, '-c', snippet], cwd=tree, env=env, capture_output=True, text=True, check=True)
+    return json.loads(output.stdout.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--tree', default=ROOT, help='要测量的检出目录，默认为当前仓库')
+    parser.add_argument('--runs', type=int, default=10)
+    args = parser.parse_args()
+
+    tree = os.path.abspath(args.tree)
+    with tempfile.TemporaryDirectory() as comfyui_root:
+        # 新版本从 COMFYUI_ROOT 读取 ComfyUI 目录，避免在测量时创建真实的输入目录
+        env = dict(os.environ, COMFYUI_ROOT=comfyui_root, PYTHONDONTWRITEBYTECODE='1', PYTHONPATH=tree)
+        run_snippet(tree, TIMING_SNIPPET, env)  # 预热文件系统缓存
+        samples = [run_snippet(tree, TIMING_SNIPPET, env) for _ in range(args.runs)]
+        counts = run_snippet(tree, COUNT_SNIPPET, env)
+
+    print(f"{tree}（{args.runs} 轮，中位数）")
+    for key in ('import', 'first_request', 'services'):
+        values = [sample[key] * 1000 for sample in samples]
+        print(f"  {key:14s} {statistics.median(values):8.1f} ms  (最小 {min(values):.1f} ms)")
+    total = [sum(sample.values()) * 1000 for sample in samples]
+    print(f"  {'total':14s} {statistics.median(total):8.1f} ms")
+    print(f"  load_dotenv 调用 {counts['load_dotenv']} 次，TaskCoordinator 创建 {counts['TaskCoordinator']} 次")
+
+
+if __name__ == '__main__':
+    main()
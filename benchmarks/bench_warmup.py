@@ -0,0 +1,76 @@
+"""冷启动与预热后的首个请求延迟对比
+
+分别以 WARMUP=off 和 WARMUP=on 启动服务（python app.py），预热模式下等待 /readyz 返回 200，
+然后连续发送两次同样的 /enhance 请求，对比第一个请求（冷/热）和第二个请求的耗时。
+需要 ComfyUI、百度接口和本地LLM都可用；每轮之间应重启 ComfyUI 以清空已加载的模型。
+
+用法：
+    python benchmarks/bench_warmup.py 图片路径 [--port 5000] [--ready-timeout 900]
+"""
+import argparse
+import os
+import subprocess
+import sys
+import time
+
+import requests
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def wait_until(url, timeout, expected=(200,)):
+    """轮询 url 直到返回 expected 中的状态码，返回等待的秒数，超时返回None"""
+    start = time.monotonic()
+    while time.monotonic() - start < timeout:
+        try:
+            if requests.get(url, timeout=5).status_code in expected:
+                return time.monotonic() - start
+        except requests.exceptions.RequestException:
+            pass
+        time.sleep(1)
+    return None
+
+
+def enhance(base_url, image_path):
+    start = time.monotonic()
+    with open(image_path, 'rb') as f:
+        response = requests.post(f"{base_url}/enhance", files={'file': f}, data={'denoise_value': 60, 'preset': 'best'},
+                                 timeout=1200)
+    return time.monotonic() - start, response.json().get('success')
+
+
+def run(mode, image_path, port, ready_timeout):
+    env = dict(os.environ, WARMUP=mode)
+    server = subprocess.Popen([sys.executable, 'app.py'], cwd=ROOT, env=env,
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    base_url = f"http://127.0.0.1:{port}"
+    try:
+        # 先等进程能响应，再等就绪
+        if wait_until(f"{base_url}/readyz", 60, expected=(200, 503)) is None:
+            print(f"{mode}: 服务没有启动")
+            return
+        ready_seconds = wait_until(f"{base_url}/readyz", ready_timeout)
+        first = enhance(base_url, image_path)
+        second = enhance(base_url, image_path)
+        print(f"WARMUP={mode:3s} 就绪等待 {ready_seconds or 0:7.1f}s  第一个请求 {first[0]:7.1f}s ({'成功' if first[1] else '失败'})"
+              f"  第二个请求 {second[0]:7.1f}s ({'成功' if second[1] else '失败'})")
+    finally:
+        server.terminate()
+        server.wait(30)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('image')
+    parser.add_argument('--port', type=int, default=5000)
+    parser.add_argument('--ready-timeout', type=float, default=900)
+    args = parser.parse_args()
+
+    for mode in ('off', 'on'):
+        run(mode, os.path.abspath(args.image), args.port, args.ready_timeout)
+        if mode == 'off':
+            input("请重启 ComfyUI（清空已加载的模型）后按回车继续...")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,121 @@
+"""多进程部署（gunicorn）在 1/2/4/8 个工作进程下的吞吐量
+
+预先在共享状态中写入测试图片的分析结果，然后并发请求 /generate_review：每个请求都会解码图片、
+计算感知哈希、从共享状态同步近重复缓存并命中，不访问百度、本地LLM或 ComfyUI。
+也就验证了一个进程写入的缓存能被所有工作进程复用。
+
+用法：
+    python benchmarks/bench_workers.py uploads/1.png [--workers 1 2 4 8] [--concurrency 16] [--duration 10]
+"""
+import argparse
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import requests
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from services.phash_index import hash_file  # noqa: E402
+from services.shared_state import SharedState  # noqa: E402
+
+CACHED_RESULT = {
+    'status': 'success',
+    'analysis': {'status': 'success', 'description': '基准测试', 'colors': ['蓝色'], 'objects': ['小猫']},
+    'review': {'status': 'success', 'content': '基准测试评论'},
+    'prompts': {'status': 'success', 'positive_prompt': 'a cat', 'negative_prompt': 'blurry'}
+}
+
+
+def seed(state_path, image_path):
+    hashes = hash_file(image_path)
+    SharedState(state_path).cache_set('analysis', os.path.basename(image_path),
+                                      {'phash': int(hashes[0]), 'dhash': int(hashes[1]), 'payload': CACHED_RESULT})
+
+
+def wait_until_up(base_url, timeout=60):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            requests.get(f"{base_url}/readyz", timeout=2)
+            return True
+        except requests.exceptions.RequestException:
+            time.sleep(0.2)
+    return False
+
+
+def load(base_url, image_name, concurrency, duration):
+    latencies, errors = [], []
+    lock = threading.Lock()
+    deadline = time.monotonic() + duration
+
+    def client():
+        session = requests.Session()
+        while time.monotonic() < deadline:
+            start = time.perf_counter()
+            try:
+                response = session.post(f"{base_url}/generate_review", json={'image_path': f"/uploads/{image_name}"},
+                                        timeout=30)
+                ok = response.json().get('status') == 'success'
+            except Exception:
+                ok = False
+            with lock:
+                (latencies if ok else errors).append(time.perf_counter() - start)
+
+    threads = [threading.Thread(target=client) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return latencies, errors
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('image', help='uploads 目录中的图片')
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4, 8])
+    parser.add_argument('--threads', type=int, default=8, help='每个工作进程的线程数')
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--duration', type=float, default=10)
+    parser.add_argument('--port', type=int, default=5055)
+    args = parser.parse_args()
+
+    image_name = os.path.basename(args.image)
+    if not os.path.exists(os.path.join(ROOT, 'uploads', image_name)):
+        shutil.copy(args.image, os.path.join(ROOT, 'uploads', image_name))
+    base_url = f"http://127.0.0.1:{args.port}"
+
+    print(f"CPU 核数 {os.cpu_count()}，并发 {args.concurrency}，每轮 {args.duration:.0f} 秒")
+    print(f"{'workers':>8} {'req/s':>8} {'p50 ms':>8} {'p95 ms':>8} {'errors':>7}")
+    for workers in args.workers:
+        with tempfile.TemporaryDirectory() as tmp:
+            state_path = os.path.join(tmp, 'shared_state.db')
+            seed(state_path, os.path.join(ROOT, 'uploads', image_name))
+            env = dict(os.environ, STATE_DB_PATH=state_path, WARMUP='off', COMFYUI_ROOT=os.path.join(tmp, 'comfyui'),
+                       WEB_CONCURRENCY=str(workers), GUNICORN_THREADS=str(args.threads),
+                       BIND=f"127.0.0.1:{args.port}")
+            server = subprocess.Popen([sys.executable, '-m', 'gunicorn', '-c', 'gunicorn.conf.py', 'app:app'],
+                                      cwd=ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            try:
+                if not wait_until_up(base_url):
+                    print(f"{workers:>8} 服务没有启动")
+                    continue
+                load(base_url, image_name, args.concurrency, 2)  # 各进程创建服务并同步缓存
+                latencies, errors = load(base_url, image_name, args.concurrency, args.duration)
+                latencies.sort()
+                p95 = latencies[int(len(latencies) * 0.95)] * 1000 if latencies else 0
+                print(f"{workers:>8} {len(latencies) / args.duration:>8.1f} "
+                      f"{statistics.median(latencies) * 1000 if latencies else 0:>8.1f} {p95:>8.1f} {len(errors):>7}")
+            finally:
+                server.terminate()
+                server.wait(30)
+
+
+if __name__ == '__main__':
+    main()
@@ -3,20 +3,80 @@ from dotenv import load_dotenv
 
 load_dotenv()
 
+# 项目根目录
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
 class Config:
     # ComfyUI配置
     COMFYUI_URL = os.getenv('COMFYUI_URL', 'http://localhost:8188')
-    
+    # ComfyUI 安装目录（输入图片写到 input 子目录，输出从 output 子目录读取）
+    COMFYUI_ROOT = os.getenv('COMFYUI_ROOT', os.path.join(BASE_DIR, 'ComfyUI'))
+
     # LLM配置
     LLM_STUDIO_URL = os.getenv('LLM_STUDIO_URL', 'http://localhost:1234')
     LLM_MODEL = os.getenv('LLM_MODEL', 'default')
-    
+    LLM_VISION_MODEL = os.getenv('LLM_VISION_MODEL', LLM_MODEL)
+    # 请求服务端保留提示词的 KV 缓存（llama.cpp 的 cache_prompt，不支持的服务会忽略）
+    LLM_CACHE_PROMPT = os.getenv('LLM_CACHE_PROMPT', 'on').lower() != 'off'
+
+    # 百度多模态分析配置
+    BAIDU_TOKEN = os.getenv('BAIDU_TOKEN', 'bce-v3/ALTAK-5vJ2WWcxX1gOitlDF7bDt/d00bb952484368905660e7444ecda5fbbaffca52')
+    ANALYSIS_OUTPUT_MODE = os.getenv('ANALYSIS_OUTPUT_MODE', 'json')
+    ANALYSIS_HEDGE_PROVIDER = os.getenv('ANALYSIS_HEDGE_PROVIDER', 'baidu')
+    ANALYSIS_HEDGE_PERCENTILE = float(os.getenv('ANALYSIS_HEDGE_PERCENTILE', 95))
+    ANALYSIS_HEDGE_DELAY = float(os.getenv('ANALYSIS_HEDGE_DELAY', 8))
+
+    # 任务协调和近重复图片复用
+    COORDINATOR_STRATEGY = os.getenv('COORDINATOR_STRATEGY', 'two_call')
+    PHASH_MAX_DISTANCE = int(os.getenv('PHASH_MAX_DISTANCE', 10))
+    PHASH_MIN_CONFIDENCE = float(os.getenv('PHASH_MIN_CONFIDENCE', 0.9))
+    # 近重复缓存最多保留的条目数和保留时间（秒，0 表示不过期）
+    PHASH_CACHE_MAX_ENTRIES = int(os.getenv('PHASH_CACHE_MAX_ENTRIES', 20000))
+    PHASH_CACHE_TTL = float(os.getenv('PHASH_CACHE_TTL', 7 * 24 * 3600))
+
+    # 美化工作流：干净扫描件是否使用轻量变体，以及美化请求的默认延迟预算（秒）
+    ENHANCE_LIGHT_VARIANT = os.getenv('ENHANCE_LIGHT_VARIANT', 'auto').lower() != 'off'
+    ENHANCE_LATENCY_BUDGET = float(os.getenv('ENHANCE_LATENCY_BUDGET', 90))
+    # 一次美化请求最多生成的候选图数量（/enhance 的 variants 参数）
+    ENHANCE_MAX_VARIANTS = int(os.getenv('ENHANCE_MAX_VARIANTS', 4))
+    # 图片分析期间并行准备输入图片和工作流（on/off）
+    ENHANCE_PIPELINE = os.getenv('ENHANCE_PIPELINE', 'on').lower() != 'off'
+
+    # 图片解码内存：像素数上限（解压炸弹限制）、每个进程图片任务的内存预算（MB）和等待预算的最长时间（秒）
+    IMAGE_MAX_PIXELS = int(os.getenv('IMAGE_MAX_PIXELS', 50_000_000))
+    IMAGE_MEMORY_BUDGET_MB = int(os.getenv('IMAGE_MEMORY_BUDGET_MB', 512))
+    IMAGE_MEMORY_WAIT = float(os.getenv('IMAGE_MEMORY_WAIT', 30))
+
+    # ComfyUI 节点缓存：输入图片按内容哈希命名，最后一次使用后保留的时间（秒）；
+    # 同一张图片的后续任务在 ComfyUI 正在执行该图片的工作流时插到队首（on/off）
+    COMFYUI_INPUT_TTL = float(os.getenv('COMFYUI_INPUT_TTL', 900))
+    COMFYUI_CACHE_AFFINITY = os.getenv('COMFYUI_CACHE_AFFINITY', 'on').lower() != 'off'
+
+    # ComfyUI 状态采样（/queue 和 /system_stats）的间隔（秒），0 表示不采样
+    COMFYUI_TELEMETRY_INTERVAL = float(os.getenv('COMFYUI_TELEMETRY_INTERVAL', 15))
+
+    # 启动预热
+    WARMUP = os.getenv('WARMUP', 'on').lower() != 'off'
+    WARMUP_COMFYUI_TEMPLATES = [t.strip() for t in os.getenv('WARMUP_COMFYUI_TEMPLATES', 'enhance,animation').split(',')
+                                if t.strip()]
+
+    # 多进程部署时各工作进程共享的任务状态和缓存（SQLite WAL 文件）
+    STATE_DB_PATH = os.getenv('STATE_DB_PATH', os.path.join(BASE_DIR, 'instance', 'shared_state.db'))
+    # 各工作进程把自己的指标写入共享状态的间隔（秒），/metrics 导出所有进程的合计
+    METRICS_PUBLISH_INTERVAL = float(os.getenv('METRICS_PUBLISH_INTERVAL', 5))
+
     # 文件路径配置
     UPLOAD_FOLDER = 'static/uploads'
     OUTPUT_FOLDER = 'static/output'
-    
+
     # 允许的文件类型
     ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg'}
-    
+
     # 最大文件大小（5MB）
-    MAX_CONTENT_LENGTH = 5 * 1024 * 1024 
\ No newline at end of file
+    MAX_CONTENT_LENGTH = 5 * 1024 * 1024
+
+    @staticmethod
+    def upstream_settings(provider, defaults):
+        """上游限流参数，环境变量 {PROVIDER}_{KEY}（如 BAIDU_RATE_LIMIT）覆盖默认值"""
+        return {key: type(value)(os.getenv(f"{provider.upper()}_{key.upper()}", value))
+                for key, value in defaults.items()}
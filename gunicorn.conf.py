@@ -0,0 +1,46 @@
+"""生产环境的 gunicorn 配置
+
+    gunicorn -c gunicorn.conf.py app:app
+
+多个工作进程（prefork），每个进程用线程处理请求：美化和动画请求会同步等待 ComfyUI，
+SSE 进度推送也会长时间占用一个线程。各进程的任务状态、近重复结果缓存、工作流耗时统计和指标
+通过 STATE_DB_PATH 指向的 SQLite 文件共享。
+"""
+import os
+
+bind = os.getenv('BIND', '0.0.0.0:5000')
+workers = int(os.getenv('WEB_CONCURRENCY', 4))
+worker_class = 'gthread'
+threads = int(os.getenv('GUNICORN_THREADS', 8))
+
+# 同步的动画请求最长等待 ANIMATION_TIMEOUT（600 秒）再加上图片分析的时间
+timeout = int(os.getenv('GUNICORN_TIMEOUT', 900))
+graceful_timeout = 30
+keepalive = 5
+
+# 在主进程中导入应用（各服务在第一次使用时才创建，不会在 fork 前建立连接或线程）
+preload_app = True
+
+accesslog = '-'
+errorlog = '-'
+
+
+def on_starting(server):
+    """主进程启动时清空上一次运行留下的各进程指标"""
+    from app import reset_shared_metrics
+    reset_shared_metrics()
+
+
+def post_fork(server, worker):
+    """每个工作进程 fork 之后各自预热（连接池、进度监听和本地缓存都属于进程本身），
+    开始定期写入本进程的指标，并接管已停止的进程留下的未完成任务"""
+    from app import configure_metrics, configure_warmup, recover_jobs
+    configure_metrics()
+    recover_jobs()
+    configure_warmup()
+
+
+def worker_exit(server, worker):
+    """工作进程退出前写入最后一次指标，退出后它的计数器和直方图仍计入合计"""
+    from services.metrics import PROCESS_METRICS
+    PROCESS_METRICS.publish()
@@ -1,54 +1,267 @@
 import requests
+import copy
+import hashlib
 import json
 import os
 import logging
+import re
+import threading
 from PIL import Image
 import io
 import time
 import traceback
 import shutil
-from agents.task_coordinator import TaskCoordinator
+from concurrent.futures import ThreadPoolExecutor, wait
+from config.config import Config
+from services.comfyui_telemetry import QUEUE_DEPTH, ComfyUITelemetry
+from services.progress_tracker import ProgressTracker
+from services import metrics
+from services.image_memory import SharedImage, image_budget
 
 logger = logging.getLogger(__name__)
 # Set default logging level to INFO
 logger.setLevel(logging.INFO)
 
+# 动画输出格式配置：VHS_VideoCombine 的 format 参数、文件扩展名和 MIME 类型
+ANIMATION_FORMATS = {
+    'gif': {'vhs_format': 'image/gif', 'extension': 'gif', 'mimetype': 'image/gif'},
+    'webp': {'vhs_format': 'image/webp', 'extension': 'webp', 'mimetype': 'image/webp'},
+    'mp4': {'vhs_format': 'video/h264-mp4', 'extension': 'mp4', 'mimetype': 'video/mp4',
+            'extra_inputs': {'pix_fmt': 'yuv420p', 'crf': 23, 'save_metadata': False}},
+    'webm': {'vhs_format': 'video/webm', 'extension': 'webm', 'mimetype': 'video/webm',
+             'extra_inputs': {'pix_fmt': 'yuv420p', 'crf': 30, 'save_metadata': False}},
+}
+DEFAULT_ANIMATION_FORMAT = 'gif'
+
+# 封面缩略图的最长边（像素）
+POSTER_MAX_SIZE = 320
+
+# 动画工作流中用于计算进度和ETA的采样器节点类型
+ANIMATION_SAMPLER_CLASS = 'WanVideoSampler'
+
+# 动画动作的提示词，{subject} 为分析得到的主体；未知动作使用 smile
+ANIMATION_ACTIONS = {
+    'smile': "{subject}, smiling, lips slightly open, eyes winking, cheerful expression, white background",
+    'wave': "{subject}, waving hands, arms raised, friendly gesture, dynamic pose, white background",
+    'dance': "{subject}, dancing, arms up, legs moving, joyful movement, dynamic pose, white background",
+    'walk': "{subject}, walking, legs in motion, arms swinging, natural stride, white background",
+    'jump': "{subject}, jumping, legs bent, arms up, mid-air pose, dynamic movement, white background",
+    'spin': "{subject}, spinning, arms spread, body rotating, dynamic motion, white background"
+}
+DEFAULT_ANIMATION_ACTION = 'smile'
+
+# 多动作动画：一个工作流中每个动作复制一份提示词、文本编码、采样、解码、合成和封面节点，
+# 模型加载和图片编码（WanVideoImageClipEncode）等其余节点所有动作共用。
+# 第 i 个动作的分支节点编号为原编号 + i * ANIMATION_BRANCH_ID_OFFSET（第一个动作沿用原编号）
+ANIMATION_BRANCH_NODES = ('166', '142', '144', '145', '168', '170', '171')
+ANIMATION_BRANCH_ID_OFFSET = 1000
+ANIMATION_OUTPUT_NODE = '168'
+ANIMATION_POSTER_NODE = '171'
+
+# 动画渲染档位：帧数（Int 节点 154）、最长边（Int 节点 163，即 ImageScaleByAspectRatio 的缩放长度）和
+# WanVideoSampler 步数，None 表示沿用模板中的设置（81 帧、360、16 步）。preview 是几秒内完成的短、
+# 低分辨率、少步数预览，用户确认后用相同的提示词和种子以 full 档重新渲染（Wan 的帧数需为 4k+1）
+ANIMATION_TIERS = {
+    'preview': {'frames': 17, 'size': 256, 'steps': 6},
+    'full': {'frames': None, 'size': None, 'steps': None},
+}
+DEFAULT_ANIMATION_TIER = 'full'
+ANIMATION_FRAMES_NODE = '154'
+ANIMATION_SIZE_NODE = '163'
+ANIMATION_SEED_NODE = '164'
+ENHANCE_SAMPLER_CLASS = 'KSampler'
+
+# 服务端等待工作流输出的最长时间（秒），超时后会从ComfyUI中取消该工作流
+ENHANCE_TIMEOUT = 600
+ANIMATION_TIMEOUT = 600
+
+JOB_SECONDS = metrics.histogram('comfyui_job_seconds', 'ComfyUI 工作流执行耗时（秒）', ['workflow'])
+CANCELLATIONS = metrics.counter('comfyui_cancellations_total', '已取消的 ComfyUI 工作流数', ['reason', 'stage'])
+GPU_SECONDS_FREED = metrics.counter('comfyui_gpu_seconds_freed_total', '取消工作流后估算释放的 GPU 时间（秒）', ['reason', 'stage'])
+GPU_SECONDS_SAVED = metrics.counter('comfyui_gpu_seconds_saved_total', '较轻的美化工作流相对 best 预设平均耗时节省的 GPU 时间（秒）', ['workflow'])
+ENHANCE_VARIANTS = metrics.counter('comfyui_enhance_variant_total', '美化任务使用的工作流变体', ['variant'])
+ENHANCE_PRESET_CHOICES = metrics.counter('comfyui_enhance_preset_total', '美化任务选择的预设', ['preset', 'reason'])
+ANIMATION_GPU_SECONDS = metrics.histogram(
+    'comfyui_animation_gpu_seconds',
+    '每个动画分摊的 ComfyUI 执行耗时（秒）；multi 为一个工作流生成多个动作',
+    ['mode']
+)
+NODE_CACHE = metrics.counter(
+    'comfyui_node_cache_total',
+    'ComfyUI 工作流节点的执行情况（hit: 复用缓存的输出，miss: 重新执行）',
+    ['workflow', 'outcome']
+)
+FRONT_SUBMISSIONS = metrics.counter('comfyui_front_submissions_total', '为复用节点缓存插到队首的工作流数', ['workflow'])
+ENHANCE_VARIANT_GPU_SECONDS = metrics.histogram(
+    'comfyui_enhance_variant_gpu_seconds',
+    '每张候选美化图分摊的 ComfyUI 执行耗时（秒），按一次生成的候选数分组',
+    ['variants']
+)
+ANIMATION_TIER_GPU_SECONDS = metrics.counter(
+    'comfyui_animation_tier_gpu_seconds_total', '各渲染档位动画工作流的累计执行耗时（秒）', ['tier']
+)
+ANIMATION_RENDERS = metrics.counter('comfyui_animation_renders_total', '各渲染档位完成的动画数（多动作时每个动作计一个）', ['tier'])
+ANIMATION_PROMOTIONS = metrics.counter('comfyui_animation_promotions_total', '由预览重新渲染为完整动画的工作流数')
+ANIMATION_KEPT_GPU_SECONDS = metrics.histogram(
+    'comfyui_animation_kept_gpu_seconds',
+    '每个完整档动画的执行耗时（秒，由预览升级的包含预览的耗时）',
+    ['source']
+)
+ENHANCE_PREPARE_BLOCKING = metrics.histogram(
+    'comfyui_enhance_prepare_blocking_seconds',
+    '图片分析完成后等待输入图片和工作流准备完成的时间（秒，sequential 为准备的全部耗时）',
+    ['mode'], buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2, 5)
+)
+
+# 与图片分析并行准备美化输入的线程池（所有服务实例共享）
+_prepare_executor = ThreadPoolExecutor(max_workers=16, thread_name_prefix='enhance-prepare')
+
+# 美化工作流的质量/延迟预设：两遍 KSampler 的步数（second_steps 为 0 时去掉第二遍放大采样）、
+# 第二遍放大倍数、调度器（None 表示沿用工作流中的设置），以及没有实测数据时的预计耗时（秒）
+ENHANCE_PRESETS = {
+    'best': {'steps': 20, 'second_steps': 15, 'second_pass_scale': 1.25, 'scheduler': None, 'estimated_seconds': 40},
+    'balanced': {'steps': 14, 'second_steps': 10, 'second_pass_scale': 1.15, 'scheduler': 'karras', 'estimated_seconds': 22},
+    'fast': {'steps': 10, 'second_steps': 0, 'second_pass_scale': 1.0, 'scheduler': 'karras', 'estimated_seconds': 10}
+}
+# 按质量从高到低排列
+ENHANCE_PRESET_ORDER = ['best', 'balanced', 'fast']
+DEFAULT_ENHANCE_PRESET = 'best'
+# 笔迹占比低于该值的简单画作用 best 预设收益不大，最多使用 balanced
+SIMPLE_DRAWING_INK_RATIO = 0.05
+# 节省 GPU 时间的比较基准
+ENHANCE_BASELINE_WORKFLOW = 'enhance_best'
+# 一次生成多张候选图时插入的 RepeatLatentBatch 节点：把 VAE 编码后的 latent 复制成一个批次，
+# 模型加载、提示词编码和 VAE 编码只执行一次，KSampler 为批次中的每一张生成不同的噪声
+ENHANCE_BATCH_NODE = '60'
+
+# 按内容哈希命名的输入图片（{用途}_{哈希}.{扩展名}），超过 COMFYUI_INPUT_TTL 未使用时删除
+STAGED_INPUT_PATTERN = re.compile(r'^(enhance|animation)_[0-9a-f]{16}\.\w+$')
+# 两次清理输入目录之间的最短间隔（秒）
+INPUT_EVICTION_INTERVAL = 60
+
+# 预热工作流：极小的输入尺寸、1 步采样，只为让 ComfyUI 加载模板用到的模型
+WARMUP_TEMPLATES = ('enhance', 'animation')
+WARMUP_IMAGE_NAME = 'warmup_priming.png'
+WARMUP_TIMEOUT = 600
+
 class ComfyUIService:
-    def __init__(self, comfyui_url):
+    def __init__(self, comfyui_url, task_coordinator=None, config=Config, shared_state=None):
+        """
+        Args:
+            comfyui_url: ComfyUI 服务地址
+            task_coordinator: 共享的任务协调器，为空时在第一次使用时创建
+            config: 配置类，默认 config.Config
+            shared_state: SharedState，多进程部署时让各进程共享模板平均耗时和已提交工作流的模板名称
+        """
         self.comfyui_url = comfyui_url
-        self.client_id = "kids_art_project"
+        self.config = config
+        self.shared_state = shared_state
+        # ComfyUI 只向同一 clientId 最后建立的 websocket 推送事件，多进程部署时每个进程需要不同的 clientId
+        self.client_id = f"kids_art_project_{os.getpid()}"
         
-        # 获取 ComfyUI 根目录
-        self.comfyui_root = r"C:\pinokio\api\comfyui.git\app"
+        # 复用到 ComfyUI 的 HTTP 连接（轮询 /history 时尤其频繁）
+        self.session = requests.Session()
+        
+        # 已解析的工作流模板，每次使用时返回副本
+        self._workflow_cache = {}
+        
+        # ComfyUI 根目录
+        self.comfyui_root = config.COMFYUI_ROOT
         self.comfyui_input_dir = os.path.join(self.comfyui_root, 'input')
         
-        # 初始化任务协调器
-        self.task_coordinator = TaskCoordinator()
+        self._task_coordinator = task_coordinator
+        
+        # 队列和设备状态采样、各节点耗时统计，以及进度监听（都在首次提交工作流时启动）
+        self.telemetry = ComfyUITelemetry(comfyui_url, config.COMFYUI_TELEMETRY_INTERVAL, shared_state)
+        self.progress_tracker = ProgressTracker(comfyui_url, self.client_id, self.telemetry)
+        
+        # 干净扫描件是否使用轻量美化工作流（auto/off），以及美化请求的默认延迟预算（秒）
+        self.enhance_light_variant = config.ENHANCE_LIGHT_VARIANT
+        self.enhance_budget = config.ENHANCE_LATENCY_BUDGET
+        self.enhance_max_variants = config.ENHANCE_MAX_VARIANTS
+        # 图片分析期间是否并行准备输入图片和工作流
+        self.enhance_pipeline = config.ENHANCE_PIPELINE
+        
+        # 按内容哈希命名、保留在输入目录中的输入图片 {文件名: 预处理元数据}（同时写入共享状态），同一张图片
+        # 再次提交时文件名和内容都不变，ComfyUI 可以复用 LoadImage 及其下游节点的缓存输出
+        self.input_ttl = config.COMFYUI_INPUT_TTL
+        self.cache_affinity = config.COMFYUI_CACHE_AFFINITY
+        self._staged_inputs = {}
+        self._staged_lock = threading.Lock()
+        self._last_eviction = 0.0
+        
+        # 已提交工作流的模板名称，以及各模板的平均执行耗时（用于估算取消后释放的GPU时间）
+        self._prompt_workflows = {}
+        self._avg_job_seconds = {}
+        # 动画工作流包含的动作数、美化工作流的候选图数，用于统计每个输出分摊的执行耗时
+        self._prompt_actions = {}
+        self._prompt_variants = {}
+        # 动画工作流的渲染档位，以及已完成的动画工作流的执行耗时（保存结果时取走）
+        self._prompt_tiers = {}
+        self._prompt_gpu_seconds = {}
+        # 重启后继续等待的工作流：进度事件发往重启前的 clientId，拿不到开始执行的时间，不计入耗时统计
+        self._resumed_prompts = set()
         
         # 确保输入目录存在
         if not os.path.exists(self.comfyui_input_dir):
             os.makedirs(self.comfyui_input_dir)
             logger.info("已初始化 ComfyUI 输入目录")
-        
-        # 检查 ComfyUI 目录结构
-        logger.debug(f"ComfyUI根目录: {self.comfyui_root}")
         logger.debug(f"ComfyUI输入目录: {self.comfyui_input_dir}")
+    
+    @property
+    def task_coordinator(self):
+        """任务协调器（没有注入时在第一次使用时创建，之后所有请求共用）"""
+        if self._task_coordinator is None:
+            from agents.task_coordinator import TaskCoordinator
+            self._task_coordinator = TaskCoordinator(config=self.config)
+        return self._task_coordinator
+    
+    def enhance_image(self, image_path, denoise_value=60, preset=None, budget_seconds=None):
+        """使用ComfyUI美化图片
         
-        # 列出 ComfyUI 目录内容
-        try:
-            if logger.isEnabledFor(logging.DEBUG):
-                logger.debug("ComfyUI 目录内容:")
-                for root, dirs, files in os.walk(self.comfyui_root):
-                    logger.debug(f"目录: {root}")
-                    for d in dirs:
-                        logger.debug(f"  子目录: {d}")
-                    for f in files:
-                        logger.debug(f"  文件: {f}")
-        except Exception as e:
-            logger.debug(f"无法列出 ComfyUI 目录内容: {str(e)}")
+        Args:
+            image_path: 图片路径
+            denoise_value: 降噪值（0-100）
+            preset: 质量预设 fast/balanced/best，为空时按队列长度和延迟预算自动选择
+            budget_seconds: 本次请求的延迟预算（秒），默认使用 ENHANCE_LATENCY_BUDGET
+            
+        Returns:
+            str: 美化后的图片路径，失败时返回None
+        """
+        output_paths = self._enhance(image_path, denoise_value, preset, budget_seconds)
+        return output_paths[0] if output_paths else None
     
-    def enhance_image(self, image_path, denoise_value=60):
-        """使用ComfyUI美化图片"""
+    def enhance_variants(self, image_path, variants, denoise_value=60, preset=None, budget_seconds=None):
+        """在一次采样中生成多张候选美化图
+        
+        候选图共用一次图片分析、模型加载和 VAE 编码，作为同一个批次在 KSampler 中一起采样，
+        比用户不满意时逐次重新美化节省 LLM 调用和 GPU 时间。
+        
+        Args:
+            image_path: 图片路径
+            variants: 候选图数量，超过 ENHANCE_MAX_VARIANTS 时按上限生成
+            denoise_value: 降噪值（0-100）
+            preset: 质量预设，同 enhance_image
+            budget_seconds: 本次请求的延迟预算（秒）
+            
+        Returns:
+            List[str]: 候选图路径列表，失败时返回None
+        """
+        variants = max(1, min(int(variants), self.enhance_max_variants))
+        return self._enhance(image_path, denoise_value, preset, budget_seconds, variants)
+    
+    def _enhance(self, image_path, denoise_value, preset, budget_seconds, variants=1):
+        """美化流程：图片分析、提交美化工作流、保存输出
+        
+        Returns:
+            List[str]: 美化后的图片路径（每张候选图一个），失败时返回None
+        """
+        # 预处理依赖 NumPy，在第一次美化时才导入，缩短应用启动时间
+        from services.image_preprocess import remove_white_background
+        
+        started_at = time.monotonic()
+        image = None
+        prepared = None
         try:
             logger.info("开始处理图片美化任务")
             
@@ -70,9 +283,17 @@ class ComfyUIService:
             file_size = os.path.getsize(image_path)
             logger.info(f"原始图片文件大小: {file_size} 字节")
             
+            # 图片只解码一次（按内存预算放行），分析、感知哈希、调色板和预处理共用
+            image = SharedImage(image_path, image_budget)
+            
+            # 输入图片的预处理、写入 ComfyUI 输入目录和工作流的准备都不依赖提示词，
+            # 与百度/LLM 分析并行执行，分析完成后只需填入提示词即可提交
+            prepared = _prepare_executor.submit(self._prepare_enhance, image_path, image, denoise_value) \
+                if self.enhance_pipeline else None
+            
             # 使用任务协调器处理图片
             logger.info(f"开始使用任务协调器处理图片: {image_path}")
-            result = self.task_coordinator.process_image(image_path)
+            result = self.task_coordinator.process_image(image_path, image)
             if result.get("status") == "error":
                 logger.error(f"图片处理失败: {result.get('error')}")
                 return None
@@ -96,46 +317,38 @@ class ComfyUIService:
             logger.info(f"负面提示词: {negative_prompt}")
             logger.info("=====================\n")
             
-            comfyui_image_path = os.path.join(self.comfyui_input_dir, original_filename)
-            logger.info(f"ComfyUI输入图片路径: {comfyui_image_path}")
-            
-            # 复制并转换图片为PNG格式
+            blocking_start = time.monotonic()
             try:
-                with Image.open(image_path) as img:
-                    if img.mode != 'RGB':
-                        logger.info(f"转换图片模式: {img.mode} -> RGB")
-                        img = img.convert('RGB')
-                    img.save(comfyui_image_path, 'PNG')
-                    logger.info(f"已保存处理图片: {comfyui_image_path}")
+                input_filename, preprocessed, workflow = prepared.result() if prepared else \
+                    self._prepare_enhance(image_path, image, denoise_value)
             except Exception as e:
-                logger.error(f"图片处理失败: {str(e)}")
-                logger.exception("图片处理详细错误")
+                logger.error(f"准备美化输入失败: {str(e)}")
+                logger.exception("准备美化输入详细错误")
                 return None
+            ENHANCE_PREPARE_BLOCKING.observe(time.monotonic() - blocking_start,
+                                             mode='pipelined' if prepared else 'sequential')
+            # 之后只等待 GPU，提前释放解码结果和预留的内存
+            image.close()
+            light = bool(preprocessed and preprocessed['clean_scan'] and self.enhance_light_variant)
             
-            # 读取工作流配置
-            workflow = self._load_workflow('enhance_workflow.json')
-            if not workflow:
-                logger.error("加载工作流配置失败")
-                return None
+            # 选择质量预设：预算从请求开始计算，已经扣除图片分析的耗时
+            if preset in ENHANCE_PRESETS:
+                ENHANCE_PRESET_CHOICES.inc(preset=preset, reason='requested')
+            else:
+                budget = self.enhance_budget if budget_seconds is None else budget_seconds
+                complexity = 1.0 - preprocessed['background_ratio'] if preprocessed else None
+                preset = self.choose_enhance_preset(budget - (time.monotonic() - started_at), complexity, variants)
             
-            # 更新工作流配置
+            # 填入提示词，按预设和候选数调整工作流
             try:
-                # 更新图片加载节点
-                workflow["50"]["inputs"]["image"] = original_filename
-                
-                # 更新降噪值（通过 FloatSlider 节点）
-                workflow["48"]["inputs"]["float_value"] = denoise_value
-                
-                # 更新提示词
                 workflow["6"]["inputs"]["text"] = positive_prompt
                 workflow["7"]["inputs"]["text"] = negative_prompt
+                self._apply_enhance_variant(workflow, preprocessed['size'] if preprocessed else None, light, preset,
+                                            variants)
                 
-                # 更新 LoRA
-                workflow["28"]["inputs"]["lora_name"] = "白边贴纸·风格_v1.0.safetensors"
-                
-                logger.info("已更新工作流配置")
+                logger.info(f"已更新工作流配置（预设 {preset}，{'轻量' if light else '完整'}工作流，{variants} 张候选图）")
                 logger.debug(f"工作流配置详情:")
-                logger.debug(f"- 输入图片: {original_filename}")
+                logger.debug(f"- 输入图片: {input_filename}")
                 logger.debug(f"- 降噪值: {denoise_value}")
                 logger.debug(f"- 正面提示词: {positive_prompt}")
                 logger.debug(f"- 负面提示词: {negative_prompt}")
@@ -144,50 +357,219 @@ class ComfyUIService:
                 return None
             
             # 发送工作流
-            prompt_id = self._queue_prompt(workflow)
+            variant = f"enhance_{preset}" + ('_light' if light else '')
+            ENHANCE_VARIANTS.inc(variant=variant)
+            workflow_name = variant if variants == 1 else f"{variant}_x{variants}"
+            prompt_id = self._queue_prompt(workflow, workflow_name, ENHANCE_SAMPLER_CLASS,
+                                           front=self._should_jump_queue(input_filename))
             if not prompt_id:
                 logger.error("无法将工作流加入队列")
                 return None
+            self._prompt_variants[prompt_id] = variants
             logger.info(f"工作流已加入队列，prompt_id: {prompt_id}")
             
             # 等待处理完成
-            output = self._wait_for_output(prompt_id)
+            output = self._wait_for_output(prompt_id, timeout=ENHANCE_TIMEOUT)
             if not output:
                 logger.error("工作流处理失败或超时")
                 return None
             logger.info(f"工作流处理完成，输出: {output}")
             
-            # 保存美化后的图片
-            enhanced_filename = f"enhanced_{original_filename}"
-            output_path = os.path.join('uploads', enhanced_filename)
-            logger.info(f"准备保存美化后的图片: {output_path}")
+            if len(output) < variants:
+                logger.error(f"工作流输出 {len(output)} 张图片，少于请求的 {variants} 张候选图")
+                return None
             
-            if self._save_output(output, output_path):
-                logger.info(f"美化后的图片已保存: {output_path}")
+            # 保存美化后的图片；多张候选图时按序号命名
+            output_paths = []
+            for index, output_file in enumerate(output[:variants]):
+                if variants == 1:
+                    enhanced_filename = f"enhanced_{original_filename}"
+                else:
+                    name, ext = os.path.splitext(original_filename)
+                    enhanced_filename = f"enhanced_{name}_{index + 1}{ext}"
+                output_path = os.path.join('uploads', enhanced_filename)
+                logger.info(f"准备保存美化后的图片: {output_path}")
                 
-                # 检查文件是否存在和大小
-                if os.path.exists(output_path):
-                    enhanced_size = os.path.getsize(output_path)
-                    logger.info(f"美化后图片文件大小: {enhanced_size} 字节")
+                # 轻量工作流没有在GPU上去背景，改为在CPU上把白色背景设为透明
+                saved = (light and remove_white_background(output_file, output_path)) or \
+                    self._save_output([output_file], output_path)
+                if saved:
+                    logger.info(f"美化后的图片已保存: {output_path}")
+                    
+                    # 检查文件是否存在和大小
+                    if os.path.exists(output_path):
+                        enhanced_size = os.path.getsize(output_path)
+                        logger.info(f"美化后图片文件大小: {enhanced_size} 字节")
+                    else:
+                        logger.error(f"美化后图片文件不存在: {output_path}")
                 else:
-                    logger.error(f"美化后图片文件不存在: {output_path}")
-            else:
-                logger.error(f"保存美化后的图片失败")
-                return None
+                    logger.error(f"保存美化后的图片失败")
+                    return None
+                output_paths.append(output_path)
             
-            # 清理临时文件
-            try:
-                os.remove(comfyui_image_path)
-                logger.info("已清理临时文件")
-            except Exception as e:
-                logger.info(f"清理临时文件失败: {str(e)}")
+            # 输入图片保留一段时间供同一张图片的后续任务复用，只清理过期的
+            self._evict_inputs()
             
-            return output_path
+            return output_paths
             
         except Exception as e:
             logger.error(f"图片美化失败: {str(e)}")
             logger.exception("美化图片详细错误信息")
             return None
+        finally:
+            if prepared is not None:
+                # 分析失败提前返回时，等准备线程用完解码结果再释放预留的内存
+                wait([prepared])
+            if image is not None:
+                image.close()
+    
+    def _prepare_enhance(self, image_path, image, denoise_value):
+        """准备美化工作流中不依赖提示词的部分
+        
+        在 CPU 上清理画作（纸张背景置白、裁剪、缩放到原生分辨率，失败时直接转换为PNG）并以内容哈希命名
+        写入 ComfyUI 输入目录（同一张图片重复美化时复用已写入的文件），然后加载工作流模板并填入输入图片、
+        降噪值和 LoRA。提示词、预设和候选数在图片分析完成后填入。
+        
+        Args:
+            image_path: 图片路径
+            image: SharedImage，与图片分析共用同一份解码结果
+            denoise_value: 降噪值（0-1.0）
+            
+        Returns:
+            Tuple[str, Dict, Dict]: (输入目录中的文件名, 预处理元数据, 工作流)
+        """
+        from services.image_preprocess import preprocess_drawing
+        
+        def prepare(source, target):
+            preprocessed = preprocess_drawing(source, target, image)
+            if preprocessed is not None:
+                return preprocessed
+            with Image.open(source) as img:
+                if img.mode != 'RGB':
+                    logger.info(f"转换图片模式: {img.mode} -> RGB")
+                    img = img.convert('RGB')
+                img.save(target, 'PNG')
+            return {}
+        
+        input_filename, preprocessed = self._stage_input(image_path, 'enhance', prepare)
+        logger.info(f"ComfyUI输入图片: {input_filename}")
+        
+        workflow = self._load_workflow('enhance_workflow.json')
+        if not workflow:
+            raise ValueError("加载工作流配置失败")
+        # 图片加载节点、降噪值（FloatSlider 节点）和 LoRA
+        workflow["50"]["inputs"]["image"] = input_filename
+        workflow["48"]["inputs"]["float_value"] = denoise_value
+        workflow["28"]["inputs"]["lora_name"] = "白边贴纸·风格_v1.0.safetensors"
+        return input_filename, preprocessed, workflow
+    
+    def choose_enhance_preset(self, budget_seconds, complexity=None, variants=1):
+        """按 ComfyUI 队列长度和延迟预算选择美化预设
+        
+        预计耗时 = 队列中各任务的预计耗时之和 + 该预设的平均耗时（没有实测数据时使用预设的估计值），
+        从质量最高的预设开始选择第一个不超过预算的；都超过时使用 fast。
+        一次生成多张候选图时使用该候选数的平均耗时，没有实测数据时按单张耗时乘以候选数保守估计。
+        
+        Args:
+            budget_seconds: 剩余的延迟预算（秒）
+            complexity: 画作的笔迹占比，简单画作不使用 best
+            variants: 候选图数量
+            
+        Returns:
+            str: 预设名称
+        """
+        self._sync_job_seconds()
+        queue_wait = self._estimate_queue_wait()
+        candidates = ENHANCE_PRESET_ORDER
+        if complexity is not None and complexity < SIMPLE_DRAWING_INK_RATIO:
+            candidates = candidates[1:]
+        
+        for preset in candidates:
+            preset_seconds = self._avg_job_seconds.get(f"enhance_{preset}", ENHANCE_PRESETS[preset]['estimated_seconds'])
+            if variants > 1:
+                preset_seconds = self._avg_job_seconds.get(f"enhance_{preset}_x{variants}", preset_seconds * variants)
+            if queue_wait + preset_seconds <= budget_seconds:
+                reason = 'auto'
+                break
+        else:
+            preset, reason = ENHANCE_PRESET_ORDER[-1], 'over_budget'
+        ENHANCE_PRESET_CHOICES.inc(preset=preset, reason=reason)
+        logger.info(f"美化预设: {preset}（队列预计等待 {queue_wait:.0f} 秒，剩余预算 {budget_seconds:.0f} 秒）")
+        return preset
+    
+    def _estimate_queue_wait(self):
+        """估算 ComfyUI 队列中现有任务的总耗时（秒），查询失败时返回0"""
+        try:
+            response = self.session.get(f"{self.comfyui_url}/queue", timeout=5)
+            queue = response.json()
+        except Exception as e:
+            logger.warning(f"查询ComfyUI队列失败: {str(e)}")
+            return 0.0
+        items = queue.get("queue_running", []) + queue.get("queue_pending", [])
+        QUEUE_DEPTH.set(len(items))
+        
+        # 本服务（包括其他工作进程）提交的任务按其模板的平均耗时估算，其他任务按所有模板的平均耗时估算
+        prompt_workflows = self._prompt_workflows
+        if self.shared_state and items:
+            prompt_workflows = dict(self.shared_state.cache_items('prompt_workflows'), **prompt_workflows)
+        known = [seconds for seconds in self._avg_job_seconds.values() if seconds]
+        default_seconds = sum(known) / len(known) if known else ENHANCE_PRESETS[DEFAULT_ENHANCE_PRESET]['estimated_seconds']
+        return sum(self._avg_job_seconds.get(prompt_workflows.get(item[1]), default_seconds) for item in items)
+    
+    def _sync_job_seconds(self):
+        """读取其他工作进程记录的模板平均耗时"""
+        if not self.shared_state:
+            return
+        try:
+            self._avg_job_seconds.update(self.shared_state.cache_items('job_seconds'))
+        except Exception as e:
+            logger.warning(f"读取共享的工作流耗时失败: {str(e)}")
+    
+    def _apply_enhance_variant(self, workflow, size, light, preset=DEFAULT_ENHANCE_PRESET, variants=1):
+        """按预设和预处理后的图片尺寸调整美化工作流，干净扫描件改用轻量变体
+        
+        第一遍采样使用图片本身的原生分辨率（不再统一拉伸到竖版 600x800），第二遍按预设的倍数放大。
+        预设没有第二遍采样或使用轻量变体时去掉第二遍放大采样（节点 58、11）；
+        轻量变体还会用 SaveImage 代替 GPU 去背景节点 42。
+        多张候选图时在节点 10 和第一遍 KSampler 之间插入 RepeatLatentBatch，下游节点按批次处理。
+        
+        Args:
+            workflow: 美化工作流
+            size: 预处理后的图片宽高，为空时沿用工作流中节点 10 的尺寸
+            light: 是否使用轻量变体
+            preset: 质量预设名称
+            variants: 候选图数量（latent 批次大小）
+        """
+        from services.image_preprocess import second_pass_size
+        
+        config = ENHANCE_PRESETS[preset]
+        if size:
+            workflow["10"]["inputs"]["width"], workflow["10"]["inputs"]["height"] = size
+        size = (workflow["10"]["inputs"]["width"], workflow["10"]["inputs"]["height"])
+        workflow["58"]["inputs"]["width"], workflow["58"]["inputs"]["height"] = \
+            second_pass_size(size, config['second_pass_scale'])
+        
+        workflow["3"]["inputs"]["steps"] = config['steps']
+        workflow["11"]["inputs"]["steps"] = config['second_steps']
+        if config['scheduler']:
+            workflow["3"]["inputs"]["scheduler"] = workflow["11"]["inputs"]["scheduler"] = config['scheduler']
+        
+        if light or not config['second_steps']:
+            workflow["13"]["inputs"]["samples"] = ["3", 0]
+            del workflow["58"], workflow["11"]
+        if light:
+            workflow["42"] = {
+                "inputs": {"filename_prefix": "xiao_enhance", "images": ["13", 0]},
+                "class_type": "SaveImage",
+                "_meta": {"title": "Save Image"}
+            }
+        if variants > 1:
+            workflow[ENHANCE_BATCH_NODE] = {
+                "inputs": {"samples": ["10", 0], "amount": variants},
+                "class_type": "RepeatLatentBatch",
+                "_meta": {"title": "Repeat Latent Batch"}
+            }
+            workflow["3"]["inputs"]["latent_image"] = [ENHANCE_BATCH_NODE, 0]
     
     def adjust_image(self, image_path, denoise_value):
         """使用ComfyUI调整图片参数"""
@@ -217,27 +599,140 @@ class ComfyUIService:
             logger.error(f"图片调整失败: {str(e)}")
             return None
     
-    def create_animation(self, image_path, action='smile'):
-        """使用ComfyUI将图片转换为视频"""
+    def create_animation(self, image_path, action=DEFAULT_ANIMATION_ACTION, output_format=DEFAULT_ANIMATION_FORMAT,
+                         job=None, timeout=ANIMATION_TIMEOUT, tier=DEFAULT_ANIMATION_TIER, seed=None):
+        """使用ComfyUI将图片转换为视频
+        
+        Args:
+            image_path: 输入图片路径
+            action: 动画动作
+            output_format: 输出格式，ANIMATION_FORMATS 中的键（gif/webp/mp4/webm）
+            job: 后台任务对象，提供时会记录 prompt_id 以便查询进度，并响应任务的取消请求
+            timeout: 服务端等待输出的最长时间（秒），超时后取消ComfyUI中的工作流
+            tier: 渲染档位，ANIMATION_TIERS 中的键（preview/full）
+            seed: 采样种子，为空时使用模板中的种子
+            
+        Returns:
+            Dict: 包含动画路径、封面缩略图路径、格式、MIME类型、渲染档位、提示词、种子和执行耗时的字典，失败时返回None
+        """
         try:
-            logger.info("开始生成动画任务")
+            logger.info(f"开始生成动画任务（{tier}）")
+            prompt_id, prompts, seed = self._submit_animation(image_path, [action], output_format, job, tier, seed=seed)
+            result = self._finish_animation(prompt_id, image_path, output_format, timeout, job, tier=tier)
+            return dict(result, prompts=prompts, seed=seed)
             
-            if not os.path.exists(image_path):
-                raise Exception(f"输入图片不存在: {image_path}")
+        except Exception as e:
+            logger.error(f"动画生成失败: {str(e)}")
+            logger.error(traceback.format_exc())
+            return None
+    
+    def create_animations(self, image_path, actions, output_format=DEFAULT_ANIMATION_FORMAT, job=None,
+                          timeout=ANIMATION_TIMEOUT, tier=DEFAULT_ANIMATION_TIER, seed=None):
+        """在一个ComfyUI工作流中为同一张图片生成多个动作的动画
+        
+        只分析一次图片；模型加载和图片编码节点所有动作共用，每个动作只增加文本编码、采样、
+        解码和合成节点。
+        
+        Args:
+            image_path: 输入图片路径
+            actions: 动作列表（ANIMATION_ACTIONS 中的键，重复的只生成一次）
+            output_format: 输出格式
+            job: 后台任务对象
+            timeout: 服务端等待输出的最长时间（秒）
+            tier: 渲染档位（preview/full）
+            seed: 采样种子，为空时使用模板中的种子
             
-            # 复制输入图片到ComfyUI输入目录
-            input_filename = os.path.basename(image_path)
-            comfyui_input_path = os.path.join(self.comfyui_input_dir, input_filename)
+        Returns:
+            Dict: animations（按动作顺序，每项包含 action、animation、poster）、format、mimetype、
+                渲染档位、提示词、种子和执行耗时，失败时返回None
+        """
+        try:
+            actions = list(dict.fromkeys(actions))
+            unknown = [action for action in actions if action not in ANIMATION_ACTIONS]
+            if not actions or unknown:
+                raise Exception(f"不支持的动画动作: {unknown or actions}")
+            logger.info(f"开始生成多动作动画任务（{tier}）: {actions}")
+            prompt_id, prompts, seed = self._submit_animation(image_path, actions, output_format, job, tier, seed=seed)
+            result = self._finish_animation(prompt_id, image_path, output_format, timeout, job, actions=actions,
+                                            tier=tier)
+            return dict(result, prompts=prompts, seed=seed)
             
-            try:
-                shutil.copy2(image_path, comfyui_input_path)
-                logger.debug(f"已复制输入图片到ComfyUI: {comfyui_input_path}")
-            except Exception as e:
-                raise Exception(f"复制输入图片失败: {str(e)}")
+        except Exception as e:
+            logger.error(f"多动作动画生成失败: {str(e)}")
+            logger.error(traceback.format_exc())
+            return None
+    
+    def promote_animation(self, image_path, preview, action=DEFAULT_ANIMATION_ACTION,
+                          output_format=DEFAULT_ANIMATION_FORMAT, job=None, timeout=ANIMATION_TIMEOUT):
+        """把预览档动画重新渲染为完整动画
+        
+        沿用预览的提示词和种子（不再分析图片），动作和构图与预览一致，只是帧数、分辨率和步数恢复为模板设置。
+        
+        Args:
+            image_path: 输入图片路径（与预览相同）
+            preview: 预览的结果，使用其中的 prompts、seed 和 gpu_seconds；没有提示词时重新分析图片
+            action: 预览的动作，多动作预览时为动作列表
+            output_format: 输出格式
+            job: 后台任务对象
+            timeout: 服务端等待输出的最长时间（秒）
             
+        Returns:
+            Dict: 与 create_animation（或 create_animations）相同，另外 total_gpu_seconds 为预览和完整渲染的耗时之和；失败时返回None
+        """
+        try:
+            actions = action if isinstance(action, list) else None
+            logger.info(f"开始把预览升级为完整动画（种子 {preview.get('seed')}）")
+            prompt_id, prompts, seed = self._submit_animation(
+                image_path, actions or [action], output_format, job, DEFAULT_ANIMATION_TIER,
+                prompts=preview.get('prompts'), seed=preview.get('seed'))
+            ANIMATION_PROMOTIONS.inc()
+            result = self._finish_animation(prompt_id, image_path, output_format, timeout, job, actions=actions,
+                                            preview_seconds=preview.get('gpu_seconds') or 0.0)
+            return dict(result, prompts=prompts, seed=seed)
+            
+        except Exception as e:
+            logger.error(f"升级预览动画失败: {str(e)}")
+            logger.error(traceback.format_exc())
+            return None
+    
+    def _submit_animation(self, image_path, actions, output_format, job=None, tier=DEFAULT_ANIMATION_TIER,
+                          prompts=None, seed=None):
+        """把输入图片写入ComfyUI输入目录、分析主体并提交动画工作流
+        
+        Args:
+            image_path: 输入图片路径
+            actions: 动作列表
+            output_format: 输出格式
+            job: 后台任务对象
+            tier: 渲染档位（preview/full）
+            prompts: 各动作的提示词（升级预览时沿用预览的提示词），为空时分析图片生成
+            seed: 采样种子，为空时使用模板中的种子
+            
+        Returns:
+            Tuple[str, List[str], int]: (prompt_id, 各动作的提示词, 采样种子)
+            
+        Raises:
+            Exception: 输入无效、分析失败、任务已取消或提交失败
+        """
+        if not os.path.exists(image_path):
+            raise Exception(f"输入图片不存在: {image_path}")
+        
+        format_config = ANIMATION_FORMATS.get(output_format)
+        if not format_config:
+            raise Exception(f"不支持的动画格式: {output_format}")
+        
+        # 复制输入图片到ComfyUI输入目录（按内容哈希命名，同一张图片的后续动作复用图片编码节点的缓存）
+        try:
+            input_filename, _ = self._stage_input(image_path, 'animation')
+            logger.debug(f"已复制输入图片到ComfyUI: {input_filename}")
+        except Exception as e:
+            raise Exception(f"复制输入图片失败: {str(e)}")
+        
+        if prompts and len(prompts) == len(actions):
+            logger.info(f"沿用已有的动画提示词: {prompts}")
+        else:
             # 使用任务协调器分析图片
-            task_coordinator = TaskCoordinator()
-            analysis_result = task_coordinator.image_analyzer.analyze_image(image_path)
+            analysis_result = self.task_coordinator.image_analyzer.analyze_image(image_path)
             
             if analysis_result.get("status") == "error":
                 raise Exception(f"图片分析失败: {analysis_result.get('error')}")
@@ -250,62 +745,228 @@ class ComfyUIService:
                 # 使用第一个检测到的物体作为主体
                 subject = f"a {objects[0]}"
             
-            # 动作提示词配置
-            action_prompts = {
-                'smile': f"{subject}, smiling, lips slightly open, eyes winking, cheerful expression, white background",
-                'wave': f"{subject}, waving hands, arms raised, friendly gesture, dynamic pose, white background",
-                'dance': f"{subject}, dancing, arms up, legs moving, joyful movement, dynamic pose, white background",
-                'walk': f"{subject}, walking, legs in motion, arms swinging, natural stride, white background",
-                'jump': f"{subject}, jumping, legs bent, arms up, mid-air pose, dynamic movement, white background",
-                'spin': f"{subject}, spinning, arms spread, body rotating, dynamic motion, white background"
-            }
-            
-            # 获取当前动作的提示词
-            current_prompt = action_prompts.get(action, action_prompts['smile'])
+            # 获取各动作的提示词
+            prompts = [ANIMATION_ACTIONS.get(action, ANIMATION_ACTIONS[DEFAULT_ANIMATION_ACTION]).format(subject=subject)
+                       for action in actions]
             logger.info(f"\n=== 动画生成提示词 ===")
             logger.info(f"检测到的物体: {objects}")
             logger.info(f"选择的主体: {subject}")
-            logger.info(f"动作: {action}")
-            logger.info(f"完整提示词: {current_prompt}")
+            for action, prompt in zip(actions, prompts):
+                logger.info(f"动作: {action}")
+                logger.info(f"完整提示词: {prompt}")
             logger.info("=====================\n")
+        
+        workflow = self._animation_workflow(input_filename, prompts, format_config, tier, seed)
+        seed = workflow[ANIMATION_SEED_NODE]["inputs"]["seed"]
+        logger.info(f"动画输出格式: {output_format} ({format_config['vhs_format']})，渲染档位 {tier}，种子 {seed}")
+        
+        # 分析期间任务可能已被取消，此时不再提交工作流
+        if job and job.cancelled:
+            raise Exception(f"任务已取消: {job.cancel_reason}")
+        
+        # 发送工作流到队列
+        workflow_name = self._animation_workflow_name(len(actions), tier)
+        prompt_id = self._queue_prompt(workflow, workflow_name, ANIMATION_SAMPLER_CLASS,
+                                       front=self._should_jump_queue(input_filename))
+        if not prompt_id:
+            raise Exception("无法将工作流加入队列")
+        self._prompt_actions[prompt_id] = len(actions)
+        self._prompt_tiers[prompt_id] = tier
+        if job:
+            # 立即写入任务日志，服务重启后可以凭 prompt_id 继续等待输出
+            job.record_prompt(prompt_id, self.comfyui_url)
+        return prompt_id, prompts, seed
+    
+    @staticmethod
+    def _animation_workflow_name(count, tier=DEFAULT_ANIMATION_TIER):
+        """动画工作流的模板名称（animation、animation_x3、animation_preview、animation_preview_x3）"""
+        name = 'animation' if tier == DEFAULT_ANIMATION_TIER else f"animation_{tier}"
+        return name if count == 1 else f"{name}_x{count}"
+    
+    def _animation_workflow(self, input_filename, prompts, format_config, tier=DEFAULT_ANIMATION_TIER, seed=None):
+        """构建动画工作流，每个提示词一个分支（一个提示词时与模板相同）
+        
+        Args:
+            input_filename: ComfyUI 输入目录中的图片文件名
+            prompts: 各动作的提示词
+            format_config: ANIMATION_FORMATS 中的输出格式配置
+            tier: 渲染档位，设置帧数、最长边和采样步数
+            seed: 采样种子，为空时使用模板中的种子
+        """
+        workflow = self._load_workflow('animation_workflow.json')
+        workflow["150"]["inputs"]["image"] = input_filename
+        
+        # 渲染档位和种子（复制分支之前设置，所有分支相同）
+        settings = ANIMATION_TIERS[tier]
+        if settings['frames']:
+            workflow[ANIMATION_FRAMES_NODE]["inputs"]["Number"] = str(settings['frames'])
+        if settings['size']:
+            workflow[ANIMATION_SIZE_NODE]["inputs"]["Number"] = str(settings['size'])
+        if settings['steps']:
+            workflow["144"]["inputs"]["steps"] = settings['steps']
+        if seed is not None:
+            workflow[ANIMATION_SEED_NODE]["inputs"]["seed"] = int(seed)
+        
+        # 更新输出格式（复制分支之前设置，所有分支相同）
+        combine_inputs = workflow[ANIMATION_OUTPUT_NODE]["inputs"]
+        combine_inputs["format"] = format_config['vhs_format']
+        combine_inputs.update(format_config.get('extra_inputs', {}))
+        
+        branch_template = {node_id: workflow[node_id] for node_id in ANIMATION_BRANCH_NODES}
+        for index, prompt in enumerate(prompts):
+            for node_id, node in branch_template.items():
+                branch_node = copy.deepcopy(node)
+                for name, value in branch_node["inputs"].items():
+                    # 分支内部的连接指向同一分支的节点，其余连接指向共用节点
+                    if isinstance(value, list) and value and value[0] in branch_template:
+                        branch_node["inputs"][name] = [self._branch_node_id(value[0], index), value[1]]
+                workflow[self._branch_node_id(node_id, index)] = branch_node
+            workflow[self._branch_node_id("166", index)]["inputs"]["string"] = prompt
+        return workflow
+    
+    @staticmethod
+    def _branch_node_id(node_id, index):
+        return node_id if index == 0 else str(int(node_id) + index * ANIMATION_BRANCH_ID_OFFSET)
+    
+    def resume_animation(self, prompt_id, image_path, output_format=DEFAULT_ANIMATION_FORMAT, job=None,
+                         timeout=ANIMATION_TIMEOUT, actions=None, tier=DEFAULT_ANIMATION_TIER, preview_seconds=None):
+        """服务重启后继续等待已提交到 ComfyUI 的动画工作流，不重新提交
+        
+        Args:
+            prompt_id: 重启前提交的 prompt_id
+            image_path: 输入图片路径（用于确定输出文件名）
+            output_format: 输出格式
+            job: 后台任务对象
+            timeout: 从现在起等待输出的最长时间（秒）
+            actions: 多动作动画的动作列表（与提交时相同），单个动作时为None
+            tier: 渲染档位（与提交时相同）
+            preview_seconds: 由预览升级的完整渲染，预览的执行耗时
             
-            # 加载动画工作流
-            workflow = self._load_workflow('animation_workflow.json')
-            
-            # 更新工作流配置
-            workflow["150"]["inputs"]["image"] = input_filename
-            workflow["166"]["inputs"]["string"] = current_prompt
-            
-            # 发送工作流到队列
-            prompt_id = self._queue_prompt(workflow)
-            if not prompt_id:
-                raise Exception("无法将工作流加入队列")
-            
-            # 等待处理完成
-            output = self._wait_for_output(prompt_id, timeout=600)  # 增加超时时间到10分钟
-            if not output:
-                raise Exception("工作流处理失败或超时")
-            
-            # 保存生成的动画
-            output_filename = f"animated_{os.path.splitext(input_filename)[0]}.gif"
-            output_path = os.path.join('uploads', output_filename)
-            self._save_output(output, output_path)
-            
-            # 清理临时文件
-            try:
-                os.remove(comfyui_input_path)
-                logger.debug("已清理临时文件")
-            except Exception as e:
-                logger.debug(f"清理临时文件失败: {str(e)}")
-            
-            logger.info("动画生成完成")
-            return output_path
-            
+        Returns:
+            Dict: 与 create_animation（或 create_animations）相同（不含提示词和种子）；ComfyUI 中已经没有该工作流时返回 {'lost': True}，其他失败返回None
+        """
+        try:
+            if job and job.backend and job.backend != self.comfyui_url:
+                logger.warning(f"工作流 {prompt_id} 提交到了 {job.backend}，当前后端为 {self.comfyui_url}")
+                return {'lost': True}
+            known = self._prompt_known(prompt_id)
+            if known is False:
+                logger.warning(f"ComfyUI 中已找不到工作流 {prompt_id}（可能 ComfyUI 也重启过）")
+                return {'lost': True}
+            logger.info(f"继续等待重启前提交的动画工作流 {prompt_id}")
+            # 进度事件会发往重启前的 clientId，这里只登记模板和动作数，执行耗时不计入统计
+            count = len(actions) if actions else 1
+            workflow = self._animation_workflow(os.path.basename(image_path), [''] * count,
+                                                ANIMATION_FORMATS[output_format], tier)
+            workflow_name = self._animation_workflow_name(count, tier)
+            self.progress_tracker.register(prompt_id, workflow, ANIMATION_SAMPLER_CLASS, workflow_name)
+            self._prompt_workflows[prompt_id] = workflow_name
+            self._prompt_actions[prompt_id] = count
+            self._prompt_tiers[prompt_id] = tier
+            self._resumed_prompts.add(prompt_id)
+            return self._finish_animation(prompt_id, image_path, output_format, timeout, job, actions=actions,
+                                          tier=tier, preview_seconds=preview_seconds)
         except Exception as e:
-            logger.error(f"动画生成失败: {str(e)}")
+            logger.error(f"继续动画任务失败: {str(e)}")
             logger.error(traceback.format_exc())
             return None
     
+    def _prompt_known(self, prompt_id):
+        """ComfyUI 是否还记得该工作流（已完成或仍在队列中）
+        
+        Returns:
+            bool: ComfyUI 无法访问时返回None
+        """
+        try:
+            history = self.session.get(f"{self.comfyui_url}/history/{prompt_id}", timeout=10).json()
+            if prompt_id in history:
+                return True
+            queue = self.session.get(f"{self.comfyui_url}/queue", timeout=10).json()
+            items = queue.get("queue_running", []) + queue.get("queue_pending", [])
+            return any(item[1] == prompt_id for item in items)
+        except Exception as e:
+            logger.warning(f"查询工作流 {prompt_id} 状态失败: {str(e)}")
+            return None
+    
+    def _finish_animation(self, prompt_id, image_path, output_format, timeout, job=None, actions=None,
+                          tier=DEFAULT_ANIMATION_TIER, preview_seconds=None):
+        """等待动画工作流的输出，保存动画和封面缩略图（多动作时每个动作一份，按原图文件名命名）
+        
+        预览档的文件名带 _preview 后缀，升级后的完整动画不会覆盖预览。preview_seconds 不为空时
+        （由预览升级）每个动画的 GPU 耗时包含预览的耗时。
+        """
+        format_config = ANIMATION_FORMATS[output_format]
+        base_name = os.path.splitext(os.path.basename(image_path))[0]
+        if tier != DEFAULT_ANIMATION_TIER:
+            base_name = f"{base_name}_{tier}"
+        
+        # 等待处理完成
+        output = self._wait_for_output(prompt_id, timeout=timeout, job=job, by_node=actions is not None)
+        gpu_seconds = self._prompt_gpu_seconds.pop(prompt_id, None)
+        if not output:
+            raise Exception("工作流处理失败或超时")
+        
+        # 保留的（完整档）动画每个分摊的 GPU 耗时，由预览升级的加上预览的耗时
+        count = len(actions) if actions else 1
+        total_gpu_seconds = None
+        if gpu_seconds is not None:
+            total_gpu_seconds = gpu_seconds + (preview_seconds or 0.0)
+            if tier == DEFAULT_ANIMATION_TIER:
+                for _ in range(count):
+                    ANIMATION_KEPT_GPU_SECONDS.observe(total_gpu_seconds / count,
+                                                       source='promoted' if preview_seconds is not None else 'direct')
+        
+        if actions is None:
+            animation_path, poster_path = self._save_animation(output, base_name, format_config)
+        else:
+            animations = []
+            for index, action in enumerate(actions):
+                files = (output.get(self._branch_node_id(ANIMATION_OUTPUT_NODE, index), []) +
+                         output.get(self._branch_node_id(ANIMATION_POSTER_NODE, index), []))
+                animation_path, poster_path = self._save_animation(files, f"{base_name}_{action}", format_config)
+                animations.append({'action': action, 'animation': animation_path, 'poster': poster_path})
+        
+        # 输入图片保留一段时间供同一张图片的后续动作复用，只清理过期的
+        self._evict_inputs()
+        
+        logger.info("动画生成完成")
+        summary = {
+            'format': output_format,
+            'mimetype': format_config['mimetype'],
+            'tier': tier,
+            'gpu_seconds': round(gpu_seconds, 1) if gpu_seconds is not None else None
+        }
+        if preview_seconds is not None and total_gpu_seconds is not None:
+            summary['total_gpu_seconds'] = round(total_gpu_seconds, 1)
+        if actions is not None:
+            return dict(summary, animations=animations)
+        return dict(summary, animation=animation_path, poster=poster_path)
+    
+    def _save_animation(self, output_files, base_name, format_config):
+        """保存一个动画及其封面缩略图
+        
+        Returns:
+            Tuple[str, str]: (动画路径, 封面缩略图路径或None)
+            
+        Raises:
+            Exception: 保存动画失败
+        """
+        output_path = os.path.join('uploads', f"animated_{base_name}.{format_config['extension']}")
+        if not self._save_output(output_files, output_path):
+            raise Exception("保存动画失败")
+        
+        # 生成封面缩略图
+        poster_path = self._save_poster(output_files, os.path.join('uploads', f"poster_{base_name}.jpg"))
+        return output_path, poster_path
+    
+    def get_progress(self, prompt_id, include_preview=True):
+        """获取工作流的执行进度，未跟踪时返回None"""
+        return self.progress_tracker.get_progress(prompt_id, include_preview)
+    
+    def wait_for_progress(self, prompt_id, last_version, timeout=15):
+        """阻塞等待工作流进度变化，返回最新的进度快照"""
+        return self.progress_tracker.wait_for_update(prompt_id, last_version, timeout)
+    
     def _extract_subject(self, description):
         """从描述中提取主体"""
         try:
@@ -337,49 +998,227 @@ class ComfyUIService:
             logger.error(f"提取主体失败: {str(e)}")
             return None
     
+    def _stage_input(self, image_path, kind, prepare=None):
+        """把输入图片以内容哈希命名写入 ComfyUI 输入目录
+        
+        同一张图片（内容相同）每次得到相同的文件名和文件内容，ComfyUI 可以跳过 LoadImage 及其下游
+        输入未变的节点。文件在最后一次使用后保留 input_ttl 秒，由 _evict_inputs 清理。prepare 返回的元数据
+        保存在共享状态中，其他工作进程写入的文件也可以直接复用。
+        
+        Args:
+            image_path: 原始图片路径
+            kind: 用途（enhance/animation），同一张图片不同用途写入的内容不同
+            prepare: prepare(源路径, 目标路径) 写入目标文件并返回元数据；为空时直接复制原图
+            
+        Returns:
+            Tuple[str, object]: (输入目录中的文件名, prepare 返回的元数据)
+        """
+        sha1 = hashlib.sha1()
+        with open(image_path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                sha1.update(chunk)
+        digest = sha1.hexdigest()[:16]
+        extension = '.png' if prepare else os.path.splitext(image_path)[1].lower()
+        name = f"{kind}_{digest}{extension}"
+        path = os.path.join(self.comfyui_input_dir, name)
+        
+        with self._staged_lock:
+            staged = name in self._staged_inputs
+            metadata = self._staged_inputs.get(name)
+        if not staged and self.shared_state:
+            shared = self.shared_state.cache_get('staged_inputs', name)
+            if shared is not None:
+                staged, metadata = True, shared['metadata']
+        if staged:
+            try:
+                # 更新修改时间，其他工作进程清理时据此判断文件仍在使用
+                os.utime(path)
+                logger.info(f"复用已写入的输入图片: {name}")
+                return name, metadata
+            except FileNotFoundError:
+                # 已被清理，重新写入
+                pass
+        
+        # 先写临时文件再改名，ComfyUI 和其他工作进程不会读到写了一半的文件
+        temp_path = f"{path}.{os.getpid()}-{threading.get_ident()}.tmp"
+        try:
+            if prepare:
+                metadata = prepare(image_path, temp_path)
+            else:
+                shutil.copy2(image_path, temp_path)
+            os.replace(temp_path, path)
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+        with self._staged_lock:
+            self._staged_inputs[name] = metadata
+        if self.shared_state:
+            self.shared_state.cache_set('staged_inputs', name, {'metadata': metadata})
+        return name, metadata
+    
+    def _evict_inputs(self, force=False):
+        """删除超过 input_ttl 秒未使用的输入图片
+        
+        按文件修改时间判断，多个工作进程共用输入目录时不会删除其他进程刚用过的文件；
+        其他进程已经删除的文件也从本进程的记录中移除。
+        """
+        now = time.time()
+        if not force and now - self._last_eviction < INPUT_EVICTION_INTERVAL:
+            return
+        self._last_eviction = now
+        try:
+            entries = list(os.scandir(self.comfyui_input_dir))
+        except OSError as e:
+            logger.debug(f"读取ComfyUI输入目录失败: {str(e)}")
+            return
+        remaining = set()
+        for entry in entries:
+            if not STAGED_INPUT_PATTERN.match(entry.name):
+                continue
+            try:
+                if now - entry.stat().st_mtime > self.input_ttl:
+                    os.remove(entry.path)
+                    if self.shared_state:
+                        self.shared_state.cache_delete('staged_inputs', entry.name)
+                    logger.debug(f"已清理过期的输入图片: {entry.name}")
+                else:
+                    remaining.add(entry.name)
+            except OSError:
+                pass
+        with self._staged_lock:
+            for name in set(self._staged_inputs) - remaining:
+                del self._staged_inputs[name]
+    
+    def _should_jump_queue(self, input_filename):
+        """ComfyUI 正在执行使用同一输入图片的工作流、且队列中还有其他工作流时返回True
+        
+        ComfyUI 默认只保留上一个工作流的节点输出，紧接着执行才能复用它的缓存；
+        队列为空时新工作流本来就紧接着执行。
+        """
+        if not self.cache_affinity:
+            return False
+        try:
+            queue = self.session.get(f"{self.comfyui_url}/queue", timeout=5).json()
+        except Exception as e:
+            logger.debug(f"查询ComfyUI队列失败: {str(e)}")
+            return False
+        if not queue.get("queue_pending"):
+            return False
+        for item in queue.get("queue_running", []):
+            nodes = item[2] if len(item) > 2 and isinstance(item[2], dict) else {}
+            if any(node.get("inputs", {}).get("image") == input_filename for node in nodes.values()):
+                return True
+        return False
+    
     def _load_workflow(self, workflow_name):
-        """加载ComfyUI工作流配置"""
+        """加载ComfyUI工作流配置（模板只解析一次，返回可修改的副本）"""
         try:
-            workflow_path = os.path.join('workflows', workflow_name)
-            if not os.path.exists(workflow_path):
-                raise Exception(f"工作流文件不存在: {workflow_path}")
-                
-            with open(workflow_path, 'r', encoding='utf-8') as f:
-                workflow = json.load(f)
-            logger.debug(f"已加载工作流: {workflow_name}")
-            return workflow
+            if workflow_name not in self._workflow_cache:
+                workflow_path = os.path.join('workflows', workflow_name)
+                if not os.path.exists(workflow_path):
+                    raise Exception(f"工作流文件不存在: {workflow_path}")
+                    
+                with open(workflow_path, 'r', encoding='utf-8') as f:
+                    self._workflow_cache[workflow_name] = json.load(f)
+                logger.debug(f"已加载工作流: {workflow_name}")
+            return copy.deepcopy(self._workflow_cache[workflow_name])
             
         except Exception as e:
             logger.error(f"加载工作流失败: {str(e)}")
             raise
     
-    def _queue_prompt(self, workflow):
-        """将工作流发送到ComfyUI队列"""
+    def warm_up(self, template):
+        """提交一个极小的预热工作流，让 ComfyUI 提前加载该模板用到的模型
+        
+        美化模板会加载 SD 检查点、LoRA 和去背景模型，动画模板会加载 Wan 视频模型、T5 和 CLIP。
+        
+        Args:
+            template: 模板名称（WARMUP_TEMPLATES 中的 enhance/animation）
+            
+        Returns:
+            bool: 预热工作流是否执行成功
+        """
+        image_path = os.path.join(self.comfyui_input_dir, WARMUP_IMAGE_NAME)
+        if not os.path.exists(image_path):
+            image = Image.new('RGB', (128, 128), 'white')
+            image.paste((40, 80, 200), (32, 32, 96, 96))
+            image.save(image_path, 'PNG')
+        
+        workflow = self._load_workflow(f"{template}_workflow.json")
+        if template == 'enhance':
+            workflow["50"]["inputs"]["image"] = WARMUP_IMAGE_NAME
+            workflow["6"]["inputs"]["text"] = "a drawing"
+            workflow["7"]["inputs"]["text"] = "blurry"
+            for node in ("10", "58"):
+                workflow[node]["inputs"]["width"] = workflow[node]["inputs"]["height"] = 64
+            for node in ("3", "11"):
+                workflow[node]["inputs"]["steps"] = 1
+        else:
+            workflow["150"]["inputs"]["image"] = WARMUP_IMAGE_NAME
+            workflow["166"]["inputs"]["string"] = "a drawing, white background"
+            workflow["154"]["inputs"]["Number"] = "5"
+            workflow["163"]["inputs"]["Number"] = "128"
+            workflow["144"]["inputs"]["steps"] = 1
+        
+        workflow_name = f"warmup_{template}"
+        prompt_id = self._queue_prompt(workflow, workflow_name)
+        output = self._wait_for_output(prompt_id, timeout=WARMUP_TIMEOUT) if prompt_id else None
+        # 预热耗时包含模型加载，不计入模板的平均耗时
+        self._avg_job_seconds.pop(workflow_name, None)
+        if self.shared_state:
+            self.shared_state.cache_delete('job_seconds', workflow_name)
+        return bool(output)
+    
+    def _validate_input_image(self, image_filename):
+        """确认 LoadImage 节点引用的输入图片存在且可以打开
+
+        非 RGB 的图片转换为 RGB；按内容哈希命名的输入图片不改写（同名文件的内容必须保持不变）。
+        """
+        image_path = os.path.join(self.comfyui_input_dir, image_filename)
+        if not os.path.exists(image_path):
+            raise Exception(f"输入图片不存在: {image_path}")
+        
+        # 验证图片格式
+        try:
+            with Image.open(image_path) as img:
+                if img.mode != 'RGB' and not STAGED_INPUT_PATTERN.match(image_filename):
+                    img = img.convert('RGB')
+                    img.save(image_path, 'PNG')
+                    logger.debug("已转换图片为RGB模式")
+        except Exception as e:
+            raise Exception(f"图片验证失败: {str(e)}")
+    
+    def _queue_prompt(self, workflow, workflow_name='workflow', sampler_class=None, front=False):
+        """将工作流发送到ComfyUI队列
+        
+        Args:
+            workflow: 工作流配置
+            workflow_name: 工作流模板名称，用于统计执行耗时
+            sampler_class: 用于计算进度和ETA的采样器节点类型
+            front: 是否插到队首（紧接着当前执行的工作流执行，复用其节点缓存）
+            
+        Returns:
+            str: prompt_id，失败时返回None
+        """
         try:
             logger.debug("正在发送工作流到ComfyUI...")
             
-            # 验证输入图片
-            if "18" in workflow and "inputs" in workflow["18"] and "image" in workflow["18"]["inputs"]:
-                image_filename = workflow["18"]["inputs"]["image"]
-                image_path = os.path.join(self.comfyui_input_dir, image_filename)
-                
-                if not os.path.exists(image_path):
-                    raise Exception(f"输入图片不存在: {image_path}")
-                
-                # 验证图片格式
-                try:
-                    with Image.open(image_path) as img:
-                        if img.mode != 'RGB':
-                            img = img.convert('RGB')
-                            img.save(image_path, 'PNG')
-                            logger.debug("已转换图片为RGB模式")
-                except Exception as e:
-                    raise Exception(f"图片验证失败: {str(e)}")
-            
-            response = requests.post(
-                f"{self.comfyui_url}/prompt",
-                json={"prompt": workflow}
-            )
+            # 验证输入图片（各模板的 LoadImage 节点编号不同，按节点类型查找）
+            for node in workflow.values():
+                image_filename = node.get("inputs", {}).get("image") if node.get("class_type") == "LoadImage" else None
+                if image_filename:
+                    self._validate_input_image(image_filename)
+            
+            # 提交前确保进度监听已启动，client_id 用于接收该工作流的 websocket 事件
+            self.progress_tracker.start()
+            self.telemetry.start()
+            
+            payload = {"prompt": workflow, "client_id": self.client_id}
+            if front:
+                payload["front"] = True
+                FRONT_SUBMISSIONS.inc(workflow=workflow_name)
+                logger.info(f"ComfyUI 正在执行同一张图片的工作流，{workflow_name} 插到队首以复用节点缓存")
+            response = self.session.post(f"{self.comfyui_url}/prompt", json=payload)
             
             if response.status_code != 200:
                 error_msg = f"ComfyUI服务器返回错误: {response.status_code}"
@@ -390,6 +1229,12 @@ class ComfyUIService:
             if not prompt_id:
                 logger.error("未获取到有效的prompt_id")
                 return None
+            
+            # 登记进度跟踪
+            self.progress_tracker.register(prompt_id, workflow, sampler_class, workflow_name)
+            self._prompt_workflows[prompt_id] = workflow_name
+            if self.shared_state:
+                self.shared_state.cache_set('prompt_workflows', prompt_id, workflow_name)
                 
             return prompt_id
             
@@ -400,28 +1245,22 @@ class ComfyUIService:
             logger.error(f"发送工作流失败: {str(e)}")
             return None
     
-    def _wait_for_output(self, prompt_id, timeout=600):
-        """等待工作流执行完成并获取输出"""
+    def _wait_for_output(self, prompt_id, timeout=600, job=None, by_node=False):
+        """等待工作流执行完成并获取输出
+        
+        Args:
+            prompt_id: 工作流的 prompt_id
+            timeout: 服务端截止时间（秒），超时后从ComfyUI中取消该工作流
+            job: 后台任务对象，任务被取消时同样会取消ComfyUI中的工作流
+            by_node: 是否按输出节点分组返回
+            
+        Returns:
+            list: 输出文件路径列表（by_node 时为 {节点编号: 文件路径列表}），失败、超时或取消时返回None
+        """
         try:
             workflow_start_time = time.time()
             logger.info(f"开始等待工作流 {prompt_id} 的输出，超时时间: {timeout}秒")
             
-            # 从工作流中获取输入文件名
-            input_filename = None
-            try:
-                response = requests.get(f"{self.comfyui_url}/history")
-                if response.status_code == 200:
-                    history = response.json()
-                    if prompt_id in history:
-                        prompt_info = history[prompt_id]
-                        if "prompt" in prompt_info:
-                            workflow = prompt_info["prompt"]
-                            if "150" in workflow and "inputs" in workflow["150"] and "image" in workflow["150"]["inputs"]:
-                                input_filename = workflow["150"]["inputs"]["image"]
-                                logger.info(f"找到输入文件名: {input_filename}")
-            except Exception as e:
-                logger.error(f"获取输入文件名失败: {str(e)}")
-            
             # 确保输出目录存在
             output_dir = os.path.join(self.comfyui_root, "output")
             logger.info(f"ComfyUI输出目录: {output_dir}")
@@ -430,124 +1269,209 @@ class ComfyUIService:
                 raise Exception(f"ComfyUI输出目录不存在: {output_dir}")
             
             while True:
+                # 检查是否被取消
+                if job and job.cancelled:
+                    logger.info(f"任务已取消，取消工作流 {prompt_id}")
+                    self.cancel_prompt(prompt_id, job.cancel_reason or 'client')
+                    return None
+                
                 # 检查是否超时
                 if time.time() - workflow_start_time > timeout:
-                    logger.error(f"等待工作流 {prompt_id} 输出超时")
-                    # 在超时时尝试查找最新的GIF文件
-                    gif_files = []
-                    for file in os.listdir(output_dir):
-                        if file.endswith('.gif'):
-                            file_path = os.path.join(output_dir, file)
-                            file_time = os.path.getmtime(file_path)
-                            gif_files.append((file_path, file_time))
-                            logger.debug(f"找到GIF文件: {file_path}, 修改时间: {file_time}")
-                    
-                    if gif_files:
-                        latest_gif = max(gif_files, key=lambda x: x[1])
-                        logger.info(f"找到最新的GIF文件: {latest_gif[0]}")
-                        return [latest_gif[0]]
-                    else:
-                        raise Exception("等待输出超时")
+                    logger.error(f"等待工作流 {prompt_id} 输出超时，取消该工作流")
+                    self.cancel_prompt(prompt_id, 'deadline')
+                    return None
 
                 # 检查历史记录
-                history_url = f"{self.comfyui_url}/history"
+                history_url = f"{self.comfyui_url}/history/{prompt_id}"
                 try:
-                    response = requests.get(history_url)
+                    response = self.session.get(history_url)
                     if response.status_code != 200:
                         logger.error(f"获取历史记录失败: HTTP {response.status_code}")
-                        time.sleep(1)
+                        self._poll_interval(job)
                         continue
 
                     history = response.json()
                     if prompt_id not in history:
                         logger.debug(f"工作流 {prompt_id} 尚未完成，继续等待...")
-                        time.sleep(1)
+                        self._poll_interval(job)
                         continue
 
                     prompt_info = history[prompt_id]
                     logger.debug(f"工作流状态: {prompt_info.get('status', {})}")
                     
+                    # 检查是否出错
+                    status = prompt_info.get("status", {})
+                    if status.get("status_str", status.get("status", "")) == "error":
+                        error_msg = status.get("message", "未知错误")
+                        logger.error(f"工作流执行出错: {error_msg}")
+                        raise Exception(f"工作流执行出错: {error_msg}")
+                    
                     # 检查是否执行完成
                     if "outputs" in prompt_info:
                         # 获取输出文件路径
-                        output_files = []
+                        output_files = {}
                         for node_id, node_output in prompt_info["outputs"].items():
                             logger.debug(f"检查节点 {node_id} 的输出")
-                            if "images" in node_output:
-                                for image in node_output["images"]:
-                                    file_path = os.path.join(output_dir, image["filename"])
+                            # SaveImage 等节点输出在 images 中，VHS_VideoCombine 输出在 gifs 中
+                            for output_key in ("images", "gifs"):
+                                for image in node_output.get(output_key, []):
+                                    file_path = os.path.join(output_dir, image.get("subfolder", ""), image["filename"])
                                     logger.debug(f"检查输出文件: {file_path}")
                                     if os.path.exists(file_path):
-                                        output_files.append(file_path)
+                                        output_files.setdefault(node_id, []).append(file_path)
                                         logger.info(f"找到有效输出文件: {file_path}")
                                     else:
                                         logger.warning(f"输出文件不存在: {file_path}")
                         
                         if output_files:
-                            logger.info(f"工作流完成，找到 {len(output_files)} 个输出文件")
-                            return output_files
-                        else:
-                            # 查找最新的GIF文件
-                            gif_files = []
-                            for file in os.listdir(output_dir):
-                                if file.endswith('.gif'):
-                                    file_path = os.path.join(output_dir, file)
-                                    file_time = os.path.getmtime(file_path)
-                                    gif_files.append((file_path, file_time))
-                                    logger.debug(f"找到GIF文件: {file_path}, 修改时间: {file_time}")
-                            
-                            if gif_files:
-                                # 按修改时间排序，获取最新的文件
-                                latest_gif = max(gif_files, key=lambda x: x[1])
-                                logger.info(f"找到最新的GIF文件: {latest_gif[0]}")
-                                return [latest_gif[0]]
-                            else:
-                                logger.warning("未找到GIF文件")
-                                # 列出输出目录中的所有文件
-                                logger.info("输出目录中的文件:")
-                                for file in os.listdir(output_dir):
-                                    file_path = os.path.join(output_dir, file)
-                                    file_time = os.path.getmtime(file_path)
-                                    logger.info(f"  - {file} (修改时间: {file_time})")
-                            
-                            time.sleep(1)
-                            continue
-                    
-                    # 检查是否出错
-                    status = prompt_info.get("status", {})
-                    if status.get("status", "") == "error":
-                        error_msg = status.get("message", "未知错误")
-                        logger.error(f"工作流执行出错: {error_msg}")
-                        raise Exception(f"工作流执行出错: {error_msg}")
-                    
-                    # 检查执行状态
-                    if status.get("status", "") == "executing":
-                        logger.debug("工作流正在执行中...")
-                    elif status.get("status", "") == "completed":
-                        logger.debug("工作流已完成，但未找到输出")
-                    else:
-                        logger.debug(f"工作流状态: {status}")
+                            logger.info(f"工作流完成，找到 {sum(map(len, output_files.values()))} 个输出文件")
+                            self._record_cache_hits(prompt_id, prompt_info)
+                            self._record_job_duration(prompt_id)
+                            if by_node:
+                                return output_files
+                            return [path for paths in output_files.values() for path in paths]
+                        
+                        # 输出文件可能仍在写入，继续等待直到截止时间
+                        logger.warning(f"工作流 {prompt_id} 已有输出记录，但输出文件尚不存在")
 
                 except requests.exceptions.RequestException as e:
                     logger.error(f"请求历史记录失败: {str(e)}")
-                    time.sleep(1)
-                    continue
                 except json.JSONDecodeError as e:
                     logger.error(f"解析历史记录响应失败: {str(e)}")
-                    time.sleep(1)
-                    continue
-                except Exception as e:
-                    logger.error(f"处理历史记录时发生错误: {str(e)}")
-                    time.sleep(1)
-                    continue
 
                 # 等待一段时间后再次检查
-                time.sleep(1)
+                self._poll_interval(job)
 
         except Exception as e:
             logger.error(f"等待输出失败: {str(e)}")
             logger.error(traceback.format_exc())
             return None
+        finally:
+            self.progress_tracker.unregister(prompt_id)
+            self._prompt_workflows.pop(prompt_id, None)
+            self._prompt_actions.pop(prompt_id, None)
+            self._prompt_variants.pop(prompt_id, None)
+            self._prompt_tiers.pop(prompt_id, None)
+            self._resumed_prompts.discard(prompt_id)
+            if self.shared_state:
+                self.shared_state.cache_delete('prompt_workflows', prompt_id)
+    
+    def _poll_interval(self, job=None, seconds=1):
+        """轮询间隔；任务被取消时立即返回"""
+        if job:
+            job.cancel_event.wait(seconds)
+        else:
+            time.sleep(seconds)
+    
+    def _record_job_duration(self, prompt_id):
+        """记录工作流执行耗时，并更新该模板的平均耗时"""
+        progress = self.progress_tracker.get_progress(prompt_id, include_preview=False)
+        if not progress:
+            return
+        if prompt_id in self._resumed_prompts:
+            # 只知道继续等待的时间，不是执行耗时，计入平均耗时会低估之后的排队时间
+            logger.info(f"工作流 {prompt_id} 为重启后继续等待的工作流，不统计执行耗时")
+            return
+        duration = time.time() - (progress['started_at'] or progress['queued_at'])
+        workflow_name = self._prompt_workflows.get(prompt_id, 'workflow')
+        JOB_SECONDS.observe(duration, workflow=workflow_name)
+        self._sync_job_seconds()
+        average = self._avg_job_seconds.get(workflow_name)
+        self._avg_job_seconds[workflow_name] = duration if average is None else 0.8 * average + 0.2 * duration
+        if self.shared_state:
+            self.shared_state.cache_set('job_seconds', workflow_name, self._avg_job_seconds[workflow_name])
+        logger.info(f"工作流 {prompt_id} ({workflow_name}) 执行耗时: {duration:.1f}秒")
+        
+        actions = self._prompt_actions.get(prompt_id)
+        if actions:
+            ANIMATION_GPU_SECONDS.observe(duration / actions, mode='multi' if actions > 1 else 'single')
+        tier = self._prompt_tiers.get(prompt_id)
+        if tier:
+            ANIMATION_TIER_GPU_SECONDS.inc(duration, tier=tier)
+            ANIMATION_RENDERS.inc(actions or 1, tier=tier)
+            self._prompt_gpu_seconds[prompt_id] = duration
+        variants = self._prompt_variants.get(prompt_id)
+        if variants:
+            ENHANCE_VARIANT_GPU_SECONDS.observe(duration / variants, variants=str(variants))
+            if variants > 1:
+                logger.info(f"{variants} 张候选图，每张分摊 {duration / variants:.1f} 秒")
+        
+        # 节省的 GPU 时间只比较单张美化的预设和变体
+        baseline = self._avg_job_seconds.get(ENHANCE_BASELINE_WORKFLOW)
+        if baseline and workflow_name.startswith('enhance_') and workflow_name != ENHANCE_BASELINE_WORKFLOW \
+                and (variants or 1) == 1:
+            saved = max(0.0, baseline - duration)
+            GPU_SECONDS_SAVED.inc(saved, workflow=workflow_name)
+            logger.info(f"{workflow_name} 比 {ENHANCE_BASELINE_WORKFLOW} 平均耗时节省 {saved:.1f} 秒 GPU 时间")
+    
+    def _record_cache_hits(self, prompt_id, prompt_info):
+        """统计 ComfyUI 复用缓存输出（execution_cached）的节点数
+        
+        Returns:
+            Tuple[int, int]: (命中缓存的节点数, 节点总数)
+        """
+        cached = set()
+        for event, data in prompt_info.get("status", {}).get("messages", []):
+            if event == "execution_cached":
+                cached.update(data.get("nodes", []))
+        prompt = prompt_info.get("prompt", [])
+        total = len(prompt[2]) if len(prompt) > 2 and isinstance(prompt[2], dict) else len(cached)
+        workflow_name = self._prompt_workflows.get(prompt_id, 'workflow')
+        NODE_CACHE.inc(len(cached), workflow=workflow_name, outcome='hit')
+        NODE_CACHE.inc(max(total - len(cached), 0), workflow=workflow_name, outcome='miss')
+        logger.info(f"工作流 {prompt_id} ({workflow_name}) 命中节点缓存 {len(cached)}/{total}")
+        return len(cached), total
+    
+    def cancel_prompt(self, prompt_id, reason='client'):
+        """取消ComfyUI中的工作流：排队中的从 /queue 删除，执行中的调用 /interrupt
+        
+        Args:
+            prompt_id: 工作流的 prompt_id
+            reason: 取消原因（client/client_disconnect/deadline）
+            
+        Returns:
+            str: 取消时工作流所处的阶段（queued/running/finished），查询失败时返回None
+        """
+        try:
+            response = self.session.get(f"{self.comfyui_url}/queue", timeout=10)
+            queue = response.json()
+            running_ids = {item[1] for item in queue.get("queue_running", [])}
+            pending_ids = {item[1] for item in queue.get("queue_pending", [])}
+            
+            if prompt_id in pending_ids:
+                self.session.post(f"{self.comfyui_url}/queue", json={"delete": [prompt_id]}, timeout=10)
+                stage = 'queued'
+            elif prompt_id in running_ids:
+                # 新版ComfyUI按 prompt_id 中断；旧版忽略参数并中断当前执行的工作流（上面已确认正是该工作流）
+                self.session.post(f"{self.comfyui_url}/interrupt", json={"prompt_id": prompt_id}, timeout=10)
+                stage = 'running'
+            else:
+                stage = 'finished'
+        except Exception as e:
+            logger.error(f"取消工作流 {prompt_id} 失败: {str(e)}")
+            return None
+        
+        freed_seconds = self._estimate_remaining_seconds(prompt_id, stage)
+        CANCELLATIONS.inc(reason=reason, stage=stage)
+        GPU_SECONDS_FREED.inc(freed_seconds, reason=reason, stage=stage)
+        logger.info(f"已取消工作流 {prompt_id}，阶段: {stage}，原因: {reason}，估算释放GPU时间: {freed_seconds:.1f}秒")
+        return stage
+    
+    def _estimate_remaining_seconds(self, prompt_id, stage):
+        """估算取消时工作流剩余的GPU执行时间（秒）"""
+        if stage not in ('queued', 'running'):
+            return 0.0
+        
+        average = self._avg_job_seconds.get(self._prompt_workflows.get(prompt_id), 0.0)
+        if stage == 'queued':
+            return average
+        
+        progress = self.progress_tracker.get_progress(prompt_id, include_preview=False)
+        if progress and progress['eta_seconds'] is not None:
+            return float(progress['eta_seconds'])
+        if progress and progress['started_at']:
+            return max(average - (time.time() - progress['started_at']), 0.0)
+        return average
     
     def _save_output(self, output_data, output_path):
         """保存ComfyUI的输出"""
@@ -565,33 +1489,23 @@ class ComfyUIService:
             # 检查输出类型
             if isinstance(output_data, list) and len(output_data) > 0:
                 # 处理图片输出
-                if output_path.endswith('.gif'):
-                    # 对于动画输出，直接复制生成的GIF文件
-                    gif_path = output_data[0]
-                    logger.info(f"处理GIF文件:")
-                    logger.info(f"  - 源文件路径: {gif_path}")
+                output_ext = os.path.splitext(output_path)[1].lower()
+                animation_extensions = {f".{config['extension']}" for config in ANIMATION_FORMATS.values()}
+                if output_ext in animation_extensions:
+                    # 对于动画输出，直接复制扩展名匹配的动画文件（输出中可能还包含封面帧）
+                    matched_files = [f for f in output_data if f.lower().endswith(output_ext)]
+                    animation_path = matched_files[0] if matched_files else output_data[0]
+                    logger.info(f"处理动画文件:")
+                    logger.info(f"  - 源文件路径: {animation_path}")
                     logger.info(f"  - 目标路径: {output_path}")
                     
-                    # 检查源文件是否存在
-                    if not os.path.exists(gif_path):
-                        logger.error(f"源GIF文件不存在: {gif_path}")
-                        # 尝试在ComfyUI输出目录中查找
-                        comfyui_output_dir = os.path.join(self.comfyui_root, "output")
-                        if os.path.exists(comfyui_output_dir):
-                            logger.info(f"搜索ComfyUI输出目录: {comfyui_output_dir}")
-                            for file in os.listdir(comfyui_output_dir):
-                                if file.endswith('.gif'):
-                                    potential_path = os.path.join(comfyui_output_dir, file)
-                                    logger.info(f"找到潜在的GIF文件: {potential_path}")
-                                    gif_path = potential_path
-                                    break
-                    
-                    if os.path.exists(gif_path):
-                        logger.info(f"复制GIF文件: {gif_path} -> {output_path}")
-                        shutil.copy2(gif_path, output_path)
+                    # 只使用本工作流记录的输出文件，不在输出目录中猜测其他任务的文件
+                    if os.path.exists(animation_path) and animation_path.lower().endswith(output_ext):
+                        logger.info(f"复制动画文件: {animation_path} -> {output_path}")
+                        shutil.copy2(animation_path, output_path)
                         logger.info(f"已保存动画到: {output_path}")
                     else:
-                        logger.error(f"找不到生成的GIF文件: {gif_path}")
+                        logger.error(f"找不到生成的动画文件: {animation_path}")
                         return False
                 else:
                     # 对于普通图片输出，保存第一张图片
@@ -625,4 +1539,31 @@ class ComfyUIService:
         except Exception as e:
             logger.error(f"保存输出失败: {str(e)}")
             logger.exception("保存输出详细错误")
-            return False 
\ No newline at end of file
+            return False
+
+    def _save_poster(self, output_data, poster_path):
+        """从工作流输出的封面帧生成小尺寸缩略图
+        
+        Args:
+            output_data: 工作流输出文件路径列表
+            poster_path: 缩略图保存路径
+            
+        Returns:
+            str: 缩略图路径，没有封面帧或生成失败时返回None
+        """
+        try:
+            frame_files = [f for f in output_data or [] if f.lower().endswith('.png')]
+            if not frame_files:
+                logger.warning("工作流输出中没有封面帧")
+                return None
+            
+            with Image.open(frame_files[0]) as img:
+                img = img.convert('RGB')
+                img.thumbnail((POSTER_MAX_SIZE, POSTER_MAX_SIZE))
+                img.save(poster_path, 'JPEG', quality=80)
+            logger.info(f"已生成封面缩略图: {poster_path}")
+            return poster_path
+            
+        except Exception as e:
+            logger.error(f"生成封面缩略图失败: {str(e)}")
+            return None
@@ -0,0 +1,287 @@
+import logging
+import os
+import threading
+import time
+from collections import deque
+
+import requests
+
+from services import metrics
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+# 调试接口中保留的最近工作流数（每个工作流各节点的耗时）
+RECENT_PROMPTS = 20
+
+# 节点耗时分桶（秒）：文本编码等轻量节点在 1 秒以内，视频采样可达数分钟
+NODE_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120, 300, 600)
+
+# 共享状态中的命名空间：最近一次采样、各进程的节点耗时汇总、最近的工作流
+SAMPLE_NAMESPACE = 'comfyui_sample'
+NODES_NAMESPACE = 'comfyui_nodes'
+RECENT_NAMESPACE = 'comfyui_recent'
+# 采样租约：持有者每个采样间隔续期一次，超过 LEASE_INTERVALS 个间隔没有续期时由其他进程接管
+LEASE_NAME = 'comfyui_telemetry'
+LEASE_INTERVALS = 3
+
+# /system_stats 中每个设备的显存字段，键为指标的 kind 标签
+DEVICE_FIELDS = {'total': 'vram_total', 'free': 'vram_free', 'torch_total': 'torch_vram_total', 'torch_free': 'torch_vram_free'}
+
+NODE_SECONDS = metrics.histogram('comfyui_node_seconds', 'ComfyUI 各类节点的执行耗时（秒，不含命中缓存的节点）',
+                                 ['template', 'node_class'], buckets=NODE_BUCKETS)
+# ComfyUI 的状态与进程无关，多进程汇总时取最后一次更新的值
+QUEUE_ITEMS = metrics.gauge('comfyui_queue_items', '最近一次采样的 ComfyUI 队列任务数', ['state'], multiprocess_mode='latest')
+QUEUE_DEPTH = metrics.gauge('comfyui_queue_depth', '最近一次查询到的 ComfyUI 队列长度（执行中 + 排队中）',
+                            multiprocess_mode='latest')
+VRAM_BYTES = metrics.gauge('comfyui_vram_bytes', 'ComfyUI 设备显存（字节，kind 为 total/free/torch_total/torch_free）',
+                           ['device', 'kind'], multiprocess_mode='latest')
+RAM_BYTES = metrics.gauge('comfyui_ram_bytes', 'ComfyUI 主机内存（字节，kind 为 total/free）', ['kind'],
+                          multiprocess_mode='latest')
+UP = metrics.gauge('comfyui_up', '最近一次采样时 ComfyUI 是否可以访问（1 可以，0 不可以）', multiprocess_mode='latest')
+BUSY_SECONDS = metrics.counter('comfyui_busy_seconds_total', '采样时 ComfyUI 正在执行工作流的累计时间（秒，按采样间隔估算）')
+SAMPLE_ERRORS = metrics.counter('comfyui_telemetry_errors_total', '采样 ComfyUI 状态失败的次数', ['endpoint'])
+
+
+def reset_shared_state(store):
+    """清空共享状态中各进程的节点耗时汇总和最近的工作流（主进程启动时调用，之前运行的进程不再计入）"""
+    for namespace in (NODES_NAMESPACE, RECENT_NAMESPACE):
+        store.cache_clear(namespace)
+
+
+def workflow_template(workflow_name):
+    """工作流名称对应的模板（enhance_best_x4 -> enhance，animation_x3 -> animation，warmup_enhance -> warmup）"""
+    return (workflow_name or 'workflow').split('_')[0]
+
+
+class ComfyUITelemetry:
+    """ComfyUI 运行状态采集
+
+    后台线程每隔 interval 秒采样一次 /queue（执行中和排队中的任务数）和 /system_stats（各设备显存、主机内存），
+    写入 Prometheus 指标；各节点的执行耗时由 ProgressTracker 根据 websocket 的 executing 事件计算后上报，
+    按模板和节点类型汇总，用来找出最慢的节点（如 WanVideoSampler 与 WanVideoDecode）和估算需要的 GPU 数量。
+
+    多进程部署时通过共享状态协调：只有持有采样租约的进程访问 ComfyUI，采样结果写入共享状态供其他进程的调试接口读取；
+    各进程的节点耗时汇总和最近的工作流也写入共享状态，调试接口显示所有进程的合计。
+    """
+
+    def __init__(self, comfyui_url, interval=15, shared_state=None):
+        """
+        Args:
+            comfyui_url: ComfyUI 服务地址
+            interval: 采样间隔（秒），不大于0时不启动后台采样（节点耗时照常统计）
+            shared_state: SharedState，为空时每个进程各自采样和统计
+        """
+        self.comfyui_url = comfyui_url
+        self.interval = interval
+        self.shared_state = shared_state
+        # 采样线程单独使用一个连接，不与提交和轮询工作流的请求共用
+        self.session = requests.Session()
+        self._lock = threading.Lock()
+        self._thread = None
+        self._sample = None
+        self._node_stats = {}
+        self._recent = deque(maxlen=RECENT_PROMPTS)
+
+    def start(self):
+        """启动后台采样线程（重复调用无副作用）"""
+        if self.interval <= 0:
+            return
+        with self._lock:
+            if self._thread and self._thread.is_alive():
+                return
+            self._thread = threading.Thread(target=self._run, name='comfyui-telemetry', daemon=True)
+            self._thread.start()
+        logger.info(f"已启动 ComfyUI 状态采样，间隔 {self.interval} 秒")
+
+    def _run(self):
+        previous = None
+        while True:
+            if self._holds_lease():
+                sample = self.sample()
+                # 上一次采样时有任务在执行，就把两次采样之间的时间计为忙碌时间（用于计算 GPU 利用率）
+                if previous and previous['queue'] and previous['queue']['running']:
+                    BUSY_SECONDS.inc(min(sample['at'] - previous['at'], max(self.interval, 1) * 2))
+                previous = sample
+            else:
+                previous = None
+            time.sleep(self.interval)
+
+    def _holds_lease(self):
+        """本进程是否负责采样（没有共享状态或共享状态不可用时各自采样）"""
+        if self.shared_state is None:
+            return True
+        try:
+            return self.shared_state.acquire_lease(LEASE_NAME, self.interval * LEASE_INTERVALS)
+        except Exception as e:
+            logger.warning(f"获取 ComfyUI 采样租约失败: {str(e)}")
+            return True
+
+    def sample(self):
+        """采样一次 ComfyUI 的队列和设备状态并更新指标
+
+        Returns:
+            Dict: 本次采样结果，ComfyUI 不可访问时 up 为 False
+        """
+        now = time.time()
+        sample = {'at': now, 'up': False, 'queue': None, 'system': None, 'devices': []}
+
+        queue = self._get_json('queue')
+        if queue is not None:
+            running = [item[1] for item in queue.get('queue_running', [])]
+            pending = [item[1] for item in queue.get('queue_pending', [])]
+            sample['queue'] = {'running': len(running), 'pending': len(pending), 'running_prompts': running}
+            QUEUE_ITEMS.set(len(running), state='running')
+            QUEUE_ITEMS.set(len(pending), state='pending')
+            QUEUE_DEPTH.set(len(running) + len(pending))
+
+        stats = self._get_json('system_stats')
+        if stats is not None:
+            system = stats.get('system', {})
+            sample['system'] = {key: system.get(key) for key in
+                                ('ram_total', 'ram_free', 'comfyui_version', 'pytorch_version')}
+            for kind in ('total', 'free'):
+                if system.get(f'ram_{kind}') is not None:
+                    RAM_BYTES.set(system[f'ram_{kind}'], kind=kind)
+            for device in stats.get('devices', []):
+                label = f"{device.get('type', 'device')}:{device.get('index', 0)}"
+                info = {'device': label, 'name': device.get('name')}
+                for kind, field in DEVICE_FIELDS.items():
+                    if device.get(field) is None:
+                        continue
+                    info[field] = device[field]
+                    VRAM_BYTES.set(device[field], device=label, kind=kind)
+                if info.get('vram_total'):
+                    info['vram_used_ratio'] = round(1 - info.get('vram_free', 0) / info['vram_total'], 4)
+                sample['devices'].append(info)
+
+        sample['up'] = queue is not None or stats is not None
+        UP.set(1 if sample['up'] else 0)
+        with self._lock:
+            self._sample = sample
+        self._share(lambda store: store.cache_set(SAMPLE_NAMESPACE, 'latest', sample))
+        return sample
+
+    def _share(self, write):
+        """写入共享状态，失败时只记录日志"""
+        if self.shared_state is None:
+            return
+        try:
+            write(self.shared_state)
+        except Exception as e:
+            logger.warning(f"写入共享的 ComfyUI 状态失败: {str(e)}")
+
+    def _get_json(self, endpoint):
+        try:
+            response = self.session.get(f"{self.comfyui_url}/{endpoint}", timeout=5)
+            response.raise_for_status()
+            return response.json()
+        except Exception as e:
+            SAMPLE_ERRORS.inc(endpoint=endpoint)
+            logger.debug(f"采样 ComfyUI /{endpoint} 失败: {str(e)}")
+            return None
+
+    def record_node(self, workflow_name, class_type, seconds):
+        """记录一个节点的执行耗时
+
+        Args:
+            workflow_name: 工作流模板名称（如 enhance_best、animation_x3）
+            class_type: 节点类型（如 WanVideoSampler）
+            seconds: 从该节点开始执行到下一个节点开始（或工作流结束）的时间
+        """
+        template = workflow_template(workflow_name)
+        class_type = class_type or 'unknown'
+        NODE_SECONDS.observe(seconds, template=template, node_class=class_type)
+        with self._lock:
+            stats = self._node_stats.setdefault((template, class_type), {'count': 0, 'seconds': 0.0, 'max': 0.0})
+            stats['count'] += 1
+            stats['seconds'] += seconds
+            stats['max'] = max(stats['max'], seconds)
+
+    def record_prompt(self, prompt_id, workflow_name, node_times, cached_nodes=0):
+        """记录一个执行完成的工作流的各节点耗时（调试接口中显示最近 RECENT_PROMPTS 个）
+
+        Args:
+            prompt_id: ComfyUI 的 prompt_id
+            workflow_name: 工作流模板名称
+            node_times: [(节点ID, 节点类型, 耗时秒)]，按执行顺序
+            cached_nodes: 命中缓存、没有执行的节点数
+        """
+        entry = {
+            'prompt_id': prompt_id,
+            'workflow': workflow_name,
+            'finished_at': time.time(),
+            'seconds': round(sum(seconds for _, _, seconds in node_times), 3),
+            'cached_nodes': cached_nodes,
+            'nodes': [{'node': node_id, 'class_type': class_type, 'seconds': round(seconds, 3)}
+                      for node_id, class_type, seconds in node_times]
+        }
+        with self._lock:
+            self._recent.appendleft(entry)
+            node_stats = [[template, class_type, stats] for (template, class_type), stats in self._node_stats.items()]
+
+        def share(store):
+            store.cache_set(RECENT_NAMESPACE, prompt_id, entry)
+            store.cache_trim(RECENT_NAMESPACE, max_entries=RECENT_PROMPTS)
+            # 节点耗时是本进程的累计值，按进程保存，已退出进程的值也计入合计
+            store.cache_set(NODES_NAMESPACE, str(os.getpid()), node_stats)
+        self._share(share)
+
+    def _shared_view(self):
+        """共享状态中的最近一次采样、所有进程的节点耗时汇总和最近的工作流，不可用时返回None"""
+        if self.shared_state is None:
+            return None
+        try:
+            sample = self.shared_state.cache_get(SAMPLE_NAMESPACE, 'latest')
+            node_stats = {}
+            for entries in self.shared_state.cache_items(NODES_NAMESPACE).values():
+                for template, class_type, stats in entries:
+                    total = node_stats.setdefault((template, class_type), {'count': 0, 'seconds': 0.0, 'max': 0.0})
+                    total['count'] += stats['count']
+                    total['seconds'] += stats['seconds']
+                    total['max'] = max(total['max'], stats['max'])
+            recent = sorted(self.shared_state.cache_items(RECENT_NAMESPACE).values(),
+                            key=lambda entry: -entry['finished_at'])
+            return sample, node_stats, recent
+        except Exception as e:
+            logger.warning(f"读取共享的 ComfyUI 状态失败: {str(e)}")
+            return None
+
+    def snapshot(self, refresh=False):
+        """调试接口返回的状态：最近一次采样、各模板按总耗时排序的节点类型和最近的工作流
+
+        Args:
+            refresh: 是否先重新采样（还没有采样过时总会采样一次）
+        """
+        shared = self._shared_view()
+        with self._lock:
+            sample = self._sample
+            node_stats = {key: dict(stats) for key, stats in self._node_stats.items()}
+            recent = list(self._recent)
+        if shared is not None:
+            shared_sample, node_stats, recent = shared
+            if shared_sample and (sample is None or shared_sample['at'] > sample['at']):
+                sample = shared_sample
+        if refresh or sample is None:
+            sample = self.sample()
+
+        totals = {}
+        for (template, _), stats in node_stats.items():
+            totals[template] = totals.get(template, 0.0) + stats['seconds']
+        nodes = {}
+        for (template, class_type), stats in sorted(node_stats.items(), key=lambda item: -item[1]['seconds']):
+            nodes.setdefault(template, []).append({
+                'class_type': class_type,
+                'count': stats['count'],
+                'total_seconds': round(stats['seconds'], 3),
+                'mean_seconds': round(stats['seconds'] / stats['count'], 3),
+                'max_seconds': round(stats['max'], 3),
+                'share': round(stats['seconds'] / totals[template], 4) if totals[template] else 0.0
+            })
+        return {
+            'comfyui_url': self.comfyui_url,
+            'interval': self.interval,
+            'sample': dict(sample, age_seconds=round(time.time() - sample['at'], 1)),
+            'nodes': nodes,
+            'recent_prompts': recent
+        }
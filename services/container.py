@@ -0,0 +1,76 @@
+import logging
+import threading
+import time
+
+from config.config import Config
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+
+class ServiceContainer:
+    """应用共享的依赖容器
+
+    配置只从 config.Config 读取一次；任务协调器（三个代理）、ComfyUI 服务和任务管理器在第一次
+    使用时创建，之后所有请求共用同一个实例。导入 app.py 时不会创建任何服务，也不会访问 ComfyUI 目录，
+    因此多进程部署时可以在主进程中预加载应用，各工作进程 fork 之后再创建自己的服务和连接。
+    """
+
+    def __init__(self, config=Config):
+        self.config = config
+        self._instances = {}
+        self._lock = threading.RLock()
+
+    def _get(self, name, factory):
+        instance = self._instances.get(name)
+        if instance is not None:
+            return instance
+        with self._lock:
+            if name not in self._instances:
+                start = time.perf_counter()
+                self._instances[name] = factory()
+                logger.info(f"已创建 {name}，耗时 {time.perf_counter() - start:.3f} 秒")
+            return self._instances[name]
+
+    @property
+    def shared_state(self):
+        """各工作进程共享的任务状态和缓存（SQLite WAL）"""
+        def create():
+            from services.shared_state import SharedState
+            return SharedState(self.config.STATE_DB_PATH)
+        return self._get('shared_state', create)
+
+    @property
+    def task_coordinator(self):
+        def create():
+            from agents.task_coordinator import TaskCoordinator
+            return TaskCoordinator(config=self.config, shared_state=self.shared_state)
+        return self._get('task_coordinator', create)
+
+    @property
+    def comfyui_service(self):
+        def create():
+            from services.comfyui_service import ComfyUIService
+            return ComfyUIService(self.config.COMFYUI_URL, task_coordinator=self.task_coordinator, config=self.config,
+                                  shared_state=self.shared_state)
+        return self._get('comfyui_service', create)
+
+    @property
+    def llm_service(self):
+        """本地LLM的提示词生成链路（/generate_prompts 流式返回）"""
+        def create():
+            from services.llm_service import LLMService
+            return LLMService(self.config.LLM_STUDIO_URL, self.config.LLM_VISION_MODEL)
+        return self._get('llm_service', create)
+
+    @property
+    def job_manager(self):
+        def create():
+            from services.job_manager import JobManager
+            return JobManager(store=self.shared_state,
+                              progress_source=lambda prompt_id: self.comfyui_service.get_progress(prompt_id, False))
+        return self._get('job_manager', create)
+
+    def created(self):
+        """已经创建的服务名称"""
+        return sorted(self._instances)
@@ -0,0 +1,65 @@
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, wait
+
+
+class LatencyWindow:
+    """最近若干次请求耗时的滑动窗口，用于计算对冲阈值"""
+
+    def __init__(self, size=200):
+        self._samples = deque(maxlen=size)
+        self._lock = threading.Lock()
+
+    def record(self, seconds):
+        with self._lock:
+            self._samples.append(seconds)
+
+    def __len__(self):
+        with self._lock:
+            return len(self._samples)
+
+    def percentile(self, percent):
+        """返回窗口内耗时的百分位数，窗口为空时返回None"""
+        with self._lock:
+            samples = sorted(self._samples)
+        if not samples:
+            return None
+        index = min(len(samples) - 1, max(0, int(round(percent / 100.0 * (len(samples) - 1)))))
+        return samples[index]
+
+
+def hedged_call(primary, hedge, hedge_delay, executor):
+    """对冲请求：primary 在 hedge_delay 秒内没有返回时再发起 hedge，取先成功的结果
+
+    primary 在对冲之前就失败时直接抛出异常（对冲只用于处理长尾延迟）；
+    对冲后两个请求都失败时抛出 primary 的异常。落后的请求还在线程池中排队时取消，
+    已经开始执行的无法中止，其结果会被丢弃。
+
+    Args:
+        primary: 首选请求（无参可调用对象）
+        hedge: 对冲请求（无参可调用对象）
+        hedge_delay: 发起对冲前等待的秒数
+        executor: 执行请求的线程池
+
+    Returns:
+        Tuple: (结果, 来源 primary/hedge, 是否发起了对冲, 耗时秒数)
+    """
+    start = time.monotonic()
+    futures = {executor.submit(primary): 'primary'}
+    done, _ = wait(futures, timeout=hedge_delay)
+    hedged = not done
+    if hedged:
+        futures[executor.submit(hedge)] = 'hedge'
+
+    errors = {}
+    pending = set(futures)
+    while pending:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            if future.exception() is None:
+                for loser in pending:
+                    loser.cancel()
+                return future.result(), futures[future], hedged, time.monotonic() - start
+            errors[futures[future]] = future.exception()
+    raise errors.get('primary') or errors['hedge']
@@ -0,0 +1,193 @@
+import base64
+import io
+import logging
+import os
+import threading
+import time
+
+from PIL import Image
+
+from config.config import Config
+from services import metrics
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+# 一次请求内共享的解码分辨率（最长边）：美化预处理、感知哈希、调色板和分析请求的图片都从这一份缩小
+WORKING_SIZE = 1024
+# 不超过该大小的原图直接以原始字节发送给分析模型，更大的改为发送工作分辨率的 JPEG
+INLINE_MAX_BYTES = 1024 * 1024
+ANALYSIS_JPEG_QUALITY = 90
+# 解码之外的处理开销：预处理在工作分辨率上的 float32 数组及其中间结果、分析请求的 JSON 等
+WORKING_OVERHEAD_BYTES = 48 * 1024 * 1024
+
+# 解压炸弹限制：像素数超过该值的图片在 SharedImage 读取文件头时即被拒绝。不修改 PIL 全局的
+# Image.MAX_IMAGE_PIXELS，其他代码打开图片时仍使用 PIL 默认的限制
+MAX_PIXELS = Config.IMAGE_MAX_PIXELS
+
+RESERVED_BYTES = metrics.gauge('image_memory_reserved_bytes', '图片任务当前预留的解码内存（字节）')
+WAIT_SECONDS = metrics.histogram('image_memory_wait_seconds', '图片任务等待内存预算的时间（秒）',
+                                 buckets=(0.01, 0.05, 0.1, 0.5, 1, 2, 5, 10, 30))
+REJECTIONS = metrics.counter('image_memory_rejected_total', '因内存预算或像素数限制被拒绝的图片任务', ['reason'])
+
+
+class ImageMemoryError(Exception):
+    """图片任务无法在内存限制内处理，error_code 会写入代理返回的错误字典"""
+
+    error_code = 'image_memory'
+
+
+class ImageTooLarge(ImageMemoryError):
+    """像素数超过 IMAGE_MAX_PIXELS（可能是解压炸弹）"""
+
+    error_code = 'image_too_large'
+
+
+class ImageMemoryBusy(ImageMemoryError):
+    """在等待时间内没有等到足够的内存预算"""
+
+    error_code = 'image_memory_busy'
+
+
+class MemoryBudget:
+    """每个进程的图片解码内存预算：按估计的解码内存预留，预算内还有空间时才放行图片任务"""
+
+    def __init__(self, limit_bytes, wait_seconds):
+        """
+        Args:
+            limit_bytes: 预算（字节）
+            wait_seconds: 默认的最长等待时间（秒）
+        """
+        self.limit_bytes = limit_bytes
+        self.wait_seconds = wait_seconds
+        self._reserved = 0
+        self._condition = threading.Condition()
+
+    def acquire(self, nbytes, timeout=None):
+        """预留 nbytes 字节，等待超时时抛出 ImageMemoryBusy
+
+        单个任务超过整个预算时按整个预算预留（独占），保证它最终可以执行。
+
+        Returns:
+            int: 实际预留的字节数，释放时传给 release
+        """
+        nbytes = min(nbytes, self.limit_bytes)
+        deadline = time.monotonic() + (self.wait_seconds if timeout is None else timeout)
+        start = time.monotonic()
+        with self._condition:
+            while self._reserved + nbytes > self.limit_bytes:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    REJECTIONS.inc(reason='budget')
+                    raise ImageMemoryBusy(f"图片任务过多，等待内存预算超时（已预留 {self._reserved >> 20}MB）")
+                self._condition.wait(remaining)
+            self._reserved += nbytes
+            RESERVED_BYTES.set(self._reserved)
+        WAIT_SECONDS.observe(time.monotonic() - start)
+        return nbytes
+
+    def release(self, nbytes):
+        with self._condition:
+            self._reserved -= nbytes
+            RESERVED_BYTES.set(self._reserved)
+            self._condition.notify_all()
+
+    @property
+    def reserved_bytes(self):
+        return self._reserved
+
+
+class SharedImage:
+    """一次请求内共享的图片解码结果
+
+    创建时只读取文件头：检查像素数，估计解码需要的内存并在内存预算中预留。第一次使用时
+    按 draft 模式（JPEG 在解码时直接缩小）解码为最长边不超过 WORKING_SIZE 的 RGB 图片（透明区域为白色），
+    之后感知哈希、调色板、分析请求的图片和美化预处理都使用这一份，不再各自打开原图。
+    用完后调用 close（或使用 with）释放预留的内存。
+    """
+
+    def __init__(self, path, budget=None, timeout=None, max_pixels=None):
+        """
+        Args:
+            path: 图片文件路径
+            budget: MemoryBudget，为空时不做内存预算
+            timeout: 等待内存预算的最长时间（秒），默认使用预算的 wait_seconds
+            max_pixels: 像素数上限，默认 IMAGE_MAX_PIXELS
+
+        Raises:
+            ImageTooLarge: 像素数超过上限
+            ImageMemoryBusy: 等待内存预算超时
+        """
+        self.path = path
+        max_pixels = MAX_PIXELS if max_pixels is None else max_pixels
+        try:
+            with Image.open(path) as img:
+                self.original_size = img.size
+                self.format = img.format
+                if img.size[0] * img.size[1] > max_pixels:
+                    REJECTIONS.inc(reason='pixels')
+                    raise ImageTooLarge(f"图片像素过多: {img.size[0]}x{img.size[1]}，上限 {max_pixels} 像素")
+                img.draft('RGB', (WORKING_SIZE, WORKING_SIZE))
+                decoded_size, bands, mode = img.size, len(img.getbands()), img.mode
+        except Image.DecompressionBombError as e:
+            # 超过 PIL 自身的限制（两倍于 Image.MAX_IMAGE_PIXELS）时在读取文件头时就会抛出
+            REJECTIONS.inc(reason='pixels')
+            raise ImageTooLarge(f"图片像素过多: {str(e)}") from e
+        self.file_size = os.path.getsize(path)
+        # 解码结果加上模式转换的副本（带透明通道时还有白色底图和合成结果），再加上工作分辨率上的处理开销
+        copies = 4 if bands in (2, 4) or mode == 'P' else 2
+        self.estimated_bytes = decoded_size[0] * decoded_size[1] * max(bands, 3) * copies + WORKING_OVERHEAD_BYTES
+        self._working = None
+        self._lock = threading.Lock()
+        self._budget = budget
+        self._reserved = budget.acquire(self.estimated_bytes, timeout) if budget else 0
+
+    def working(self):
+        """最长边不超过 WORKING_SIZE 的 RGB 图片（只解码一次；调用方不要修改它）"""
+        with self._lock:
+            if self._working is None:
+                with Image.open(self.path) as img:
+                    img.draft('RGB', (WORKING_SIZE, WORKING_SIZE))
+                    if img.mode in ('RGBA', 'LA', 'P'):
+                        rgba = img.convert('RGBA')
+                        background = Image.new('RGBA', rgba.size, (255, 255, 255, 255))
+                        image = Image.alpha_composite(background, rgba).convert('RGB')
+                    else:
+                        image = img.convert('RGB')
+                image.thumbnail((WORKING_SIZE, WORKING_SIZE), Image.BILINEAR, reducing_gap=2.0)
+                self._working = image
+            return self._working
+
+    def analysis_base64(self):
+        """发送给分析模型的图片（base64）
+
+        小图直接使用原始字节；大图（通常是手机照片）改为工作分辨率的 JPEG，
+        避免把整个文件读入内存再生成约 1.33 倍大小的 base64 副本。
+        """
+        if self.file_size <= INLINE_MAX_BYTES and max(self.original_size) <= WORKING_SIZE * 2:
+            with open(self.path, 'rb') as f:
+                image_data = f.read()
+            if not image_data:
+                raise ValueError("图片文件为空")
+            return base64.b64encode(image_data).decode()
+        buffer = io.BytesIO()
+        self.working().save(buffer, 'JPEG', quality=ANALYSIS_JPEG_QUALITY)
+        logger.debug(f"分析图片 {self.original_size} -> {self.working().size}，{self.file_size} -> {buffer.tell()} 字节")
+        return base64.b64encode(buffer.getbuffer()).decode()
+
+    def close(self):
+        """释放解码结果和预留的内存（可重复调用）"""
+        with self._lock:
+            self._working = None
+            reserved, self._reserved = self._reserved, 0
+        if reserved:
+            self._budget.release(reserved)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+image_budget = MemoryBudget(Config.IMAGE_MEMORY_BUDGET_MB * 1024 * 1024, Config.IMAGE_MEMORY_WAIT)
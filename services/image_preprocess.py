@@ -0,0 +1,219 @@
+import logging
+import time
+from collections import deque
+
+import numpy as np
+from PIL import Image
+
+from services.image_memory import WORKING_SIZE
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+# 美化工作流第一遍采样的原生分辨率（宽, 高），按画面方向选择；第二遍默认放大到 1.25 倍
+NATIVE_SIZES = {
+    'portrait': (600, 800),
+    'landscape': (800, 600),
+    'square': (704, 704)
+}
+SECOND_PASS_SCALE = 1.25
+
+# 笔迹判定：比纸张暗这么多（或超过纸张噪声的 3 倍）的像素，或者饱和度足够高的浅色笔迹（例如黄色蜡笔）
+INK_MIN_DARKNESS = 30
+INK_MIN_CHROMA = 40
+# 自动裁剪时四周保留的边距（占笔迹区域边长的比例）
+CROP_MARGIN = 0.06
+
+# 边缘像素噪声超过该值时认为画面不是画在纸上（例如满幅的数码画），只缩放不清理
+MAX_PAPER_NOISE = 45
+
+# “干净扫描件”的判定阈值：纸张足够白、足够均匀，且大部分是纸张
+CLEAN_PAPER_MIN_LEVEL = 170
+CLEAN_PAPER_MAX_NOISE = 12
+CLEAN_MIN_BACKGROUND_RATIO = 0.6
+
+# 输出去背景：接近白色且与画面边缘连通的区域视为背景，在缩小 BACKGROUND_SCALE 倍的掩码上传播
+BACKGROUND_WHITE_LEVEL = 235
+BACKGROUND_SCALE = 4
+# 保留主体外一圈白边（贴纸风格），单位为缩小后的像素
+STICKER_RIM = 4
+
+
+def _round8(value):
+    return max(8, int(round(value / 8.0)) * 8)
+
+
+def second_pass_size(size, scale=SECOND_PASS_SCALE):
+    """第二遍采样（LatentUpscale）的尺寸"""
+    return _round8(size[0] * scale), _round8(size[1] * scale)
+
+
+def _native_size(width, height):
+    ratio = width / float(height)
+    if ratio < 0.85:
+        return NATIVE_SIZES['portrait']
+    if ratio > 1.18:
+        return NATIVE_SIZES['landscape']
+    return NATIVE_SIZES['square']
+
+
+def _load_rgb(image, max_size):
+    """解码为不超过 max_size 的 RGB 数组（JPEG 使用 draft 模式），透明区域视为白纸"""
+    image.draft('RGB', (max_size, max_size))
+    if image.mode in ('RGBA', 'LA', 'P'):
+        image = image.convert('RGBA')
+        background = Image.new('RGBA', image.size, (255, 255, 255, 255))
+        image = Image.alpha_composite(background, image)
+    image = image.convert('RGB')
+    image.thumbnail((max_size, max_size), Image.BILINEAR, reducing_gap=2.0)
+    return np.asarray(image, dtype=np.float32)
+
+
+def preprocess_drawing(image_path, output_path, image=None):
+    """在 CPU 上清理画作后再送入 ComfyUI
+
+    估计纸张颜色，按纸张颜色做白平衡并把纸张背景置为纯白，裁剪到有笔迹的区域，
+    用白色补边到目标宽高比后缩放到工作流的原生分辨率，保存为 PNG。
+
+    Args:
+        image_path: 原始图片路径
+        output_path: 清理后的 PNG 保存路径
+        image: 本次请求共享的 SharedImage，为空时从 image_path 解码
+
+    Returns:
+        Dict: 包含 size（输出宽高）、original_size、crop_box、background_ratio、paper_level、
+              paper_noise、on_paper（是否检测到纸张并做了清理）、clean_scan（是否为干净扫描件）、seconds；
+              失败时返回None
+    """
+    start = time.perf_counter()
+    try:
+        if image is not None:
+            original_size = image.original_size
+            pixels = np.asarray(image.working(), dtype=np.float32)
+        else:
+            with Image.open(image_path) as img:
+                original_size = img.size
+                pixels = _load_rgb(img, WORKING_SIZE)
+        height, width = pixels.shape[:2]
+
+        # 纸张颜色和噪声取自四周边缘像素
+        border = np.concatenate([pixels[0], pixels[-1], pixels[:, 0], pixels[:, -1]])
+        paper_color = np.median(border, axis=0)
+        gray = pixels @ np.array([0.299, 0.587, 0.114], dtype=np.float32)
+        paper_level = float(paper_color @ np.array([0.299, 0.587, 0.114]))
+        border_gray = border @ np.array([0.299, 0.587, 0.114], dtype=np.float32)
+        paper_noise = float(np.percentile(np.abs(border_gray - paper_level), 75))
+
+        darkness = max(INK_MIN_DARKNESS, 3 * paper_noise)
+        r, g, b = pixels[..., 0], pixels[..., 1], pixels[..., 2]
+        chroma = np.maximum(np.maximum(r, g), b) - np.minimum(np.minimum(r, g), b)
+        paper_chroma = float(paper_color.max() - paper_color.min())
+        ink = (gray < paper_level - darkness) | (chroma > paper_chroma + INK_MIN_CHROMA)
+        background_ratio = 1.0 - float(ink.mean())
+        on_paper = bool(paper_noise <= MAX_PAPER_NOISE and ink.mean() >= 0.005)
+
+        crop_box = (0, 0, width, height)
+        if on_paper:
+            # 白平衡：把纸张颜色拉到白色，再把非笔迹像素直接置白（去掉阴影、纸纹和铅笔底稿的灰雾）
+            balanced = np.clip(pixels * (255.0 / np.maximum(paper_color, 1.0)), 0, 255)
+            balanced[~ink] = 255
+            # 裁剪到笔迹区域：忽略笔迹像素很少的行和列（零星噪点）
+            rows = np.flatnonzero(ink.sum(axis=1) > max(2, width * 0.002))
+            cols = np.flatnonzero(ink.sum(axis=0) > max(2, height * 0.002))
+        else:
+            balanced = pixels
+            rows = cols = []
+        if len(rows) and len(cols):
+            top, bottom, left, right = rows[0], rows[-1] + 1, cols[0], cols[-1] + 1
+            margin_y, margin_x = int((bottom - top) * CROP_MARGIN), int((right - left) * CROP_MARGIN)
+            crop_box = (max(0, left - margin_x), max(0, top - margin_y),
+                        min(width, right + margin_x), min(height, bottom + margin_y))
+        left, top, right, bottom = crop_box
+        cropped = balanced[top:bottom, left:right]
+
+        # 用白色补边到目标宽高比，再缩放到原生分辨率
+        target = _native_size(right - left, bottom - top)
+        crop_height, crop_width = cropped.shape[:2]
+        scale = max(crop_width / float(target[0]), crop_height / float(target[1]))
+        canvas_width, canvas_height = int(round(target[0] * scale)), int(round(target[1] * scale))
+        canvas = np.full((canvas_height, canvas_width, 3), 255, dtype=np.uint8)
+        offset_y, offset_x = (canvas_height - crop_height) // 2, (canvas_width - crop_width) // 2
+        canvas[offset_y:offset_y + crop_height, offset_x:offset_x + crop_width] = cropped.astype(np.uint8)
+        Image.fromarray(canvas).resize(target, Image.LANCZOS).save(output_path, 'PNG')
+
+        # crop_box 换算回原图坐标
+        ratio = original_size[0] / float(width)
+        result = {
+            'size': target,
+            'original_size': original_size,
+            'crop_box': tuple(int(round(v * ratio)) for v in crop_box),
+            'background_ratio': round(background_ratio, 3),
+            'paper_level': round(paper_level, 1),
+            'paper_noise': round(paper_noise, 1),
+            'on_paper': on_paper,
+            'clean_scan': on_paper and (paper_level >= CLEAN_PAPER_MIN_LEVEL and paper_noise <= CLEAN_PAPER_MAX_NOISE
+                           and background_ratio >= CLEAN_MIN_BACKGROUND_RATIO),
+            'seconds': round(time.perf_counter() - start, 4)
+        }
+        logger.info(f"图片预处理完成: {result}")
+        return result
+    except Exception as e:
+        logger.error(f"图片预处理失败: {str(e)}")
+        return None
+
+
+def _border_connected(mask):
+    """与画面边缘 4 连通的 True 像素（广度优先搜索，每个像素最多入队一次）"""
+    height, width = mask.shape
+    size = height * width
+    candidate = mask.ravel().tolist()
+    reached = bytearray(size)
+    border = set(range(width)) | set(range(size - width, size)) | set(range(0, size, width)) | \
+        set(range(width - 1, size, width))
+    queue = deque(index for index in border if candidate[index])
+    for index in queue:
+        reached[index] = 1
+    while queue:
+        index = queue.popleft()
+        x = index % width
+        for neighbour, inside in ((index - width, index >= width), (index + width, index + width < size),
+                                  (index - 1, x > 0), (index + 1, x < width - 1)):
+            if inside and candidate[neighbour] and not reached[neighbour]:
+                reached[neighbour] = 1
+                queue.append(neighbour)
+    return np.frombuffer(bytes(reached), dtype=np.uint8).reshape(height, width).astype(bool)
+
+
+def remove_white_background(image_path, output_path):
+    """CPU 去背景：把与画面边缘连通的近白色区域设为透明，并在主体外保留一圈白边
+
+    用于轻量美化工作流（跳过 GPU 上的 imageRemBg）。在缩小后的图上用广度优先搜索找出
+    与边缘连通的近白色区域（被主体包围的白色区域保留），再放大回原尺寸作为 alpha 通道。
+
+    Returns:
+        bool: 是否成功保存
+    """
+    try:
+        with Image.open(image_path) as img:
+            rgb = img.convert('RGB')
+        small = np.asarray(rgb.resize((max(1, rgb.width // BACKGROUND_SCALE), max(1, rgb.height // BACKGROUND_SCALE)),
+                                      Image.BOX))
+        background = _border_connected(small.min(axis=2) >= BACKGROUND_WHITE_LEVEL)
+
+        # 主体向外膨胀 STICKER_RIM 像素，保留贴纸风格的白边
+        foreground = ~background
+        for _ in range(STICKER_RIM):
+            grown = foreground.copy()
+            grown[1:] |= foreground[:-1]
+            grown[:-1] |= foreground[1:]
+            grown[:, 1:] |= foreground[:, :-1]
+            grown[:, :-1] |= foreground[:, 1:]
+            foreground = grown
+
+        alpha = Image.fromarray(foreground.astype(np.uint8) * 255).resize(rgb.size, Image.BILINEAR)
+        rgb.putalpha(alpha)
+        rgb.save(output_path, 'PNG')
+        return True
+    except Exception as e:
+        logger.error(f"去背景失败: {str(e)}")
+        return False
@@ -0,0 +1,350 @@
+import logging
+import os
+import threading
+import time
+import traceback
+import uuid
+
+from services import metrics
+from services.shared_state import process_alive
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+JOBS_RECOVERED = metrics.counter('jobs_recovered_total', '服务重启后继续执行的未完成任务数')
+
+# 任务状态
+JOB_QUEUED = 'queued'
+JOB_RUNNING = 'running'
+JOB_SUCCEEDED = 'succeeded'
+JOB_FAILED = 'failed'
+JOB_CANCELLED = 'cancelled'
+FINISHED_STATES = {JOB_SUCCEEDED, JOB_FAILED, JOB_CANCELLED}
+
+# 已结束任务在内存中保留的时间（秒）
+FINISHED_JOB_TTL = 3600
+
+# 多进程部署时，本进程执行中任务的状态/进度写入共享状态、以及读取其他进程发来的取消请求的间隔（秒）
+SYNC_INTERVAL = 1.0
+
+# 最后一个进度订阅者断开后，等待客户端重连的时间（秒），超时后取消任务
+DISCONNECT_GRACE_SECONDS = 15
+
+
+class Job:
+    """一个后台执行的长任务（如动画生成）"""
+
+    def __init__(self, kind, params=None):
+        self.id = uuid.uuid4().hex
+        self.kind = kind
+        self.params = params or {}
+        self.status = JOB_QUEUED
+        self.prompt_id = None
+        self.result = None
+        self.error = None
+        self.created_at = time.time()
+        self.finished_at = None
+        # 取消信号：任务函数在等待 ComfyUI 时检查该事件
+        self.cancel_event = threading.Event()
+        self.cancel_reason = None
+        self.watchers = 0
+        # 最近一次的进度快照（同步到共享状态，供其他进程查询）
+        self.progress = None
+        # 是否为其他工作进程中执行的任务的只读快照
+        self.remote = False
+        # 任务日志：任务函数的参数（服务重启后据此继续任务）和执行工作流的后端地址
+        self.inputs = None
+        self.backend = None
+        self._on_change = None
+
+    @property
+    def finished(self):
+        return self.status in FINISHED_STATES
+
+    @property
+    def cancelled(self):
+        return self.cancel_event.is_set()
+
+    def record_prompt(self, prompt_id, backend):
+        """记录已提交的工作流并立即写入任务日志"""
+        self.prompt_id = prompt_id
+        self.backend = backend
+        if self._on_change:
+            self._on_change(self)
+
+    def to_dict(self):
+        return {
+            'job_id': self.id,
+            'kind': self.kind,
+            'status': self.status,
+            'prompt_id': self.prompt_id,
+            'result': self.result,
+            'error': self.error,
+            'cancel_reason': self.cancel_reason,
+            'created_at': self.created_at,
+            'finished_at': self.finished_at
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        """由共享状态中保存的内容构造只读快照（任务在其他工作进程中执行）"""
+        job = cls(data['kind'], data.get('params'))
+        job.id = data['job_id']
+        job.status = data['status']
+        job.prompt_id = data['prompt_id']
+        job.result = data['result']
+        job.error = data['error']
+        job.cancel_reason = data['cancel_reason'] or data.get('cancel_requested')
+        job.created_at = data['created_at']
+        job.finished_at = data['finished_at']
+        job.progress = data.get('progress')
+        job.inputs = data.get('inputs')
+        job.backend = data.get('backend')
+        job.remote = True
+        return job
+
+
+class JobManager:
+    """在后台线程中执行任务，并提供按ID查询任务状态的能力
+
+    提供共享状态时，任务状态和进度会写入共享状态：其他工作进程可以查询和取消本进程中的任务，
+    本进程也能查询其他进程中的任务（只读快照，不含预览帧）。共享状态同时是任务日志：记录任务函数的
+    参数、prompt_id 和后端地址，服务重启后由 recover() 继续未完成的任务。
+    """
+
+    def __init__(self, store=None, progress_source=None):
+        """
+        Args:
+            store: SharedState，多进程部署时共享任务状态；为空时任务只在本进程内可见
+            progress_source: 按 prompt_id 返回进度快照（不含预览帧）的函数，用于同步到共享状态
+        """
+        self._jobs = {}
+        self._lock = threading.Lock()
+        self._store = store
+        self._progress_source = progress_source
+        self._saved = {}
+        self._sync_thread = None
+
+    def submit(self, kind, func, *args, params=None, **kwargs):
+        """提交后台任务
+
+        Args:
+            kind: 任务类型，如 animate
+            func: 任务函数，会以 job 关键字参数接收任务对象；返回None视为失败
+            params: 记录在任务上的请求参数
+
+        Returns:
+            Job: 新建的任务
+        """
+        job = Job(kind, params)
+        job.inputs = {'args': list(args), 'kwargs': kwargs}
+        self._start(job, func)
+        logger.info(f"已提交后台任务: {kind} {job.id}")
+        return job
+
+    def recover(self, handlers):
+        """继续已停止的进程留下的未完成任务（服务重启后调用）
+
+        任务以原来的参数和 ID 重新交给对应的任务函数，job.prompt_id 保留重启前提交的工作流，
+        任务函数据此继续等待 ComfyUI 的输出而不是重新提交。多个工作进程同时调用时每个任务只会被一个进程接管。
+
+        Args:
+            handlers: {任务类型: 任务函数}，与 submit 时的任务函数相同
+
+        Returns:
+            List[Job]: 接管的任务
+        """
+        if self._store is None:
+            return []
+        recovered = []
+        for data in self._store.unfinished_jobs():
+            # 所属进程仍在运行（进程号和启动时间都一致）时不接管；没有记录启动时间的旧任务
+            # 无法区分当前进程和重启前使用同一进程号的进程，按重启前的进程处理
+            started_at = data.get('owner_started_at')
+            if (process_alive(data['owner_pid'], started_at)
+                    and (data['owner_pid'] != os.getpid() or started_at is not None)):
+                continue
+            if not self._store.claim_job(data['job_id'], data['owner_pid']):
+                continue
+            job = Job.from_dict(data)
+            job.remote = False
+            if job.cancel_reason:
+                job.cancel_event.set()
+            func = handlers.get(job.kind)
+            if func is None or not job.inputs:
+                job.status = JOB_FAILED
+                job.error = f"服务重启，无法继续 {job.kind} 任务"
+                job.finished_at = time.time()
+                self._save(job)
+                logger.warning(f"无法继续任务: {job.id} ({job.kind})")
+                continue
+            logger.info(f"继续重启前的任务: {job.kind} {job.id} prompt_id: {job.prompt_id}")
+            self._start(job, func)
+            recovered.append(job)
+        JOBS_RECOVERED.inc(len(recovered))
+        return recovered
+
+    def _start(self, job, func):
+        job._on_change = self._save
+        with self._lock:
+            self._cleanup()
+            self._jobs[job.id] = job
+        self._save(job)
+        self._start_sync()
+
+        args, kwargs = job.inputs['args'], job.inputs['kwargs']
+        thread = threading.Thread(target=self._run, args=(job, func, args, kwargs), name=f"job-{job.id[:8]}", daemon=True)
+        thread.start()
+
+    def get(self, job_id):
+        """按ID获取任务（本进程中没有时从共享状态读取快照），不存在时返回None"""
+        with self._lock:
+            job = self._jobs.get(job_id)
+        if job or self._store is None:
+            return job
+        data = self._store.load_job(job_id)
+        return Job.from_dict(data) if data else None
+
+    def wait_for_remote_progress(self, job, last_version, timeout=15):
+        """等待其他进程中任务的进度变化或结束
+
+        Returns:
+            Tuple[Job, Dict]: (最新的任务快照, 进度快照)，超时返回当前状态
+        """
+        deadline = time.monotonic() + timeout
+        while True:
+            time.sleep(SYNC_INTERVAL)
+            job = self.get(job.id) or job
+            progress = job.progress
+            if job.finished or (progress and progress['version'] != last_version) or time.monotonic() >= deadline:
+                return job, progress
+
+    def cancel(self, job_id, reason='client'):
+        """请求取消任务
+
+        Args:
+            job_id: 任务ID
+            reason: 取消原因（client/client_disconnect/deadline）
+
+        Returns:
+            Job: 被取消的任务，不存在时返回None
+        """
+        job = self.get(job_id)
+        if not job:
+            return None
+        if job.remote:
+            # 由执行该任务的进程在下一次同步时取消
+            if not job.finished and self._store.request_cancel(job_id, reason):
+                job.cancel_reason = reason
+                logger.info(f"已请求取消其他进程中的任务: {job_id} 原因: {reason}")
+            return job
+        if not job.finished and not job.cancelled:
+            job.cancel_reason = reason
+            job.cancel_event.set()
+            logger.info(f"已请求取消任务: {job_id} 原因: {reason}")
+        return job
+
+    def attach_watcher(self, job):
+        """登记一个进度订阅者（如 SSE 连接）；断开后自动取消只对执行任务的进程中的订阅者生效"""
+        if job.remote:
+            return
+        with self._lock:
+            job.watchers += 1
+
+    def detach_watcher(self, job):
+        """订阅者断开；没有订阅者且宽限期内未重连时取消任务"""
+        if job.remote:
+            return
+        with self._lock:
+            job.watchers -= 1
+            if job.watchers > 0 or job.finished:
+                return
+
+        def cancel_if_abandoned():
+            with self._lock:
+                abandoned = job.watchers <= 0 and not job.finished
+            if abandoned:
+                logger.info(f"客户端已断开，取消任务: {job.id}")
+                self.cancel(job.id, 'client_disconnect')
+
+        timer = threading.Timer(DISCONNECT_GRACE_SECONDS, cancel_if_abandoned)
+        timer.daemon = True
+        timer.start()
+
+    def _run(self, job, func, args, kwargs):
+        job.status = JOB_RUNNING
+        self._save(job)
+        try:
+            result = func(*args, job=job, **kwargs)
+            if job.cancelled:
+                job.status = JOB_CANCELLED
+                job.error = f"任务已取消: {job.cancel_reason}"
+            elif result is None:
+                job.status = JOB_FAILED
+                job.error = job.error or f"{job.kind} 任务失败"
+            else:
+                job.result = result
+                job.status = JOB_SUCCEEDED
+        except Exception as e:
+            logger.error(f"后台任务失败: {job.id} {str(e)}")
+            logger.error(traceback.format_exc())
+            job.error = str(e)
+            job.status = JOB_CANCELLED if job.cancelled else JOB_FAILED
+        finally:
+            job.finished_at = time.time()
+            self._save(job)
+            logger.info(f"后台任务结束: {job.id} 状态: {job.status}")
+
+    def _save(self, job):
+        """把任务状态写入共享状态（内容没有变化时跳过）"""
+        if self._store is None:
+            return
+        snapshot = dict(job.to_dict(), params=job.params, progress=job.progress, inputs=job.inputs, backend=job.backend)
+        if self._saved.get(job.id) == snapshot:
+            return
+        try:
+            self._store.save_job(snapshot)
+            self._saved[job.id] = snapshot
+        except Exception as e:
+            logger.warning(f"写入共享任务状态失败: {job.id} {str(e)}")
+
+    def _start_sync(self):
+        if self._store is None:
+            return
+        with self._lock:
+            if self._sync_thread and self._sync_thread.is_alive():
+                return
+            self._sync_thread = threading.Thread(target=self._sync_loop, name='job-sync', daemon=True)
+            self._sync_thread.start()
+
+    def _sync_loop(self):
+        """定期写入本进程中执行中任务的 prompt_id 和进度，并处理其他进程发来的取消请求"""
+        while True:
+            time.sleep(SYNC_INTERVAL)
+            with self._lock:
+                running = [job for job in self._jobs.values() if not job.finished]
+            if not running:
+                continue
+            try:
+                for job in running:
+                    if self._progress_source and job.prompt_id:
+                        job.progress = self._progress_source(job.prompt_id)
+                    self._save(job)
+                for job_id, reason in self._store.cancel_requests([job.id for job in running]).items():
+                    self.cancel(job_id, reason)
+            except Exception as e:
+                logger.warning(f"同步共享任务状态失败: {str(e)}")
+
+    def _cleanup(self):
+        """清理过期的已结束任务（调用方需持有锁）"""
+        now = time.time()
+        expired = [job_id for job_id, job in self._jobs.items()
+                   if job.finished and now - job.finished_at > FINISHED_JOB_TTL]
+        for job_id in expired:
+            del self._jobs[job_id]
+            self._saved.pop(job_id, None)
+        if self._store is not None and expired:
+            try:
+                self._store.delete_finished_jobs(now - FINISHED_JOB_TTL)
+            except Exception as e:
+                logger.warning(f"清理共享任务状态失败: {str(e)}")
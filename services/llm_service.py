@@ -1,54 +1,51 @@
-import requests
 import logging
 import base64
 import json
+import time
+
+from services import metrics
+from services.upstream_governor import governor
 
 logger = logging.getLogger(__name__)
 
+PROMPT_CHAIN_SECONDS = metrics.histogram(
+    'llm_prompt_chain_seconds',
+    '提示词生成链路耗时（秒）：first_token 为调用方拿到第一个 token，total 为两段全部完成',
+    ['mode', 'point'],
+    buckets=(0.25, 0.5, 1, 2, 3, 5, 8, 12, 20, 30, 60, 120)
+)
+
 class LLMService:
     def __init__(self, llm_studio_url, model_name):
         self.llm_studio_url = llm_studio_url
         self.model_name = model_name
     
-    def generate_prompts(self, original_image_path, enhanced_image_path):
-        """根据原始图片和美化后的图片生成提示词"""
-        try:
-            # 读取并编码图片
-            original_image = self._encode_image(original_image_path)
-            enhanced_image = self._encode_image(enhanced_image_path)
-            
-            # 构建系统提示
-            system_prompt = """你是一个专业的儿童绘画分析专家，擅长生成创意提示词。
-你的任务是分析原始绘画和其美化版本，然后生成适当的提示词用于进一步处理。
-请重点关注：
-1. 图片中的主要元素和主题
-2. 颜色和风格特点
-3. 可能的动画效果建议
-4. 如何让图片更加生动有趣"""
+    def generate_prompts(self, original_image_path, enhanced_image_path, stream=False):
+        """根据原始图片和美化后的图片生成提示词
 
-            # 构建用户提示
-            user_prompt = f"""请分析这两张图片：
-1. 原始儿童绘画
-2. 美化后的版本
+        Args:
+            original_image_path: 原始图片路径
+            enhanced_image_path: 美化后的图片路径
+            stream: 是否以流式方式调用本地LLM（见 stream_prompts），结果相同，首个 token 更早到达
 
-请生成一个详细的提示词，描述美化后的图片，并建议如何将其动画化。
-重点关注关键元素、颜色和可能的动作。"""
+        Returns:
+            Dict: enhancement_prompt、animation_prompt 和 timings（first_token_seconds、
+            enhancement_seconds、total_seconds）；失败时返回None
+        """
+        if stream:
+            for event in self.stream_prompts(original_image_path, enhanced_image_path):
+                if event["status"] == "success":
+                    return {key: event[key] for key in ("enhancement_prompt", "animation_prompt", "timings")}
+                if event["status"] == "error":
+                    return None
+            return None
 
-            # 调用本地LLM API
-            response = requests.post(
+        try:
+            start = time.perf_counter()
+            response = governor.post(
+                'llm_studio',
                 f"{self.llm_studio_url}/api/generate",
-                json={
-                    "model": self.model_name,
-                    "prompt": user_prompt,
-                    "system": system_prompt,
-                    "images": [original_image, enhanced_image],
-                    "stream": False,
-                    "options": {
-                        "temperature": 0.7,
-                        "top_p": 0.9,
-                        "max_tokens": 500
-                    }
-                }
+                json=self._enhancement_body(original_image_path, enhanced_image_path, stream=False)
             )
             
             if response.status_code != 200:
@@ -63,15 +60,191 @@ class LLMService:
                 logger.error("No response from LLM")
                 return None
             
+            # 非流式模式下第一个 token 和完整回复同时到达
+            enhancement_seconds = time.perf_counter() - start
+            animation_prompt = self._generate_animation_prompt(prompt_text)
+            timings = self._record_timings('blocking', enhancement_seconds, enhancement_seconds,
+                                           time.perf_counter() - start)
+            
             # 返回结构化的提示词
             return {
                 "enhancement_prompt": prompt_text,
-                "animation_prompt": self._generate_animation_prompt(prompt_text)
+                "animation_prompt": animation_prompt,
+                "timings": timings
             }
             
         except Exception as e:
             logger.error(f"Error in generate_prompts: {str(e)}")
             return None
+
+    def stream_prompts(self, original_image_path, enhanced_image_path):
+        """流式生成提示词，边生成边把部分结果交给调用方
+
+        以 stream: true 调用 /api/generate，逐行解析 NDJSON。第一段（图片描述）收到 done 后立即
+        发起第二段（动画提示词），第二段同样流式返回。
+
+        Args:
+            original_image_path: 原始图片路径
+            enhanced_image_path: 美化后的图片路径
+
+        Yields:
+            Dict: {"status": "partial", "stage": "enhancement"|"animation", "delta": 新增文本}；
+            最后一个事件为 {"status": "success", "enhancement_prompt", "animation_prompt", "timings"}
+            或 {"status": "error", "error": 错误信息}
+        """
+        start = time.perf_counter()
+        first_token_seconds = None
+        try:
+            chunks = []
+            for chunk in self._stream_generate(self._enhancement_body(original_image_path, enhanced_image_path,
+                                                                      stream=True)):
+                if first_token_seconds is None:
+                    first_token_seconds = time.perf_counter() - start
+                chunks.append(chunk)
+                yield {"status": "partial", "stage": "enhancement", "delta": chunk}
+            prompt_text = ''.join(chunks)
+            if not prompt_text:
+                logger.error("No response from LLM")
+                yield {"status": "error", "error": "No response from LLM"}
+                return
+            enhancement_seconds = time.perf_counter() - start
+
+            chunks = []
+            try:
+                for chunk in self._stream_generate(self._animation_body(prompt_text, stream=True)):
+                    chunks.append(chunk)
+                    yield {"status": "partial", "stage": "animation", "delta": chunk}
+                animation_prompt = ''.join(chunks)
+            except Exception as e:
+                # 与非流式模式一致：第二段失败时动画提示词为None
+                logger.error(f"Error in _generate_animation_prompt: {str(e)}")
+                animation_prompt = None
+
+            yield {
+                "status": "success",
+                "enhancement_prompt": prompt_text,
+                "animation_prompt": animation_prompt,
+                "timings": self._record_timings('stream', first_token_seconds, enhancement_seconds,
+                                                time.perf_counter() - start)
+            }
+        except Exception as e:
+            logger.error(f"Error in stream_prompts: {str(e)}")
+            yield {"status": "error", "error": str(e)}
+
+    def _stream_generate(self, body):
+        """以流式方式调用 /api/generate，逐个产出回复片段
+
+        done 为 true 的行是最后一行，读完紧随其后的分块结束标记就返回（连接放回连接池、释放并发槽位）。
+
+        Raises:
+            Exception: 请求失败、流中返回错误或流在 done 之前结束
+        """
+        done = False
+        with governor.stream('llm_studio', f"{self.llm_studio_url}/api/generate", json=body) as response:
+            if response.status_code != 200:
+                raise Exception(f"LLM API call failed: {response.text}")
+            for line in response.iter_lines():
+                if not line or done:
+                    continue
+                data = json.loads(line)
+                if data.get('error'):
+                    raise Exception(f"LLM stream error: {data['error']}")
+                if data.get('response'):
+                    yield data['response']
+                done = bool(data.get('done'))
+        if not done:
+            raise Exception("LLM stream ended before done")
+
+    def _record_timings(self, mode, first_token_seconds, enhancement_seconds, total_seconds):
+        PROMPT_CHAIN_SECONDS.observe(first_token_seconds, mode=mode, point='first_token')
+        PROMPT_CHAIN_SECONDS.observe(total_seconds, mode=mode, point='total')
+        return {
+            "first_token_seconds": round(first_token_seconds, 3),
+            "enhancement_seconds": round(enhancement_seconds, 3),
+            "total_seconds": round(total_seconds, 3)
+        }
+
+    def _enhancement_body(self, original_image_path, enhanced_image_path, stream):
+        """第一段请求：根据两张图片生成描述"""
+        # 读取并编码图片
+        original_image = self._encode_image(original_image_path)
+        enhanced_image = self._encode_image(enhanced_image_path)
+        
+        # 构建系统提示
+        system_prompt = """你是一个专业的儿童绘画分析专家，擅长生成创意提示词。
+你的任务是分析原始绘画和其美化版本，然后生成适当的提示词用于进一步处理。
+请重点关注：
+1. 图片中的主要元素和主题
+2. 颜色和风格特点
+3. 可能的动画效果建议
+4. 如何让图片更加生动有趣"""
+
+        # 构建用户提示
+        user_prompt = f"""请分析这两张图片：
+1. 原始儿童绘画
+2. 美化后的版本
+
+请生成一个详细的提示词，描述美化后的图片，并建议如何将其动画化。
+重点关注关键元素、颜色和可能的动作。"""
+
+        return {
+            "model": self.model_name,
+            "prompt": user_prompt,
+            "system": system_prompt,
+            "images": [original_image, enhanced_image],
+            "stream": stream,
+            "options": {
+                "temperature": 0.7,
+                "top_p": 0.9,
+                "max_tokens": 500
+            }
+        }
+    
+    def analyze_image(self, image_base64, prompt, json_format=False):
+        """使用本地多模态模型分析图片（作为百度分析的对冲/备用通道）
+        
+        Args:
+            image_base64: base64编码的图片
+            prompt: 分析提示词
+            json_format: 是否要求模型输出JSON
+            
+        Returns:
+            Tuple[str, Dict]: (模型回复文本, token用量)
+            
+        Raises:
+            Exception: 请求失败或没有回复
+        """
+        body = {
+            "model": self.model_name,
+            "prompt": prompt,
+            "images": [image_base64],
+            "stream": False,
+            "options": {
+                "temperature": 0.2
+            }
+        }
+        if json_format:
+            body["format"] = "json"
+        
+        response = governor.post(
+            'llm_studio',
+            f"{self.llm_studio_url}/api/generate",
+            json=body
+        )
+        if response.status_code != 200:
+            raise Exception(f"LLM API call failed: {response.text}")
+        
+        result = response.json()
+        text = result.get('response', '')
+        if not text:
+            raise Exception("No response from LLM")
+        
+        usage = {
+            "prompt_tokens": result.get("prompt_eval_count", 0),
+            "completion_tokens": result.get("eval_count", 0)
+        }
+        usage["total_tokens"] = usage["prompt_tokens"] + usage["completion_tokens"]
+        return text, usage
     
     def _encode_image(self, image_path):
         """将图片编码为base64"""
@@ -81,8 +254,27 @@ class LLMService:
     def _generate_animation_prompt(self, enhancement_prompt):
         """根据增强提示生成动画提示"""
         try:
-            # 构建系统提示
-            system_prompt = """你是一个专业的动画提示词生成专家。
+            response = governor.post(
+                'llm_studio',
+                f"{self.llm_studio_url}/api/generate",
+                json=self._animation_body(enhancement_prompt, stream=False)
+            )
+            
+            if response.status_code != 200:
+                logger.error(f"LLM API call failed: {response.text}")
+                return None
+            
+            result = response.json()
+            return result.get('response', '')
+            
+        except Exception as e:
+            logger.error(f"Error in _generate_animation_prompt: {str(e)}")
+            return None
+
+    def _animation_body(self, enhancement_prompt, stream):
+        """第二段请求：把图片描述转换为动画提示词"""
+        # 构建系统提示
+        system_prompt = """你是一个专业的动画提示词生成专家。
 你的任务是将静态图片描述转换为动态动画提示词。
 请重点关注：
 1. 动作和运动描述
@@ -90,8 +282,8 @@ class LLMService:
 3. 特效和过渡效果
 4. 如何让动画更加生动有趣"""
 
-            # 构建用户提示
-            user_prompt = f"""基于这个图片描述：
+        # 构建用户提示
+        user_prompt = f"""基于这个图片描述：
 {enhancement_prompt}
 
 请生成一个详细的动画提示词，包括：
@@ -100,28 +292,14 @@ class LLMService:
 3. 特效建议
 4. 如何让动画更加生动有趣"""
 
-            response = requests.post(
-                f"{self.llm_studio_url}/api/generate",
-                json={
-                    "model": self.model_name,
-                    "prompt": user_prompt,
-                    "system": system_prompt,
-                    "stream": False,
-                    "options": {
-                        "temperature": 0.7,
-                        "top_p": 0.9,
-                        "max_tokens": 300
-                    }
-                }
-            )
-            
-            if response.status_code != 200:
-                logger.error(f"LLM API call failed: {response.text}")
-                return None
-            
-            result = response.json()
-            return result.get('response', '')
-            
-        except Exception as e:
-            logger.error(f"Error in _generate_animation_prompt: {str(e)}")
-            return None 
\ No newline at end of file
+        return {
+            "model": self.model_name,
+            "prompt": user_prompt,
+            "system": system_prompt,
+            "stream": stream,
+            "options": {
+                "temperature": 0.7,
+                "top_p": 0.9,
+                "max_tokens": 300
+            }
+        }
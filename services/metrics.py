@@ -0,0 +1,333 @@
+import logging
+import os
+import threading
+import time
+
+from services.shared_state import process_alive
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+# 直方图默认分桶（秒）
+DEFAULT_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+# 多进程汇总时瞬时值指标的合并方式：all 每个存活进程一条（加 pid 标签），sum/max/min 对存活进程求和/最大/最小，
+# latest 取所有存活进程中最后一次更新的值（如只由一个进程采样的 ComfyUI 状态）
+GAUGE_MODES = ('all', 'sum', 'max', 'min', 'latest')
+
+
+class _Metric:
+    """带标签的指标基类"""
+
+    metric_type = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"指标 {self.name} 的标签应为 {self.labelnames}，实际为 {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def _format_labels(self, key, extra=None):
+        pairs = list(zip(self.labelnames, key)) + list(extra or [])
+        if not pairs:
+            return ''
+        escaped = [(k, v.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')) for k, v in pairs]
+        return '{' + ','.join(f'{k}="{v}"' for k, v in escaped) + '}'
+
+    def get(self, **labels):
+        """读取当前值（便于在代码中使用指标做决策）"""
+        with self._lock:
+            return self._values.get(self._key(labels), 0)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.metric_type}"]
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{self._format_labels(key)} {value}")
+        return lines
+
+    def dump(self):
+        """可 JSON 序列化的当前状态，用于多进程汇总"""
+        with self._lock:
+            values = [[list(key), value] for key, value in self._values.items()]
+        return {'type': self.metric_type, 'documentation': self.documentation,
+                'labelnames': list(self.labelnames), 'values': values}
+
+    def merge(self, dump, pid, live):
+        """把一个进程 dump() 的值累加进来（计数器和直方图包含已退出进程的值）"""
+        with self._lock:
+            for key, value in dump['values']:
+                key = tuple(key)
+                self._values[key] = self._values.get(key, 0) + value
+
+
+class Counter(_Metric):
+    """只增不减的计数器"""
+
+    metric_type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    """可增可减的瞬时值"""
+
+    metric_type = 'gauge'
+
+    def __init__(self, name, documentation, labelnames=(), multiprocess_mode='all'):
+        super().__init__(name, documentation, labelnames)
+        if multiprocess_mode not in GAUGE_MODES:
+            raise ValueError(f"指标 {name} 的多进程合并方式应为 {GAUGE_MODES} 之一，实际为 {multiprocess_mode}")
+        self.multiprocess_mode = multiprocess_mode
+        self._updated = {}
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+            self._updated[key] = time.time()
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+            self._updated[key] = time.time()
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def dump(self):
+        with self._lock:
+            values = [[list(key), value, self._updated.get(key, 0)] for key, value in self._values.items()]
+        return {'type': self.metric_type, 'documentation': self.documentation,
+                'labelnames': list(self.labelnames), 'mode': self.multiprocess_mode, 'values': values}
+
+    def merge(self, dump, pid, live):
+        """按 multiprocess_mode 合并一个进程的值，已退出进程的值不计入"""
+        if not live:
+            return
+        mode = self.multiprocess_mode
+        with self._lock:
+            for key, value, updated in dump['values']:
+                key = tuple(key) + ((str(pid),) if mode == 'all' else ())
+                current = self._values.get(key)
+                if current is None or mode == 'all':
+                    self._values[key], self._updated[key] = value, updated
+                elif mode == 'sum':
+                    self._values[key] = current + value
+                elif mode == 'max':
+                    self._values[key] = max(current, value)
+                elif mode == 'min':
+                    self._values[key] = min(current, value)
+                elif updated > self._updated[key]:
+                    self._values[key], self._updated[key] = value, updated
+
+
+class Histogram(_Metric):
+    """分桶统计的直方图"""
+
+    metric_type = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = {'buckets': [0] * len(self.buckets), 'sum': 0.0, 'count': 0}
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state['buckets'][i] += 1
+            state['sum'] += value
+            state['count'] += 1
+
+    def get(self, **labels):
+        """返回 (count, sum)"""
+        with self._lock:
+            state = self._values.get(self._key(labels))
+            return (state['count'], state['sum']) if state else (0, 0.0)
+
+    def dump(self):
+        with self._lock:
+            values = [[list(key), {'buckets': list(state['buckets']), 'sum': state['sum'], 'count': state['count']}]
+                      for key, state in self._values.items()]
+        return {'type': self.metric_type, 'documentation': self.documentation,
+                'labelnames': list(self.labelnames), 'buckets': list(self.buckets), 'values': values}
+
+    def merge(self, dump, pid, live):
+        if tuple(dump['buckets']) != self.buckets:
+            logger.warning(f"进程 {pid} 的直方图 {self.name} 分桶不同，跳过")
+            return
+        with self._lock:
+            for key, other in dump['values']:
+                key = tuple(key)
+                state = self._values.get(key)
+                if state is None:
+                    state = self._values[key] = {'buckets': [0] * len(self.buckets), 'sum': 0.0, 'count': 0}
+                state['buckets'] = [a + b for a, b in zip(state['buckets'], other['buckets'])]
+                state['sum'] += other['sum']
+                state['count'] += other['count']
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.metric_type}"]
+        with self._lock:
+            for key, state in sorted(self._values.items()):
+                for bound, count in zip(self.buckets, state['buckets']):
+                    lines.append(f"{self.name}_bucket{self._format_labels(key, [('le', str(bound))])} {count}")
+                lines.append(f"{self.name}_bucket{self._format_labels(key, [('le', '+Inf')])} {state['count']}")
+                lines.append(f"{self.name}_sum{self._format_labels(key)} {state['sum']}")
+                lines.append(f"{self.name}_count{self._format_labels(key)} {state['count']}")
+        return lines
+
+
+class MetricsRegistry:
+    """进程内指标注册表，按 Prometheus 文本格式导出"""
+
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        with self._lock:
+            existing = self._metrics.get(metric.name)
+            if existing:
+                return existing
+            self._metrics[metric.name] = metric
+            return metric
+
+    def render(self):
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+    def dump(self):
+        """所有指标的 {名称: dump()}"""
+        with self._lock:
+            metrics = list(self._metrics.values())
+        return {metric.name: metric.dump() for metric in metrics}
+
+
+def _empty_metric(name, dump):
+    """按 dump() 的元数据创建一个空指标，用来累加各进程的值"""
+    if dump['type'] == 'counter':
+        return Counter(name, dump['documentation'], dump['labelnames'])
+    if dump['type'] == 'histogram':
+        return Histogram(name, dump['documentation'], dump['labelnames'], dump['buckets'])
+    labelnames = dump['labelnames'] + (['pid'] if dump['mode'] == 'all' else [])
+    return Gauge(name, dump['documentation'], labelnames, dump['mode'])
+
+
+def merge_dumps(dumps, live_pids):
+    """合并各进程的 MetricsRegistry.dump()
+
+    Args:
+        dumps: {pid: MetricsRegistry.dump()}，按顺序合并（指标按第一次出现的顺序导出）
+        live_pids: 仍在运行的进程，已退出进程的计数器和直方图照常累加，瞬时值不计入
+
+    Returns:
+        MetricsRegistry: 合并后的注册表
+    """
+    registry = MetricsRegistry()
+    for pid, dump in dumps.items():
+        for name, metric_dump in dump.items():
+            registry.register(_empty_metric(name, metric_dump)).merge(metric_dump, pid, pid in live_pids)
+    return registry
+
+
+class ProcessMetrics:
+    """多进程部署（gunicorn 多个工作进程）时汇总所有工作进程的指标
+
+    每个工作进程每隔 interval 秒（以及退出前）把自己的注册表写入共享状态；/metrics 由任意进程处理时
+    都先写入自己的最新值，再合并所有进程的值导出：计数器和直方图求和（包含已退出进程的累计值，
+    保证总数单调递增），瞬时值按各自的 multiprocess_mode 合并。没有关联共享状态时只导出本进程的指标。
+    """
+
+    NAMESPACE = 'metrics'
+
+    def __init__(self, registry=None):
+        self.registry = registry or REGISTRY
+        self._store = None
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def attach_store(self, store, interval=5):
+        """关联共享状态并启动定期写入的后台线程（重复调用无副作用）
+
+        Args:
+            store: SharedState
+            interval: 写入间隔（秒），不大于0时只在导出时写入
+        """
+        with self._lock:
+            self._store = store
+            if interval <= 0 or (self._thread and self._thread.is_alive()):
+                return
+            self._thread = threading.Thread(target=self._run, args=(interval,), name='metrics-publish', daemon=True)
+            self._thread.start()
+
+    def reset(self, store):
+        """清空共享状态中各进程的指标（主进程启动时调用，之前运行的进程的值不再计入）"""
+        store.cache_clear(self.NAMESPACE)
+
+    def _run(self, interval):
+        while True:
+            time.sleep(interval)
+            self.publish()
+
+    def publish(self):
+        """把本进程的指标写入共享状态"""
+        if self._store is None:
+            return
+        try:
+            self._store.cache_set(self.NAMESPACE, str(os.getpid()), self.registry.dump())
+        except Exception as e:
+            logger.warning(f"写入进程指标失败: {str(e)}")
+
+    def render(self):
+        """所有进程合并后的 Prometheus 文本"""
+        if self._store is None:
+            return self.registry.render()
+        self.publish()
+        try:
+            stored = self._store.cache_items(self.NAMESPACE)
+        except Exception as e:
+            logger.warning(f"读取其他进程的指标失败，只导出本进程的指标: {str(e)}")
+            return self.registry.render()
+        # 本进程的指标排在最前，导出顺序与单进程时相同
+        own = str(os.getpid())
+        dumps = {int(pid): stored[pid] for pid in sorted(stored, key=lambda pid: pid != own)}
+        live_pids = {pid for pid in dumps if process_alive(pid)}
+        return merge_dumps(dumps, live_pids).render()
+
+
+REGISTRY = MetricsRegistry()
+PROCESS_METRICS = ProcessMetrics()
+
+
+def counter(name, documentation, labelnames=()):
+    """创建（或获取已注册的）计数器"""
+    return REGISTRY.register(Counter(name, documentation, labelnames))
+
+
+def gauge(name, documentation, labelnames=(), multiprocess_mode='all'):
+    """创建（或获取已注册的）瞬时值指标，multiprocess_mode 见 GAUGE_MODES"""
+    return REGISTRY.register(Gauge(name, documentation, labelnames, multiprocess_mode))
+
+
+def histogram(name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+    """创建（或获取已注册的）直方图"""
+    return REGISTRY.register(Histogram(name, documentation, labelnames, buckets))
@@ -0,0 +1,188 @@
+import logging
+import time
+
+import numpy as np
+from PIL import Image
+
+from services import metrics
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+# 聚类前把图片缩小到这个尺寸以内
+SAMPLE_SIZE = 128
+CLUSTER_COUNT = 6
+KMEANS_ITERATIONS = 8
+# 与纸张颜色的 RGB 距离小于该值的像素视为背景
+PAPER_DISTANCE = 48
+# 占比低于该值的颜色不计入调色板
+MIN_COLOR_RATIO = 0.05
+
+PALETTE_SECONDS = metrics.histogram(
+    'palette_extract_seconds', '本地调色板提取耗时（秒）', buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5)
+)
+COLOR_MERGES = metrics.counter('palette_color_merges_total', '本地调色板对模型颜色字段的补全结果', ['action'])
+
+# 色相区间（度）与颜色名称，按区间上界排列
+HUE_NAMES = [
+    (15, '红色'),
+    (40, '橙色'),
+    (70, '黄色'),
+    (165, '绿色'),
+    (195, '青色'),
+    (255, '蓝色'),
+    (290, '紫色'),
+    (340, '粉色'),
+    (360, '红色')
+]
+ACHROMATIC_NAMES = {'黑色', '灰色', '白色'}
+
+
+def _rgb_to_hsv(rgb):
+    """(N, 3) 的 0-1 RGB 数组转换为色相（度）、饱和度、明度"""
+    maximum = rgb.max(axis=1)
+    minimum = rgb.min(axis=1)
+    delta = maximum - minimum
+    safe_delta = np.where(delta == 0, 1, delta)
+    r, g, b = rgb[:, 0], rgb[:, 1], rgb[:, 2]
+    hue = np.select(
+        [maximum == r, maximum == g],
+        [((g - b) / safe_delta) % 6, (b - r) / safe_delta + 2],
+        (r - g) / safe_delta + 4
+    ) * 60
+    hue = np.where(delta == 0, 0, hue)
+    saturation = np.where(maximum == 0, 0, delta / np.where(maximum == 0, 1, maximum))
+    return hue, saturation, maximum
+
+
+def color_name(rgb):
+    """把一个 0-255 的 RGB 颜色映射为中文颜色名"""
+    hue, saturation, value = (float(v[0]) for v in _rgb_to_hsv(np.asarray([rgb], dtype=np.float64) / 255))
+    if value < 0.2:
+        return '黑色'
+    if saturation < 0.2:
+        return '白色' if value > 0.85 else '灰色'
+    if hue < 45 and value < 0.6:
+        return '棕色'
+    if (hue < 15 or hue >= 340) and saturation < 0.45 and value > 0.75:
+        return '粉色'
+    return next(name for upper, name in HUE_NAMES if hue < upper)
+
+
+def _load_pixels(image):
+    """缩小图片并返回 (H, W, 3) 的 RGB 像素，透明区域视为白纸"""
+    image.draft('RGB', (SAMPLE_SIZE * 2, SAMPLE_SIZE * 2))
+    if image.mode in ('RGBA', 'LA', 'P'):
+        image = image.convert('RGBA')
+        background = Image.new('RGBA', image.size, (255, 255, 255, 255))
+        image = Image.alpha_composite(background, image)
+    image = image.convert('RGB')
+    image.thumbnail((SAMPLE_SIZE, SAMPLE_SIZE), Image.BILINEAR)
+    return np.asarray(image, dtype=np.float32)
+
+
+def _quantize(pixels):
+    """把像素按每通道 5 位量化成颜色直方图，返回 (颜色, 像素数)，聚类只需处理非空的颜色格"""
+    codes = (pixels.astype(np.uint16) >> 3)
+    codes = (codes[:, 0] << 10) | (codes[:, 1] << 5) | codes[:, 2]
+    histogram = np.bincount(codes, minlength=1 << 15)
+    occupied = np.flatnonzero(histogram)
+    colors = np.stack([occupied >> 10, (occupied >> 5) & 31, occupied & 31], axis=1) * 8 + 4
+    return colors.astype(np.float32), histogram[occupied].astype(np.float32)
+
+
+def _kmeans(colors, weights, k, iterations):
+    """加权的向量化 k-means，初始中心取自按亮度排序后的等间隔样本（结果确定）"""
+    order = np.argsort(colors.sum(axis=1), kind='stable')
+    centers = colors[order[np.linspace(0, len(colors) - 1, k).astype(int)]].copy()
+    squared_norms = (colors ** 2).sum(axis=1)[:, None]
+    for _ in range(iterations):
+        # |x - c|^2 = |x|^2 - 2x·c + |c|^2
+        distances = squared_norms - 2 * colors @ centers.T + (centers ** 2).sum(axis=1)[None, :]
+        labels = distances.argmin(axis=1)
+        counts = np.bincount(labels, weights=weights, minlength=k)
+        sums = np.stack([np.bincount(labels, weights=weights * colors[:, c], minlength=k) for c in range(3)], axis=1)
+        non_empty = counts > 0
+        centers[non_empty] = sums[non_empty] / counts[non_empty, None]
+    return centers, counts
+
+
+def extract_palette(image_path, max_colors=5, image=None):
+    """提取图片的主要颜色（不含白纸背景）
+
+    Args:
+        image_path: 图片文件路径
+        max_colors: 最多返回的颜色数
+        image: 已解码的 PIL 图片（如 SharedImage.working()），为空时从 image_path 解码
+
+    Returns:
+        List[Dict]: [{"name": "蓝色", "hex": "#3050c8", "ratio": 0.32}]，按占比降序；失败时返回None
+    """
+    start = time.perf_counter()
+    try:
+        if image is not None:
+            pixels = _load_pixels(image)
+        else:
+            with Image.open(image_path) as img:
+                pixels = _load_pixels(img)
+
+        # 去掉纸张背景：接近白色，或接近边缘像素中位色（拍照时纸张常偏灰偏黄）的像素；
+        # 剩下的像素太少（整张图都是背景色）时保留全部像素
+        border = np.concatenate([pixels[0], pixels[-1], pixels[:, 0], pixels[:, -1]])
+        paper_color = np.median(border, axis=0)
+        pixels = pixels.reshape(-1, 3)
+        hue, saturation, value = _rgb_to_hsv(pixels / 255)
+        paper = ((value > 0.85) & (saturation < 0.12)) | \
+                (((pixels - paper_color) ** 2).sum(axis=1) < PAPER_DISTANCE ** 2)
+        if (~paper).sum() >= len(pixels) * 0.02:
+            pixels = pixels[~paper]
+
+        colors, weights = _quantize(pixels)
+        centers, counts = _kmeans(colors, weights, min(CLUSTER_COUNT, len(colors)), KMEANS_ITERATIONS)
+
+        # 同名颜色合并，颜色值取占比最大的聚类中心
+        palette = {}
+        for center, count in zip(centers, counts):
+            if count == 0:
+                continue
+            name = color_name(center)
+            ratio = float(count) / len(pixels)
+            entry = palette.setdefault(name, {"name": name, "hex": None, "ratio": 0.0, "_best": 0.0})
+            entry["ratio"] += ratio
+            if ratio > entry["_best"]:
+                entry["_best"] = ratio
+                entry["hex"] = '#%02x%02x%02x' % tuple(int(round(c)) for c in center)
+
+        colors = sorted(palette.values(), key=lambda e: e["ratio"], reverse=True)
+        result = [{"name": e["name"], "hex": e["hex"], "ratio": round(float(e["ratio"]), 3)}
+                  for e in colors if e["ratio"] >= MIN_COLOR_RATIO][:max_colors]
+        PALETTE_SECONDS.observe(time.perf_counter() - start)
+        return result
+    except Exception as e:
+        logger.error(f"调色板提取失败: {str(e)}")
+        return None
+
+
+def merge_colors(colors, palette):
+    """用本地调色板补全模型给出的颜色列表
+
+    模型没有给出颜色时直接使用调色板的颜色名；已有颜色时保留模型的描述（通常带部位，
+    例如“蓝色头发”），只追加模型没有提到的彩色（黑白灰多来自线条、阴影和纸张，不追加）。
+
+    Args:
+        colors: 模型返回的颜色列表
+        palette: extract_palette 的结果
+
+    Returns:
+        Tuple[List[str], str]: (补全后的颜色列表, 操作 filled/augmented/unchanged)
+    """
+    names = [entry["name"] for entry in palette or []]
+    if not colors:
+        merged, action = names, 'filled' if names else 'unchanged'
+    else:
+        # 模型常用“蓝”“蓝色的”等写法，按颜色名的第一个字匹配
+        missing = [name for name in names
+                   if name not in ACHROMATIC_NAMES and not any(name[0] in color for color in colors)]
+        merged, action = list(colors) + missing, 'augmented' if missing else 'unchanged'
+    COLOR_MERGES.inc(action=action)
+    return merged, action
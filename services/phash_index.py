@@ -0,0 +1,357 @@
+import itertools
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+from PIL import Image
+
+from services import metrics
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+HASH_BITS = 64
+# 多索引哈希把 64 位哈希切成 4 段，每段 16 位
+CHUNK_COUNT = 4
+CHUNK_BITS = HASH_BITS // CHUNK_COUNT
+CHUNK_MASK = (1 << CHUNK_BITS) - 1
+# 多进程部署时两次从共享状态同步缓存之间的最短间隔（秒），其他进程新写入的条目最多晚这么久可见
+SYNC_INTERVAL = 1.0
+
+LOOKUPS = metrics.counter('phash_lookups_total', '感知哈希近重复查询结果', ['outcome'])
+LOOKUP_SECONDS = metrics.histogram(
+    'phash_lookup_seconds', '感知哈希索引查询耗时（秒）', buckets=(0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.01)
+)
+INDEX_SIZE = metrics.gauge('phash_index_entries', '感知哈希索引中的条目数')
+EVICTIONS = metrics.counter('phash_cache_evictions_total', '近重复缓存因条目数上限或过期淘汰的条目数')
+
+
+def _dct_matrix(n):
+    """n 点 DCT-II 变换矩阵"""
+    k = np.arange(n)[:, None]
+    i = np.arange(n)[None, :]
+    matrix = np.cos(np.pi * (2 * i + 1) * k / (2 * n)) * np.sqrt(2.0 / n)
+    matrix[0] /= np.sqrt(2.0)
+    return matrix
+
+
+_DCT_32 = _dct_matrix(32)
+
+
+def _bits_to_int(bits):
+    """把 64 个布尔值按顺序打包为整数"""
+    return int(np.packbits(bits.astype(np.uint8)).view('>u8')[0])
+
+
+def image_hashes(image):
+    """计算图片的 pHash 和 dHash
+
+    Args:
+        image: PIL 图片（任意模式和尺寸）
+
+    Returns:
+        Tuple[int, int]: (pHash, dHash)，均为 64 位整数
+    """
+    if image.mode in ('RGBA', 'LA', 'P'):
+        # 透明区域按白纸处理
+        image = image.convert('RGBA')
+        background = Image.new('RGBA', image.size, (255, 255, 255, 255))
+        image = Image.alpha_composite(background, image)
+    gray = image.convert('L')
+
+    # pHash：32x32 灰度图做二维 DCT，取左上角 8x8 低频系数（去掉直流分量）与中位数比较
+    pixels = np.asarray(gray.resize((32, 32), Image.LANCZOS), dtype=np.float64)
+    low_freq = (_DCT_32 @ pixels @ _DCT_32.T)[:8, :8].flatten()
+    phash = _bits_to_int(low_freq > np.median(low_freq[1:]))
+
+    # dHash：9x8 灰度图相邻像素比较
+    pixels = np.asarray(gray.resize((9, 8), Image.LANCZOS), dtype=np.int16)
+    dhash = _bits_to_int((pixels[:, 1:] > pixels[:, :-1]).flatten())
+    return phash, dhash
+
+
+def hash_file(image_path):
+    """计算图片文件的 (pHash, dHash)；JPEG 使用 draft 模式按缩小尺寸解码"""
+    with Image.open(image_path) as img:
+        img.draft('L', (128, 128))
+        return image_hashes(img)
+
+
+def cache_key(hashes):
+    """按图片内容生成的缓存键：(pHash, dHash) 的 32 位十六进制串
+
+    上传文件名不能作为键：不同手机上传的文件名经常重复（image.jpg），secure_filename 还会把中文文件名
+    变成 'png' 这样的扩展名，用文件名做键时新的画会顶掉之前的缓存条目。
+    """
+    return f"{int(hashes[0]):016x}{int(hashes[1]):016x}"
+
+
+def hamming(a, b):
+    return bin(a ^ b).count('1')
+
+
+# 每个 16 位整数的置位数，用于向量化的汉明距离计算（NumPy 2 以上直接用 bitwise_count）
+_POPCOUNT_TABLE = np.array([bin(i).count('1') for i in range(1 << 16)], dtype=np.uint8)
+
+
+def _popcount64(values):
+    """uint64 数组逐元素的置位数"""
+    if hasattr(np, 'bitwise_count'):
+        return np.bitwise_count(values)
+    return _POPCOUNT_TABLE[values.view(np.uint16)].reshape(-1, 4).sum(axis=1)
+
+
+def _flip_masks(radius, bits=CHUNK_BITS):
+    """所有置位数不超过 radius 的 bits 位掩码（与段值异或即得到要探查的桶）"""
+    masks = [0]
+    for distance in range(1, radius + 1):
+        for positions in itertools.combinations(range(bits), distance):
+            masks.append(sum(1 << p for p in positions))
+    return np.array(masks, dtype=np.int64)
+
+
+class MultiIndexHashIndex:
+    """多索引哈希（MIH）：按汉明半径查找近似重复的 64 位感知哈希
+
+    哈希被切成 CHUNK_COUNT 段，每段建一张按段值分桶的表（桶起始下标 + 记录位置，类似 CSR）。
+    由鸽巢原理，汉明距离不超过 r 的两个哈希至少有一段的距离不超过 r // CHUNK_COUNT，因此只需在
+    每张表里取出这么小半径内的桶，再对候选项用 NumPy 做完整距离校验。新加入的记录先放在未分桶的
+    尾部直接扫描，尾部超过 REINDEX_THRESHOLD 条（或已分桶记录数的 1/64）时重建分桶表，同时压缩掉已删除的记录。
+    """
+
+    REINDEX_THRESHOLD = 4096
+
+    def __init__(self):
+        self._phashes = np.zeros(1024, dtype=np.uint64)
+        self._dhashes = np.zeros(1024, dtype=np.uint64)
+        self._alive = np.zeros(1024, dtype=bool)
+        self._keys = []
+        self._payloads = []
+        self._positions = {}
+        # 每段一张表：(各段值对应的桶在 order 中的起始下标, 按段值排序的记录位置)，覆盖前 self._indexed 条记录
+        self._tables = []
+        self._indexed = 0
+        self._flip_mask_cache = {}
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return len(self._positions)
+
+    def add(self, key, phash, dhash, payload):
+        """添加或替换一条记录"""
+        with self._lock:
+            self.remove(key)
+            position = len(self._keys)
+            if position == len(self._phashes):
+                self._grow()
+            self._phashes[position] = phash
+            self._dhashes[position] = dhash
+            self._alive[position] = True
+            self._keys.append(key)
+            self._payloads.append(payload)
+            self._positions[key] = position
+            if position + 1 - self._indexed > max(self.REINDEX_THRESHOLD, self._indexed // 64):
+                self._reindex()
+            INDEX_SIZE.set(len(self._positions))
+
+    def remove(self, key):
+        with self._lock:
+            position = self._positions.pop(key, None)
+            if position is None:
+                return
+            self._alive[position] = False
+            self._payloads[position] = None
+            INDEX_SIZE.set(len(self._positions))
+
+    def search(self, phash, radius):
+        """查找 pHash 距离不超过 radius 的所有记录
+
+        Returns:
+            list: [(距离, key, dHash, payload)]，按距离升序
+        """
+        query = np.uint64(phash)
+        with self._lock:
+            candidates = [np.arange(self._indexed, len(self._keys))]
+            flip_masks = self._flip_masks(radius // CHUNK_COUNT)
+            for i, (bucket_starts, order) in enumerate(self._tables):
+                probes = ((phash >> (i * CHUNK_BITS)) & CHUNK_MASK) ^ flip_masks
+                lo, hi = bucket_starts[probes], bucket_starts[probes + 1]
+                counts = hi - lo
+                total = int(counts.sum())
+                if total:
+                    # 把所有 [lo, hi) 区间展开成下标
+                    offsets = np.repeat(lo - (np.cumsum(counts) - counts), counts)
+                    candidates.append(order[offsets + np.arange(total)])
+
+            positions = np.concatenate(candidates)
+            positions = positions[self._alive[positions]]
+            distances = _popcount64(self._phashes[positions] ^ query)
+            matched = distances <= radius
+            # 同一条记录可能从多张表命中，只在（很少的）匹配项上去重
+            results = {int(p): int(d) for p, d in zip(positions[matched], distances[matched])}
+            results = [(d, self._keys[p], int(self._dhashes[p]), self._payloads[p]) for p, d in results.items()]
+        results.sort(key=lambda r: r[0])
+        return results
+
+    def _grow(self):
+        capacity = len(self._phashes) * 2
+        self._phashes = np.resize(self._phashes, capacity)
+        self._dhashes = np.resize(self._dhashes, capacity)
+        alive = np.zeros(capacity, dtype=bool)
+        alive[:len(self._alive)] = self._alive
+        self._alive = alive
+
+    def _reindex(self):
+        """压缩掉已删除的记录并重建每段的分桶表"""
+        alive = np.flatnonzero(self._alive[:len(self._keys)])
+        count = len(alive)
+        self._phashes[:count] = self._phashes[alive]
+        self._dhashes[:count] = self._dhashes[alive]
+        self._alive[:] = False
+        self._alive[:count] = True
+        self._keys = [self._keys[p] for p in alive]
+        self._payloads = [self._payloads[p] for p in alive]
+        self._positions = {key: position for position, key in enumerate(self._keys)}
+        positions = np.arange(count)
+        hashes = self._phashes[:count]
+        self._tables = []
+        for i in range(CHUNK_COUNT):
+            chunks = ((hashes >> np.uint64(i * CHUNK_BITS)) & np.uint64(CHUNK_MASK)).astype(np.uint16)
+            # 16 位整数的稳定排序是基数排序，百万条记录约几十毫秒
+            order = np.argsort(chunks, kind='stable')
+            bucket_starts = np.searchsorted(chunks[order], np.arange(CHUNK_MASK + 2))
+            self._tables.append((bucket_starts, positions[order]))
+        self._indexed = len(self._keys)
+
+    def _flip_masks(self, radius):
+        if radius not in self._flip_mask_cache:
+            self._flip_mask_cache[radius] = _flip_masks(radius)
+        return self._flip_mask_cache[radius]
+
+
+class NearDuplicateCache:
+    """基于感知哈希的近重复图片结果缓存（重新拍照、轻微裁剪、JPEG/PNG 转存的同一幅画）
+
+    条目数超过 max_entries 时淘汰最早写入的条目，写入超过 ttl 秒的条目在查找前淘汰；
+    共享状态中的条目按同样的规则删除，新启动的进程只会同步到未淘汰的条目。
+    """
+
+    def __init__(self, max_distance=10, min_confidence=0.9, max_entries=20000, ttl=0):
+        """
+        Args:
+            max_distance: pHash 的最大汉明距离（搜索半径）
+            min_confidence: 复用缓存所需的最低置信度，置信度 = 1 - (pHash距离 + dHash距离) / 128
+            max_entries: 最多保留的条目数
+            ttl: 条目保留时间（秒），不大于0时不按时间淘汰
+        """
+        self.max_distance = max_distance
+        self.min_confidence = min_confidence
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._index = MultiIndexHashIndex()
+        # key -> 写入时间，按写入顺序排列
+        self._stored_at = OrderedDict()
+        self._lock = threading.Lock()
+        self._store = None
+        self._namespace = None
+        self._synced_seq = 0
+        self._synced_at = None
+        self._sync_lock = threading.Lock()
+
+    def attach_store(self, store, namespace='analysis'):
+        """多进程部署时通过共享状态（SharedState）同步缓存：store() 同时写入共享状态，
+        lookup() 之前增量读取其他进程新写入的条目（每 SYNC_INTERVAL 秒最多一次）"""
+        self._store = store
+        self._namespace = namespace
+        self._synced_seq = 0
+        self._synced_at = None
+        self._trim_store()
+        self._sync()
+
+    def _sync(self):
+        """距上次同步超过 SYNC_INTERVAL 秒、且共享状态中有新的 seq 时增量读取新条目"""
+        if self._store is None:
+            return
+        now = time.monotonic()
+        if self._synced_at is not None and now - self._synced_at < SYNC_INTERVAL:
+            return
+        with self._sync_lock:
+            if self._synced_at is not None and now - self._synced_at < SYNC_INTERVAL:
+                return
+            self._synced_at = now
+            try:
+                if self._store.cache_last_seq(self._namespace) <= self._synced_seq:
+                    return
+                for seq, key, entry in self._store.cache_changes(self._namespace, self._synced_seq):
+                    self._add(key, (entry['phash'], entry['dhash']), entry['payload'], entry.get('stored_at'))
+                    self._synced_seq = seq
+            except Exception as e:
+                logger.warning(f"同步共享的近重复缓存失败: {str(e)}")
+
+    def _add(self, key, hashes, payload, stored_at=None):
+        with self._lock:
+            self._index.add(key, hashes[0], hashes[1], payload)
+            self._stored_at.pop(key, None)
+            self._stored_at[key] = stored_at or time.time()
+            self._evict()
+
+    def _evict(self):
+        """淘汰超出条目数上限和过期的条目（调用方持有 self._lock）"""
+        expire_before = time.time() - self.ttl if self.ttl > 0 else None
+        while self._stored_at:
+            key, stored_at = next(iter(self._stored_at.items()))
+            if len(self._stored_at) <= self.max_entries and (expire_before is None or stored_at >= expire_before):
+                break
+            del self._stored_at[key]
+            self._index.remove(key)
+            EVICTIONS.inc()
+
+    def _trim_store(self):
+        """删除共享状态中超出条目数上限和过期的条目"""
+        try:
+            self._store.cache_trim(self._namespace, max_entries=self.max_entries,
+                                   older_than=time.time() - self.ttl if self.ttl > 0 else None)
+        except Exception as e:
+            logger.warning(f"清理共享的近重复缓存失败: {str(e)}")
+
+    def __len__(self):
+        return len(self._index)
+
+    def lookup(self, hashes):
+        """查找最相似且置信度达到阈值的缓存结果
+
+        Args:
+            hashes: hash_file 返回的 (pHash, dHash)
+
+        Returns:
+            Tuple[Dict, float, str]: (缓存的结果, 置信度, 缓存键)，没有匹配时返回None
+        """
+        phash, dhash = hashes
+        self._sync()
+        if self.ttl > 0:
+            with self._lock:
+                self._evict()
+        start = time.perf_counter()
+        best = None
+        for distance, key, candidate_dhash, payload in self._index.search(phash, self.max_distance):
+            confidence = 1 - (distance + hamming(dhash, candidate_dhash)) / (2 * HASH_BITS)
+            if confidence >= self.min_confidence and (best is None or confidence > best[1]):
+                best = (payload, confidence, key)
+        LOOKUP_SECONDS.observe(time.perf_counter() - start)
+        LOOKUPS.inc(outcome='hit' if best else 'miss')
+        return best
+
+    def store(self, key, hashes, payload):
+        """保存一条结果"""
+        stored_at = time.time()
+        self._add(key, hashes, payload, stored_at)
+        if self._store is not None:
+            try:
+                self._store.cache_set(self._namespace, key, {'phash': int(hashes[0]), 'dhash': int(hashes[1]),
+                                                             'payload': payload, 'stored_at': stored_at})
+            except Exception as e:
+                logger.warning(f"写入共享的近重复缓存失败: {str(e)}")
+                return
+            self._trim_store()
@@ -0,0 +1,299 @@
+import base64
+import io
+import json
+import logging
+import struct
+import threading
+import time
+
+import websocket
+from PIL import Image
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+# ComfyUI websocket 二进制消息类型
+BINARY_EVENT_PREVIEW_IMAGE = 1
+
+# 预览帧的最长边（像素）
+PREVIEW_MAX_SIZE = 256
+
+# 计算ETA时参考的最近步数
+STEP_WINDOW = 5
+
+
+class ProgressTracker:
+    """监听 ComfyUI websocket 事件，记录每个 prompt 的步骤进度、ETA 和预览帧"""
+
+    def __init__(self, comfyui_url, client_id, telemetry=None):
+        """
+        Args:
+            comfyui_url: ComfyUI 服务地址
+            client_id: 提交工作流时使用的 clientId
+            telemetry: ComfyUITelemetry，为空时不统计各节点的执行耗时
+        """
+        self.telemetry = telemetry
+        self.ws_url = comfyui_url.replace('http://', 'ws://').replace('https://', 'wss://') + f"/ws?clientId={client_id}"
+        self._condition = threading.Condition()
+        self._prompts = {}
+        self._current_prompt_id = None
+        # 各采样器类型历史上的平均每步耗时（秒），用于任务刚开始时估算ETA
+        self._historic_step_seconds = {}
+        self._thread = None
+
+    def start(self):
+        """启动后台监听线程（重复调用无副作用）"""
+        with self._condition:
+            if self._thread and self._thread.is_alive():
+                return
+            self._thread = threading.Thread(target=self._run, name='comfyui-progress', daemon=True)
+            self._thread.start()
+            logger.info(f"已启动 ComfyUI 进度监听: {self.ws_url}")
+
+    def register(self, prompt_id, workflow, sampler_class, workflow_name=None):
+        """登记需要跟踪的 prompt
+
+        Args:
+            prompt_id: ComfyUI 返回的 prompt_id
+            workflow: 提交的工作流，用于找出采样器节点和各节点的类型
+            sampler_class: 用于计算步骤进度和ETA的采样器节点类型，如 WanVideoSampler
+            workflow_name: 工作流模板名称，统计节点耗时时按模板汇总
+        """
+        sampler_nodes = {node_id for node_id, node in workflow.items() if node.get('class_type') == sampler_class}
+        with self._condition:
+            self._prompts[prompt_id] = {
+                'prompt_id': prompt_id,
+                'state': 'queued',
+                'sampler_class': sampler_class,
+                'sampler_nodes': sampler_nodes,
+                'workflow_name': workflow_name,
+                'class_types': {node_id: node.get('class_type') for node_id, node in workflow.items()},
+                'timed_node': None,
+                'node_times': [],
+                'samplers_started': [],
+                'cached_nodes': 0,
+                'node': None,
+                'step': 0,
+                'max_steps': 0,
+                'step_times': [],
+                'eta_seconds': None,
+                'preview': None,
+                'preview_version': 0,
+                'version': 0,
+                'queued_at': time.time(),
+                'started_at': None,
+                'updated_at': time.time()
+            }
+            self._condition.notify_all()
+
+    def unregister(self, prompt_id):
+        """移除已结束的 prompt"""
+        with self._condition:
+            self._prompts.pop(prompt_id, None)
+            self._condition.notify_all()
+
+    def get_progress(self, prompt_id, include_preview=True):
+        """获取 prompt 的进度快照
+
+        Returns:
+            Dict: 进度信息（step/max_steps/progress/eta_seconds/preview），未登记时返回None
+        """
+        with self._condition:
+            return self._snapshot(prompt_id, include_preview)
+
+    def wait_for_update(self, prompt_id, last_version, timeout=15):
+        """阻塞等待 prompt 进度变化
+
+        Args:
+            prompt_id: 要等待的 prompt_id
+            last_version: 调用方已经看到的版本号
+            timeout: 最长等待时间（秒）
+
+        Returns:
+            Dict: 最新的进度快照，超时或未登记时返回当前快照或None
+        """
+        with self._condition:
+            self._condition.wait_for(
+                lambda: prompt_id not in self._prompts or self._prompts[prompt_id]['version'] != last_version,
+                timeout=timeout
+            )
+            return self._snapshot(prompt_id, True)
+
+    def _snapshot(self, prompt_id, include_preview):
+        info = self._prompts.get(prompt_id)
+        if not info:
+            return None
+        snapshot = {
+            'state': info['state'],
+            'node': info['node'],
+            'step': info['step'],
+            'max_steps': info['max_steps'],
+            'progress': round(info['step'] / info['max_steps'], 4) if info['max_steps'] else 0.0,
+            'eta_seconds': info['eta_seconds'],
+            'cached_nodes': info['cached_nodes'],
+            'preview_version': info['preview_version'],
+            'version': info['version'],
+            'queued_at': info['queued_at'],
+            'started_at': info['started_at']
+        }
+        if include_preview and info['preview']:
+            snapshot['preview'] = 'data:image/jpeg;base64,' + base64.b64encode(info['preview']).decode()
+        return snapshot
+
+    def _run(self):
+        """websocket 监听主循环，断线后自动重连"""
+        retry_delay = 1
+        while True:
+            ws = websocket.WebSocket()
+            try:
+                ws.connect(self.ws_url, timeout=10)
+                ws.settimeout(None)
+                logger.info("已连接 ComfyUI websocket")
+                retry_delay = 1
+                while True:
+                    message = ws.recv()
+                    if isinstance(message, bytes):
+                        self._handle_binary(message)
+                    elif message:
+                        self._handle_message(json.loads(message))
+            except Exception as e:
+                logger.debug(f"ComfyUI websocket 连接中断: {str(e)}")
+            finally:
+                try:
+                    ws.close()
+                except Exception:
+                    pass
+            time.sleep(retry_delay)
+            retry_delay = min(retry_delay * 2, 30)
+
+    def _handle_message(self, message):
+        """处理 ComfyUI 的 JSON 事件"""
+        event_type = message.get('type')
+        data = message.get('data', {})
+        prompt_id = data.get('prompt_id')
+
+        with self._condition:
+            if event_type == 'execution_start':
+                self._current_prompt_id = prompt_id
+                self._update(prompt_id, state='running', started_at=time.time())
+            elif event_type == 'executing':
+                if data.get('node') is None:
+                    # node 为空表示该 prompt 执行结束
+                    self._finish_node(prompt_id, report=True)
+                    self._update(prompt_id, state='finished', node=None, eta_seconds=0)
+                    if self._current_prompt_id == prompt_id:
+                        self._current_prompt_id = None
+                else:
+                    self._current_prompt_id = prompt_id or self._current_prompt_id
+                    self._finish_node(self._current_prompt_id)
+                    self._update(self._current_prompt_id, state='running', node=data.get('node'),
+                                 timed_node=(data.get('node'), time.time()))
+            elif event_type == 'execution_cached':
+                # ComfyUI 复用了这些节点上一次的输出，不会重新执行
+                info = self._prompts.get(prompt_id)
+                if info:
+                    self._update(prompt_id, cached_nodes=info['cached_nodes'] + len(data.get('nodes', [])))
+            elif event_type == 'progress':
+                self._handle_progress(prompt_id or self._current_prompt_id, data)
+            elif event_type == 'execution_error':
+                self._update(prompt_id, state='error', timed_node=None)
+            elif event_type == 'execution_interrupted':
+                self._update(prompt_id, state='interrupted', timed_node=None)
+
+    def _finish_node(self, prompt_id, report=False):
+        """当前节点执行结束（下一个节点开始或整个 prompt 结束），上报它的执行耗时（调用方需持有锁）
+
+        ComfyUI 按顺序执行节点，一个节点的耗时为它的 executing 事件到下一个 executing 事件的时间；
+        命中缓存的节点不会收到 executing 事件，不计入。
+
+        Args:
+            prompt_id: 当前执行的 prompt_id
+            report: prompt 是否已经执行结束，结束时上报各节点耗时的明细
+        """
+        info = self._prompts.get(prompt_id)
+        if not info or not self.telemetry:
+            return
+        if info['timed_node']:
+            node_id, started_at = info['timed_node']
+            seconds = time.time() - started_at
+            class_type = info['class_types'].get(node_id)
+            info['node_times'].append((node_id, class_type, seconds))
+            info['timed_node'] = None
+            self.telemetry.record_node(info['workflow_name'], class_type, seconds)
+        if report and info['node_times']:
+            self.telemetry.record_prompt(prompt_id, info['workflow_name'], info['node_times'], info['cached_nodes'])
+
+    def _handle_progress(self, prompt_id, data):
+        """处理步骤进度事件并更新ETA"""
+        info = self._prompts.get(prompt_id)
+        if not info:
+            return
+        node_id = data.get('node') or info['node']
+        if info['sampler_nodes'] and node_id not in info['sampler_nodes']:
+            # 只用采样器节点的步骤计算整体进度，其他节点只更新当前节点
+            self._update(prompt_id, node=node_id)
+            return
+
+        now = time.time()
+        step, max_steps = data.get('value', 0), data.get('max', 0)
+        step_times = info['step_times']
+        if step <= 1:
+            step_times.clear()
+        step_times.append(now)
+        del step_times[:-(STEP_WINDOW + 1)]
+
+        sampler_class = info['sampler_class']
+        if len(step_times) >= 2:
+            seconds_per_step = (step_times[-1] - step_times[0]) / (len(step_times) - 1)
+            historic = self._historic_step_seconds.get(sampler_class)
+            self._historic_step_seconds[sampler_class] = seconds_per_step if historic is None else 0.8 * historic + 0.2 * seconds_per_step
+        else:
+            seconds_per_step = self._historic_step_seconds.get(sampler_class)
+
+        # 多个采样器（一个工作流生成多个动作）依次执行，按已开始的采样器数累计整体步数
+        samplers_started = info['samplers_started']
+        if info['sampler_nodes'] and node_id not in samplers_started:
+            samplers_started.append(node_id)
+        finished_samplers = max(len(samplers_started) - 1, 0)
+        step += finished_samplers * max_steps
+        max_steps *= max(len(info['sampler_nodes']), 1)
+
+        eta_seconds = round(seconds_per_step * (max_steps - step), 1) if seconds_per_step is not None else None
+        self._update(prompt_id, state='running', node=node_id, step=step, max_steps=max_steps, eta_seconds=eta_seconds)
+
+    def _handle_binary(self, message):
+        """处理预览帧：缩小后保存到当前执行的 prompt"""
+        if len(message) < 8:
+            return
+        event_type, _image_format = struct.unpack('>II', message[:8])
+        if event_type != BINARY_EVENT_PREVIEW_IMAGE:
+            return
+
+        with self._condition:
+            prompt_id = self._current_prompt_id
+            if prompt_id not in self._prompts:
+                return
+        try:
+            with Image.open(io.BytesIO(message[8:])) as img:
+                img = img.convert('RGB')
+                img.thumbnail((PREVIEW_MAX_SIZE, PREVIEW_MAX_SIZE))
+                buffer = io.BytesIO()
+                img.save(buffer, 'JPEG', quality=70)
+        except Exception as e:
+            logger.debug(f"解析预览帧失败: {str(e)}")
+            return
+
+        with self._condition:
+            info = self._prompts.get(prompt_id)
+            if info:
+                self._update(prompt_id, preview=buffer.getvalue(), preview_version=info['preview_version'] + 1)
+
+    def _update(self, prompt_id, **fields):
+        """更新 prompt 状态并唤醒等待者（调用方需持有锁）"""
+        info = self._prompts.get(prompt_id)
+        if not info:
+            return
+        info.update(fields)
+        info['version'] += 1
+        info['updated_at'] = time.time()
+        self._condition.notify_all()
@@ -0,0 +1,278 @@
+import functools
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    kind TEXT NOT NULL,
+    status TEXT NOT NULL,
+    data TEXT NOT NULL,
+    owner_pid INTEGER,
+    owner_started_at INTEGER,
+    cancel_reason TEXT,
+    created_at REAL NOT NULL,
+    finished_at REAL,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS jobs_finished_at ON jobs (finished_at);
+CREATE TABLE IF NOT EXISTS cache (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    namespace TEXT NOT NULL,
+    key TEXT NOT NULL,
+    value TEXT NOT NULL,
+    updated_at REAL NOT NULL,
+    UNIQUE (namespace, key)
+);
+CREATE INDEX IF NOT EXISTS cache_namespace_seq ON cache (namespace, seq);
+CREATE TABLE IF NOT EXISTS leases (
+    name TEXT PRIMARY KEY,
+    owner_pid INTEGER NOT NULL,
+    expires_at REAL NOT NULL
+);
+"""
+
+
+def process_alive(pid, started_at=None):
+    """同一台机器上的进程是否仍在运行
+
+    Args:
+        pid: 进程号
+        started_at: 记录下来的进程启动时间（process_start_time 的返回值）；给出时启动时间不一致的进程
+            视为已退出——容器重启后进程号会被重新使用，只比较进程号会把新进程误认为原来的进程
+    """
+    if not pid:
+        return False
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    if started_at is not None:
+        current = process_start_time(pid)
+        return current is None or current == started_at
+    return True
+
+
+def process_start_time(pid):
+    """进程的启动时间（Linux 下为 /proc/<pid>/stat 中开机以来的时钟周期数），无法读取时返回None"""
+    try:
+        with open(f'/proc/{pid}/stat') as f:
+            stat = f.read()
+    except OSError:
+        return None
+    # 进程名可能包含空格和括号，从最后一个右括号之后开始分割，starttime 是第 22 个字段
+    try:
+        return int(stat.rsplit(')', 1)[1].split()[19])
+    except (IndexError, ValueError):
+        return None
+
+
+@functools.lru_cache(maxsize=None)
+def _own_start_time(pid):
+    return process_start_time(pid)
+
+
+def current_process_start_time():
+    """当前进程的启动时间，每个进程只读取一次"""
+    return _own_start_time(os.getpid())
+
+
+class SharedState:
+    """多个工作进程共享的任务状态和缓存，保存在一个 WAL 模式的 SQLite 文件中
+
+    每个线程使用自己的连接；WAL 模式下读不阻塞写，写入之间由 SQLite 的文件锁串行化，
+    不需要额外的服务。任务表保存任务状态、任务日志（参数、prompt_id、后端）、所属进程和取消请求，缓存表按命名空间保存 JSON 值，
+    seq 单调递增，其他进程可以据此增量同步新写入的条目；租约表保证某项后台工作（如 ComfyUI 状态采样）同一时间只由一个进程执行。
+    """
+
+    def __init__(self, path):
+        """
+        Args:
+            path: SQLite 文件路径，所在目录不存在时自动创建
+        """
+        self.path = path
+        self._local = threading.local()
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        with self._connection() as conn:
+            conn.executescript(SCHEMA)
+            # 旧版本创建的文件没有 owner_started_at 列
+            columns = {row[1] for row in conn.execute('PRAGMA table_info(jobs)')}
+            if 'owner_started_at' not in columns:
+                conn.execute('ALTER TABLE jobs ADD COLUMN owner_started_at INTEGER')
+        logger.info(f"共享状态: {os.path.abspath(path)}")
+
+    def _connection(self):
+        # fork 之后子进程不能沿用父进程的连接
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None, check_same_thread=False)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn, self._local.pid = conn, os.getpid()
+        return conn
+
+    # ---- 任务 ----
+
+    def save_job(self, job_dict):
+        """写入（或更新）任务状态，取消请求字段不会被覆盖"""
+        now = time.time()
+        self._connection().execute(
+            """INSERT INTO jobs (id, kind, status, data, owner_pid, owner_started_at, created_at, finished_at,
+                                 updated_at)
+               VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+               ON CONFLICT (id) DO UPDATE SET status = excluded.status, data = excluded.data,
+                   finished_at = excluded.finished_at, updated_at = excluded.updated_at""",
+            (job_dict['job_id'], job_dict['kind'], job_dict['status'], json.dumps(job_dict), os.getpid(),
+             current_process_start_time(), job_dict['created_at'], job_dict['finished_at'], now)
+        )
+
+    def load_job(self, job_id):
+        """读取任务状态
+
+        Returns:
+            Dict: Job.to_dict() 的内容加上 owner_pid、owner_started_at 和 cancel_requested；不存在时返回None
+        """
+        row = self._connection().execute(
+            'SELECT data, owner_pid, owner_started_at, cancel_reason FROM jobs WHERE id = ?', (job_id,)
+        ).fetchone()
+        if not row:
+            return None
+        data = json.loads(row[0])
+        data['owner_pid'] = row[1]
+        data['owner_started_at'] = row[2]
+        data['cancel_requested'] = row[3]
+        return data
+
+    def unfinished_jobs(self):
+        """所有未结束的任务（格式同 load_job），按创建时间排序"""
+        rows = self._connection().execute(
+            'SELECT data, owner_pid, owner_started_at, cancel_reason FROM jobs WHERE finished_at IS NULL '
+            'ORDER BY created_at'
+        ).fetchall()
+        jobs = []
+        for data, owner_pid, owner_started_at, cancel_reason in rows:
+            data = json.loads(data)
+            data['owner_pid'] = owner_pid
+            data['owner_started_at'] = owner_started_at
+            data['cancel_requested'] = cancel_reason
+            jobs.append(data)
+        return jobs
+
+    def claim_job(self, job_id, previous_owner):
+        """由当前进程接管任务；其他进程已经先接管时返回False"""
+        cursor = self._connection().execute(
+            """UPDATE jobs SET owner_pid = ?, owner_started_at = ?
+               WHERE id = ? AND owner_pid IS ? AND finished_at IS NULL""",
+            (os.getpid(), current_process_start_time(), job_id, previous_owner)
+        )
+        return cursor.rowcount > 0
+
+    def request_cancel(self, job_id, reason):
+        """记录取消请求，由执行该任务的进程读取后取消；任务不存在或已结束时返回False"""
+        cursor = self._connection().execute(
+            'UPDATE jobs SET cancel_reason = ? WHERE id = ? AND finished_at IS NULL AND cancel_reason IS NULL',
+            (reason, job_id)
+        )
+        return cursor.rowcount > 0
+
+    def cancel_requests(self, job_ids):
+        """返回 {job_id: 取消原因}，只包含已被请求取消的任务"""
+        if not job_ids:
+            return {}
+        placeholders = ','.join('?' * len(job_ids))
+        rows = self._connection().execute(
+            f'SELECT id, cancel_reason FROM jobs WHERE id IN ({placeholders}) AND cancel_reason IS NOT NULL',
+            list(job_ids)
+        ).fetchall()
+        return dict(rows)
+
+    def delete_finished_jobs(self, older_than):
+        """删除 older_than（时间戳）之前结束的任务"""
+        self._connection().execute('DELETE FROM jobs WHERE finished_at < ?', (older_than,))
+
+    # ---- 缓存 ----
+
+    def cache_set(self, namespace, key, value):
+        """写入一条缓存（值需可 JSON 序列化），覆盖时条目获得新的 seq"""
+        self._connection().execute(
+            'INSERT OR REPLACE INTO cache (namespace, key, value, updated_at) VALUES (?, ?, ?, ?)',
+            (namespace, key, json.dumps(value), time.time())
+        )
+
+    def cache_get(self, namespace, key):
+        """读取一条缓存，不存在时返回None"""
+        row = self._connection().execute(
+            'SELECT value FROM cache WHERE namespace = ? AND key = ?', (namespace, key)
+        ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def cache_delete(self, namespace, key):
+        self._connection().execute('DELETE FROM cache WHERE namespace = ? AND key = ?', (namespace, key))
+
+    def cache_trim(self, namespace, max_entries=None, older_than=None):
+        """删除命名空间下超出条目数上限（保留 seq 最大的 max_entries 条）和 older_than（时间戳）之前写入的条目"""
+        conn = self._connection()
+        if older_than is not None:
+            conn.execute('DELETE FROM cache WHERE namespace = ? AND updated_at < ?', (namespace, older_than))
+        if max_entries is not None:
+            conn.execute(
+                """DELETE FROM cache WHERE namespace = ? AND seq <= (
+                       SELECT seq FROM cache WHERE namespace = ? ORDER BY seq DESC LIMIT 1 OFFSET ?)""",
+                (namespace, namespace, max_entries)
+            )
+
+    def cache_clear(self, namespace):
+        """删除命名空间下的所有条目"""
+        self._connection().execute('DELETE FROM cache WHERE namespace = ?', (namespace,))
+
+    def cache_items(self, namespace):
+        """命名空间下的所有条目 {key: value}"""
+        rows = self._connection().execute('SELECT key, value FROM cache WHERE namespace = ?', (namespace,)).fetchall()
+        return {key: json.loads(value) for key, value in rows}
+
+    def cache_last_seq(self, namespace):
+        """命名空间下最新写入的条目的 seq，没有条目时返回0"""
+        row = self._connection().execute('SELECT MAX(seq) FROM cache WHERE namespace = ?', (namespace,)).fetchone()
+        return row[0] or 0
+
+    def cache_changes(self, namespace, after_seq):
+        """增量读取 seq 大于 after_seq 的条目
+
+        Returns:
+            List[Tuple[int, str, object]]: [(seq, key, value)]，按 seq 升序
+        """
+        rows = self._connection().execute(
+            'SELECT seq, key, value FROM cache WHERE namespace = ? AND seq > ? ORDER BY seq', (namespace, after_seq)
+        ).fetchall()
+        return [(seq, key, json.loads(value)) for seq, key, value in rows]
+
+    # ---- 租约 ----
+
+    def acquire_lease(self, name, ttl):
+        """获取或续期租约，持有者需要在 ttl 秒内再次调用续期
+
+        Returns:
+            bool: 当前进程持有租约时返回True；其他进程持有且未过期（或持有者仍在运行）时返回False
+        """
+        conn = self._connection()
+        now = time.time()
+        row = conn.execute('SELECT owner_pid FROM leases WHERE name = ?', (name,)).fetchone()
+        # 持有者已经退出时不必等到租约过期
+        expired_before = now if row is None or process_alive(row[0]) else float('inf')
+        cursor = conn.execute(
+            """INSERT INTO leases (name, owner_pid, expires_at) VALUES (?, ?, ?)
+               ON CONFLICT (name) DO UPDATE SET owner_pid = excluded.owner_pid, expires_at = excluded.expires_at
+               WHERE leases.owner_pid = excluded.owner_pid OR leases.expires_at < ?""",
+            (name, os.getpid(), now + ttl, expired_before)
+        )
+        return cursor.rowcount > 0
@@ -0,0 +1,417 @@
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from config.config import Config
+from services import metrics
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+# 各上游的默认限流参数，可通过环境变量覆盖，例如 BAIDU_RATE_LIMIT、LLM_STUDIO_MAX_CONCURRENCY
+PROVIDER_DEFAULTS = {
+    'baidu': {
+        'rate_limit': 5.0,          # 令牌桶：每秒请求数
+        'burst': 10,                # 令牌桶容量
+        'initial_concurrency': 4,   # 自适应并发的初始上限
+        'max_concurrency': 16,
+        'queue_timeout': 30.0,      # 排队等待的最长时间（秒）
+        'request_timeout': 60.0,    # 单次请求超时（秒）
+        'failure_threshold': 5,     # 熔断：连续失败（超时、无法连接、5xx）多少次后断开
+        'open_seconds': 30.0        # 熔断：断开后多久放行一个探测请求（秒）
+    },
+    'llm_studio': {
+        'rate_limit': 20.0,
+        'burst': 20,
+        'initial_concurrency': 2,
+        'max_concurrency': 8,
+        'queue_timeout': 60.0,
+        'request_timeout': 120.0,
+        'failure_threshold': 3,
+        'open_seconds': 30.0
+    }
+}
+
+# 延迟超过基线的倍数时视为过载
+LATENCY_TOLERANCE = 2.0
+# 乘性减小的系数，以及两次减小之间的最短间隔（秒）
+DECREASE_FACTOR = 0.7
+DECREASE_COOLDOWN = 2.0
+
+QUEUE_DEPTH = metrics.gauge('upstream_queue_depth', '等待上游并发槽位的请求数', ['provider'])
+INFLIGHT = metrics.gauge('upstream_inflight', '正在执行的上游请求数', ['provider'])
+CONCURRENCY_LIMIT = metrics.gauge('upstream_concurrency_limit', '上游当前的自适应并发上限', ['provider'])
+LIMIT_CHANGES = metrics.counter('upstream_limit_changes_total', '自适应并发上限的调整次数', ['provider', 'direction'])
+REQUESTS = metrics.counter('upstream_requests_total', '上游请求结果', ['provider', 'outcome'])
+REQUEST_SECONDS = metrics.histogram('upstream_request_seconds', '上游请求耗时（秒）', ['provider'])
+QUEUE_WAIT_SECONDS = metrics.histogram('upstream_queue_wait_seconds', '上游请求排队耗时（秒）', ['provider'])
+CIRCUIT_STATE = metrics.gauge('upstream_circuit_state', '上游熔断器状态（0: 闭合，1: 半开探测中，2: 断开）', ['provider'])
+CIRCUIT_TRANSITIONS = metrics.counter('upstream_circuit_transitions_total', '上游熔断器的状态切换次数', ['provider', 'state'])
+
+# 熔断器状态及其在 upstream_circuit_state 中的取值
+CIRCUIT_CLOSED = 'closed'
+CIRCUIT_HALF_OPEN = 'half_open'
+CIRCUIT_OPEN = 'open'
+CIRCUIT_STATE_VALUES = {CIRCUIT_CLOSED: 0, CIRCUIT_HALF_OPEN: 1, CIRCUIT_OPEN: 2}
+
+
+class UpstreamError(Exception):
+    """上游调用失败，error_code 会写入代理返回的错误字典"""
+
+    error_code = 'upstream_error'
+
+
+class UpstreamQueueTimeout(UpstreamError):
+    """在截止时间内没有等到令牌或并发槽位"""
+
+    error_code = 'queue_timeout'
+
+
+class UpstreamThrottled(UpstreamError):
+    """上游返回 429"""
+
+    error_code = 'upstream_throttled'
+
+
+class UpstreamUnavailable(UpstreamError):
+    """上游返回 5xx、超时或无法连接"""
+
+    error_code = 'upstream_unavailable'
+
+
+class UpstreamCircuitOpen(UpstreamError):
+    """上游熔断器断开，请求没有发出"""
+
+    error_code = 'circuit_open'
+
+
+class TokenBucket:
+    """令牌桶限速，支持在截止时间内等待令牌"""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = float(burst)
+        self._updated_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, deadline):
+        """取得一个令牌；截止时间前无法取得时抛出 UpstreamQueueTimeout"""
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated_at) * self.rate)
+            self._updated_at = now
+            wait = 0.0 if self._tokens >= 1 else (1 - self._tokens) / self.rate
+            if now + wait > deadline:
+                raise UpstreamQueueTimeout("等待限流令牌超时")
+            # 先预留令牌，在锁外等待
+            self._tokens -= 1
+        if wait > 0:
+            time.sleep(wait)
+
+
+class AdaptiveConcurrencyLimiter:
+    """AIMD 自适应并发控制：请求正常时并发上限加性增大，出现 429/5xx 或延迟明显升高时乘性减小"""
+
+    def __init__(self, provider, initial_limit, max_limit, min_limit=1):
+        self.provider = provider
+        self.limit = float(initial_limit)
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self._inflight = 0
+        self._waiting = 0
+        self._baseline_latency = None
+        self._last_decrease = 0.0
+        self._condition = threading.Condition()
+        CONCURRENCY_LIMIT.set(int(self.limit), provider=provider)
+
+    def acquire(self, deadline):
+        """等待并发槽位；截止时间前无法取得时抛出 UpstreamQueueTimeout"""
+        with self._condition:
+            self._waiting += 1
+            QUEUE_DEPTH.set(self._waiting, provider=self.provider)
+            try:
+                while self._inflight >= int(self.limit):
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise UpstreamQueueTimeout(f"等待 {self.provider} 并发槽位超时")
+                    self._condition.wait(remaining)
+                self._inflight += 1
+                INFLIGHT.set(self._inflight, provider=self.provider)
+            finally:
+                self._waiting -= 1
+                QUEUE_DEPTH.set(self._waiting, provider=self.provider)
+
+    def release(self, latency, overloaded):
+        """释放槽位并根据本次请求的结果调整并发上限
+
+        Args:
+            latency: 请求耗时（秒）
+            overloaded: 是否收到 429/5xx 或超时
+        """
+        with self._condition:
+            self._inflight -= 1
+            INFLIGHT.set(self._inflight, provider=self.provider)
+
+            slow = self._baseline_latency is not None and latency > self._baseline_latency * LATENCY_TOLERANCE
+            if overloaded or slow:
+                now = time.monotonic()
+                if now - self._last_decrease >= DECREASE_COOLDOWN and self.limit > self.min_limit:
+                    self.limit = max(self.min_limit, self.limit * DECREASE_FACTOR)
+                    self._last_decrease = now
+                    LIMIT_CHANGES.inc(provider=self.provider, direction='decrease')
+                    logger.info(f"{self.provider} 并发上限降低到 {self.limit:.2f}（{'过载' if overloaded else '延迟升高'}）")
+            else:
+                previous = int(self.limit)
+                self.limit = min(self.max_limit, self.limit + 1.0 / self.limit)
+                if int(self.limit) > previous:
+                    LIMIT_CHANGES.inc(provider=self.provider, direction='increase')
+
+            if not overloaded:
+                # 慢速更新的延迟基线，过载请求不计入
+                self._baseline_latency = latency if self._baseline_latency is None else 0.95 * self._baseline_latency + 0.05 * latency
+
+            CONCURRENCY_LIMIT.set(int(self.limit), provider=self.provider)
+            self._condition.notify_all()
+
+
+class CircuitBreaker:
+    """熔断器：连续失败达到阈值后断开，断开期间的请求立即失败，不再排队等待超时
+
+    断开 open_seconds 秒后进入半开状态，只放行一个探测请求：成功则闭合，失败则重新断开。
+    探测请求没有返回结果（例如排队超时）时，再过 open_seconds 秒放行下一个。
+    """
+
+    def __init__(self, provider, failure_threshold, open_seconds):
+        self.provider = provider
+        self.failure_threshold = failure_threshold
+        self.open_seconds = open_seconds
+        self.state = CIRCUIT_CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._lock = threading.Lock()
+        CIRCUIT_STATE.set(0, provider=provider)
+
+    def allow(self):
+        """是否放行一个请求；断开期间到时后放行的请求即为探测请求"""
+        with self._lock:
+            if self.state == CIRCUIT_CLOSED:
+                return True
+            now = time.monotonic()
+            if now - self._opened_at < self.open_seconds:
+                return False
+            self._opened_at = now
+            self._set_state(CIRCUIT_HALF_OPEN)
+            return True
+
+    def rejecting(self):
+        """当前是否会拒绝请求（只查询，不占用探测机会）"""
+        with self._lock:
+            return self.state != CIRCUIT_CLOSED and time.monotonic() - self._opened_at < self.open_seconds
+
+    def record(self, failed):
+        """记录一次已发出请求的结果
+
+        Args:
+            failed: 是否超时、无法连接或返回 5xx
+        """
+        with self._lock:
+            if not failed:
+                self._failures = 0
+                if self.state != CIRCUIT_CLOSED:
+                    logger.info(f"{self.provider} 熔断器闭合")
+                    self._set_state(CIRCUIT_CLOSED)
+                return
+            self._failures += 1
+            if self.state == CIRCUIT_HALF_OPEN or (self.state == CIRCUIT_CLOSED and
+                                                   self._failures >= self.failure_threshold):
+                self._opened_at = time.monotonic()
+                logger.warning(f"{self.provider} 连续失败 {self._failures} 次，熔断 {self.open_seconds:.0f} 秒")
+                self._set_state(CIRCUIT_OPEN)
+
+    def _set_state(self, state):
+        self.state = state
+        CIRCUIT_STATE.set(CIRCUIT_STATE_VALUES[state], provider=self.provider)
+        CIRCUIT_TRANSITIONS.inc(provider=self.provider, state=state)
+
+
+class UpstreamGovernor:
+    """所有对外部模型服务的请求都经过这里：熔断 + 令牌桶限速 + 自适应并发 + 带截止时间的排队"""
+
+    def __init__(self, provider_settings=None):
+        self._settings = {}
+        self._buckets = {}
+        self._limiters = {}
+        self._breakers = {}
+        self._sessions = {}
+        for provider, defaults in (provider_settings or PROVIDER_DEFAULTS).items():
+            settings = Config.upstream_settings(provider, defaults)
+            self._settings[provider] = settings
+            self._buckets[provider] = TokenBucket(settings['rate_limit'], settings['burst'])
+            self._limiters[provider] = AdaptiveConcurrencyLimiter(
+                provider, settings['initial_concurrency'], settings['max_concurrency']
+            )
+            self._breakers[provider] = CircuitBreaker(provider, settings['failure_threshold'], settings['open_seconds'])
+            # 每个上游一个连接池，大小与最大并发一致，复用 TCP/TLS 连接
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=settings['max_concurrency'])
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            self._sessions[provider] = session
+
+    def post(self, provider, url, deadline=None, **kwargs):
+        """经过限流发送 POST 请求
+
+        Args:
+            provider: 上游名称（baidu/llm_studio）
+            url: 请求地址
+            deadline: 排队截止时间（time.monotonic() 时间戳），默认使用该上游的 queue_timeout
+            **kwargs: 传给 requests 的参数，未指定 timeout 时使用该上游的 request_timeout
+
+        Returns:
+            requests.Response: 上游响应（非 429/5xx）
+
+        Raises:
+            UpstreamError: 熔断器断开、排队超时、被限流或上游不可用
+        """
+        return self.request(provider, 'POST', url, deadline=deadline, **kwargs)
+
+    def request(self, provider, method, url, deadline=None, **kwargs):
+        limiter = self._limiters[provider]
+        kwargs.setdefault('timeout', self._settings[provider]['request_timeout'])
+        self._admit(provider, deadline)
+
+        start = time.monotonic()
+        response = None
+        try:
+            response = self._sessions[provider].request(method, url, **kwargs)
+        except (requests.exceptions.Timeout, requests.exceptions.ConnectionError) as e:
+            REQUESTS.inc(provider=provider, outcome='unavailable')
+            raise UpstreamUnavailable(f"{provider} 请求失败: {str(e)}") from e
+        finally:
+            latency = time.monotonic() - start
+            REQUEST_SECONDS.observe(latency, provider=provider)
+            # 没有拿到响应（超时、连接失败）或 429/5xx 都视为过载信号，429 以外的计入熔断
+            overloaded = response is None or response.status_code == 429 or response.status_code >= 500
+            limiter.release(latency, overloaded)
+            self._breakers[provider].record(response is None or response.status_code >= 500)
+
+        self._check_status(provider, response)
+        return response
+
+    @contextmanager
+    def stream(self, provider, url, deadline=None, **kwargs):
+        """经过限流发送流式 POST 请求（如 NDJSON），在 with 块内逐块读取响应
+
+        并发槽位一直占用到 with 块退出（响应读完或调用方提前结束），耗时按整个响应计算，
+        与非流式请求的耗时可比。with 块内抛出的异常（如读取中途断流）记为过载和熔断失败后原样抛出。
+
+        Yields:
+            requests.Response: 以 stream=True 发送的上游响应（非 429/5xx）
+
+        Raises:
+            UpstreamError: 熔断器断开、排队超时、被限流或上游不可用
+        """
+        limiter = self._limiters[provider]
+        kwargs.setdefault('timeout', self._settings[provider]['request_timeout'])
+        self._admit(provider, deadline)
+
+        start = time.monotonic()
+        response = None
+        overloaded = True
+        body_failed = False
+        try:
+            try:
+                response = self._sessions[provider].post(url, stream=True, **kwargs)
+            except (requests.exceptions.Timeout, requests.exceptions.ConnectionError) as e:
+                REQUESTS.inc(provider=provider, outcome='unavailable')
+                raise UpstreamUnavailable(f"{provider} 请求失败: {str(e)}") from e
+            self._check_status(provider, response)
+            overloaded = False
+            try:
+                yield response
+            except Exception:
+                # 读取响应体时断流、读超时等同样是上游故障，计入过载和熔断
+                overloaded = body_failed = True
+                raise
+        finally:
+            if response is not None:
+                response.close()
+            latency = time.monotonic() - start
+            REQUEST_SECONDS.observe(latency, provider=provider)
+            limiter.release(latency, overloaded)
+            self._breakers[provider].record(body_failed or response is None or response.status_code >= 500)
+
+    def available(self, provider):
+        """上游的熔断器是否放行请求；断开时调用方可以直接使用降级方案"""
+        return not self._breakers[provider].rejecting()
+
+    def circuit_state(self, provider):
+        """熔断器状态 closed/half_open/open"""
+        return self._breakers[provider].state
+
+    def _admit(self, provider, deadline):
+        """检查熔断器，然后在截止时间内等待令牌和并发槽位"""
+        if not self._breakers[provider].allow():
+            REQUESTS.inc(provider=provider, outcome='circuit_open')
+            raise UpstreamCircuitOpen(f"{provider} 熔断中，请求未发出")
+        if deadline is None:
+            deadline = time.monotonic() + self._settings[provider]['queue_timeout']
+        queued_at = time.monotonic()
+        try:
+            self._buckets[provider].acquire(deadline)
+            self._limiters[provider].acquire(deadline)
+        except UpstreamQueueTimeout:
+            REQUESTS.inc(provider=provider, outcome='queue_timeout')
+            raise
+        QUEUE_WAIT_SECONDS.observe(time.monotonic() - queued_at, provider=provider)
+
+    def _check_status(self, provider, response):
+        if response.status_code == 429:
+            REQUESTS.inc(provider=provider, outcome='throttled')
+            raise UpstreamThrottled(f"{provider} 限流 (HTTP 429): {response.text[:200]}")
+        if response.status_code >= 500:
+            REQUESTS.inc(provider=provider, outcome='unavailable')
+            raise UpstreamUnavailable(f"{provider} 服务错误 (HTTP {response.status_code}): {response.text[:200]}")
+        REQUESTS.inc(provider=provider, outcome='ok' if response.status_code < 400 else 'client_error')
+
+    def warm(self, provider, url, connections=1, timeout=10):
+        """预先建立到上游的连接并放入连接池（不经过限流，不计入请求指标）
+
+        Args:
+            provider: 上游名称
+            url: 用于建立连接的地址（返回任何状态码都可以）
+            connections: 并发建立的连接数
+
+        Returns:
+            bool: 是否成功连接
+        """
+        session = self._sessions[provider]
+
+        def connect():
+            try:
+                session.get(url, timeout=timeout).close()
+                return True
+            except requests.exceptions.RequestException as e:
+                logger.warning(f"预热 {provider} 连接失败: {str(e)}")
+                return False
+
+        threads = [threading.Thread(target=connect, daemon=True) for _ in range(connections - 1)]
+        for thread in threads:
+            thread.start()
+        connected = connect()
+        for thread in threads:
+            thread.join(timeout)
+        return connected
+
+
+governor = UpstreamGovernor()
+
+
+def error_code_for(exception):
+    """代理返回错误字典时使用的错误码"""
+    return getattr(exception, 'error_code', 'internal_error')
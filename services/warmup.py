@@ -0,0 +1,116 @@
+import logging
+import threading
+import time
+
+from services import metrics
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+STEP_PENDING = 'pending'
+STEP_RUNNING = 'running'
+STEP_OK = 'ok'
+STEP_FAILED = 'failed'
+
+READY = metrics.gauge('app_ready', '预热是否完成（1 表示可以接收流量）')
+WARMUP_STEP_SECONDS = metrics.gauge('warmup_step_seconds', '各预热步骤的耗时（秒），即首个请求原本要承担的冷启动开销', ['step'])
+FIRST_REQUEST_SECONDS = metrics.gauge('first_request_seconds', '启动后各接口第一个请求的耗时（秒）', ['endpoint', 'state'])
+
+
+class WarmupManager:
+    """启动预热：并行执行各预热步骤，全部结束（成功或失败）或超时后进入就绪状态
+
+    单个步骤失败不会阻止就绪，例如百度接口暂时不可用时服务仍然可以处理美化和动画请求；
+    失败的步骤会在 status() 中列出。
+    """
+
+    def __init__(self, timeout=900):
+        """
+        Args:
+            timeout: 预热的最长时间（秒），超时后即使还有步骤未完成也进入就绪状态
+        """
+        self.timeout = timeout
+        self._steps = {}
+        self._lock = threading.Lock()
+        self._ready = threading.Event()
+        self._started_at = None
+        self._ready_at = None
+        self._first_requests = set()
+        READY.set(0)
+
+    def add_step(self, name, func):
+        """登记一个预热步骤，func 无参数，返回 False 或抛出异常表示失败"""
+        self._steps[name] = {'func': func, 'status': STEP_PENDING, 'seconds': None, 'error': None}
+
+    def start(self):
+        """在后台线程中执行所有预热步骤"""
+        if self._started_at is not None:
+            return
+        self._started_at = time.time()
+        threads = [threading.Thread(target=self._run_step, args=(name,), daemon=True) for name in self._steps]
+        for thread in threads:
+            thread.start()
+        threading.Thread(target=self._wait_for_steps, args=(threads,), daemon=True).start()
+        logger.info(f"开始预热: {', '.join(self._steps) or '无'}")
+
+    def skip(self):
+        """不预热，直接进入就绪状态"""
+        self._mark_ready()
+
+    @property
+    def ready(self):
+        return self._ready.is_set()
+
+    def status(self):
+        """就绪状态和各步骤的执行情况"""
+        with self._lock:
+            steps = {name: {k: v for k, v in step.items() if k != 'func'} for name, step in self._steps.items()}
+        return {
+            'ready': self.ready,
+            'started_at': self._started_at,
+            'ready_at': self._ready_at,
+            'steps': steps
+        }
+
+    def record_request(self, endpoint, seconds, started_at):
+        """记录各接口启动后第一个请求的耗时，区分请求开始时预热是否已完成（warm/cold）"""
+        with self._lock:
+            if endpoint in self._first_requests:
+                return
+            self._first_requests.add(endpoint)
+        state = 'warm' if self._ready_at is not None and started_at >= self._ready_at else 'cold'
+        FIRST_REQUEST_SECONDS.set(seconds, endpoint=endpoint, state=state)
+        logger.info(f"{endpoint} 第一个请求耗时 {seconds:.2f} 秒（{state}）")
+
+    def _run_step(self, name):
+        step = self._steps[name]
+        with self._lock:
+            step['status'] = STEP_RUNNING
+        start = time.monotonic()
+        try:
+            ok = step['func']() is not False
+            error = None if ok else '预热步骤返回失败'
+        except Exception as e:
+            ok, error = False, str(e)
+        seconds = time.monotonic() - start
+        with self._lock:
+            step.update(status=STEP_OK if ok else STEP_FAILED, seconds=round(seconds, 3), error=error)
+        WARMUP_STEP_SECONDS.set(seconds, step=name)
+        if ok:
+            logger.info(f"预热步骤 {name} 完成，耗时 {seconds:.1f} 秒")
+        else:
+            logger.warning(f"预热步骤 {name} 失败（{seconds:.1f} 秒）: {error}")
+
+    def _wait_for_steps(self, threads):
+        deadline = time.monotonic() + self.timeout
+        for thread in threads:
+            thread.join(max(0.0, deadline - time.monotonic()))
+        if any(thread.is_alive() for thread in threads):
+            logger.warning(f"预热超过 {self.timeout} 秒仍未完成，先进入就绪状态")
+        self._mark_ready()
+
+    def _mark_ready(self):
+        self._ready_at = time.time()
+        self._ready.set()
+        READY.set(1)
+        logger.info("服务已就绪")
@@ -0,0 +1,119 @@
+"""图片分析结果的 schema 校验、严格/宽松解析和修复请求"""
+import json
+
+import pytest
+
+from agents.analysis_schema import ANALYSIS_SCHEMA, compile_validator, parse_strict, parse_tolerant
+from agents.image_analysis_agent import ImageAnalysisAgent
+
+VALID = {
+    "description": "一只戴帽子的小猫",
+    "scene": "草地",
+    "style": "蜡笔画",
+    "colors": ["蓝色帽子", "橙色猫"],
+    "objects": ["小猫", "帽子"],
+    "subject_features": "圆眼睛"
+}
+
+
+def test_valid_payload_passes():
+    assert compile_validator(ANALYSIS_SCHEMA)(VALID) == []
+    assert parse_strict(json.dumps(VALID, ensure_ascii=False)) == (VALID, [])
+
+
+@pytest.mark.parametrize('change, error', [
+    ({'description': None}, '$.description 缺失'),
+    ({'objects': '小猫'}, '$.objects 应为 array'),
+    ({'colors': ['蓝色', 3]}, '$.colors[] 应为 string'),
+    ({'description': '  '}, '$.description 不能为空'),
+    ({'objects': []}, '$.objects 至少需要 1 项'),
+])
+def test_missing_or_wrong_typed_field_is_reported(change, error):
+    payload = dict(VALID, **change)
+    payload = {k: v for k, v in payload.items() if v is not None}
+    data, errors = parse_strict(json.dumps(payload, ensure_ascii=False))
+    assert data is None
+    assert errors == [error]
+
+
+def test_non_object_stops_after_type_error():
+    assert compile_validator(ANALYSIS_SCHEMA)(["not", "an", "object"]) == ["$ 应为 object"]
+    assert parse_strict("not json")[0] is None
+
+
+def test_fused_schema_requires_sd_prompt():
+    assert parse_strict(json.dumps(VALID), 'fused')[1] == ['$.sd_prompt 缺失']
+
+
+@pytest.mark.parametrize('content', [
+    "```json\n" + json.dumps(VALID, ensure_ascii=False) + "\n```",
+    "好的，分析如下：" + json.dumps(VALID, ensure_ascii=False) + "\n希望对你有帮助。",
+])
+def test_tolerant_accepts_fenced_or_surrounding_prose(content):
+    assert parse_strict(content)[0] is None
+    assert parse_tolerant(content) == (VALID, [])
+
+
+def test_tolerant_splits_string_lists_and_fills_optional_fields():
+    data, errors = parse_tolerant(json.dumps({"description": "小猫", "objects": "小猫、帽子, 太阳"}, ensure_ascii=False))
+    assert errors == []
+    assert data["objects"] == ["小猫", "帽子", "太阳"]
+    assert data["colors"] == [] and data["scene"] == ""
+
+
+@pytest.mark.parametrize('objects_label', ['主体', '物体'])
+def test_labeled_lines_map_subject_and_object_labels(objects_label):
+    content = "\n".join([
+        "1. **描述**：一只小猫",
+        "2. 场景: 草地",
+        "3. 风格：蜡笔画",
+        "4. 颜色：蓝色帽子、橙色猫",
+        f"5. {objects_label}：小猫，帽子",
+        "6. 主体特征：圆眼睛",
+    ])
+    data, errors = parse_tolerant(content)
+    assert errors == []
+    assert data["objects"] == ["小猫", "帽子"]
+    # “主体特征”不会被当成“主体”
+    assert data["subject_features"] == "圆眼睛"
+    assert data["description"] == "一只小猫" and data["scene"] == "草地"
+
+
+class RepairingAgent(ImageAnalysisAgent):
+    """修复请求返回预设回复，记录请求次数"""
+
+    def __init__(self, replies):
+        super().__init__()
+        self.replies = list(replies)
+        self.calls = []
+
+    def _call_model(self, messages, structured, usage=None):
+        self.calls.append(messages)
+        reply = self.replies.pop(0)
+        if isinstance(reply, Exception):
+            raise reply
+        return reply
+
+
+def test_parse_content_prefers_strict_then_tolerant_without_repair():
+    agent = RepairingAgent([])
+    assert agent._parse_content(json.dumps(VALID), structured=True) == (VALID, "strict")
+    assert agent._parse_content("```" + json.dumps(VALID) + "```", structured=True) == (VALID, "tolerant")
+    assert agent.calls == []
+
+
+def test_parse_content_repairs_once():
+    agent = RepairingAgent([json.dumps(VALID)])
+    fields, outcome = agent._parse_content("一只小猫在草地上", structured=True)
+    assert (fields, outcome) == (VALID, "repaired")
+    assert len(agent.calls) == 1
+    # 修复请求只带上一次的回复文本，不再上传图片
+    assert isinstance(agent.calls[0][0]["content"], str)
+    assert "一只小猫在草地上" in agent.calls[0][0]["content"]
+
+
+@pytest.mark.parametrize('reply', ["仍然不是JSON", Exception("timeout")])
+def test_parse_content_fails_after_single_repair(reply):
+    agent = RepairingAgent([reply])
+    assert agent._parse_content("一只小猫在草地上", structured=False) == (None, "failed")
+    assert len(agent.calls) == 1
@@ -0,0 +1,125 @@
+"""接口的参数校验"""
+import io
+import json
+import threading
+import time
+from types import SimpleNamespace
+
+import pytest
+from PIL import Image
+
+import app as app_module
+from services.job_manager import JOB_SUCCEEDED, JobManager
+
+
+def wait_until(condition, timeout=10):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.02)
+    return True
+
+
+@pytest.fixture
+def client(tmp_path, monkeypatch):
+    monkeypatch.setitem(app_module.app.config, 'UPLOAD_FOLDER', str(tmp_path))
+    return app_module.app.test_client()
+
+
+def png_upload():
+    buffer = io.BytesIO()
+    Image.new('RGB', (8, 8), 'white').save(buffer, 'PNG')
+    buffer.seek(0)
+    return buffer, 'photo.png'
+
+
+@pytest.mark.parametrize('value', ['abc', '0', '-5', 'nan', ''])
+def test_animate_rejects_invalid_timeout(client, value):
+    response = client.post('/animate', data={'file': png_upload(), 'timeout': value})
+    assert response.status_code == 400
+    assert '超时时间' in response.get_json()['error']
+
+
+def test_parse_timeout_caps_at_server_deadline():
+    assert app_module.parse_timeout(None) == (app_module.ANIMATION_TIMEOUT, None)
+    assert app_module.parse_timeout('5') == (5.0, None)
+    assert app_module.parse_timeout('inf') == (app_module.ANIMATION_TIMEOUT, None)
+
+
+def finished_preview(tmp_path, monkeypatch):
+    """在独立的 JobManager 中登记一个已完成的预览任务"""
+    manager = JobManager()
+    monkeypatch.setattr(app_module, 'container', SimpleNamespace(job_manager=manager))
+    filepath = tmp_path / 'photo.png'
+    Image.new('RGB', (8, 8), 'white').save(filepath)
+    job = manager.submit('animate', lambda *args, job=None: {'tier': 'preview', 'seed': 7},
+                         str(filepath), 'photo.png', 'smile', 'gif')
+    assert wait_until(lambda: job.status == JOB_SUCCEEDED)
+    return job
+
+
+@pytest.mark.parametrize('value', ['abc', '0', '-1'])
+def test_promote_rejects_invalid_timeout(client, tmp_path, monkeypatch, value):
+    job = finished_preview(tmp_path, monkeypatch)
+    response = client.post(f'/jobs/{job.id}/promote', data={'timeout': value})
+    assert response.status_code == 400
+    assert '超时时间' in response.get_json()['error']
+
+
+def test_promote_unknown_job_returns_404(client, monkeypatch):
+    monkeypatch.setattr(app_module, 'container', SimpleNamespace(job_manager=JobManager()))
+    response = client.post('/jobs/missing/promote')
+    assert response.status_code == 404
+
+
+@pytest.mark.parametrize('kind, result, finishes', [
+    ('animate', {'tier': 'full'}, True),        # 已经是完整动画
+    ('enhance', {'tier': 'preview'}, True),     # 不是动画任务
+    ('animate', {'tier': 'preview'}, False),    # 预览还没有完成
+])
+def test_promote_requires_finished_preview(client, monkeypatch, kind, result, finishes):
+    manager = JobManager()
+    monkeypatch.setattr(app_module, 'container', SimpleNamespace(job_manager=manager))
+    release = threading.Event()
+
+    def render(*args, job=None):
+        if not finishes:
+            release.wait(10)
+        return result
+
+    job = manager.submit(kind, render, 'photo.png', 'photo.png', 'smile', 'gif')
+    try:
+        if finishes:
+            assert wait_until(lambda: job.status == JOB_SUCCEEDED)
+        response = client.post(f'/jobs/{job.id}/promote')
+        assert response.status_code == 409
+    finally:
+        release.set()
+
+
+def test_generate_prompts_streams_ndjson_events(client, tmp_path, monkeypatch):
+    for name in ('photo.png', 'photo_enhanced.png'):
+        Image.new('RGB', (8, 8), 'white').save(tmp_path / name)
+    calls = []
+
+    def stream_prompts(original, enhanced):
+        calls.append((original, enhanced))
+        yield {'status': 'partial', 'stage': 'enhancement', 'delta': '一只猫'}
+        yield {'status': 'success', 'enhancement_prompt': '一只猫', 'animation_prompt': 'cat', 'timings': {}}
+
+    llm_service = SimpleNamespace(stream_prompts=stream_prompts)
+    monkeypatch.setattr(app_module, 'container', SimpleNamespace(llm_service=llm_service))
+    response = client.post('/generate_prompts', json={'original_path': '/uploads/photo.png',
+                                                      'enhanced_path': '/uploads/photo_enhanced.png?t=1'})
+    assert response.status_code == 200
+    assert response.mimetype == 'application/x-ndjson'
+    events = [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+    assert [event['status'] for event in events] == ['partial', 'success']
+    assert calls == [(str(tmp_path / 'photo.png'), str(tmp_path / 'photo_enhanced.png'))]
+
+
+def test_generate_prompts_missing_image_returns_404(client):
+    response = client.post('/generate_prompts', json={'original_path': '/uploads/missing.png',
+                                                      'enhanced_path': '/uploads/missing.png'})
+    assert response.status_code == 404
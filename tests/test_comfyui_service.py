@@ -0,0 +1,273 @@
+"""ComfyUIService 的工作流构建和输入图片的写入、清理"""
+import os
+import time
+from types import SimpleNamespace
+
+import pytest
+from PIL import Image
+
+from config.config import Config
+from services.comfyui_service import (ANIMATION_BRANCH_ID_OFFSET, ANIMATION_BRANCH_NODES, ANIMATION_FORMATS,
+                                      ANIMATION_OUTPUT_NODE, ANIMATION_SAMPLER_CLASS, ANIMATION_SEED_NODE,
+                                      ENHANCE_BATCH_NODE, ENHANCE_PRESETS, ComfyUIService)
+from services.image_preprocess import second_pass_size
+from services.shared_state import SharedState
+
+
+@pytest.fixture
+def comfyui_config(tmp_path):
+    return type('TestConfig', (Config,), {'COMFYUI_ROOT': str(tmp_path / 'comfyui'), 'COMFYUI_INPUT_TTL': 3600})
+
+
+@pytest.fixture
+def service(comfyui_config):
+    # 构建工作流和写入输入图片都不访问 ComfyUI
+    return ComfyUIService('http://comfyui.invalid', config=comfyui_config)
+
+
+def links(node):
+    return [value for value in node['inputs'].values() if isinstance(value, list) and len(value) == 2
+            and isinstance(value[0], str)]
+
+
+@pytest.mark.parametrize('count', [2, 3])
+def test_animation_workflow_branches(service, count):
+    base = service._animation_workflow('drawing.png', ['prompt'], ANIMATION_FORMATS['gif'])
+    prompts = [f'prompt {index}' for index in range(count)]
+    workflow = service._animation_workflow('drawing.png', prompts, ANIMATION_FORMATS['gif'], seed=42)
+
+    # 每个分支一份分支节点，编号不与模板中的节点冲突
+    branch_ids = [[str(int(node_id) + index * ANIMATION_BRANCH_ID_OFFSET) for node_id in ANIMATION_BRANCH_NODES]
+                  for index in range(1, count)]
+    for ids in branch_ids:
+        assert not set(ids) & set(base)
+    assert set(workflow) == set(base) | {node_id for ids in branch_ids for node_id in ids}
+
+    # 所有连接都指向存在的节点
+    for node_id, node in workflow.items():
+        for target, _ in links(node):
+            assert target in workflow, f"{node_id} -> {target}"
+
+    samplers = [node_id for node_id, node in workflow.items() if node['class_type'] == ANIMATION_SAMPLER_CLASS]
+    assert len(samplers) == count
+    for index in range(count):
+        offset = index * ANIMATION_BRANCH_ID_OFFSET
+        branch = {node_id: str(int(node_id) + offset) for node_id in ANIMATION_BRANCH_NODES}
+        assert workflow[branch['166']]['inputs']['string'] == prompts[index]
+        # 分支内部的连接留在本分支内，分支节点之外的连接指向共用节点
+        for node_id in ANIMATION_BRANCH_NODES:
+            for target, _ in links(workflow[branch[node_id]]):
+                template_id = str(int(target) % ANIMATION_BRANCH_ID_OFFSET)
+                assert target == (branch[template_id] if template_id in branch else template_id)
+        # 每个分支有自己的采样节点，种子都取自请求的种子（预览升级时所有动作按同一种子重新渲染）
+        sampler = workflow[branch['144']]
+        assert sampler['class_type'] == ANIMATION_SAMPLER_CLASS
+        assert sampler['inputs']['seed'] == [ANIMATION_SEED_NODE, 0]
+        assert workflow[branch[ANIMATION_OUTPUT_NODE]]['inputs']['format'] == ANIMATION_FORMATS['gif']['vhs_format']
+    assert workflow[ANIMATION_SEED_NODE]['inputs']['seed'] == 42
+
+
+def test_single_prompt_animation_workflow_matches_template(service):
+    workflow = service._animation_workflow('drawing.png', ['prompt'], ANIMATION_FORMATS['gif'])
+    template = service._load_workflow('animation_workflow.json')
+    assert set(workflow) == set(template)
+    assert workflow['166']['inputs']['string'] == 'prompt'
+    assert workflow['150']['inputs']['image'] == 'drawing.png'
+
+
+def drawing(path, color):
+    Image.new('RGB', (16, 16), color).save(path)
+    return str(path)
+
+
+class CountingPrepare:
+    def __init__(self):
+        self.calls = 0
+
+    def __call__(self, source, target):
+        self.calls += 1
+        with Image.open(source) as img:
+            img.save(target, 'PNG')
+        return {'size': [16, 16], 'clean_scan': True}
+
+
+def test_stage_input_dedupes_by_content(service, tmp_path):
+    prepare = CountingPrepare()
+    first = drawing(tmp_path / 'a.png', 'red')
+    copy = drawing(tmp_path / 'b.png', 'red')
+
+    name, metadata = service._stage_input(first, 'enhance', prepare)
+    assert service._stage_input(copy, 'enhance', prepare) == (name, metadata)
+    assert prepare.calls == 1
+    # 不同用途写入不同的文件
+    other, _ = service._stage_input(first, 'animation')
+    assert other != name
+    assert sorted(os.listdir(service.comfyui_input_dir)) == sorted([name, other])
+
+
+def test_staged_metadata_shared_between_workers(comfyui_config, tmp_path):
+    store = SharedState(str(tmp_path / 'shared_state.db'))
+    first = ComfyUIService('http://comfyui.invalid', config=comfyui_config, shared_state=store)
+    second = ComfyUIService('http://comfyui.invalid', config=comfyui_config, shared_state=store)
+    prepare = CountingPrepare()
+    image = drawing(tmp_path / 'a.png', 'red')
+
+    staged = first._stage_input(image, 'enhance', prepare)
+    assert second._stage_input(image, 'enhance', prepare) == staged
+    assert prepare.calls == 1
+
+    # 文件被删除后重新写入
+    os.remove(os.path.join(first.comfyui_input_dir, staged[0]))
+    assert second._stage_input(image, 'enhance', prepare) == staged
+    assert prepare.calls == 2
+
+
+def test_evict_inputs_removes_only_expired_files(comfyui_config, tmp_path):
+    store = SharedState(str(tmp_path / 'shared_state.db'))
+    service = ComfyUIService('http://comfyui.invalid', config=comfyui_config, shared_state=store)
+    prepare = CountingPrepare()
+    old_name, _ = service._stage_input(drawing(tmp_path / 'old.png', 'red'), 'enhance', prepare)
+    recent_name, _ = service._stage_input(drawing(tmp_path / 'recent.png', 'blue'), 'enhance', prepare)
+    unrelated = os.path.join(service.comfyui_input_dir, 'user_upload.png')
+    drawing(unrelated, 'green')
+    expired = time.time() - service.input_ttl - 10
+    for path in (os.path.join(service.comfyui_input_dir, old_name), unrelated):
+        os.utime(path, (expired, expired))
+
+    service._evict_inputs(force=True)
+    assert sorted(os.listdir(service.comfyui_input_dir)) == sorted([recent_name, 'user_upload.png'])
+    assert store.cache_get('staged_inputs', old_name) is None
+    assert store.cache_get('staged_inputs', recent_name) is not None
+
+    # 复用会刷新修改时间，之后的清理不会删除它
+    service._stage_input(drawing(tmp_path / 'recent_copy.png', 'blue'), 'enhance', prepare)
+    assert time.time() - os.path.getmtime(os.path.join(service.comfyui_input_dir, recent_name)) < 60
+    assert prepare.calls == 2
+
+    service._stage_input(drawing(tmp_path / 'old_again.png', 'red'), 'enhance', prepare)
+    assert prepare.calls == 3
+
+
+def assert_links_resolve(workflow):
+    for node_id, node in workflow.items():
+        for target, _ in links(node):
+            assert target in workflow, f"{node_id} -> {target}"
+
+
+@pytest.mark.parametrize('preset', ['best', 'balanced'])
+def test_enhance_preset_with_second_pass(service, preset):
+    workflow = service._load_workflow('enhance_workflow.json')
+    config = ENHANCE_PRESETS[preset]
+    service._apply_enhance_variant(workflow, (704, 704), light=False, preset=preset)
+
+    assert (workflow['10']['inputs']['width'], workflow['10']['inputs']['height']) == (704, 704)
+    assert (workflow['58']['inputs']['width'], workflow['58']['inputs']['height']) == \
+        second_pass_size((704, 704), config['second_pass_scale'])
+    assert workflow['3']['inputs']['steps'] == config['steps']
+    assert workflow['11']['inputs']['steps'] == config['second_steps']
+    template = service._load_workflow('enhance_workflow.json')
+    for node_id in ('3', '11'):
+        expected = config['scheduler'] or template[node_id]['inputs']['scheduler']
+        assert workflow[node_id]['inputs']['scheduler'] == expected
+    # 第二遍采样保留：VAEDecode 仍然解码第二遍的结果
+    assert workflow['13']['inputs']['samples'] == ['11', 0]
+    assert workflow['42']['class_type'] == template['42']['class_type']
+    assert_links_resolve(workflow)
+
+
+def test_fast_preset_drops_second_pass(service):
+    workflow = service._load_workflow('enhance_workflow.json')
+    service._apply_enhance_variant(workflow, (600, 800), light=False, preset='fast')
+
+    assert '58' not in workflow and '11' not in workflow
+    assert workflow['13']['inputs']['samples'] == ['3', 0]
+    assert workflow['3']['inputs']['steps'] == ENHANCE_PRESETS['fast']['steps']
+    assert workflow['3']['inputs']['scheduler'] == ENHANCE_PRESETS['fast']['scheduler']
+    assert (workflow['10']['inputs']['width'], workflow['10']['inputs']['height']) == (600, 800)
+    assert_links_resolve(workflow)
+
+
+def test_enhance_preset_keeps_template_size_without_preprocessing(service):
+    workflow = service._load_workflow('enhance_workflow.json')
+    size = (workflow['10']['inputs']['width'], workflow['10']['inputs']['height'])
+    service._apply_enhance_variant(workflow, None, light=False, preset='best')
+    assert (workflow['10']['inputs']['width'], workflow['10']['inputs']['height']) == size
+
+
+
+def test_light_variant_saves_first_pass(service):
+    workflow = service._load_workflow('enhance_workflow.json')
+    service._apply_enhance_variant(workflow, (704, 704), light=True, preset='best')
+
+    # 轻量变体：去掉第二遍采样，SaveImage 代替去背景节点 42，直接保存第一遍的解码结果
+    assert '58' not in workflow and '11' not in workflow
+    assert workflow['13']['inputs']['samples'] == ['3', 0]
+    assert workflow['42']['class_type'] == 'SaveImage'
+    assert workflow['42']['inputs']['images'] == ['13', 0]
+    assert_links_resolve(workflow)
+
+
+@pytest.mark.parametrize('light', [False, True])
+def test_variants_repeat_latent_batch(service, light):
+    workflow = service._load_workflow('enhance_workflow.json')
+    service._apply_enhance_variant(workflow, (704, 704), light=light, preset='best', variants=3)
+
+    batch = workflow[ENHANCE_BATCH_NODE]
+    assert batch['class_type'] == 'RepeatLatentBatch'
+    assert batch['inputs'] == {'samples': ['10', 0], 'amount': 3}
+    assert workflow['3']['inputs']['latent_image'] == [ENHANCE_BATCH_NODE, 0]
+    assert_links_resolve(workflow)
+
+
+def test_single_variant_has_no_batch_node(service):
+    workflow = service._load_workflow('enhance_workflow.json')
+    service._apply_enhance_variant(workflow, (704, 704), light=False, preset='best')
+    assert ENHANCE_BATCH_NODE not in workflow
+    assert workflow['3']['inputs']['latent_image'] == ['10', 0]
+
+
+@pytest.fixture
+def submitted(service, monkeypatch):
+    """替换提交工作流的 HTTP 请求，记录提交的工作流；不启动进度监听和状态采样"""
+    workflows = []
+
+    def post(url, json=None, **kwargs):
+        workflows.append(json['prompt'])
+        return SimpleNamespace(status_code=200, json=lambda: {'prompt_id': f'prompt-{len(workflows)}'})
+
+    monkeypatch.setattr(service, 'session', SimpleNamespace(post=post))
+    monkeypatch.setattr(service.progress_tracker, 'start', lambda: None)
+    monkeypatch.setattr(service.telemetry, 'start', lambda: None)
+    return workflows
+
+
+def test_queue_prompt_checks_load_image_node_of_any_template(service, submitted, tmp_path):
+    workflow = service._load_workflow('enhance_workflow.json')
+    workflow['50']['inputs']['image'] = 'enhance_0123456789abcdef.png'
+    # 美化模板的 LoadImage 是节点 50，输入图片不存在时不提交
+    assert service._queue_prompt(workflow, 'enhance') is None
+    assert submitted == []
+
+    name, _ = service._stage_input(drawing(tmp_path / 'a.png', 'red'), 'enhance', CountingPrepare())
+    workflow['50']['inputs']['image'] = name
+    assert service._queue_prompt(workflow, 'enhance') == 'prompt-1'
+    assert submitted == [workflow]
+
+
+def test_queue_prompt_converts_only_unstaged_inputs(service, submitted):
+    os.makedirs(service.comfyui_input_dir, exist_ok=True)
+    staged = 'animation_0123456789abcdef.png'
+    Image.new('RGBA', (8, 8), (255, 0, 0, 128)).save(os.path.join(service.comfyui_input_dir, staged))
+    Image.new('RGBA', (8, 8), (255, 0, 0, 128)).save(os.path.join(service.comfyui_input_dir, 'upload.png'))
+
+    animation = service._animation_workflow(staged, ['prompt'], ANIMATION_FORMATS['gif'])
+    assert service._queue_prompt(animation, 'animation') == 'prompt-1'
+    enhance = service._load_workflow('enhance_workflow.json')
+    enhance['50']['inputs']['image'] = 'upload.png'
+    assert service._queue_prompt(enhance, 'enhance') == 'prompt-2'
+
+    # 按内容哈希命名的文件内容不变，其他输入图片转换为 RGB
+    with Image.open(os.path.join(service.comfyui_input_dir, staged)) as img:
+        assert img.mode == 'RGBA'
+    with Image.open(os.path.join(service.comfyui_input_dir, 'upload.png')) as img:
+        assert img.mode == 'RGB'
@@ -0,0 +1,105 @@
+"""对冲请求：对冲阈值、先返回的结果胜出、取消落后的请求和两个请求都失败"""
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from services.hedging import LatencyWindow, hedged_call
+
+
+@pytest.fixture
+def executor():
+    executor = ThreadPoolExecutor(max_workers=4)
+    yield executor
+    executor.shutdown(wait=False)
+
+
+def call(result, seconds=0.0, calls=None, name=None):
+    """固定耗时后返回 result（为异常时抛出）的请求"""
+    def run():
+        if calls is not None:
+            calls.append(name)
+        time.sleep(seconds)
+        if isinstance(result, Exception):
+            raise result
+        return result
+    return run
+
+
+def test_percentile_of_latency_window():
+    window = LatencyWindow(size=100)
+    assert window.percentile(95) is None
+    for seconds in range(1, 101):
+        window.record(seconds / 100)
+    assert len(window) == 100
+    assert window.percentile(0) == 0.01
+    assert window.percentile(50) == pytest.approx(0.51)
+    assert window.percentile(95) == pytest.approx(0.95)
+    assert window.percentile(100) == 1.0
+
+
+def test_window_keeps_only_recent_samples():
+    window = LatencyWindow(size=3)
+    for seconds in (10, 10, 1, 2, 3):
+        window.record(seconds)
+    assert window.percentile(100) == 3
+
+
+def test_fast_primary_does_not_hedge(executor):
+    calls = []
+    result = hedged_call(call('p', 0.0, calls, 'primary'), call('h', 0.0, calls, 'hedge'), 0.5, executor)
+    assert result[:3] == ('p', 'primary', False)
+    assert calls == ['primary']
+
+
+def test_hedge_fires_after_delay_and_first_result_wins(executor):
+    start = time.monotonic()
+    result, source, hedged, elapsed = hedged_call(call('p', 0.5), call('h', 0.05), 0.1, executor)
+    assert (result, source, hedged) == ('h', 'hedge', True)
+    # 对冲在阈值之后才发起，胜出的对冲请求在阈值加上它自身的耗时后返回
+    assert 0.15 <= elapsed < 0.45
+    assert time.monotonic() - start < 0.45
+
+
+def test_slow_primary_still_wins_if_first(executor):
+    result, source, hedged, _ = hedged_call(call('p', 0.15), call('h', 0.5), 0.05, executor)
+    assert (result, source, hedged) == ('p', 'primary', True)
+
+
+def test_queued_loser_is_cancelled():
+    """线程池被其他请求占满时对冲请求还在排队，首选请求先返回后对冲请求被取消，不再执行"""
+    executor = ThreadPoolExecutor(max_workers=2)
+    release = threading.Event()
+    calls = []
+    try:
+        executor.submit(release.wait)
+        # 首选请求开始执行后，另一个请求的任务排在对冲请求之前
+        threading.Timer(0.02, lambda: executor.submit(release.wait)).start()
+        result = hedged_call(call('p', 0.15, calls, 'primary'), call('h', 0.0, calls, 'hedge'), 0.05, executor)
+        assert result[:3] == ('p', 'primary', True)
+        release.set()
+        executor.submit(lambda: None).result(timeout=1)
+        assert calls == ['primary']
+    finally:
+        release.set()
+        executor.shutdown(wait=False)
+
+
+def test_failed_primary_before_delay_raises_without_hedging(executor):
+    calls = []
+    with pytest.raises(ValueError, match='primary failed'):
+        hedged_call(call(ValueError('primary failed')), call('h', 0.0, calls, 'hedge'), 0.5, executor)
+    assert calls == []
+
+
+def test_hedge_wins_when_primary_fails_after_delay(executor):
+    result = hedged_call(call(ValueError('primary failed'), 0.1), call('h', 0.2), 0.05, executor)
+    assert result[:3] == ('h', 'hedge', True)
+
+
+@pytest.mark.parametrize('primary_seconds, hedge_seconds', [(0.1, 0.2), (0.2, 0.1)])
+def test_both_fail_raises_primary_error(executor, primary_seconds, hedge_seconds):
+    with pytest.raises(ValueError, match='primary failed'):
+        hedged_call(call(ValueError('primary failed'), primary_seconds),
+                    call(RuntimeError('hedge failed'), hedge_seconds), 0.05, executor)
@@ -0,0 +1,79 @@
+"""图片解码内存预算和共享解码结果"""
+import threading
+
+import pytest
+from PIL import Image
+
+from services.image_memory import (WORKING_OVERHEAD_BYTES, WORKING_SIZE, ImageMemoryBusy, ImageTooLarge,
+                                   MemoryBudget, SharedImage)
+
+MB = 1024 * 1024
+
+
+def test_budget_acquire_and_release():
+    budget = MemoryBudget(100 * MB, wait_seconds=0.05)
+    assert budget.acquire(60 * MB) == 60 * MB
+    assert budget.acquire(40 * MB) == 40 * MB
+    assert budget.reserved_bytes == 100 * MB
+    with pytest.raises(ImageMemoryBusy):
+        budget.acquire(1)
+
+    budget.release(60 * MB)
+    assert budget.reserved_bytes == 40 * MB
+    budget.release(40 * MB)
+    # 超过整个预算的任务按整个预算预留（独占）
+    assert budget.acquire(500 * MB) == 100 * MB
+    budget.release(100 * MB)
+    assert budget.reserved_bytes == 0
+
+
+def test_budget_waiter_proceeds_after_release():
+    budget = MemoryBudget(100 * MB, wait_seconds=5)
+    budget.acquire(80 * MB)
+    acquired = []
+    waiter = threading.Thread(target=lambda: acquired.append(budget.acquire(50 * MB)))
+    waiter.start()
+    waiter.join(0.1)
+    assert not acquired
+
+    budget.release(80 * MB)
+    waiter.join(5)
+    assert acquired == [50 * MB]
+    assert budget.reserved_bytes == 50 * MB
+
+
+def test_large_jpeg_decoded_in_draft_mode(tmp_path):
+    path = tmp_path / 'photo.jpg'
+    Image.new('RGB', (4000, 3000), (200, 120, 40)).save(path, 'JPEG', quality=80)
+    budget = MemoryBudget(512 * MB, wait_seconds=1)
+
+    with SharedImage(str(path), budget) as image:
+        assert image.original_size == (4000, 3000)
+        # 按 draft 缩小后的尺寸（1/2、1/4 或 1/8）估计，而不是 4000x3000
+        full_estimate = 4000 * 3000 * 3 * 2 + WORKING_OVERHEAD_BYTES
+        assert image.estimated_bytes <= (2000 * 1500 * 3 * 2 + WORKING_OVERHEAD_BYTES) < full_estimate
+        assert budget.reserved_bytes == image.estimated_bytes
+        working = image.working()
+        assert working.mode == 'RGB' and max(working.size) <= WORKING_SIZE
+        assert image.working() is working
+    assert budget.reserved_bytes == 0
+
+
+def test_transparent_image_composited_on_white(tmp_path):
+    path = tmp_path / 'sticker.png'
+    Image.new('RGBA', (64, 32), (255, 0, 0, 0)).save(path)
+    with SharedImage(str(path)) as image:
+        assert image.working().getpixel((0, 0)) == (255, 255, 255)
+
+
+def test_pixel_limit_enforced_without_changing_pil_global(tmp_path):
+    path = tmp_path / 'wide.png'
+    Image.new('L', (300, 200)).save(path)
+    pil_limit = Image.MAX_IMAGE_PIXELS
+    budget = MemoryBudget(512 * MB, wait_seconds=1)
+
+    with pytest.raises(ImageTooLarge):
+        SharedImage(str(path), budget, max_pixels=300 * 200 - 1)
+    assert budget.reserved_bytes == 0
+    SharedImage(str(path), max_pixels=300 * 200).close()
+    assert Image.MAX_IMAGE_PIXELS == pil_limit
@@ -0,0 +1,35 @@
+"""CPU 去背景的连通区域判定"""
+import numpy as np
+from PIL import Image, ImageDraw
+
+from services.image_preprocess import _border_connected, remove_white_background
+
+
+def test_border_connected_keeps_enclosed_region():
+    mask = np.array([
+        [1, 1, 1, 1, 1, 1],
+        [1, 0, 0, 0, 0, 1],
+        [1, 0, 1, 1, 0, 1],
+        [1, 0, 1, 1, 0, 0],
+        [1, 0, 0, 0, 0, 1],
+        [0, 1, 1, 0, 1, 1],
+    ], dtype=bool)
+    reached = _border_connected(mask)
+    expected = mask.copy()
+    expected[2:4, 2:4] = False
+    assert np.array_equal(reached, expected)
+    assert not _border_connected(np.zeros((3, 4), dtype=bool)).any()
+
+
+def test_remove_white_background_clears_border_region_and_keeps_enclosed_white(tmp_path):
+    image = Image.new('RGB', (160, 160), 'white')
+    # 黑色方框，框内的白色与边缘不连通
+    ImageDraw.Draw(image).rectangle((40, 40, 120, 120), outline='black', width=12)
+    source, output = tmp_path / 'drawing.png', tmp_path / 'sticker.png'
+    image.save(source)
+
+    assert remove_white_background(str(source), str(output))
+    alpha = np.asarray(Image.open(output))[..., 3]
+    assert alpha[0, 0] == 0 and alpha[-1, -1] == 0
+    assert alpha[80, 80] == 255
+    assert alpha[45, 45] == 255
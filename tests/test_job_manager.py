@@ -0,0 +1,192 @@
+"""JobManager 在多个工作进程共享同一个 SharedState 时的接管和取消"""
+import multiprocessing
+import os
+import sqlite3
+import time
+
+import pytest
+
+from services import job_manager
+from services.job_manager import JOB_CANCELLED, JOB_SUCCEEDED, Job, JobManager
+from services.shared_state import SharedState, current_process_start_time
+
+# 用 fork 模拟 gunicorn 的工作进程（每个进程的 pid 不同）
+fork = multiprocessing.get_context('fork')
+
+
+def wait_until(condition, timeout=10):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.02)
+    return True
+
+
+def echo(value, job=None):
+    return {'value': value, 'pid': os.getpid()}
+
+
+def block_until_cancelled(*args, job=None):
+    job.cancel_event.wait(30)
+    return {'cancelled': job.cancelled}
+
+
+def submit_and_die(db_path, queue):
+    """提交一个不会结束的任务后立即退出，留下所属进程已停止的未完成任务"""
+    job = JobManager(store=SharedState(db_path)).submit('echo', block_until_cancelled, 'hello')
+    queue.put(job.id)
+    queue.close()
+    queue.join_thread()
+    os._exit(0)
+
+
+def recover_in_worker(db_path, barrier, queue):
+    store = SharedState(db_path)
+    manager = JobManager(store=store)
+    barrier.wait()
+    recovered = manager.recover({'echo': echo})
+    for job in recovered:
+        # 结束状态写入共享状态之后才能退出
+        wait_until(lambda: store.load_job(job.id)['finished_at'] is not None)
+    queue.put([job.id for job in recovered])
+
+
+@pytest.fixture
+def db_path(tmp_path):
+    path = str(tmp_path / 'shared_state.db')
+    SharedState(path)
+    return path
+
+
+def test_recover_claims_dead_owners_job_once(db_path):
+    queue = fork.Queue()
+    owner = fork.Process(target=submit_and_die, args=(db_path, queue))
+    owner.start()
+    job_id = queue.get(timeout=10)
+    owner.join(10)
+    store = SharedState(db_path)
+    assert store.load_job(job_id)['owner_pid'] == owner.pid
+    assert store.load_job(job_id)['finished_at'] is None
+
+    barrier = fork.Barrier(2)
+    workers = [fork.Process(target=recover_in_worker, args=(db_path, barrier, queue)) for _ in range(2)]
+    for worker in workers:
+        worker.start()
+    claimed = [queue.get(timeout=20) for _ in workers]
+    for worker in workers:
+        worker.join(10)
+
+    assert sorted(len(ids) for ids in claimed) == [0, 1]
+    assert [job_id] in claimed
+    data = store.load_job(job_id)
+    assert data['status'] == JOB_SUCCEEDED
+    assert data['result']['value'] == 'hello'
+    assert data['owner_pid'] in {worker.pid for worker in workers}
+    # 已结束的任务不会再被接管
+    assert JobManager(store=store).recover({'echo': echo}) == []
+
+
+def test_recover_skips_jobs_of_live_processes(db_path):
+    # 先 fork 再在本进程中启动任务线程：fork 时其他线程可能正持有 SQLite 的锁
+    queue, barrier = fork.Queue(), fork.Barrier(2)
+    worker = fork.Process(target=recover_in_worker, args=(db_path, barrier, queue))
+    worker.start()
+    owner = JobManager(store=SharedState(db_path))
+    job = owner.submit('echo', block_until_cancelled)
+    try:
+        barrier.wait(10)
+        assert queue.get(timeout=20) == []
+        worker.join(10)
+    finally:
+        owner.cancel(job.id)
+    assert wait_until(lambda: job.finished)
+
+
+def save_unfinished_job(store, owner_pid, owner_started_at):
+    job = Job('echo')
+    job.inputs = {'args': ['hello'], 'kwargs': {}}
+    JobManager(store=store)._save(job)
+    store._connection().execute('UPDATE jobs SET owner_pid = ?, owner_started_at = ? WHERE id = ?',
+                                (owner_pid, owner_started_at, job.id))
+    return job.id
+
+
+def test_recover_claims_job_of_reused_pid(db_path):
+    """进程号仍在使用但启动时间不同（容器重启后进程号被重新分配）时视为原进程已退出"""
+    store = SharedState(db_path)
+    job_id = save_unfinished_job(store, os.getppid(), -1)
+    recovered = JobManager(store=store).recover({'echo': echo})
+    assert [job.id for job in recovered] == [job_id]
+    assert wait_until(lambda: store.load_job(job_id)['status'] == JOB_SUCCEEDED)
+    data = store.load_job(job_id)
+    assert (data['owner_pid'], data['owner_started_at']) == (os.getpid(), current_process_start_time())
+
+
+def test_recover_skips_own_running_jobs(db_path):
+    manager = JobManager(store=SharedState(db_path))
+    job = manager.submit('echo', block_until_cancelled)
+    try:
+        assert manager.recover({'echo': echo}) == []
+    finally:
+        manager.cancel(job.id)
+    assert wait_until(lambda: job.finished)
+
+
+def test_recover_legacy_job_without_start_time_of_own_pid(db_path):
+    """旧版本没有记录启动时间：进程号与当前进程相同的任务来自重启前的进程"""
+    store = SharedState(db_path)
+    job_id = save_unfinished_job(store, os.getpid(), None)
+    assert [job.id for job in JobManager(store=store).recover({'echo': echo})] == [job_id]
+    assert wait_until(lambda: store.load_job(job_id)['status'] == JOB_SUCCEEDED)
+
+
+def test_adds_owner_started_at_to_existing_file(tmp_path):
+    path = str(tmp_path / 'old.db')
+    conn = sqlite3.connect(path)
+    conn.execute("""CREATE TABLE jobs (id TEXT PRIMARY KEY, kind TEXT NOT NULL, status TEXT NOT NULL,
+                    data TEXT NOT NULL, owner_pid INTEGER, cancel_reason TEXT, created_at REAL NOT NULL,
+                    finished_at REAL, updated_at REAL NOT NULL)""")
+    conn.close()
+    store = SharedState(path)
+    job_id = save_unfinished_job(store, os.getppid(), -1)
+    assert store.load_job(job_id)['owner_started_at'] == -1
+
+
+def test_cancel_sets_event_and_finishes_cancelled():
+    manager = JobManager()
+    job = manager.submit('wait', block_until_cancelled)
+    assert wait_until(lambda: job.status == 'running')
+    assert manager.cancel(job.id, 'deadline') is job
+    assert wait_until(lambda: job.finished)
+    assert job.status == JOB_CANCELLED
+    assert job.cancel_reason == 'deadline'
+    # 重复取消不改变原因
+    manager.cancel(job.id, 'client')
+    assert job.cancel_reason == 'deadline'
+
+
+def test_cancel_remote_job_through_shared_state(db_path, monkeypatch):
+    monkeypatch.setattr(job_manager, 'SYNC_INTERVAL', 0.05)
+    owner = JobManager(store=SharedState(db_path))
+    other = JobManager(store=SharedState(db_path))
+    job = owner.submit('wait', block_until_cancelled)
+    assert wait_until(lambda: job.status == 'running')
+
+    remote = other.get(job.id)
+    assert remote.remote and not remote.cancelled
+    assert other.cancel(job.id, 'client').cancel_reason == 'client'
+    assert other._store.cancel_requests([job.id, 'missing']) == {job.id: 'client'}
+    # 同一个任务只记录第一次取消请求
+    assert not other._store.request_cancel(job.id, 'deadline')
+
+    assert wait_until(lambda: job.finished)
+    assert job.status == JOB_CANCELLED
+    assert job.cancel_reason == 'client'
+    assert wait_until(lambda: other.get(job.id).status == JOB_CANCELLED)
+    # 已结束的任务不能再请求取消
+    assert not other._store.request_cancel(job.id, 'client')
+
+
+def test_cancel_unknown_job_returns_none(db_path):
+    assert JobManager(store=SharedState(db_path)).cancel('missing') is None
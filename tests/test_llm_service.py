@@ -0,0 +1,111 @@
+"""流式提示词生成对 NDJSON 的逐行解析"""
+import json
+
+import pytest
+import requests
+
+from services import llm_service
+from services.llm_service import LLMService
+from services.upstream_governor import UpstreamGovernor
+
+LLM_SETTINGS = {
+    'rate_limit': 100.0, 'burst': 100, 'initial_concurrency': 4, 'max_concurrency': 8,
+    'queue_timeout': 1.0, 'request_timeout': 1.0, 'failure_threshold': 5, 'open_seconds': 30.0
+}
+
+
+class ChunkedBody:
+    """每次最多读出 size 字节，JSON 行会被切在分块中间"""
+
+    def __init__(self, data, size=7):
+        self._data = data
+        self._size = size
+
+    def read(self, amount=None, **kwargs):
+        chunk, self._data = self._data[:self._size], self._data[self._size:]
+        return chunk
+
+
+def ndjson_response(*events, tail=b''):
+    response = requests.Response()
+    response.status_code = 200
+    body = b''.join(json.dumps(event).encode() + b'\n' for event in events) + tail
+    response.raw = ChunkedBody(body)
+    return response
+
+
+class FakeSession:
+    """按调用顺序返回预设的流式响应"""
+
+    def __init__(self, responses):
+        self.responses = list(responses)
+        self.bodies = []
+
+    def post(self, url, json=None, **kwargs):
+        self.bodies.append(json)
+        return self.responses.pop(0)
+
+
+@pytest.fixture
+def images(tmp_path):
+    paths = []
+    for name in ('original.png', 'enhanced.png'):
+        path = tmp_path / name
+        path.write_bytes(b'png')
+        paths.append(str(path))
+    return paths
+
+
+def llm_with(monkeypatch, *responses):
+    governor = UpstreamGovernor({'llm_studio': LLM_SETTINGS})
+    session = FakeSession(responses)
+    governor._sessions['llm_studio'] = session
+    monkeypatch.setattr(llm_service, 'governor', governor)
+    return LLMService('http://llm', 'llava'), session
+
+
+def test_stream_prompts_yields_deltas_then_success(monkeypatch, images):
+    service, session = llm_with(
+        monkeypatch,
+        ndjson_response({'response': '一只'}, {'response': '红色的猫'}, {'response': '', 'done': True}),
+        ndjson_response({'response': 'cat '}, {'response': 'waving', 'done': True})
+    )
+    events = list(service.stream_prompts(*images))
+
+    assert [(e['stage'], e['delta']) for e in events if e['status'] == 'partial'] == [
+        ('enhancement', '一只'), ('enhancement', '红色的猫'), ('animation', 'cat '), ('animation', 'waving')
+    ]
+    final = events[-1]
+    assert final['status'] == 'success'
+    assert final['enhancement_prompt'] == '一只红色的猫'
+    assert final['animation_prompt'] == 'cat waving'
+    assert set(final['timings']) == {'first_token_seconds', 'enhancement_seconds', 'total_seconds'}
+    # 第二段以第一段的完整文本为输入
+    assert session.bodies[0]['stream'] is True and len(session.bodies[0]['images']) == 2
+    assert '一只红色的猫' in json.dumps(session.bodies[1], ensure_ascii=False)
+
+
+def test_stream_without_done_reports_error(monkeypatch, images):
+    # 连接在 done 之前断开，最后一行只写了一半
+    service, _ = llm_with(monkeypatch, ndjson_response({'response': '一只'}, tail='{"response": "红'.encode()))
+    events = list(service.stream_prompts(*images))
+
+    assert events[0] == {'status': 'partial', 'stage': 'enhancement', 'delta': '一只'}
+    assert events[-1]['status'] == 'error'
+    assert llm_service.governor._limiters['llm_studio'].limit < LLM_SETTINGS['initial_concurrency']
+
+
+def test_stream_ending_cleanly_before_done_is_an_error(monkeypatch, images):
+    service, _ = llm_with(monkeypatch, ndjson_response({'response': '一只'}))
+    assert service.generate_prompts(*images, stream=True) is None
+
+
+def test_animation_stage_failure_keeps_enhancement_prompt(monkeypatch, images):
+    service, _ = llm_with(
+        monkeypatch,
+        ndjson_response({'response': '一只猫', 'done': True}),
+        ndjson_response({'response': 'cat'})
+    )
+    result = service.generate_prompts(*images, stream=True)
+    assert result['enhancement_prompt'] == '一只猫'
+    assert result['animation_prompt'] is None
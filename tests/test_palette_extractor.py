@@ -0,0 +1,59 @@
+"""本地调色板提取：在纯色块组成的合成图片上聚类和命名"""
+from PIL import Image, ImageDraw
+
+from services.palette_extractor import color_name, extract_palette, merge_colors
+
+
+def paper_drawing(path, blocks, paper=(245, 242, 235)):
+    """略带黄色的纸上画几个纯色块，blocks 为 [(颜色, (左, 上, 右, 下))]"""
+    image = Image.new('RGB', (200, 200), paper)
+    draw = ImageDraw.Draw(image)
+    for color, box in blocks:
+        draw.rectangle(box, fill=color)
+    image.save(path)
+    return str(path)
+
+
+def test_two_colors_on_paper(tmp_path):
+    path = paper_drawing(tmp_path / 'two.png', [((220, 30, 30), (20, 20, 119, 179)),
+                                                ((40, 70, 210), (120, 20, 179, 179))])
+    palette = extract_palette(path)
+    assert [entry['name'] for entry in palette] == ['红色', '蓝色']
+    # 纸张不计入，红色块面积约为蓝色的 5/3
+    assert abs(palette[0]['ratio'] - 0.625) < 0.05 and abs(palette[1]['ratio'] - 0.375) < 0.05
+    assert all(entry['hex'].startswith('#') and len(entry['hex']) == 7 for entry in palette)
+
+
+def test_three_colors_and_small_areas_dropped(tmp_path):
+    path = paper_drawing(tmp_path / 'three.png', [((240, 210, 30), (10, 10, 99, 189)),
+                                                  ((40, 170, 60), (100, 10, 189, 99)),
+                                                  ((130, 60, 190), (100, 100, 189, 189)),
+                                                  # 占比低于 5% 的小点
+                                                  ((230, 120, 20), (0, 195, 5, 199))])
+    palette = extract_palette(path, max_colors=5)
+    assert sorted(entry['name'] for entry in palette) == ['紫色', '绿色', '黄色']
+    assert palette[0]['name'] == '黄色'
+    assert extract_palette(path, max_colors=1) == palette[:1]
+
+
+def test_transparent_background_treated_as_paper(tmp_path):
+    image = Image.new('RGBA', (100, 100), (0, 0, 0, 0))
+    ImageDraw.Draw(image).ellipse((20, 20, 80, 80), fill=(30, 160, 60, 255))
+    path = tmp_path / 'sticker.png'
+    image.save(path)
+    assert [entry['name'] for entry in extract_palette(str(path))] == ['绿色']
+
+
+def test_color_names():
+    assert color_name((20, 20, 20)) == '黑色'
+    assert color_name((250, 250, 250)) == '白色'
+    assert color_name((128, 128, 128)) == '灰色'
+    assert color_name((120, 70, 30)) == '棕色'
+    assert color_name((250, 170, 180)) == '粉色'
+
+
+def test_merge_colors():
+    palette = [{'name': '红色'}, {'name': '黑色'}, {'name': '蓝色'}]
+    assert merge_colors([], palette) == (['红色', '黑色', '蓝色'], 'filled')
+    assert merge_colors(['红色的衣服'], palette) == (['红色的衣服', '蓝色'], 'augmented')
+    assert merge_colors(['红', '蓝色头发'], palette) == (['红', '蓝色头发'], 'unchanged')
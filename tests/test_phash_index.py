@@ -0,0 +1,111 @@
+"""多索引哈希与暴力汉明扫描的一致性，以及近重复缓存的淘汰"""
+import random
+
+import pytest
+
+from services import phash_index
+from services.phash_index import MultiIndexHashIndex, NearDuplicateCache, cache_key, hamming
+from services.shared_state import SharedState
+
+
+def brute_force(entries, phash, radius):
+    return sorted((hamming(phash, stored), key) for key, stored in entries.items() if hamming(phash, stored) <= radius)
+
+
+def near(rng, value, distance):
+    """与 value 汉明距离恰好为 distance 的哈希"""
+    for bit in rng.sample(range(64), distance):
+        value ^= 1 << bit
+    return value
+
+
+@pytest.mark.parametrize('seed', [0, 1, 2])
+def test_search_matches_brute_force(seed):
+    rng = random.Random(seed)
+    index = MultiIndexHashIndex()
+    index.REINDEX_THRESHOLD = 64
+    entries = {}
+    for i in range(3000):
+        key = f"k{rng.randrange(2000)}"
+        # 一部分记录聚集在已有记录附近，保证各个半径都有命中
+        base = rng.choice(list(entries.values())) if entries and rng.random() < 0.5 else rng.getrandbits(64)
+        phash = near(rng, base, rng.randrange(12))
+        index.add(key, phash, rng.getrandbits(64), {'i': i})
+        entries[key] = phash
+        if rng.random() < 0.2:
+            removed = f"k{rng.randrange(2000)}"
+            index.remove(removed)
+            entries.pop(removed, None)
+    # 最后一批记录还没有分桶，只在尾部扫描
+    assert index._indexed < len(index._keys)
+    assert len(index) == len(entries)
+
+    for _ in range(300):
+        query = near(rng, rng.choice(list(entries.values())), rng.randrange(10)) if rng.random() < 0.7 \
+            else rng.getrandbits(64)
+        radius = rng.choice([0, 3, 4, 8, 10, 12, 16])
+        results = index.search(query, radius)
+        assert sorted((distance, key) for distance, key, _, _ in results) == brute_force(entries, query, radius)
+        assert [distance for distance, _, _, _ in results] == sorted(distance for distance, _, _, _ in results)
+
+
+def test_search_after_reindex_and_replace():
+    index = MultiIndexHashIndex()
+    index.add('a', 0, 0, 'first')
+    index._reindex()
+    index.add('a', 0xFF, 0, 'second')
+    index.add('b', 0x1, 0, 'b')
+    assert [(d, k, p) for d, k, _, p in index.search(0, 8)] == [(1, 'b', 'b'), (8, 'a', 'second')]
+    index._reindex()
+    assert [(d, k, p) for d, k, _, p in index.search(0, 8)] == [(1, 'b', 'b'), (8, 'a', 'second')]
+    assert len(index._keys) == 2
+
+
+def test_cache_key_depends_on_content_only():
+    assert cache_key((1, 2)) == cache_key((1, 2))
+    assert cache_key((1, 2)) != cache_key((2, 1))
+
+
+def test_cache_evicts_oldest_entries_locally_and_in_shared_state(tmp_path):
+    store = SharedState(str(tmp_path / 'shared_state.db'))
+    cache = NearDuplicateCache(max_entries=3)
+    cache.attach_store(store)
+    rng = random.Random(0)
+    hashes = [(rng.getrandbits(64), rng.getrandbits(64)) for _ in range(5)]
+    for i, pair in enumerate(hashes):
+        cache.store(cache_key(pair), pair, {'i': i})
+
+    assert len(cache) == 3
+    assert cache.lookup(hashes[0]) is None
+    assert cache.lookup(hashes[4])[0] == {'i': 4}
+    assert sorted(store.cache_items('analysis')) == sorted(cache_key(pair) for pair in hashes[2:])
+
+    # 新启动的进程只同步到未淘汰的条目
+    restarted = NearDuplicateCache(max_entries=3)
+    restarted.attach_store(store)
+    assert len(restarted) == 3
+
+
+def test_cache_syncs_other_workers_entries_at_most_once_per_interval(tmp_path, monkeypatch):
+    store = SharedState(str(tmp_path / 'shared_state.db'))
+    writer, reader = NearDuplicateCache(), NearDuplicateCache()
+    writer.attach_store(store)
+    reader.attach_store(store)
+    reads = []
+    cache_changes = store.cache_changes
+    monkeypatch.setattr(store, 'cache_changes', lambda *args: reads.append(args) or cache_changes(*args))
+    rng = random.Random(1)
+    pair = (rng.getrandbits(64), rng.getrandbits(64))
+
+    # 间隔内不再访问共享状态，新条目要等到下一次同步
+    writer.store(cache_key(pair), pair, {'i': 1})
+    for _ in range(50):
+        assert reader.lookup(pair) is None
+    assert reads == []
+
+    monkeypatch.setattr(phash_index, 'SYNC_INTERVAL', 0)
+    assert reader.lookup(pair)[0] == {'i': 1}
+    assert len(reads) == 1
+    # seq 没有变化时只查询最新的 seq，不读取条目
+    assert reader.lookup(pair)[0] == {'i': 1}
+    assert len(reads) == 1
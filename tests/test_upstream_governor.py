@@ -0,0 +1,143 @@
+"""熔断器的状态转换和流式请求的结果记录"""
+from types import SimpleNamespace
+
+import pytest
+import requests
+
+from services import upstream_governor
+from services.upstream_governor import (CIRCUIT_CLOSED, CIRCUIT_HALF_OPEN, CIRCUIT_OPEN, CIRCUIT_STATE,
+                                        CIRCUIT_STATE_VALUES, CircuitBreaker, UpstreamGovernor)
+
+STREAM_SETTINGS = {
+    'rate_limit': 100.0, 'burst': 100, 'initial_concurrency': 4, 'max_concurrency': 8,
+    'queue_timeout': 1.0, 'request_timeout': 1.0, 'failure_threshold': 1, 'open_seconds': 30.0
+}
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """替换熔断器使用的单调时钟，clock.now 可以直接拨动"""
+    clock = SimpleNamespace(now=1000.0)
+    monkeypatch.setattr(upstream_governor, 'time', SimpleNamespace(monotonic=lambda: clock.now))
+    return clock
+
+
+def assert_state(breaker, state):
+    assert breaker.state == state
+    assert CIRCUIT_STATE.get(provider=breaker.provider) == CIRCUIT_STATE_VALUES[state]
+
+
+def test_opens_after_consecutive_failures(clock):
+    breaker = CircuitBreaker('test_open', failure_threshold=3, open_seconds=30)
+    breaker.record(failed=True)
+    breaker.record(failed=True)
+    # 成功一次后重新计数
+    breaker.record(failed=False)
+    breaker.record(failed=True)
+    breaker.record(failed=True)
+    assert_state(breaker, CIRCUIT_CLOSED)
+    assert breaker.allow() and not breaker.rejecting()
+
+    breaker.record(failed=True)
+    assert_state(breaker, CIRCUIT_OPEN)
+    assert breaker.rejecting()
+    clock.now += 29
+    assert not breaker.allow()
+
+
+def test_half_open_probe_success_closes(clock):
+    breaker = CircuitBreaker('test_close', failure_threshold=1, open_seconds=30)
+    breaker.record(failed=True)
+    clock.now += 30
+    assert not breaker.rejecting()
+
+    assert breaker.allow()
+    assert_state(breaker, CIRCUIT_HALF_OPEN)
+    # 探测请求返回之前不放行其他请求
+    assert not breaker.allow()
+    assert breaker.rejecting()
+
+    breaker.record(failed=False)
+    assert_state(breaker, CIRCUIT_CLOSED)
+    assert breaker.allow() and breaker.allow()
+
+
+def test_half_open_probe_failure_reopens(clock):
+    breaker = CircuitBreaker('test_reopen', failure_threshold=1, open_seconds=30)
+    breaker.record(failed=True)
+    clock.now += 30
+    assert breaker.allow()
+    breaker.record(failed=True)
+    assert_state(breaker, CIRCUIT_OPEN)
+    clock.now += 29
+    assert not breaker.allow()
+    clock.now += 1
+    assert breaker.allow()
+    assert_state(breaker, CIRCUIT_HALF_OPEN)
+
+
+def test_lost_probe_releases_next_probe_after_open_seconds(clock):
+    breaker = CircuitBreaker('test_lost_probe', failure_threshold=1, open_seconds=30)
+    breaker.record(failed=True)
+    clock.now += 30
+    assert breaker.allow()
+    # 探测请求没有返回结果（例如排队超时），再过 open_seconds 秒放行下一个
+    clock.now += 29
+    assert not breaker.allow()
+    clock.now += 1
+    assert breaker.allow()
+    assert_state(breaker, CIRCUIT_HALF_OPEN)
+
+
+class FakeStreamResponse:
+    """逐行返回预设内容，读到 None 时模拟连接中途断开"""
+
+    status_code = 200
+    text = ''
+
+    def __init__(self, lines):
+        self._lines = lines
+        self.closed = False
+
+    def iter_lines(self):
+        for line in self._lines:
+            if line is None:
+                raise requests.exceptions.ChunkedEncodingError('连接中断')
+            yield line
+
+    def close(self):
+        self.closed = True
+
+
+def stream_governor(provider, lines):
+    governor = UpstreamGovernor({provider: STREAM_SETTINGS})
+    response = FakeStreamResponse(lines)
+    governor._sessions[provider] = SimpleNamespace(post=lambda url, **kwargs: response)
+    return governor, response
+
+
+def test_stream_read_failure_counts_as_overload_and_breaker_failure():
+    governor, response = stream_governor('test_stream_broken', [b'{"response": "a"}', None])
+    limiter = governor._limiters['test_stream_broken']
+
+    with pytest.raises(requests.exceptions.ChunkedEncodingError):
+        with governor.stream('test_stream_broken', 'http://upstream/api') as upstream:
+            for _ in upstream.iter_lines():
+                pass
+
+    assert response.closed
+    assert limiter.limit < STREAM_SETTINGS['initial_concurrency']
+    assert governor.circuit_state('test_stream_broken') == CIRCUIT_OPEN
+    assert not governor.available('test_stream_broken')
+
+
+def test_stream_read_to_end_is_success():
+    governor, response = stream_governor('test_stream_ok', [b'{"response": "a"}', b'{"done": true}'])
+    limiter = governor._limiters['test_stream_ok']
+
+    with governor.stream('test_stream_ok', 'http://upstream/api') as upstream:
+        assert list(upstream.iter_lines()) == [b'{"response": "a"}', b'{"done": true}']
+
+    assert response.closed
+    assert limiter.limit >= STREAM_SETTINGS['initial_concurrency']
+    assert governor.circuit_state('test_stream_ok') == CIRCUIT_CLOSED